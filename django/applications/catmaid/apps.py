@@ -147,6 +147,33 @@ def check_spatial_update_setup(app_configs, **kwargs) -> List[str]:
             hint="Migrate CATMAID"))
     return messages
 
+def check_stats_summary_delta_log_setup(app_configs, **kwargs) -> List[str]:
+    messages = []
+
+    if is_read_only():
+        messages.append(Warning('Read only mode: statistics summary delta log '
+            'setup not checked', hint='This is okay for database replicas'))
+        return messages
+
+    from catmaid.control.stats import (disable_stats_summary_delta_log,
+            is_stats_summary_delta_log_enabled)
+
+    # Enabling the log requires a rebuild of the statistics summary, which is
+    # why this is left to management commands. A log that isn't wanted anymore
+    # is removed though, so that it doesn't grow without being folded.
+    enabled = is_stats_summary_delta_log_enabled()
+    if getattr(settings, 'STATS_SUMMARY_DELTA_LOG', False):
+        if not enabled:
+            messages.append(Warning(
+                "The statistics summary delta log is not enabled",
+                hint="Run the catmaid_stats_summary_worker or the "
+                "catmaid_refresh_node_statistics management command"))
+    elif enabled:
+        disable_stats_summary_delta_log()
+        logger.info('Statistics summary delta log disabled')
+
+    return messages
+
 def check_client_settings(app_configs, **kwargs):
     """Reset the default client settings for a catmaid instance.
     """
@@ -253,6 +280,9 @@ class CATMAIDConfig(AppConfig):
         # Enable or disable spatial update notifications
         register(check_spatial_update_setup)
 
+        # Remove the statistics summary delta log if it isn't used
+        register(check_stats_summary_delta_log_setup)
+
         # Make sure the expected default client instance settings are set.
         register(check_client_settings)
 
@@ -2,6 +2,7 @@
 
 from collections import defaultdict
 import dateutil.parser
+from itertools import chain
 import re
 
 from typing import Any, DefaultDict, Dict, FrozenSet, List, Optional, Set, Tuple, Union
@@ -401,50 +402,37 @@ def get_sub_annotation_ids(project_id:Union[int,str], annotation_sets, relations
     """ Sub-annotations are annotations that are annotated with an annotation
     from the annotation_set passed. Additionally, transivitely annotated
     annotations are returned as well. Note that all entries annotation_sets
-    must be frozenset instances, they need to be hashable.
+    must be frozenset instances, they need to be hashable. The annotation
+    hierarchy is read from the table catmaid_annotation_closure, which is
+    maintained by the database.
     """
     if not annotation_sets:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data:Set = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa:Dict = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT ac.annotation_id, ac.sub_annotation_id
+        FROM catmaid_annotation_closure ac
+        JOIN UNNEST(%(annotation_ids)s::bigint[]) query(id)
+            ON ac.annotation_id = query.id
+        WHERE ac.project_id = %(project_id)s
+    """, {
+        'project_id': int(project_id),
+        'annotation_ids': list(set(chain.from_iterable(annotation_sets))),
+    })
+
+    # Map each annotation to all its (transitive) sub-annotations
+    sub_annotations:DefaultDict[Any, Set] = defaultdict(set)
+    for annotation_id, sub_annotation_id in cursor.fetchall():
+        sub_annotations[annotation_id].add(sub_annotation_id)
+
+    # Collect all sub-annotations for every annotation in the annotation set
+    # passed.
     sa_ids:Dict = {}
     for annotation_set in annotation_sets:
-        # Start with an empty result set for each requested annotation set
         ls:Set = set()
         for a in annotation_set:
-            working_set = set([a])
-            while working_set:
-                parent_id = working_set.pop()
-                # Try to get the sub-annotations for this parent
-                child_ids = aaa.get(parent_id) or set_wrapper()
-                for child_id in child_ids.data:
-                    if child_id not in sa_ids:
-                        if child_id not in ls:
-                            # Add all children as sub annotations
-                            ls.add(child_id)
-                            working_set.add(child_id)
+            ls.update(sub_annotations.get(a, ()))
         # Store the result list for this ID
         sa_ids[annotation_set] = list(ls)
 
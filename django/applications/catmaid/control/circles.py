@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+import copy
+from datetime import timedelta
 from functools import partial
-from itertools import combinations, chain
+from itertools import combinations
 import json
 import math
 import networkx as nx
+import numpy as np
+import threading
 from rest_framework.decorators import api_view
 
 from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Set, Tuple, Union
 
+from django.conf import settings
 from django.db import connection
 from django.http import HttpRequest, JsonResponse
 
@@ -18,6 +23,21 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_request_list
 from catmaid.control.skeleton import _neuronnames
 
+
+# Transactions are logged with their start time, but their changes become
+# visible only once they are committed. Refreshes of connectivity indices
+# therefore look back this far in the transaction log.
+CONNECTIVITY_INDEX_REFRESH_MARGIN = timedelta(minutes=10)
+
+# Not all changes are recorded in the transaction log, e.g. those made by
+# management commands. Connectivity indices are rebuilt after this time.
+CONNECTIVITY_INDEX_MAX_AGE = timedelta(hours=1)
+
+# If more than this fraction of indexed skeletons has changed since the last
+# refresh, a connectivity index is rebuilt rather than updated.
+CONNECTIVITY_INDEX_MAX_UPDATE_RATIO = 0.1
+
+
 def _next_circle(skeleton_set:Set, relations, cursor, allowed_connector_ids=None) -> DefaultDict:
     """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
     cursor.execute(f'''
@@ -45,6 +65,236 @@ def _relations(cursor, project_id:Union[int,str]) -> Dict:
     cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
     return dict(cursor.fetchall())
 
+def _fetch_skeleton_edges(cursor, project_id, relations, skeleton_ids=None) -> Tuple:
+    """Return source skeleton IDs, target skeleton IDs and the number of
+    presynaptic/postsynaptic link pairs between them. If skeleton IDs are
+    passed in, only edges from or to these skeletons are returned.
+    """
+    if skeleton_ids is None:
+        skeleton_constraint = ''
+    else:
+        skeleton_constraint = '''
+          AND tc1.connector_id IN (
+              SELECT connector_id
+              FROM treenode_connector
+              WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[]))
+          AND (tc1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+              OR tc2.skeleton_id = ANY(%(skeleton_ids)s::bigint[]))
+        '''
+    cursor.execute(f'''
+        SELECT tc1.skeleton_id, tc2.skeleton_id, count(*)
+        FROM treenode_connector tc1
+        JOIN treenode_connector tc2
+            ON tc1.connector_id = tc2.connector_id
+        WHERE tc1.project_id = %(project_id)s
+          AND tc1.relation_id = %(pre)s
+          AND tc2.relation_id = %(post)s
+          AND tc1.skeleton_id != tc2.skeleton_id
+          {skeleton_constraint}
+        GROUP BY tc1.skeleton_id, tc2.skeleton_id
+    ''', {
+        'project_id': int(project_id),
+        'pre': relations.get('presynaptic_to'),
+        'post': relations.get('postsynaptic_to'),
+        'skeleton_ids': None if skeleton_ids is None else list(skeleton_ids),
+    })
+    edges = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+    return edges[:, 0], edges[:, 1], edges[:, 2]
+
+def _db_time(cursor):
+    cursor.execute('SELECT now()')
+    return cursor.fetchone()[0]
+
+
+class SkeletonConnectivityIndex:
+    """A compressed sparse row (CSR) adjacency of all synaptically connected
+    skeletons of a project. The weight of an edge from skeleton A to skeleton B
+    is the number of pairs of a presynaptic link of A and a postsynaptic link of
+    B on the same connector, just like _next_circle() counts them. Edges are
+    stored both by source and by target, so that partners in either direction
+    can be looked up without a database query. Indices are not changed after
+    they are created, refresh() returns a new index instead.
+    """
+
+    def __init__(self, project_id, sources, targets, weights, built,
+            refreshed=None, transactions=None) -> None:
+        self.project_id = int(project_id)
+        self.built = built
+        self.refreshed = built if refreshed is None else refreshed
+        # The (transaction ID, execution time) pairs of the transaction log
+        # that are already part of this index.
+        self.transactions = transactions or set()
+
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int64)
+        self.skeleton_ids = np.unique(np.concatenate([sources, targets]))
+        source_rows = np.searchsorted(self.skeleton_ids, sources)
+        target_rows = np.searchsorted(self.skeleton_ids, targets)
+        self.out_indptr, self.out_indices, self.out_weights = self._csr(
+                source_rows, target_rows, weights)
+        self.in_indptr, self.in_indices, self.in_weights = self._csr(
+                target_rows, source_rows, weights)
+
+    def _csr(self, rows, columns, weights) -> Tuple:
+        order = np.lexsort((columns, rows))
+        indptr = np.zeros(len(self.skeleton_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.skeleton_ids)),
+                out=indptr[1:])
+        return indptr, columns[order], weights[order]
+
+    def __len__(self) -> int:
+        return len(self.out_weights)
+
+    def edges(self) -> Tuple:
+        """Return source skeleton IDs, target skeleton IDs and weights of all
+        edges.
+        """
+        sources = np.repeat(self.skeleton_ids, np.diff(self.out_indptr))
+        return sources, self.skeleton_ids[self.out_indices], self.out_weights
+
+    def partners(self, skeleton_ids, direction='out', min_weight=1) -> Tuple:
+        """Return all edges of the passed in skeletons with at least
+        <min_weight> link pairs as three arrays: the passed in skeleton IDs,
+        the partner skeleton IDs and the weights. Outgoing ("out") partners
+        are postsynaptic to the passed in skeletons, incoming ("in") partners
+        are presynaptic to them.
+        """
+        if direction == 'out':
+            indptr, indices, weights = self.out_indptr, self.out_indices, self.out_weights
+        elif direction == 'in':
+            indptr, indices, weights = self.in_indptr, self.in_indices, self.in_weights
+        else:
+            raise ValueError(f'Unknown direction: {direction}')
+
+        query = np.fromiter(skeleton_ids, dtype=np.int64)
+        rows = np.searchsorted(self.skeleton_ids, query)
+        found = rows < len(self.skeleton_ids)
+        found[found] = self.skeleton_ids[rows[found]] == query[found]
+        query, rows = query[found], rows[found]
+
+        # Collect the CSR positions of the edges of all found rows at once.
+        starts = indptr[rows]
+        lengths = indptr[rows + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(lengths.sum())
+        keep = weights[positions] >= min_weight
+        positions = positions[keep]
+
+        return (np.repeat(query, lengths)[keep],
+                self.skeleton_ids[indices[positions]], weights[positions])
+
+    def adjacent(self, skeleton_ids, direction='out', min_weight=1) -> Set:
+        """Return the set of partner skeleton IDs of the passed in skeletons,
+        see partners().
+        """
+        return set(self.partners(skeleton_ids, direction, min_weight)[1].tolist())
+
+    @classmethod
+    def build(cls, project_id, cursor=None) -> "SkeletonConnectivityIndex":
+        """Create a new index from the treenode_connector table."""
+        cursor = cursor or connection.cursor()
+        now = _db_time(cursor)
+        relations = _relations(cursor, project_id)
+        return cls(project_id, *_fetch_skeleton_edges(cursor, project_id,
+                relations), built=now)
+
+    def refresh(self, cursor=None) -> "SkeletonConnectivityIndex":
+        """Return an index that includes all changes recorded in the transaction
+        log since the last refresh. Only the edges of skeletons with changed
+        connector links are queried again. If too much changed, history
+        tracking is disabled or this index is too old, a new index is built.
+        """
+        cursor = cursor or connection.cursor()
+        now = _db_time(cursor)
+        if now - self.built > CONNECTIVITY_INDEX_MAX_AGE:
+            return self.build(self.project_id, cursor)
+
+        since = self.refreshed - CONNECTIVITY_INDEX_REFRESH_MARGIN
+        cursor.execute('''
+            SELECT transaction_id, execution_time
+            FROM catmaid_transaction_info
+            WHERE execution_time >= %(since)s
+              AND (project_id = %(project_id)s OR project_id IS NULL)
+        ''', {
+            'since': since,
+            'project_id': self.project_id,
+        })
+        transactions = set(cursor.fetchall())
+        new_transactions = transactions - self.transactions
+
+        affected:List = []
+        if new_transactions:
+            if not getattr(settings, 'HISTORY_TRACKING', True):
+                return self.build(self.project_id, cursor)
+
+            # Updated and deleted links are found through their old versions in
+            # the history table, new links through their creation time.
+            cursor.execute('''
+                SELECT tch.skeleton_id
+                FROM treenode_connector__history tch
+                WHERE tch.exec_transaction_id = ANY(%(txids)s::bigint[])
+                  AND tch.project_id = %(project_id)s
+                UNION
+                SELECT tc.skeleton_id
+                FROM treenode_connector__history tch
+                JOIN treenode_connector tc
+                    ON tc.id = tch.id
+                WHERE tch.exec_transaction_id = ANY(%(txids)s::bigint[])
+                  AND tch.project_id = %(project_id)s
+                UNION
+                SELECT tc.skeleton_id
+                FROM treenode_connector tc
+                WHERE tc.project_id = %(project_id)s
+                  AND tc.creation_time >= %(since)s
+                  AND tc.txid = ANY(%(txids)s::bigint[])
+            ''', {
+                'txids': [txid for txid, _ in new_transactions],
+                'since': min(execution_time for _, execution_time in new_transactions),
+                'project_id': self.project_id,
+            })
+            affected = [row[0] for row in cursor.fetchall()]
+
+        if len(affected) > CONNECTIVITY_INDEX_MAX_UPDATE_RATIO * len(self.skeleton_ids):
+            return self.build(self.project_id, cursor)
+
+        if affected:
+            relations = _relations(cursor, self.project_id)
+            new_sources, new_targets, new_weights = _fetch_skeleton_edges(
+                    cursor, self.project_id, relations, affected)
+            sources, targets, weights = self.edges()
+            keep = ~(np.isin(sources, affected) | np.isin(targets, affected))
+            index = SkeletonConnectivityIndex(self.project_id,
+                    np.concatenate([sources[keep], new_sources]),
+                    np.concatenate([targets[keep], new_targets]),
+                    np.concatenate([weights[keep], new_weights]),
+                    built=self.built)
+        else:
+            index = copy.copy(self)
+        index.refreshed = now
+        index.transactions = transactions
+        return index
+
+
+# Connectivity indices are kept per process and project.
+_connectivity_indices:Dict[int, SkeletonConnectivityIndex] = {}
+_connectivity_index_lock = threading.Lock()
+
+def get_connectivity_index(project_id, cursor=None) -> SkeletonConnectivityIndex:
+    """Return an up-to-date skeleton connectivity index of the passed in
+    project. It is built on first use and refreshed from the transaction log on
+    every following call.
+    """
+    project_id = int(project_id)
+    with _connectivity_index_lock:
+        index = _connectivity_indices.get(project_id)
+        if index is None:
+            index = SkeletonConnectivityIndex.build(project_id, cursor)
+        else:
+            index = index.refresh(cursor)
+        _connectivity_indices[project_id] = index
+    return index
+
 def _clean_mins(request:HttpRequest, cursor, project_id:Union[int,str]) -> Tuple[Dict, Any]:
     min_pre: float = int(request.POST.get('min_pre',  -1))
     min_post: float = int(request.POST.get('min_post', -1))
@@ -105,15 +355,28 @@ def circles_of_hell(request:HttpRequest, project_id) -> JsonResponse:
 
     allowed_connector_ids = get_request_list(request.POST, 'allowed_connector_ids', None)
 
+    if allowed_connector_ids:
+        def expand(skeleton_ids) -> Set:
+            connections = _next_circle(skeleton_ids, relations, cursor, allowed_connector_ids)
+            return set(skID for c in connections.values() \
+                       for relationID, cs in c.items() \
+                       for skID, count in cs.items() if count >= mins[relationID])
+    else:
+        # Without connector constraints, all circles can be found in memory.
+        index = get_connectivity_index(project_id, cursor)
+        min_post = mins[relations['presynaptic_to']]
+        min_pre = mins[relations['postsynaptic_to']]
+
+        def expand(skeleton_ids) -> Set:
+            return index.adjacent(skeleton_ids, 'out', min_post).union(
+                    index.adjacent(skeleton_ids, 'in', min_pre))
+
     current_circle = first_circle
     all_circles = first_circle
 
     while n_circles > 0 and current_circle:
         n_circles -= 1
-        connections = _next_circle(current_circle, relations, cursor, allowed_connector_ids)
-        next_circle = set(skID for c in connections.values() \
-                          for relationID, cs in c.items() \
-                          for skID, count in cs.items() if count >= mins[relationID])
+        next_circle = expand(current_circle)
         current_circle = next_circle - all_circles
         all_circles = all_circles.union(next_circle)
 
@@ -136,25 +399,11 @@ def find_directed_paths(request:HttpRequest, project_id=None) -> JsonResponse:
     if -1 == min:
         min = float('inf')
 
-    relations = _relations(cursor, project_id)
+    index = get_connectivity_index(project_id, cursor)
 
-    def next_level(skids, rel1, rel2):
-        cursor.execute('''
-        SELECT tc1.skeleton_id, tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2
-        WHERE tc1.skeleton_id in (%s)
-          AND tc1.connector_id = tc2.connector_id
-          AND tc1.skeleton_id != tc2.skeleton_id
-          AND tc1.relation_id = %s
-          AND tc2.relation_id = %s
-        GROUP BY tc1.skeleton_id, tc2.skeleton_id
-        HAVING count(*) >= %s
-        ''' % (','.join(str(skid) for skid in skids),
-               rel1,
-               rel2,
-               min))
-        return cursor.fetchall()
+    def next_level(skids, direction):
+        skids, partners, _ = index.partners(skids, direction, min)
+        return zip(skids.tolist(), partners.tolist())
 
 
     # bidirectional search
@@ -163,14 +412,12 @@ def find_directed_paths(request:HttpRequest, project_id=None) -> JsonResponse:
     s1 = sources
     t1 = targets
     graph = nx.DiGraph()
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
 
     while i <= middle:
         if 0 == len(s1):
             break
         s2 = set()
-        for pre_skid, post_skid in next_level(s1, pre, post):
+        for pre_skid, post_skid in next_level(s1, 'out'):
             graph.add_edge(pre_skid, post_skid)
             if post_skid not in s1:
                 s2.add(post_skid)
@@ -178,7 +425,7 @@ def find_directed_paths(request:HttpRequest, project_id=None) -> JsonResponse:
         i += 1
         if i < middle and len(t1) > 0:
             t2 = set()
-            for post_skid, pre_skid in next_level(t1, post, pre):
+            for post_skid, pre_skid in next_level(t1, 'in'):
                 graph.add_edge(pre_skid, post_skid)
                 if pre_skid not in t1:
                     t2.add(pre_skid)
@@ -214,39 +461,12 @@ def find_directed_path_skeletons(request:HttpRequest, project_id=None) -> JsonRe
     if -1 == min_synapses:
         min_synapses = float('inf')
 
-    cursor = connection.cursor()
-    relations = _relations(cursor, project_id)
-
-    def fetch_adjacent(cursor, skids, relation1, relation2, min_synapses) -> Iterator[Any]:
-        """ Return the list of skids one hop away from the given skids. """
-        cursor.execute("""
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2
-        WHERE tc1.project_id = %(project_id)s
-          AND tc1.skeleton_id = ANY (%(skeleton_ids)s::bigint[])
-          AND tc1.connector_id = tc2.connector_id
-          AND tc1.skeleton_id != tc2.skeleton_id
-          AND tc1.relation_id = %(relation_1)s
-          AND tc2.relation_id = %(relation_2)s
-        GROUP BY tc1.skeleton_id, tc2.skeleton_id
-        HAVING count(*) >= %(min_synapses)s
-        """, {
-            'project_id': int(project_id),
-            'skeleton_ids': [int(skid) for skid in skids],
-            'relation_1': int(relation1),
-            'relation_2': int(relation2),
-            'min_synapses': float(min_synapses),
-        })
-        return chain.from_iterable(cursor.fetchall())
-
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
+    index = get_connectivity_index(project_id)
 
-    def fetch_fronts(cursor, skids, max_n_hops, relation1, relation2, min_synapses) -> List[Set]:
+    def fetch_fronts(skids, max_n_hops, direction, min_synapses) -> List[Set]:
         fronts = [set(skids)]
         for n_hops in range(1, max_n_hops):
-            adjacent = set(fetch_adjacent(cursor, fronts[-1], relation1, relation2, min_synapses))
+            adjacent = index.adjacent(fronts[-1], direction, min_synapses)
             for front in fronts:
                 adjacent -= front
             if len(adjacent) > 0:
@@ -258,8 +478,8 @@ def find_directed_path_skeletons(request:HttpRequest, project_id=None) -> JsonRe
             fronts.append(set())
         return fronts
 
-    origin_fronts = fetch_fronts(cursor, origin_skids, max_n_hops, pre, post, min_synapses)
-    target_fronts = fetch_fronts(cursor, target_skids, max_n_hops, post, pre, min_synapses)
+    origin_fronts = fetch_fronts(origin_skids, max_n_hops, 'out', min_synapses)
+    target_fronts = fetch_fronts(target_skids, max_n_hops, 'in', min_synapses)
 
     skeleton_ids = origin_fronts[0].union(target_fronts[0])
 
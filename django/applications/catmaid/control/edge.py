@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from typing import List
+import math
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from django.db import connection, transaction
+from django.db import connection, connections, transaction
 from django.core.management.base import CommandError
 
 from catmaid.models import Project
@@ -396,6 +399,363 @@ def rebuild_edges_selectively(skeleton_ids, connector_ids=[], log=None) -> None:
                 '%s treenode edges, %s connector edges, %s connectors' % \
                 (num_new_tn_edges, num_new_c_edges, num_new_c_geoms))
 
+# The largest possible ID, used as upper bound of the last chunk of a table.
+MAX_ID = 2**63 - 1
+
+# The materialized edge tables, each with the table it is derived from, its
+# columns, a condition that is true for up-to-date rows and a query for the
+# expected rows of a project and a range of IDs. The ID of each materialized
+# row is the ID of the row it is derived from.
+EDGE_TABLES:Dict[str, Dict[str, str]] = {
+    'treenode_edge': {
+        'source': 'treenode',
+        'columns': 'id, parent_id, project_id, edge',
+        'match': 'x.parent_id IS NOT DISTINCT FROM e.parent_id AND '
+                'ST_AsEWKB(x.edge) = ST_AsEWKB(e.edge)',
+        'expected': '''
+            SELECT c.id, c.parent_id, c.project_id, ST_MakeLine(
+                ST_MakePoint(c.location_x, c.location_y, c.location_z),
+                ST_MakePoint(p.location_x, p.location_y, p.location_z)) AS edge
+            FROM treenode c
+            JOIN treenode p
+                ON c.parent_id = p.id OR (c.parent_id IS NULL AND c.id = p.id)
+            WHERE c.project_id = %(project_id)s
+                AND c.id BETWEEN %(min_id)s AND %(max_id)s
+        ''',
+    },
+    'treenode_connector_edge': {
+        'source': 'treenode_connector',
+        'columns': 'id, project_id, edge',
+        'match': 'ST_AsEWKB(x.edge) = ST_AsEWKB(e.edge)',
+        'expected': '''
+            SELECT tc.id, tc.project_id, ST_MakeLine(
+                ST_MakePoint(t.location_x, t.location_y, t.location_z),
+                ST_MakePoint(c.location_x, c.location_y, c.location_z)) AS edge
+            FROM treenode_connector tc
+            JOIN treenode t
+                ON t.id = tc.treenode_id
+            JOIN connector c
+                ON c.id = tc.connector_id
+            WHERE tc.project_id = %(project_id)s
+                AND tc.id BETWEEN %(min_id)s AND %(max_id)s
+        ''',
+    },
+    'connector_geom': {
+        'source': 'connector',
+        'columns': 'id, project_id, geom',
+        'match': 'ST_AsEWKB(x.geom) = ST_AsEWKB(e.geom)',
+        'expected': '''
+            SELECT c.id, c.project_id,
+                ST_MakePoint(c.location_x, c.location_y, c.location_z) AS geom
+            FROM connector c
+            WHERE c.project_id = %(project_id)s
+                AND c.id BETWEEN %(min_id)s AND %(max_id)s
+        ''',
+    },
+}
+
+
+class EdgeRebuildCheckpoint(object):
+    """A persistent record of edge table chunks that have been rebuilt. Each
+    completed chunk is appended as a line "<table> <project_id> <min_id>
+    <max_id>" to a plain text file, which allows an interrupted rebuild to skip
+    chunks that are already done when it is started again. The ID step that
+    chunks of a table and project are aligned to is stored as a line "step
+    <table> <project_id> <step>", so that a resumed rebuild uses the same
+    chunks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Map (table, project_id) to a list of completed (min_id, max_id)
+        # ranges.
+        self.completed:Dict[Tuple[str, int], List[Tuple[int, int]]] = {}
+        # Map (table, project_id) to the ID step of its chunks.
+        self.steps:Dict[Tuple[str, int], int] = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 4:
+                        # Ignore incomplete lines from interrupted writes
+                        continue
+                    if fields[0] == 'step' and fields[1] in EDGE_TABLES:
+                        self.steps[(fields[1], int(fields[2]))] = int(fields[3])
+                    elif fields[0] in EDGE_TABLES:
+                        table = fields[0]
+                        project_id, min_id, max_id = map(int, fields[1:])
+                        self.completed.setdefault((table, project_id), []).append(
+                                (min_id, max_id))
+        self._file = open(path, 'a')
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self.completed.values())
+
+    def get_step(self, table, project_id) -> Optional[int]:
+        return self.steps.get((table, project_id))
+
+    def set_step(self, table, project_id, step) -> None:
+        self.steps[(table, project_id)] = step
+        self._file.write(f'step {table} {project_id} {step}\n')
+        self._file.flush()
+
+    def is_done(self, table, project_id, min_id, max_id) -> bool:
+        ranges = self.completed.get((table, project_id), [])
+        return any(r[0] <= min_id and max_id <= r[1] for r in ranges)
+
+    def mark_done(self, table, project_id, min_id, max_id) -> None:
+        self.completed.setdefault((table, project_id), []).append((min_id, max_id))
+        self._file.write(f'{table} {project_id} {min_id} {max_id}\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def get_edge_table_chunk_step(table, project_id, chunk_size, cursor=None) -> int:
+    """Get the width of the ID ranges that cover on average <chunk_size> rows
+    of the source table of the passed in edge table for a project.
+    """
+    if chunk_size < 1:
+        raise ValueError("The chunk size needs to be at least 1")
+    if not cursor:
+        cursor = connection.cursor()
+    source = EDGE_TABLES[table]['source']
+    cursor.execute(f"""
+        SELECT min(id), max(id), count(*)
+        FROM {source}
+        WHERE project_id = %(project_id)s
+    """, {
+        'project_id': project_id,
+    })
+    min_id, max_id, n_rows = cursor.fetchone()
+    if not n_rows:
+        return chunk_size
+    return max(1, math.ceil((max_id - min_id + 1) * chunk_size / n_rows))
+
+
+def get_edge_table_chunks(table, project_id, step, cursor=None) -> List[Tuple[int, int]]:
+    """Partition the ID space of the passed in edge table for a project into
+    ranges of <step> IDs, aligned to multiples of <step>. Chunks don't depend
+    on the rows that exist at the time, which keeps them stable across runs
+    with the same step. The ranges are contiguous and cover all possible IDs,
+    which makes sure that stale rows with IDs that don't exist in the source
+    table anymore are included as well.
+    """
+    if step < 1:
+        raise ValueError("The step needs to be at least 1")
+    if not cursor:
+        cursor = connection.cursor()
+    source = EDGE_TABLES[table]['source']
+    cursor.execute(f"""
+        SELECT min(id), max(id)
+        FROM {source}
+        WHERE project_id = %(project_id)s
+    """, {
+        'project_id': project_id,
+    })
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return [(0, MAX_ID)]
+    starts = [k * step for k in range(min_id // step, max_id // step + 1)]
+    starts[0] = 0
+    ends = [s - 1 for s in starts[1:]] + [MAX_ID]
+    return list(zip(starts, ends))
+
+
+def rebuild_edge_table_chunk(table, project_id, min_id, max_id, dryrun=False) -> Tuple[int, int]:
+    """Bring all rows of the passed in edge table for a project and an ID range
+    in sync with their source table. Only rows that differ from what they are
+    expected to be are removed and only missing rows are inserted, unchanged
+    rows are not written. If <dryrun> is true, no changes are made and only
+    the differences are counted. Returns a tuple of the number of removed and
+    the number of added rows.
+    """
+    spec = EDGE_TABLES[table]
+    params = {
+        'project_id': project_id,
+        'min_id': min_id,
+        'max_id': max_id,
+    }
+    cursor = connection.cursor()
+    with transaction.atomic():
+        if dryrun:
+            cursor.execute(f"""
+                WITH expected AS ({spec['expected']})
+                SELECT
+                    (SELECT count(*)
+                     FROM {table} x
+                     WHERE x.project_id = %(project_id)s
+                        AND x.id BETWEEN %(min_id)s AND %(max_id)s
+                        AND NOT EXISTS (
+                            SELECT 1 FROM expected e
+                            WHERE e.id = x.id AND {spec['match']})),
+                    (SELECT count(*)
+                     FROM expected e
+                     WHERE NOT EXISTS (
+                         SELECT 1 FROM {table} x
+                         WHERE x.id = e.id AND {spec['match']}))
+            """, params)
+            n_removed, n_added = cursor.fetchone()
+        else:
+            cursor.execute(f"""
+                DELETE FROM {table} x
+                WHERE x.project_id = %(project_id)s
+                    AND x.id BETWEEN %(min_id)s AND %(max_id)s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM ({spec['expected']}) e
+                        WHERE e.id = x.id AND {spec['match']})
+            """, params)
+            n_removed = cursor.rowcount
+            cursor.execute(f"""
+                INSERT INTO {table} ({spec['columns']})
+                SELECT {spec['columns']}
+                FROM ({spec['expected']}) e
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {table} x
+                    WHERE x.id = e.id AND {spec['match']})
+            """, params)
+            n_added = cursor.rowcount
+    return n_removed, n_added
+
+
+def _rebuild_edge_table_chunk(task) -> Tuple[Tuple, Tuple[int, int]]:
+    """Entry point of a worker process in a multi-process rebuild."""
+    return task, rebuild_edge_table_chunk(*task)
+
+
+def rebuild_edge_tables_chunked(project_ids=None, chunk_size=100000, n_jobs=1,
+        checkpoint=None, verify=True, dryrun=False, log=None) -> Dict[str, Dict[str, int]]:
+    """Rebuild edge tables for all passed in project IDs in chunks of fixed ID
+    ranges that cover on average <chunk_size> source rows, each in its own
+    transaction. If no project IDs are passed in, all edge tables are rebuilt.
+    Chunks are processed by <n_jobs> worker processes and only rows that
+    changed are written, which keeps transactions and the generated WAL small
+    and allows regular edits to continue during the rebuild. If a <checkpoint>
+    file path is passed in, completed chunks and the ID step of each table are
+    recorded in it, so that the same chunks are used and completed ones are
+    skipped when the rebuild is started again with the same file. Unless
+    <verify> is false, all chunks are compared to their source tables once the
+    rebuild is done and chunks that still differ, e.g. due to concurrent
+    edits, are rebuilt again. If <dryrun> is true, differences are only
+    counted. Returns the number of removed, added and (after verification)
+    mismatched rows per table.
+    """
+    if not log:
+        # Assign no-op function if no log function is passed in
+        log = lambda x: None
+
+    if n_jobs < 1:
+        raise ValueError("Need at least one worker")
+
+    cursor = connection.cursor()
+    if project_ids:
+        project_ids = [int(project_id) for project_id in project_ids]
+        cursor.execute("""
+            SELECT q.id
+            FROM UNNEST(%(project_ids)s::integer[]) q(id)
+            LEFT JOIN project p
+                ON p.id = q.id
+            WHERE p.id IS NULL
+        """, {
+            'project_ids': project_ids,
+        })
+        missing = [row[0] for row in cursor.fetchall()]
+        if missing:
+            raise CommandError('Project "%s" does not exist' % missing[0])
+    else:
+        cursor.execute("SELECT id FROM project ORDER BY id")
+        project_ids = [row[0] for row in cursor.fetchall()]
+
+    if checkpoint and not dryrun:
+        checkpoint = EdgeRebuildCheckpoint(checkpoint)
+        log(f'Resuming from checkpoint with {len(checkpoint)} completed chunks')
+    else:
+        checkpoint = None
+
+    tasks = []
+    for project_id in project_ids:
+        for table in EDGE_TABLES:
+            # A resumed rebuild uses the step of its checkpoint to get the
+            # same chunks, regardless of rows added or removed in the meantime.
+            step = checkpoint.get_step(table, project_id) if checkpoint else None
+            if step is None:
+                step = get_edge_table_chunk_step(table, project_id,
+                        chunk_size, cursor)
+                if checkpoint:
+                    checkpoint.set_step(table, project_id, step)
+            for min_id, max_id in get_edge_table_chunks(table, project_id,
+                    step, cursor):
+                tasks.append((table, project_id, min_id, max_id))
+
+    stats = {table: {'removed': 0, 'added': 0, 'mismatched': 0}
+            for table in EDGE_TABLES}
+
+    def run(tasks, dryrun) -> List[Tuple]:
+        """Process all tasks and return the ones that found differences."""
+        changed = []
+        n_done = 0
+        for task, (n_removed, n_added) in imap(_rebuild_edge_table_chunk,
+                [t + (dryrun,) for t in tasks]):
+            table, project_id, min_id, max_id, _ = task
+            n_done += 1
+            if n_removed or n_added:
+                changed.append(task[:4])
+            if dryrun:
+                stats[table]['mismatched'] += n_removed + n_added
+            else:
+                stats[table]['removed'] += n_removed
+                stats[table]['added'] += n_added
+                if checkpoint:
+                    checkpoint.mark_done(table, project_id, min_id, max_id)
+            log(f'{"Checked" if dryrun else "Rebuilt"} {table} of project '
+                    f'{project_id}, IDs {min_id} - {max_id} ({n_done}/{len(tasks)} '
+                    f'chunks, {100 * n_done // len(tasks)}%): {n_removed} '
+                    f'{"stale" if dryrun else "removed"}, {n_added} '
+                    f'{"missing" if dryrun else "added"}')
+        return changed
+
+    if n_jobs > 1:
+        # Forked processes must not share the file descriptors of existing
+        # database connections.
+        connections.close_all()
+        pool = multiprocessing.Pool(n_jobs)
+        imap:Callable[..., Any] = pool.imap_unordered
+    else:
+        pool = None
+        imap = map
+
+    try:
+        if checkpoint:
+            pending = [t for t in tasks if not checkpoint.is_done(*t)]
+            log(f'Skipping {len(tasks) - len(pending)} of {len(tasks)} chunks '
+                    'that are marked done in the checkpoint')
+        else:
+            pending = tasks
+        log(f'{"Checking" if dryrun else "Rebuilding"} {len(pending)} chunks '
+                f'with {n_jobs} worker(s)')
+        if pending:
+            run(pending, dryrun)
+
+        if verify and not dryrun and tasks:
+            log(f'Verifying {len(tasks)} chunks')
+            mismatched = run(tasks, True)
+            if mismatched:
+                log(f'Rebuilding {len(mismatched)} chunks that changed during '
+                        'the rebuild')
+                run(mismatched, False)
+            else:
+                log('All edge tables are in sync')
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if checkpoint:
+            checkpoint.close()
+
+    return stats
+
+
 def get_intersected_grid_cells(p1, p2, cell_width, cell_height, cell_depth,
        p1_cell=None, p2_cell=None) -> List[List]:
     if not p1_cell:
@@ -21,6 +21,7 @@ from django.http import HttpRequest, JsonResponse
 from catmaid.models import Relation, UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_request_list
+from catmaid.control.graph2 import get_cached_skeleton_results
 from catmaid.control.link import KNOWN_LINK_PAIRS
 from catmaid.control.review import get_treenodes_to_reviews
 from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
@@ -159,9 +160,11 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
     ''' % (skeletons_string, relations[pre_rel], relations[post_rel]))
     connectors:DefaultDict = defaultdict(partial(defaultdict, list))
     skeleton_synapses:DefaultDict = defaultdict(partial(defaultdict, list))
+    skeleton_links:DefaultDict[Any, List] = defaultdict(list)
     for row in cursor.fetchall():
         connectors[row[0]][row[1]].append((row[2], row[3]))
         skeleton_synapses[row[3]][row[1]].append(row[2])
+        skeleton_links[row[3]].append(row[:3])
 
     # Cluster by synapses
     minis:DefaultDict[Any, List] = defaultdict(list)  # skeleton_id vs list of minified graphs
@@ -176,8 +179,27 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
             for treenode_id in chain.from_iterable(pp[relations[post_rel]]):
                 treenode_connector[treenode_id].append((connector_id, post_rel))
         arbors_to_expand = {skid: ls for skid, ls in arbors.items() if skid in expand}
-        expanded_arbors, minis = split_by_synapse_domain(bandwidth, locations, arbors_to_expand, treenode_connector, minis)
-        arbors.update(expanded_arbors)
+
+        def split_arbors(skeleton_ids):
+            skeleton_minis:DefaultDict[Any, List] = defaultdict(list)
+            expanded_arbors, skeleton_minis = split_by_synapse_domain(bandwidth,
+                    locations, {skid: arbors_to_expand[skid] for skid in skeleton_ids},
+                    treenode_connector, skeleton_minis)
+            return {skid: (expanded_arbors[skid], skeleton_minis[skid])
+                    for skid in skeleton_ids}
+
+        # Splits by synapse domain are cached like the ones of the graph widget
+        splits = get_cached_skeleton_results(
+                f'graph-domain-split-{project_id}-{confidence_threshold}-{bandwidth}',
+                arbors_to_expand.keys(), skeleton_links, split_arbors, cursor)
+        for skid, (expanded_arbors, skeleton_minis) in splits.items():
+            # Reviews don't change the last edition time of a skeleton
+            for g in expanded_arbors:
+                for node_id, props in g.nodes_iter(data=True):
+                    if 'reviewer_ids' in props:
+                        props['reviewer_ids'] = reviews.get(node_id, [])
+            arbors[skid] = expanded_arbors
+            minis[skid].extend(skeleton_minis)
 
 
     # Obtain neuron names
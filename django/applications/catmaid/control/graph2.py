@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from functools import partial
+import hashlib
 from itertools import count
 import json
 import networkx as nx
@@ -10,6 +11,8 @@ from numpy import subtract
 from numpy.linalg import norm
 from typing import Any, DefaultDict, Dict, List, Optional, Tuple, Union
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
 from django.http import JsonResponse
 
@@ -24,6 +27,14 @@ from catmaid.control.tree_util import simplify
 from catmaid.control.synapseclustering import tree_max_density
 
 
+# The result of splitting a single skeleton: the graph nodes it is split into,
+# structural branch nodes and edges among synapse domains (only for splits by
+# synapse domain) as well as a (connector_id, relation_id, node_id, confidence)
+# tuple for each of its synapses.
+SkeletonSplit = namedtuple('SkeletonSplit',
+        ['nodes', 'branch_nodes', 'intraedges', 'links'])
+
+
 def make_new_synapse_count_array() -> List[int]:
     return [0, 0, 0, 0, 0]
 
@@ -113,17 +124,8 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold,
     for row in cursor.fetchall():
         stc[row[0]].append(row[1:]) # skeleton_id vs (treenode_id, connector_id, relation_id, confidence)
 
-    # Fetch all treenodes of all skeletons
-    cursor.execute('''
-        SELECT skeleton_id, id, parent_id, confidence
-        FROM treenode
-        WHERE project_id = %(project_id)s
-          AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])
-        ORDER BY skeleton_id
-    ''', {
-        'project_id': project_id,
-        'skeleton_ids': skeleton_ids,
-    })
+    splits = get_skeleton_splits(project_id, skeleton_ids,
+            confidence_threshold, 0, stc, cursor)
 
     # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
     connectors:DefaultDict = defaultdict(partial(defaultdict, list))
@@ -131,31 +133,9 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold,
     # All nodes of the graph
     nodeIDs:List = []
 
-    # Read out into memory only one skeleton at a time
-    current_skid = None
-    tree:Optional[nx.DiGraph] = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            if row[2] and row[3] >= confidence_threshold:
-                # mypy cannot prove this will be a DiGraph by here
-                tree.add_edge(row[2], row[1])  # type: ignore
-
-            continue
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+    add_skeleton_splits(splits, nodeIDs, [], [], connectors)
 
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-    # Create the edges of the graph from the connectors, which was populated as a side effect of 'split_by_confidence'
+    # Create the edges of the graph from the connectors of all splits
     edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))  # pre vs post vs count
     for c in connectors.values():
         for pre in c[source_rel_id]:
@@ -213,41 +193,18 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
 
     not_to_expand = skeleton_ids - expand
 
-    if confidence_threshold > 0 and not_to_expand:
-        # Now fetch all treenodes of only skeletons in skeleton_ids (the ones not to expand)
-        cursor.execute('''
-            SELECT skeleton_id, id, parent_id, confidence
-            FROM treenode
-            WHERE project_id = %(project_id)s
-              AND skeleton_id = ANY(%(skids)s::bigint[])
-            ORDER BY skeleton_id
-        ''', {
-            'project_id': project_id,
-            'skids': list(not_to_expand),
-        })
+    # list of edges among synapse domains
+    intraedges:List = []
 
-        # Read out into memory only one skeleton at a time
-        current_skid = None
-        tree:Optional[nx.DiGraph] = None
-        for row in cursor.fetchall():
-            if row[0] == current_skid:
-                # Build the tree, breaking it at the low-confidence edges
-                if row[2] and row[3] >= confidence_threshold:
-                    # mypy cannot prove this will be a nx.DiGraph by here
-                    tree.add_edge(row[2], row[1])  # type: ignore
-                continue
-
-            if tree:
-                nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-            # Start the next tree
-            current_skid = row[0]
-            tree = nx.DiGraph()
-            if row[2] and row[3] > confidence_threshold:
-                tree.add_edge(row[2], row[1])
+    # list of branch nodes, merely structural
+    branch_nodeIDs:List = []
 
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+    if confidence_threshold > 0 and not_to_expand:
+        # Split skeletons not to expand only by confidence
+        splits = get_skeleton_splits(project_id, not_to_expand,
+                confidence_threshold, 0, stc, cursor)
+        add_skeleton_splits(splits, nodeIDs, branch_nodeIDs, intraedges,
+                connectors)
     else:
         # No need to split.
         # Populate connectors from the connections among them
@@ -256,73 +213,193 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
             for c in stc[skid]:
                 connectors[c[1]][c[2]].append((skid, c[3]))
 
+    # Split all skeletons to expand by confidence and synapse domain
+    splits = get_skeleton_splits(project_id, expand, confidence_threshold,
+            bandwidth, stc, cursor)
+    add_skeleton_splits(splits, nodeIDs, branch_nodeIDs, intraedges, connectors)
+
+    # Create the edges of the graph
+    edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))  # pre vs post vs count
+    for c in connectors.values():
+        for pre in c[source_rel_id]:
+            for post in c[target_rel_id]:
+                edges[pre[0]][post[0]][min(pre[1], post[1]) - 1] += 1
+
+    return {
+        'nodes': nodeIDs,
+        'edges': [(s, t, count)
+                for s, edge in edges.items()
+                for t, count in edge.items()],
+        'branch_nodes': branch_nodeIDs,
+        'intraedges': intraedges
+    }
+
+
+def get_skeleton_splits(project_id, skeleton_ids, confidence_threshold,
+        bandwidth, stc, cursor=None) -> Dict[int, Optional[SkeletonSplit]]:
+    """Return a SkeletonSplit (or None if there is nothing to split) for each
+    passed in skeleton, ordered by skeleton ID. Skeletons are split at edges
+    with a confidence below <confidence_threshold> and, if <bandwidth> is larger
+    than zero, additionally by synapse domain. <stc> maps each skeleton ID to
+    its (treenode_id, connector_id, relation_id, confidence) synapse rows.
+
+    Splits are cached using get_cached_skeleton_results(), which means only
+    skeletons that were edited since the last request have to be split again.
+    """
+    return get_cached_skeleton_results(
+            f'graph-split-{project_id}-{confidence_threshold}-{bandwidth}',
+            skeleton_ids, stc, lambda missing: compute_skeleton_splits(
+                project_id, missing, confidence_threshold, bandwidth, stc,
+                cursor), cursor)
+
+
+def get_cached_skeleton_results(key_prefix, skeleton_ids, synapses, compute,
+        cursor=None) -> Dict[int, Any]:
+    """Return the result of <compute> for each passed in skeleton, ordered by
+    skeleton ID. <compute> is called with a list of skeleton IDs and returns a
+    dictionary of skeleton ID vs result. <synapses> maps each skeleton ID to
+    a list of its synapse rows.
+
+    Results are kept in Django's cache for GRAPH_SPLIT_CACHE_TIMEOUT seconds,
+    keyed by <key_prefix> and skeleton ID. The key prefix has to include all
+    parameters a result depends on. A cached result is only used if the last
+    edition time of its skeleton in the skeleton summary table and its
+    synapses didn't change. The latter is needed, because link edits don't
+    update the skeleton summary.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    skeleton_ids = sorted(set(skeleton_ids))
+    timeout = settings.GRAPH_SPLIT_CACHE_TIMEOUT
 
-    # Now fetch all treenodes of all skeletons to expand
-    cursor.execute('''
-        SELECT skeleton_id, id, parent_id, confidence, location_x, location_y, location_z
+    results:Dict[int, Any] = {}
+    fingerprints:Dict[int, Tuple] = {}
+    if timeout:
+        cursor.execute('''
+            SELECT css.skeleton_id, css.last_edition_time
+            FROM catmaid_skeleton_summary css
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON skeleton.id = css.skeleton_id
+        ''', {
+            'skeleton_ids': skeleton_ids,
+        })
+        for skeleton_id, last_edition_time in cursor.fetchall():
+            skeleton_synapses = json.dumps(sorted(synapses.get(skeleton_id, [])))
+            fingerprints[skeleton_id] = (last_edition_time,
+                    hashlib.sha1(skeleton_synapses.encode('utf-8')).hexdigest())
+
+        cache_keys = {f'{key_prefix}-{skeleton_id}': skeleton_id
+                for skeleton_id in fingerprints}
+        for cache_key, cached in cache.get_many(cache_keys.keys()).items():
+            skeleton_id = cache_keys[cache_key]
+            if cached[0] == fingerprints[skeleton_id]:
+                results[skeleton_id] = cached[1]
+
+    missing = [skid for skid in skeleton_ids if skid not in results]
+    if missing:
+        computed = compute(missing)
+        results.update(computed)
+
+        if timeout:
+            cache.set_many({f'{key_prefix}-{skeleton_id}':
+                    (fingerprints[skeleton_id], result)
+                    for skeleton_id, result in computed.items()
+                    if skeleton_id in fingerprints}, timeout)
+
+    return {skid: results[skid] for skid in skeleton_ids}
+
+
+def compute_skeleton_splits(project_id, skeleton_ids, confidence_threshold,
+        bandwidth, stc, cursor=None) -> Dict[int, Optional[SkeletonSplit]]:
+    """Split the passed in skeletons like get_skeleton_splits(), but without
+    using the cache.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    with_locations = bandwidth > 0
+
+    # Fetch all treenodes of all skeletons
+    cursor.execute(f'''
+        SELECT skeleton_id, id, parent_id, confidence
+            {', location_x, location_y, location_z' if with_locations else ''}
         FROM treenode
         WHERE project_id = %(project_id)s
-          AND skeleton_id = ANY(%(skids)s::bigint[])
+          AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])
         ORDER BY skeleton_id
     ''', {
         'project_id': project_id,
-        'skids': list(expand),
+        'skeleton_ids': list(skeleton_ids),
     })
 
-    # list of edges among synapse domains
-    intraedges:List = []
+    splits:Dict[int, Optional[SkeletonSplit]] = \
+            {skid: None for skid in skeleton_ids}
 
-    # list of branch nodes, merely structural
-    branch_nodeIDs:List = []
+    def split(skeleton_id, tree, locations):
+        # Dictionary of connector_id vs relation_id vs list of sub-skeleton ID
+        connectors:DefaultDict = defaultdict(partial(defaultdict, list))
+        intraedges:List = []
+        if with_locations:
+            nodes, branch_nodes = split_by_both(skeleton_id, tree, locations,
+                    bandwidth, stc[skeleton_id], connectors, intraedges)
+        else:
+            nodes = list(split_by_confidence(skeleton_id, tree,
+                    stc[skeleton_id], connectors))
+            branch_nodes = []
+        links = [(connector_id, relation_id, node_id, confidence)
+                for connector_id, relations in connectors.items()
+                for relation_id, partners in relations.items()
+                for node_id, confidence in partners]
+        splits[skeleton_id] = SkeletonSplit(nodes, branch_nodes, intraedges,
+                links)
 
-    # reset
+    # Read out into memory only one skeleton at a time
     current_skid = None
-    tree = None
+    tree:Optional[nx.DiGraph] = None
     locations:Optional[Dict] = None
     for row in cursor.fetchall():
         if row[0] == current_skid:
             # Build the tree, breaking it at the low-confidence edges
-            # mypy cannot prove this will have a value by here
-            locations[row[1]] = row[4:]  # type: ignore
-            if row[2] and row[3] >= confidence_threshold:
+            if with_locations:
                 # mypy cannot prove this will have a value by here
+                locations[row[1]] = row[4:]  # type: ignore
+            if row[2] and row[3] >= confidence_threshold:
+                # mypy cannot prove this will be a DiGraph by here
                 tree.add_edge(row[2], row[1])  # type: ignore
             continue
 
         if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
+            split(current_skid, tree, locations)
 
         # Start the next tree
         current_skid = row[0]
         tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
+        if with_locations:
+            locations = {}
+            locations[row[1]] = row[4:]
         if row[2] and row[3] > confidence_threshold:
             tree.add_edge(row[2], row[1])
 
     if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-        nodeIDs.extend(ns)
-        branch_nodeIDs.extend(bs)
+        split(current_skid, tree, locations)
 
+    return splits
 
-    # Create the edges of the graph
-    edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))  # pre vs post vs count
-    for c in connectors.values():
-        for pre in c[source_rel_id]:
-            for post in c[target_rel_id]:
-                edges[pre[0]][post[0]][min(pre[1], post[1]) - 1] += 1
 
-    return {
-        'nodes': nodeIDs,
-        'edges': [(s, t, count)
-                for s, edge in edges.items()
-                for t, count in edge.items()],
-        'branch_nodes': branch_nodeIDs,
-        'intraedges': intraedges
-    }
+def add_skeleton_splits(splits, nodes, branch_nodes, intraedges,
+        connectors) -> None:
+    """Add the nodes, branch nodes, intraedges and connector links of the
+    passed in SkeletonSplit map to the respective collections.
+    """
+    for split in splits.values():
+        if not split:
+            continue
+        nodes.extend(split.nodes)
+        branch_nodes.extend(split.branch_nodes)
+        intraedges.extend(split.intraedges)
+        for connector_id, relation_id, node_id, confidence in split.links:
+            connectors[connector_id][relation_id].append((node_id, confidence))
 
 
 def populate_connectors(chunkIDs, chunks, cs, connectors) -> None:
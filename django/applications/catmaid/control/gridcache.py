@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""A process local cache for node grid cache cells.
+
+Grid cache cells are read on every tracing overlay update that is served by a
+grid cache node provider. With many annotators looking at the same region of a
+dataset, the same cells are read over and over again. This module provides a
+byte bounded least-recently-used (LRU) cache that is kept in every web worker
+process. It stores the encoded LOD data of individual cells along with the
+grid meta data of each project and is kept consistent through Postgres
+LISTEN/NOTIFY: cells that are marked dirty ("catmaid.dirty-cache") or that are
+recomputed ("catmaid.grid-cache-update") are evicted by a background listener
+thread. As long as this listener isn't connected, the cache isn't used.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import select
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+import ujson
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+# Notification channel that is used when a grid cell was (re-)computed. The
+# payload is a JSON object with the fields "grid_id", "x", "y" and "z". If only
+# "grid_id" is provided, the whole grid is invalidated. An empty object
+# invalidates all grids.
+GRID_CACHE_UPDATE_CHANNEL = 'catmaid.grid-cache-update'
+
+# Notification channel that is used when grid cells are marked dirty.
+DIRTY_CACHE_CHANNEL = 'catmaid.dirty-cache'
+
+# A marker for cells that are known to not exist in the database.
+MISSING_CELL = object()
+
+# The estimated memory overhead of a single cache entry in bytes.
+ENTRY_OVERHEAD = 200
+
+
+def estimate_size(value) -> int:
+    """Estimate the memory footprint of an encoded cache value in bytes.
+    """
+    if value is None or value is MISSING_CELL:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return len(ujson.dumps(value))
+
+
+class GridCellCache(object):
+    """A thread safe and byte bounded LRU cache for encoded grid cell data and
+    grid meta data. Keys of cell entries are tuples of the form (grid_id,
+    x_index, y_index, z_index, lod_min, lod_max, data_type), keys of grid meta
+    data entries are tuples of the form ('grids', project_id).
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Incremented with every invalidation. Readers remember the generation
+        # before they query the database, so that results that were read
+        # before a concurrent invalidation aren't stored.
+        self.generation = 0
+        self._entries:OrderedDict = OrderedDict()
+        # Map (grid_id, x, y, z) to the set of cell keys of this cell, i.e. the
+        # different LOD ranges and data types.
+        self._cell_keys:Dict[Tuple, Set[Tuple]] = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key:Hashable, default=None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, expires = entry
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key:Hashable, value, size:int=None, generation:int=None) -> None:
+        if size is None:
+            size = estimate_size(value)
+        size += ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires)
+            self.n_bytes += size
+            if len(key) == 7:
+                cell_key = key[:4]
+                cell_keys = self._cell_keys.get(cell_key)
+                if cell_keys is None:
+                    cell_keys = set()
+                    self._cell_keys[cell_key] = cell_keys
+                cell_keys.add(key)
+            while self.n_bytes > self.max_bytes and self._entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key) -> None:
+        """Remove a single entry. Expects the lock to be held."""
+        _, size, _ = self._entries.pop(key)
+        self.n_bytes -= size
+        if len(key) == 7:
+            cell_key = key[:4]
+            cell_keys = self._cell_keys.get(cell_key)
+            if cell_keys is not None:
+                cell_keys.discard(key)
+                if not cell_keys:
+                    del self._cell_keys[cell_key]
+
+    def invalidate_cell(self, grid_id, x, y, z) -> None:
+        with self._lock:
+            self.generation += 1
+            cell_keys = self._cell_keys.get((grid_id, x, y, z))
+            if cell_keys:
+                for key in list(cell_keys):
+                    self._remove(key)
+
+    def invalidate_grid(self, grid_id) -> None:
+        """Remove all cells of the passed in grid along with all grid meta
+        data, because a grid invalidation typically means the set of grids
+        changed as well.
+        """
+        with self._lock:
+            self.generation += 1
+            keys = [k for k in self._entries
+                    if (len(k) == 7 and k[0] == grid_id) or k[0] == 'grids']
+            for key in keys:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._cell_keys.clear()
+            self.n_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.n_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class GridCacheInvalidationListener(threading.Thread):
+    """A daemon thread that listens on a dedicated database connection for
+    grid cache related notifications and evicts matching cache entries. If the
+    connection is lost, the cache is cleared, because events might have been
+    missed, and a new connection is attempted after a delay.
+    """
+
+    channels = (DIRTY_CACHE_CHANNEL, GRID_CACHE_UPDATE_CHANNEL)
+
+    def __init__(self, cache, retry_delay=5.0, poll_timeout=5.0):
+        super().__init__(name='catmaid-grid-cache-listener', daemon=True)
+        self.cache = cache
+        self.retry_delay = retry_delay
+        self.poll_timeout = poll_timeout
+        self.connected = threading.Event()
+
+    def connect(self):
+        conn = connection.get_new_connection(connection.get_connection_params())
+        conn.autocommit = True
+        cursor = conn.cursor()
+        for channel in self.channels:
+            cursor.execute(f'LISTEN "{channel}"')
+        return conn
+
+    def handle(self, notify) -> None:
+        try:
+            data = json.loads(notify.payload) if notify.payload else {}
+        except json.decoder.JSONDecodeError:
+            logger.warning(f'Could not parse grid cache notification: {notify.payload}')
+            return
+        grid_id = data.get('grid_id')
+        if grid_id is None:
+            self.cache.clear()
+        elif 'x' in data and 'y' in data and 'z' in data:
+            self.cache.invalidate_cell(grid_id, data['x'], data['y'], data['z'])
+        else:
+            self.cache.invalidate_grid(grid_id)
+
+    def run(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = self.connect()
+                self.connected.set()
+                while True:
+                    select.select([conn], [], [], self.poll_timeout)
+                    conn.poll()
+                    while conn.notifies:
+                        self.handle(conn.notifies.pop(0))
+            except Exception as e:
+                logger.warning(f'Grid cache invalidation listener disconnected: {e}')
+            finally:
+                self.connected.clear()
+                self.cache.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(self.retry_delay)
+
+
+_cache:Optional[GridCellCache] = None
+_listener:Optional[GridCacheInvalidationListener] = None
+_pid:Optional[int] = None
+_init_lock = threading.Lock()
+
+
+def get_grid_cell_cache() -> Optional[GridCellCache]:
+    """Return the grid cell cache of this process, if it is enabled through the
+    NODE_GRID_CACHE_LOCAL_SIZE setting and its invalidation listener is
+    connected. Otherwise, None is returned. The cache and its listener are
+    created lazily and per process, which makes this safe to use after forks.
+    """
+    global _cache, _listener, _pid
+    max_bytes = getattr(settings, 'NODE_GRID_CACHE_LOCAL_SIZE', 0)
+    if not max_bytes:
+        return None
+
+    pid = os.getpid()
+    if _pid != pid:
+        with _init_lock:
+            if _pid != pid:
+                _cache = GridCellCache(max_bytes,
+                        getattr(settings, 'NODE_GRID_CACHE_LOCAL_TTL', None))
+                _listener = GridCacheInvalidationListener(_cache)
+                _listener.start()
+                _pid = pid
+
+    if _listener and _listener.connected.is_set():
+        return _cache
+    return None
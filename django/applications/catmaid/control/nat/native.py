@@ -0,0 +1,1051 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from concurrent import futures
+from itertools import groupby
+import math
+import multiprocessing
+import numpy as np
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, connections
+
+from catmaid.apps import get_system_user
+from catmaid.models import (NblastConfig, NblastConfigDefaultDistanceBreaks,
+        NblastConfigDefaultDotBreaks, PointCloud, PointSet)
+from catmaid.control.nat.r import nm_to_um
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+native_nblast_enabled = True
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    native_nblast_enabled = False
+    logger.warning('CATMAID was unable to load the scipy module. The native '
+            'NBLAST back-end is therefore disabled.')
+
+
+# A set of points along with a unit tangent vector and an alpha value for each
+# point. Alpha describes how linear the neighborhood of a point is.
+Dotprops = namedtuple('Dotprops', ['points', 'vect', 'alpha'])
+
+# Object data shared with worker processes. Workers are forked after this is
+# populated, which avoids sending all dotprops to each worker explicitly.
+_shared:Dict[str, Any] = {}
+
+
+def make_dotprops(points, k=20) -> Dotprops:
+    """Compute a tangent vector and an alpha value for each of the passed in
+    points, based on the first principal component of the <k> nearest
+    neighbors of each point (including the point itself). This follows the
+    dotprops() implementation of the nat R package.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    n_points = len(points)
+    if n_points < 2:
+        raise ValueError(f"Need at least two points for dotprops, got {n_points}")
+    k = min(k, n_points)
+
+    _, nn_idx = cKDTree(points).query(points, k=k)
+    neighbors = points[nn_idx.reshape(n_points, k)]
+    centered = neighbors - neighbors.mean(axis=1, keepdims=True)
+    inertia = np.einsum('nki,nkj->nij', centered, centered)
+    # Eigenvalues are returned in ascending order
+    eigenvalues, eigenvectors = np.linalg.eigh(inertia)
+    vect = eigenvectors[:, :, 2]
+    total = eigenvalues.sum(axis=1)
+    alpha = np.divide(eigenvalues[:, 2] - eigenvalues[:, 1], total,
+            out=np.zeros(n_points), where=total > 0)
+
+    return Dotprops(points, vect, alpha)
+
+
+def _parent_index(node_ids, parent_ids) -> np.ndarray:
+    """Map the parent ID of each node to the index of the parent node. Roots
+    get the index -1.
+    """
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+    return np.array([index.get(parent_id, -1) for parent_id in parent_ids],
+            dtype=np.int64)
+
+
+def simplify_skeleton(parent_idx, locations, n_branches=10) -> np.ndarray:
+    """Return a mask of the nodes that remain if a skeleton is reduced to the
+    longest path from its root along with the <n_branches> longest branches
+    attached to it. This is similar to simplify_neuron() of the nat R package.
+    """
+    n_nodes = len(parent_idx)
+    has_parent = parent_idx >= 0
+    edge_length = np.zeros(n_nodes)
+    edge_length[has_parent] = np.linalg.norm(locations[has_parent] -
+            locations[parent_idx[has_parent]], axis=1)
+
+    children:List[List[int]] = [[] for _ in range(n_nodes)]
+    for child, parent in enumerate(parent_idx):
+        if parent >= 0:
+            children[parent].append(child)
+
+    # Visit parents before children
+    order = []
+    stack = list(np.flatnonzero(~has_parent))
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(children[node])
+
+    # The longest downstream path of each node and the child continuing it.
+    height = np.zeros(n_nodes)
+    heavy_child = np.full(n_nodes, -1, dtype=np.int64)
+    for node in reversed(order):
+        for child in children[node]:
+            child_height = height[child] + edge_length[child]
+            if heavy_child[node] < 0 or child_height > height[node]:
+                height[node] = child_height
+                heavy_child[node] = child
+
+    # Every child that doesn't continue the longest path of its parent starts
+    # a branch. Branches are never longer than the path they are attached to,
+    # which makes the longest branches a connected subset.
+    branches = sorted((height[child] + edge_length[child], child)
+            for node in order for child in children[node]
+            if child != heavy_child[node])
+    branch_starts = [child for _, child in branches[-n_branches:]] \
+            if n_branches > 0 else []
+
+    # The main path starts at the root with the longest downstream path.
+    roots = np.flatnonzero(~has_parent)
+    keep = np.zeros(n_nodes, dtype=bool)
+    for start in [roots[np.argmax(height[roots])]] + branch_starts:
+        node = start
+        while node >= 0:
+            keep[node] = True
+            node = heavy_child[node]
+
+    return keep
+
+
+def resample_skeleton(parent_idx, locations, step) -> np.ndarray:
+    """Resample all unbranched segments of a skeleton so that consecutive
+    points have a distance of at most <step>. Branch points, roots and leaves
+    are preserved.
+    """
+    n_nodes = len(parent_idx)
+    n_children = np.bincount(parent_idx[parent_idx >= 0], minlength=n_nodes)
+    points = [locations[parent_idx < 0]]
+
+    # Each segment starts at a leaf or branch node and goes up to the next
+    # branch node or root.
+    for start in np.flatnonzero((n_children != 1) & (parent_idx >= 0)):
+        segment = [start]
+        node = parent_idx[start]
+        while True:
+            segment.append(node)
+            if parent_idx[node] < 0 or n_children[node] > 1:
+                break
+            node = parent_idx[node]
+
+        coords = locations[segment]
+        cumulative = np.concatenate(([0], np.cumsum(np.linalg.norm(
+                np.diff(coords, axis=0), axis=1))))
+        n_samples = max(2, math.ceil(cumulative[-1] / step) + 1)
+        positions = np.linspace(0, cumulative[-1], n_samples)
+        resampled = np.column_stack([np.interp(positions, cumulative, coords[:, d])
+                for d in range(3)])
+        # The end of each segment is part of the segment above or a root.
+        points.append(resampled[:-1])
+
+    return np.concatenate(points)
+
+
+def get_skeleton_dotprops(project_id, skeleton_ids, k=20, resample=1.0,
+        simplify=False, required_branches=10, omit_failures=True) -> Dict[int, Dotprops]:
+    """Load the passed in skeletons in µm space, optionally simplify and
+    resample them and compute their dotprops. Returns a dictionary mapping
+    skeleton IDs to dotprops.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT t.skeleton_id, t.id, t.parent_id, t.location_x, t.location_y,
+            t.location_z
+        FROM treenode t
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+            ON t.skeleton_id = skeleton.id
+        WHERE t.project_id = %(project_id)s
+        ORDER BY t.skeleton_id
+    """, {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids),
+    })
+
+    dotprops = {}
+    for skeleton_id, rows in groupby(cursor.fetchall(), lambda r: r[0]):
+        rows = list(rows)
+        try:
+            parent_idx = _parent_index([r[1] for r in rows], [r[2] for r in rows])
+            locations = np.array([r[3:6] for r in rows], dtype=np.float64) * nm_to_um
+            if simplify:
+                keep = simplify_skeleton(parent_idx, locations, required_branches)
+                new_index = np.cumsum(keep) - 1
+                parent_idx = np.where(parent_idx[keep] >= 0,
+                        new_index[parent_idx[keep]], -1)
+                locations = locations[keep]
+            if resample:
+                locations = resample_skeleton(parent_idx, locations, resample)
+            dotprops[skeleton_id] = make_dotprops(locations, k)
+        except ValueError as e:
+            if not omit_failures:
+                raise ValueError(f"Could not compute dotprops for skeleton {skeleton_id}: {e}")
+
+    return dotprops
+
+
+def get_pointcloud_dotprops(project_id, pointcloud_ids, k=20,
+        omit_failures=True) -> Dict[int, Dotprops]:
+    """Compute the dotprops of the passed in point clouds in µm space.
+    """
+    dotprops = {}
+    for pointcloud in PointCloud.objects.prefetch_related('points').filter(
+            project_id=project_id, pk__in=pointcloud_ids):
+        points = [(p.location_x, p.location_y, p.location_z)
+                for p in pointcloud.points.all()]
+        try:
+            dotprops[pointcloud.id] = make_dotprops(
+                    np.array(points, dtype=np.float64) * nm_to_um, k)
+        except ValueError as e:
+            if not omit_failures:
+                raise ValueError(f"Could not compute dotprops for point cloud {pointcloud.id}: {e}")
+
+    return dotprops
+
+
+def get_pointset_dotprops(project_id, pointset_ids, k=20,
+        omit_failures=True) -> Dict[int, Dotprops]:
+    """Compute the dotprops of the passed in point sets in µm space.
+    """
+    dotprops = {}
+    for pointset in PointSet.objects.filter(project_id=project_id,
+            pk__in=pointset_ids):
+        try:
+            dotprops[pointset.id] = make_dotprops(
+                    np.array(pointset.points, dtype=np.float64) * nm_to_um, k)
+        except ValueError as e:
+            if not omit_failures:
+                raise ValueError(f"Could not compute dotprops for point set {pointset.id}: {e}")
+
+    return dotprops
+
+
+def _get_dotprops_chunk(task) -> Dict[int, Dotprops]:
+    """Entry point for worker processes to compute dotprops of a chunk of
+    objects of one type.
+    """
+    object_type, project_id, object_ids, params = task
+    if object_type == 'skeleton':
+        return get_skeleton_dotprops(project_id, object_ids, **params)
+    params = {k: v for k, v in params.items() if k in ('k', 'omit_failures')}
+    if object_type == 'pointcloud':
+        return get_pointcloud_dotprops(project_id, object_ids, **params)
+    elif object_type == 'pointset':
+        return get_pointset_dotprops(project_id, object_ids, **params)
+    raise ValueError(f"Unknown object type: {object_type}")
+
+
+def _map(fn, tasks, n_jobs=1):
+    """Apply <fn> to all tasks, in parallel if <n_jobs> is larger than one.
+    Data that workers need can be stored in the module level _shared dictionary
+    before calling this function. Workers are forked processes and inherit it.
+    """
+    if n_jobs > 1 and len(tasks) > 1:
+        # Forked processes must not share database connections.
+        connections.close_all()
+        with futures.ProcessPoolExecutor(n_jobs,
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            return list(executor.map(fn, tasks))
+    return list(map(fn, tasks))
+
+
+def get_dotprops(project_id, object_type, object_ids, n_jobs=1, chunk_size=100,
+        cache=None, **params) -> Dict[int, Dotprops]:
+    """Compute the dotprops for a list of objects of the passed in type in
+    chunks, optionally using multiple processes. Returns a dictionary that maps
+    object IDs to dotprops, keeping the order of the input IDs. If a
+    DotpropsCache is passed in, cached objects are read from it and only the
+    remaining ones are computed.
+    """
+    object_ids = list(object_ids)
+    results:Dict[int, Dotprops] = {}
+    if cache is not None:
+        results.update(cache.get_many(object_ids))
+        logger.debug(f'Found {len(results)} of {len(object_ids)} objects in cache')
+    missing_ids = [object_id for object_id in object_ids
+            if object_id not in results]
+    tasks = [(object_type, project_id, missing_ids[i:i + chunk_size], params)
+            for i in range(0, len(missing_ids), chunk_size)]
+    for result in _map(_get_dotprops_chunk, tasks, n_jobs):
+        results.update(result)
+    return {object_id: results[object_id] for object_id in object_ids
+            if object_id in results}
+
+
+def _write_npy_header(f, dtype, shape) -> None:
+    """Write a .npy version 1.0 header of a fixed length to the beginning of
+    <f>. Since the header length doesn't depend on the shape, it can be
+    rewritten in place after rows have been appended.
+    """
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(DotpropsCache.header_length - 10 - 1) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00')
+    f.write(np.uint16(len(header)).tobytes())
+    f.write(header.encode('latin1'))
+
+
+class DotpropsCache:
+    """A cache of dotprops for all objects of one type in a project. Points,
+    tangent vectors and alpha values of all objects are concatenated into three
+    float32 .npy files, which are memory-mapped when read. An index file maps
+    each object ID to an offset and length in these arrays. This way only the
+    pages of the objects in use are loaded.
+
+    Updates append the new dotprops of changed objects to the arrays and
+    replace the index atomically, readers see either the old or the new
+    version. Rows of replaced or removed objects are unused until the cache is
+    compacted, which happens once they make up more than half of all rows.
+    Compaction writes a new generation of array files. Only one process should
+    update a cache at a time.
+    """
+
+    header_length = 128
+    compaction_ratio = 0.5
+
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix
+        self.index:Dict[int, Tuple[int, int]] = {}
+        self.meta:Dict[str, float] = {}
+        self.generation = 0
+        self.n_rows = 0
+        self.arrays:Dict[str, Any] = {}
+
+        # If the cache is replaced while it is loaded, the array files of the
+        # index that was read can be removed already. Loading is retried in
+        # this case.
+        for attempt in range(3):
+            try:
+                self.load()
+                break
+            except FileNotFoundError:
+                self.index, self.meta, self.arrays = {}, {}, {}
+
+    def load(self) -> None:
+        """Read the index and memory-map the arrays of the cache, if it
+        exists.
+        """
+        index_path = self.index_path()
+        if not os.path.exists(index_path):
+            return
+        with np.load(index_path, allow_pickle=False) as data:
+            self.index = {int(object_id): (int(offset), int(length))
+                    for object_id, offset, length in data['index']}
+            self.meta = {k: float(data[k]) for k in data.files
+                    if k != 'index'}
+        self.generation = int(self.meta.pop('generation'))
+        self.n_rows = int(self.meta.pop('n_rows'))
+        for name in ('points', 'vect', 'alpha'):
+            self.get_array(name)
+
+    @staticmethod
+    def get_path_prefix(project_id, object_type, detail=10) -> str:
+        extra = f"-simple-{detail}" if object_type == 'skeleton' else ''
+        return os.path.join(settings.MEDIA_ROOT,
+                settings.MEDIA_CACHE_SUBDIRECTORY,
+                f"npy-dps-cache-project-{project_id}-{object_type}{extra}")
+
+    @classmethod
+    def open(cls, project_id, object_type, detail=10, tangent_neighbors=None,
+            resample=None) -> Optional['DotpropsCache']:
+        """Return the cache for the passed in project, object type and detail
+        level if it exists. If tangent neighbors or a resampling step are
+        passed in and the cache was created with different values, None is
+        returned.
+        """
+        cache = cls(cls.get_path_prefix(project_id, object_type, detail))
+        if not cache.exists():
+            return None
+        if tangent_neighbors is not None and \
+                cache.meta.get('tangent_neighbors') != tangent_neighbors:
+            return None
+        if resample is not None and \
+                not math.isclose(cache.meta.get('resample', -1), resample):
+            return None
+        return cache
+
+    def exists(self) -> bool:
+        return bool(self.meta)
+
+    def index_path(self) -> str:
+        return f'{self.path_prefix}-index.npz'
+
+    def array_path(self, name, generation=None) -> str:
+        if generation is None:
+            generation = self.generation
+        return f'{self.path_prefix}-{generation}-{name}.npy'
+
+    def __contains__(self, object_id) -> bool:
+        return object_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get_array(self, name):
+        array = self.arrays.get(name)
+        if array is None:
+            array = self.arrays[name] = np.load(self.array_path(name),
+                    mmap_mode='r')
+        return array
+
+    def get(self, object_id) -> Optional[Dotprops]:
+        """Return the dotprops of an object as views into the memory-mapped
+        arrays or None if the object isn't cached.
+        """
+        entry = self.index.get(object_id)
+        if entry is None:
+            return None
+        offset, length = entry
+        return Dotprops(*(self.get_array(name)[offset:offset + length]
+                for name in ('points', 'vect', 'alpha')))
+
+    def get_many(self, object_ids) -> Dict[int, Dotprops]:
+        result = {}
+        for object_id in object_ids:
+            dotprops = self.get(object_id)
+            if dotprops is not None:
+                result[object_id] = dotprops
+        return result
+
+    def append_rows(self, name, rows, generation) -> None:
+        """Append rows to an array file of a generation, which is created if
+        it doesn't exist.
+        """
+        path = self.array_path(name, generation)
+        rows = np.ascontiguousarray(rows, dtype=np.float32)
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        with open(path, mode) as f:
+            if mode == 'w+b':
+                n_rows = 0
+            else:
+                np.lib.format.read_magic(f)
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+                n_rows = shape[0]
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            _write_npy_header(f, np.float32, (n_rows + len(rows),) + rows.shape[1:])
+
+    def write_index(self, index, generation, n_rows, meta) -> None:
+        """Atomically replace the index file."""
+        index_data = np.array([(object_id, offset, length) for object_id,
+                (offset, length) in index.items()], dtype=np.int64).reshape(-1, 3)
+        tmp_path = f'{self.path_prefix}-index.tmp.npz'
+        np.savez(tmp_path, index=index_data, generation=generation,
+                n_rows=n_rows, **meta)
+        os.replace(tmp_path, self.index_path())
+
+        self.index, self.generation, self.n_rows = index, generation, n_rows
+        self.meta = dict(meta)
+        self.arrays = {}
+
+    def update(self, dotprops:Dict[int, Dotprops], removed=(), meta=None) -> None:
+        """Store the dotprops of new or changed objects and remove the passed
+        in object IDs. The passed in meta data, e.g. the time of the update,
+        replaces the existing one.
+        """
+        index = dict(self.index)
+        for object_id in removed:
+            index.pop(object_id, None)
+
+        generation, n_rows = self.generation, self.n_rows
+        old_generation = None
+        if not self.exists():
+            # Start a new generation, which replaces the old one once the new
+            # index is written.
+            old_generation = generation
+            generation, n_rows = generation + 1, 0
+            self.create_generation(generation)
+
+        if dotprops:
+            for object_id, dps in dotprops.items():
+                index[object_id] = (n_rows, len(dps.points))
+                n_rows += len(dps.points)
+            values = list(dotprops.values())
+            for name in ('points', 'vect', 'alpha'):
+                self.append_rows(name, np.concatenate([getattr(d, name)
+                        for d in values]), generation)
+
+        self.write_index(index, generation, n_rows,
+                meta if meta is not None else self.meta)
+        if old_generation is not None:
+            self.remove_generation(old_generation)
+
+        n_used = sum(length for _, length in index.values())
+        if n_rows and (n_rows - n_used) / n_rows > self.compaction_ratio:
+            self.compact()
+
+    def compact(self) -> None:
+        """Write all cached objects without unused rows into a new generation
+        of array files and remove the old one.
+        """
+        old_generation = self.generation
+        generation = old_generation + 1
+        index = {}
+        n_rows = 0
+        self.create_generation(generation)
+        object_ids = list(self.index.keys())
+        for i in range(0, len(object_ids), 1000):
+            chunk = self.get_many(object_ids[i:i + 1000])
+            for object_id, dps in chunk.items():
+                index[object_id] = (n_rows, len(dps.points))
+                n_rows += len(dps.points)
+            values = list(chunk.values())
+            if not values:
+                continue
+            for name in ('points', 'vect', 'alpha'):
+                self.append_rows(name, np.concatenate([getattr(d, name)
+                        for d in values]), generation)
+
+        self.write_index(index, generation, n_rows, self.meta)
+        self.remove_generation(old_generation)
+
+    def create_generation(self, generation) -> None:
+        """Create empty array files for a generation."""
+        self.remove_generation(generation)
+        for name, shape in (('points', (0, 3)), ('vect', (0, 3)), ('alpha', (0,))):
+            self.append_rows(name, np.zeros(shape), generation)
+
+    def remove_generation(self, generation) -> None:
+        """Remove the array files of a generation. Readers that still use
+        them keep their memory maps.
+        """
+        for name in ('points', 'vect', 'alpha'):
+            path = self.array_path(name, generation)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def update_dps_cache(project_id, object_type, tangent_neighbors=20, detail=10,
+        omit_failures=True, min_nodes=500, min_soma_nodes=20,
+        soma_tags=('soma',), resample_by=1e3, full=False, n_jobs=1,
+        batch_size=1000) -> Dict[str, int]:
+    """Create or update the memory-mapped dotprops cache of a particular
+    project, object type and detail level. Unless <full> is set or the cache
+    was created with different parameters, only skeletons that were edited
+    since the last update are recomputed. Objects that don't exist anymore or
+    don't match the filter criteria anymore are removed. Returns the number of
+    updated and removed objects.
+    """
+    # A circular dependency would be the result of a top level import
+    from catmaid.control.similarity import get_all_object_ids
+
+    if not native_nblast_enabled:
+        raise ValueError("The dotprops cache requires scipy")
+
+    cache_dir = os.path.join(settings.MEDIA_ROOT, settings.MEDIA_CACHE_SUBDIRECTORY)
+    if not os.path.exists(cache_dir) or not os.access(cache_dir, os.W_OK):
+        raise ValueError(f"Can not access cache directory: {cache_dir}")
+
+    user = get_system_user()
+    resample = resample_by * nm_to_um
+    cache = DotpropsCache(DotpropsCache.get_path_prefix(project_id,
+            object_type, detail))
+
+    # Skeletons are compared with the time at which the last update started.
+    cursor = connection.cursor()
+    cursor.execute("SELECT extract(epoch from now())")
+    update_time = float(cursor.fetchone()[0])
+
+    object_ids = get_all_object_ids(project_id, user.id, object_type,
+            min_nodes, min_soma_nodes, soma_tags)
+
+    matching_params = cache.exists() and \
+            cache.meta.get('tangent_neighbors') == tangent_neighbors and \
+            math.isclose(cache.meta.get('resample', -1), resample)
+    current_ids = set(object_ids)
+    if full or not matching_params:
+        # Start from an empty cache, which replaces the existing one.
+        cache.meta, cache.index = {}, {}
+        update_ids = object_ids
+    elif object_type == 'skeleton':
+        # Transactions that were still running during the last update can
+        # have an edition time before it, which is why a margin is used.
+        cursor.execute("""
+            SELECT css.skeleton_id
+            FROM catmaid_skeleton_summary css
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON skeleton.id = css.skeleton_id
+            WHERE css.last_edition_time >=
+                to_timestamp(%(last_update)s) - interval '1 hour'
+        """, {
+            'skeleton_ids': object_ids,
+            'last_update': cache.meta['last_update'],
+        })
+        changed_ids = set(row[0] for row in cursor.fetchall())
+        update_ids = [object_id for object_id in object_ids
+                if object_id in changed_ids or object_id not in cache]
+    else:
+        update_ids = [object_id for object_id in object_ids
+                if object_id not in cache]
+
+    removed_ids = [object_id for object_id in cache.index
+            if object_id not in current_ids]
+
+    meta = {
+        'tangent_neighbors': tangent_neighbors,
+        'resample': resample,
+        'detail': detail,
+        'last_update': update_time,
+    }
+
+    dotprops_params = {
+        'k': tangent_neighbors,
+        'resample': resample,
+        'simplify': detail > 0,
+        'required_branches': detail,
+        'omit_failures': omit_failures,
+    }
+
+    logger.debug(f'Updating {len(update_ids)} and removing {len(removed_ids)} cached objects')
+    if not update_ids:
+        cache.update({}, removed_ids, meta)
+    for i in range(0, len(update_ids), batch_size):
+        batch_ids = update_ids[i:i + batch_size]
+        dotprops = get_dotprops(project_id, object_type, batch_ids, n_jobs,
+                **dotprops_params)
+        # Objects that failed are removed so that they aren't used with
+        # outdated data.
+        failed_ids = [object_id for object_id in batch_ids
+                if object_id not in dotprops]
+        cache.update(dotprops, (removed_ids if i == 0 else []) + failed_ids,
+                meta)
+        logger.info(f'{min(i + batch_size, len(update_ids))}/{len(update_ids)} objects updated')
+
+    return {
+        'updated': len(update_ids),
+        'removed': len(removed_ids),
+    }
+
+
+def bin_values(values, breaks) -> np.ndarray:
+    """Return the bin index for each value, given bin boundaries. Values
+    outside of the range are assigned to the first and last bin, like
+    findInterval(all.inside=TRUE) in R.
+    """
+    return np.digitize(values, breaks[1:-1])
+
+
+def nearest_neighbor_dotprods(query:Dotprops, target:Dotprops, target_tree,
+        use_alpha=False) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the nearest target point for each query point and return both the
+    distances and the absolute dot products of the tangent vectors. If
+    <use_alpha> is set, dot products are weighted by the alpha values of both
+    points.
+    """
+    distances, nn_idx = target_tree.query(query.points)
+    dotprods = np.abs(np.einsum('ij,ij->i', query.vect, target.vect[nn_idx]))
+    if use_alpha:
+        dotprods *= np.sqrt(query.alpha * target.alpha[nn_idx])
+    return distances, dotprods
+
+
+def nblast_score(query:Dotprops, target:Dotprops, target_tree, smat,
+        distance_breaks, dot_breaks, use_alpha=False) -> float:
+    """Compute the raw NBLAST score of a query against a target by looking up
+    the score of each query point in the scoring matrix <smat>.
+    """
+    distances, dotprods = nearest_neighbor_dotprods(query, target,
+            target_tree, use_alpha)
+    return smat[bin_values(distances, distance_breaks),
+            bin_values(dotprods, dot_breaks)].sum()
+
+
+def self_score(query:Dotprops, smat, distance_breaks, dot_breaks,
+        use_alpha=False) -> float:
+    """Compute the score of a query against itself, which is used to normalize
+    scores.
+    """
+    dotprods = query.alpha if use_alpha else np.ones(len(query.points))
+    return smat[bin_values(np.zeros(len(query.points)), distance_breaks),
+            bin_values(dotprods, dot_breaks)].sum()
+
+
+def _score_chunk(task) -> Tuple[int, np.ndarray]:
+    """Entry point for worker processes to score all shared query dotprops
+    against a range of shared target dotprops. The KD-tree of each target is
+    only built once.
+    """
+    start, end = task
+    queries, targets = _shared['queries'], _shared['targets']
+    smat, use_alpha = _shared['smat'], _shared['use_alpha']
+    distance_breaks, dot_breaks = _shared['distance_breaks'], _shared['dot_breaks']
+
+    scores = np.empty((len(queries), end - start))
+    for j in range(start, end):
+        target = targets[j]
+        target_tree = cKDTree(target.points)
+        for i, query in enumerate(queries):
+            scores[i, j - start] = nblast_score(query, target, target_tree,
+                    smat, distance_breaks, dot_breaks, use_alpha)
+    return start, scores
+
+
+def score_all(queries:List[Dotprops], targets:List[Dotprops], smat,
+        distance_breaks, dot_breaks, use_alpha=False, normalized=False,
+        n_jobs=1, chunk_size=50) -> np.ndarray:
+    """Return a matrix of NBLAST scores with one row per query and one column
+    per target. Targets are split into chunks which are scored in parallel if
+    <n_jobs> is larger than one. If <normalized> is set, scores are divided by
+    the self-score of the respective query.
+    """
+    _shared.update({
+        'queries': queries,
+        'targets': targets,
+        'smat': smat,
+        'distance_breaks': distance_breaks,
+        'dot_breaks': dot_breaks,
+        'use_alpha': use_alpha,
+    })
+    try:
+        tasks = [(i, min(i + chunk_size, len(targets)))
+                for i in range(0, len(targets), chunk_size)]
+        scores = np.empty((len(queries), len(targets)))
+        for start, chunk_scores in _map(_score_chunk, tasks, n_jobs):
+            scores[:, start:start + chunk_scores.shape[1]] = chunk_scores
+    finally:
+        _shared.clear()
+
+    if normalized:
+        scores /= np.array([self_score(q, smat, distance_breaks, dot_breaks,
+                use_alpha) for q in queries])[:, np.newaxis]
+
+    return scores
+
+
+def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
+        query_type='skeleton', target_type='skeleton', omit_failures=True,
+        normalized='raw', use_alpha=False, remove_target_duplicates=True,
+        min_nodes=500, min_soma_nodes=20, simplify=True, required_branches=10,
+        soma_tags=('soma', ), use_cache=True, reverse=False, top_n=0,
+        resample_by=1e3, use_http=False) -> Dict[str, Any]:
+    """Create NBLAST score for forward similarity from query objects to target
+    objects, using NumPy and SciPy instead of R. The parameters and the result
+    match nblast() in catmaid.control.nat.r, which allows NBLAST configurations
+    to select either back-end. If <use_cache> is set, dotprops are read from a
+    DotpropsCache if there is one for the respective object type that was
+    created with the same parameters. All other dotprops are computed from the
+    database. The <use_http> parameter is ignored.
+
+    Scores are computed in up to MAX_PARALLEL_ASYNC_WORKERS processes.
+    """
+    similarity = None
+    query_object_ids_in_use = None
+    target_object_ids_in_use = None
+    errors = []
+    try:
+        if not native_nblast_enabled:
+            raise ValueError("The native NBLAST back-end requires scipy")
+
+        config = NblastConfig.objects.get(project_id=project_id, pk=config_id)
+        n_jobs = settings.MAX_PARALLEL_ASYNC_WORKERS
+
+        # Indicate an all-by-all computation. This disabled <remove_target_duplicates>.
+        all_by_all = not query_object_ids and not target_object_ids and \
+                query_type == target_type
+        if all_by_all:
+            logger.debug('Disabling remove_target_duplicates option due to all-by-all computation')
+            remove_target_duplicates = False
+
+        from catmaid.control.similarity import get_all_object_ids
+        if all_by_all:
+            query_object_ids = get_all_object_ids(project_id, user_id,
+                    query_type, min_nodes, min_soma_nodes, soma_tags)
+            target_object_ids = query_object_ids
+        else:
+            if not query_object_ids:
+                query_object_ids = get_all_object_ids(project_id, user_id,
+                        query_type, min_nodes, min_soma_nodes, soma_tags)
+            if not target_object_ids:
+                target_object_ids = get_all_object_ids(project_id, user_id,
+                        target_type, min_nodes, min_soma_nodes, soma_tags)
+
+        if query_type == target_type and remove_target_duplicates:
+            target_object_ids = list(set(target_object_ids) - set(query_object_ids))
+
+        dotprops_params = {
+            'k': config.tangent_neighbors,
+            'resample': resample_by * nm_to_um,
+            'simplify': simplify,
+            'required_branches': required_branches,
+            'omit_failures': omit_failures,
+        }
+
+        query_cache, target_cache = None, None
+        if use_cache:
+            cache_params = {
+                'detail': required_branches if simplify else 0,
+                'tangent_neighbors': config.tangent_neighbors,
+                'resample': dotprops_params['resample'],
+            }
+            query_cache = DotpropsCache.open(project_id, query_type, **cache_params)
+            target_cache = query_cache if target_type == query_type else \
+                    DotpropsCache.open(project_id, target_type, **cache_params)
+
+        logger.debug(f'Computing dotprops for {len(query_object_ids)} query objects')
+        query_dps = get_dotprops(project_id, query_type, query_object_ids,
+                n_jobs, cache=query_cache, **dotprops_params)
+        if all_by_all:
+            target_dps = query_dps
+        else:
+            logger.debug(f'Computing dotprops for {len(target_object_ids)} target objects')
+            target_dps = get_dotprops(project_id, target_type,
+                    target_object_ids, n_jobs, cache=target_cache,
+                    **dotprops_params)
+
+        if not query_dps:
+            raise ValueError("No valid query objects found")
+
+        if not target_dps:
+            raise ValueError("No valid target objects found")
+
+        smat = np.array(config.scoring, dtype=np.float64)
+        distance_breaks = np.array(config.distance_breaks, dtype=np.float64)
+        dot_breaks = np.array(config.dot_breaks, dtype=np.float64)
+
+        logger.debug('Computing score (alpha: {a}, noramlized: {n}, reverse: {r}, top N: {tn})'.format(**{
+            'a': 'Yes' if use_alpha else 'No',
+            'n': 'No' if normalized == 'raw' else f'Yes ({normalized})',
+            'r': 'Yes' if reverse else 'No',
+            'tn': top_n if top_n else '-',
+        }))
+
+        query_ids, target_ids = list(query_dps.keys()), list(target_dps.keys())
+        if not reverse:
+            a, b = list(query_dps.values()), list(target_dps.values())
+        else:
+            a, b = list(target_dps.values()), list(query_dps.values())
+
+        score_params = {
+            'smat': smat,
+            'distance_breaks': distance_breaks,
+            'dot_breaks': dot_breaks,
+            'use_alpha': use_alpha,
+            'normalized': normalized != 'raw',
+            'n_jobs': n_jobs,
+        }
+
+        # Scores have one row per element of <a> and one column per element
+        # of <b>.
+        scores = score_all(a, b, **score_params)
+        if normalized in ('mean', 'geometric-mean'):
+            reverse_scores = score_all(b, a, **score_params).T
+            if normalized == 'mean':
+                scores = (scores + reverse_scores) / 2.0
+            else:
+                # Clamp negative scores to zero to not make negative forward
+                # and backward values become positive in the multiplication.
+                scores = np.sqrt(np.clip(scores, 0, None) *
+                        np.clip(reverse_scores, 0, None))
+
+        # Query objects are represented as rows.
+        if reverse:
+            scores = scores.T
+
+        if top_n and len(target_ids) > top_n:
+            # Only keep the top N scores of each query object. Columns are
+            # limited to targets that are in the top N of any query object,
+            # all other values are NaN.
+            top_idx = np.argsort(-scores, axis=1, kind='stable')[:, :top_n]
+            columns = list(dict.fromkeys(top_idx.flatten().tolist()))
+            top_scores = np.full((len(query_ids), len(columns)), np.nan)
+            column_index = {c: i for i, c in enumerate(columns)}
+            for row, row_top_idx in enumerate(top_idx):
+                for target_idx in row_top_idx:
+                    top_scores[row, column_index[target_idx]] = scores[row, target_idx]
+            scores = top_scores
+            target_ids = [target_ids[c] for c in columns]
+
+        similarity = scores.tolist()
+        query_object_ids_in_use = query_ids
+        target_object_ids_in_use = target_ids
+
+        logger.debug('NBLAST computation done')
+
+    except (IOError, OSError, ValueError) as e:
+        logger.exception(e)
+        errors.append(str(e))
+
+    return {
+        "errors": errors,
+        "similarity": similarity,
+        "query_object_ids": query_object_ids_in_use,
+        "target_object_ids": target_object_ids_in_use,
+    }
+
+
+def _histogram_chunk(task) -> np.ndarray:
+    """Entry point for worker processes to compute the joint histogram of
+    nearest neighbor distances and dot products for a list of object pairs.
+    """
+    pairs = task
+    objects = _shared['objects']
+    distance_breaks, dot_breaks = _shared['distance_breaks'], _shared['dot_breaks']
+    n_dist_bins, n_dot_bins = len(distance_breaks) - 1, len(dot_breaks) - 1
+
+    histogram = np.zeros(n_dist_bins * n_dot_bins, dtype=np.int64)
+    trees:Dict[int, Any] = {}
+    for query_idx, target_idx in pairs:
+        target = objects[target_idx]
+        target_tree = trees.get(target_idx)
+        if target_tree is None:
+            target_tree = trees[target_idx] = cKDTree(target.points)
+        distances, dotprods = nearest_neighbor_dotprods(objects[query_idx],
+                target, target_tree)
+        cells = bin_values(distances, distance_breaks) * n_dot_bins + \
+                bin_values(dotprods, dot_breaks)
+        histogram += np.bincount(cells, minlength=len(histogram))
+    return histogram.reshape(n_dist_bins, n_dot_bins)
+
+
+def compute_histogram(objects:List[Dotprops], pairs, distance_breaks,
+        dot_breaks, n_jobs=1, chunk_size=1000) -> np.ndarray:
+    """Compute the joint histogram of nearest neighbor distances (rows) and
+    absolute dot products (columns) for the passed in pairs of object indices.
+    """
+    _shared.update({
+        'objects': objects,
+        'distance_breaks': distance_breaks,
+        'dot_breaks': dot_breaks,
+    })
+    try:
+        # Sort pairs by target to reuse KD-trees within a chunk.
+        pairs = sorted(pairs, key=lambda p: p[1])
+        tasks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+        histogram = np.zeros((len(distance_breaks) - 1, len(dot_breaks) - 1),
+                dtype=np.int64)
+        for chunk_histogram in _map(_histogram_chunk, tasks, n_jobs):
+            histogram += chunk_histogram
+    finally:
+        _shared.clear()
+
+    return histogram
+
+
+def compute_scoring_matrix(project_id, user_id, matching_sample,
+        random_sample, distbreaks=NblastConfigDefaultDistanceBreaks,
+        dotbreaks=NblastConfigDefaultDotBreaks, resample_step=1000,
+        tangent_neighbors=5, omit_failures=True, resample_by=1e3,
+        use_http=False) -> Dict[str, Any]:
+    """Create an NBLAST scoring matrix for a set of matching objects and a set
+    of random skeletons, using NumPy and SciPy instead of R. The parameters and
+    the result match compute_scoring_matrix() in catmaid.control.nat.r.
+
+    Matching pairs are either all pairs of matching objects or the pairs
+    defined by the subsets of the matching sample. For the random sample, the
+    same number of random skeleton pairs is used. The score of each bin is
+    log2((match_prob + 1e-6) / (rand_prob + 1e-6)).
+    """
+    similarity = None
+    matching_histogram = None
+    random_histogram = None
+    matching_probability = None
+    random_probability = None
+    errors = []
+    try:
+        if not native_nblast_enabled:
+            raise ValueError("The native NBLAST back-end requires scipy")
+
+        n_jobs = settings.MAX_PARALLEL_ASYNC_WORKERS
+        distance_breaks = np.array(distbreaks, dtype=np.float64)
+        dot_breaks = np.array(dotbreaks, dtype=np.float64)
+        dotprops_params = {
+            'k': tangent_neighbors,
+            'resample': resample_by * nm_to_um,
+            'omit_failures': omit_failures,
+        }
+
+        # Matching objects are keyed by type (0: skeleton, 1: point set, 2:
+        # point cloud) and ID, like in subsets of the matching sample.
+        matching_dps:Dict[Tuple[int, int], Dotprops] = {}
+        for type_id, object_type, object_ids in (
+                (0, 'skeleton', matching_sample.sample_neurons),
+                (1, 'pointset', matching_sample.sample_pointsets),
+                (2, 'pointcloud', matching_sample.sample_pointclouds)):
+            if object_ids:
+                logger.debug(f'Computing dotprops for {len(object_ids)} matching objects of type {object_type}')
+                for object_id, dps in get_dotprops(project_id, object_type,
+                        object_ids, n_jobs, **dotprops_params).items():
+                    matching_dps[(type_id, object_id)] = dps
+
+        matching_keys = list(matching_dps.keys())
+        matching_index = {key: i for i, key in enumerate(matching_keys)}
+        if matching_sample.subset:
+            matching_pairs = []
+            for subset in matching_sample.subset:
+                indices = [matching_index.get((e[0], int(e[1])))
+                        for e in subset]
+                indices = [i for i in indices if i is not None]
+                matching_pairs.extend((a, b) for n, a in enumerate(indices)
+                        for b in indices[n + 1:])
+        else:
+            matching_pairs = [(a, b) for a in range(len(matching_keys))
+                    for b in range(len(matching_keys)) if a != b]
+
+        if not matching_pairs:
+            raise ValueError("No valid matching pairs found")
+
+        logger.debug(f'Computing dotprops for {len(random_sample.sample_neurons)} random skeletons')
+        random_dps = list(get_dotprops(project_id, 'skeleton',
+                random_sample.sample_neurons, n_jobs, **dotprops_params).values())
+        if len(random_dps) < 2:
+            raise ValueError("Need at least two valid random skeletons")
+
+        # Generate a random set of neuron pairs of same length as the matching set
+        rng = np.random.default_rng()
+        n_random = len(random_dps)
+        random_a = rng.integers(n_random, size=len(matching_pairs))
+        random_b = (random_a + rng.integers(1, n_random, size=len(random_a))) % n_random
+        random_pairs = list(zip(random_a.tolist(), random_b.tolist()))
+
+        logger.debug(f'Computing histogram of {len(matching_pairs)} matching pairs')
+        match_hist = compute_histogram(list(matching_dps.values()),
+                matching_pairs, distance_breaks, dot_breaks, n_jobs)
+
+        logger.debug(f'Computing histogram of {len(random_pairs)} random pairs')
+        rand_hist = compute_histogram(random_dps, random_pairs,
+                distance_breaks, dot_breaks, n_jobs)
+
+        match_prob = match_hist / match_hist.sum()
+        rand_prob = rand_hist / rand_hist.sum()
+
+        epsilon = 1e-6
+        smat = np.log2((match_prob + epsilon) / (rand_prob + epsilon))
+
+        similarity = smat.tolist()
+        matching_histogram = match_hist.tolist()
+        random_histogram = rand_hist.tolist()
+        matching_probability = match_prob.tolist()
+        random_probability = rand_prob.tolist()
+
+    except (IOError, OSError, ValueError) as e:
+        errors.append(str(e))
+
+    return {
+        "errors": errors,
+        "similarity": similarity,
+        "matching_histogram": matching_histogram,
+        "random_histogram": random_histogram,
+        "matching_probability": matching_probability,
+        "random_probability": random_probability
+    }
@@ -5,13 +5,18 @@ from aggdraw import Draw, Pen, Brush, Font
 from collections import defaultdict
 from concurrent import futures
 import copy
+from functools import partial
+from itertools import chain
 import json
 import math
 import msgpack
+import numpy as np
+import os
 from PIL import Image, ImageDraw
 import progressbar
 import psycopg2.extras
 import struct
+import time
 from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
 import ujson
 
@@ -29,8 +34,11 @@ from catmaid.models import (ClassInstance, UserRole, Treenode,
         ClassInstanceClassInstance, Review, Project)
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
-from catmaid.control.common import (batches, get_relation_to_id_map,
+from catmaid.control.common import (get_relation_to_id_map,
         get_request_bool, get_request_list)
+from catmaid.control.gridcache import (GRID_CACHE_UPDATE_CHANNEL, MISSING_CELL,
+        get_grid_cell_cache)
+from catmaid.control.tree_util import ArrayTree
 
 
 
@@ -40,6 +48,10 @@ ORIENTATIONS = {
     'zy': 2
 }
 
+# Node images with more nodes per pixel than this are rendered as density
+# heatmap, if the "auto" render mode is used.
+NODE_IMAGE_HEATMAP_DENSITY = 0.01
+
 class BasicNodeProvider(object):
 
     def __init__(self, *args, **kwargs):
@@ -252,6 +264,146 @@ def get_pack_array_header(n) -> bytes:
     raise ValueError("Array is too large")
 
 
+# The columnar binary node format consists of a sequence of blocks, each one
+# representing one node query result (or one LOD bucket of a cached result).
+# Because blocks are self-contained, they can be concatenated without decoding
+# them. Each block starts with a 16 byte little-endian header: a magic number
+# (4 bytes), the format version (uint16), flags (uint16, bit 0: node limit
+# reached), the number of treenodes N (uint32) and the length of the msgpack
+# encoded trailer (uint32). It is followed by these little-endian arrays:
+# treenode IDs (int64[N]), parent IDs (int64[N], -1 for root nodes), skeleton
+# IDs (int64[N]), edition times as epoch seconds (float64[N]), interleaved X, Y
+# and Z coordinates (float32[3N]), radii (float32[N]), user IDs (int32[N]) and
+# confidences (uint8[N]). Next is the msgpack encoded trailer [connectors,
+# labels, relation_map, extra_data], which contains all non-treenode data of
+# the result. Both the array section and the trailer are padded with zeros to
+# a multiple of 8 bytes, so that all arrays are aligned for typed array views.
+COLUMNAR_MAGIC = b'CMNB'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sHHII')
+COLUMNAR_FLAG_LIMIT_REACHED = 1
+
+
+def _columnar_padding(length) -> bytes:
+    return b'\x00' * (-length % 8)
+
+
+def is_node_result(data) -> bool:
+    """Whether the passed in data is a node query result, i.e. it has the form
+    [[treenodes], [connectors], {labels}, node_limit_reached, {relation_map}, ...].
+    """
+    return isinstance(data, (list, tuple)) and len(data) >= 5 and \
+            isinstance(data[2], dict) and isinstance(data[3], bool)
+
+
+def encode_columnar_block(result) -> bytes:
+    """Encode the treenodes and trailer data of a single node query result into
+    one block of the columnar node format. Nested node query results in the
+    extra data field are not included.
+    """
+    treenodes = result[0]
+    n_treenodes = len(treenodes)
+    extra_data = [e for e in result[5] if not is_node_result(e)] \
+            if len(result) > 5 else []
+    trailer = msgpack.packb([result[1], result[2], result[4], extra_data],
+            use_bin_type=True)
+    flags = COLUMNAR_FLAG_LIMIT_REACHED if result[3] else 0
+
+    parts = [COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, flags,
+            n_treenodes, len(trailer))]
+    if n_treenodes:
+        # [id, parent_id, x, y, z, confidence, radius, skeleton_id,
+        # edition_time, user_id]
+        cols = list(zip(*treenodes))
+        parts.extend([
+            np.array(cols[0], dtype='<i8').tobytes(),
+            np.array([-1 if p is None else p for p in cols[1]], dtype='<i8').tobytes(),
+            np.array(cols[7], dtype='<i8').tobytes(),
+            np.array(cols[8], dtype='<f8').tobytes(),
+            np.column_stack((cols[2], cols[3], cols[4])).astype('<f4').tobytes(),
+            np.array(cols[6], dtype='<f4').tobytes(),
+            np.array(cols[9], dtype='<i4').tobytes(),
+            np.array(cols[5], dtype='u1').tobytes(),
+        ])
+        parts.append(_columnar_padding(53 * n_treenodes))
+    parts.append(trailer)
+    parts.append(_columnar_padding(len(trailer)))
+
+    return b''.join(parts)
+
+
+def encode_columnar_node_data(result) -> bytes:
+    """Encode a node query result into the columnar node format. Node query
+    results that are part of the extra data field (index 5) are appended as
+    separate blocks.
+    """
+    blocks = [encode_columnar_block(result)]
+    if len(result) > 5:
+        for extra in result[5]:
+            if is_node_result(extra):
+                blocks.append(encode_columnar_node_data(extra))
+    return b''.join(blocks)
+
+
+def decode_columnar_node_data(data) -> List:
+    """Decode columnar node data into the regular list based node query result
+    format. The first block is the main result, all following blocks are added
+    as extra node query results.
+    """
+    data = memoryview(data)
+    results = []
+    offset = 0
+    while offset < len(data):
+        magic, version, flags, n, trailer_length = \
+                COLUMNAR_HEADER.unpack_from(data, offset)
+        if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+            raise ValueError("Unexpected columnar node data format")
+        offset += COLUMNAR_HEADER.size
+
+        treenodes:List = []
+        if n:
+            def read(dtype, count):
+                nonlocal offset
+                array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+                offset += array.nbytes
+                return array.tolist()
+            ids = read('<i8', n)
+            parent_ids = read('<i8', n)
+            skeleton_ids = read('<i8', n)
+            edition_times = read('<f8', n)
+            xyz = read('<f4', 3 * n)
+            radii = read('<f4', n)
+            user_ids = read('<i4', n)
+            confidences = read('u1', n)
+            offset += -offset % 8
+            treenodes = [[ids[i], None if parent_ids[i] == -1 else parent_ids[i],
+                    xyz[3*i], xyz[3*i + 1], xyz[3*i + 2], confidences[i],
+                    radii[i], skeleton_ids[i], edition_times[i], user_ids[i]]
+                    for i in range(n)]
+
+        connectors, labels, relation_map, extra_data = msgpack.unpackb(
+                bytes(data[offset:offset + trailer_length]), raw=False,
+                strict_map_key=False)
+        offset += trailer_length + (-trailer_length % 8)
+
+        result = [treenodes, connectors, labels,
+                bool(flags & COLUMNAR_FLAG_LIMIT_REACHED), relation_map]
+        if extra_data:
+            result.append(extra_data)
+        results.append(result)
+
+    if not results:
+        raise ValueError("No columnar node data found")
+
+    main_result = results[0]
+    if len(results) > 1:
+        if len(main_result) == 5:
+            main_result.append([])
+        main_result[5].extend(results[1:])
+
+    return main_result
+
+
 class GridCachedNodeProvider(CachedNodeProvider):
     """Find nodes in node grid caches.
     """
@@ -283,6 +435,14 @@ class GridCachedNodeProvider(CachedNodeProvider):
                 return target[0:-2] + ', ' + target_json[1:] + ']'
             else:
                 raise ValueError("Unexpected cached JSON text tuple format")
+        elif self.data_type == 'columnar':
+            # Columnar blocks can be concatenated as they are.
+            blocks = [target]
+            if encoded_extra_tuples:
+                blocks.extend(t for t in encoded_extra_tuples if t)
+            for det in decoded_extra_tuples:
+                blocks.append(encode_columnar_node_data(det))
+            return b''.join(blocks)
         elif self.data_type == 'msgpack':
             total_extra_tuples = len(decoded_extra_tuples)
             if encoded_extra_tuples:
@@ -313,6 +473,112 @@ class GridCachedNodeProvider(CachedNodeProvider):
         else:
             raise ValueError("Unexpected cached JSON tuple format")
 
+    # The maximum number of cells a query can cover to be answered by the
+    # process local grid cell cache. Larger queries read directly from the
+    # database to not flush the cache.
+    max_local_cache_cells = 1000
+
+    def get_closest_grid(self, local_cache, cursor, project_id, volume):
+        """Find the grid that has a cell configuration closest to the passed
+        in volume, based on the locally cached grid meta data of the project.
+        """
+        cache_key = ('grids', project_id)
+        generation = local_cache.generation
+        grids = local_cache.get(cache_key)
+        if grids is None:
+            cursor.execute("""
+                SELECT id, cell_width, cell_height, cell_depth, n_lod_levels
+                FROM node_grid_cache g
+                WHERE project_id = %(project_id)s
+                ORDER BY id
+            """, {
+                'project_id': project_id,
+            })
+            grids = cursor.fetchall()
+            local_cache.set(cache_key, grids, size=len(grids) * 40,
+                    generation=generation)
+
+        if not grids:
+            return None
+
+        return min(grids, key=lambda g: abs(
+                float(g[1]) * float(g[2]) * float(g[3]) - volume))
+
+    def get_cells(self, cursor, grid_id, min_w_i, min_h_i, min_d_i, max_w_i,
+            max_h_i, max_d_i, lod_min, lod_max, with_index=False) -> List:
+        """Return the LOD data of all cells in the passed in index range. If
+        <with_index> is true, each row will also contain the cell index.
+        """
+        cursor.execute("""
+            SELECT {data_type_column}[%(lod_min)s:%(lod_max)s]{index_columns}
+            FROM node_grid_cache_cell c
+            LEFT JOIN dirty_node_grid_cache_cell dc
+                -- Alternative: use ON dc.id = c.id and have update function
+                -- create ID entries in the dirty table.
+                ON dc.grid_id = c.grid_id
+                AND dc.x_index = c.x_index
+                AND dc.y_index = c.y_index
+                AND dc.z_index = c.z_index
+            WHERE c.grid_id = %(grid_id)s
+                AND c.x_index >= %(min_x_index)s AND c.x_index <= %(max_x_index)s
+                AND c.y_index >= %(min_y_index)s AND c.y_index <= %(max_y_index)s
+                AND c.z_index >= %(min_z_index)s AND c.z_index < %(max_z_index)s
+                AND {data_type_column} IS NOT NULL
+        """.format(**{
+            'data_type_column': self.data_type + '_data',
+            'index_columns': ', c.x_index, c.y_index, c.z_index' if with_index else '',
+        }), {
+            'grid_id': grid_id,
+            'min_x_index': min_w_i,
+            'min_y_index': min_h_i,
+            'min_z_index': min_d_i,
+            'max_x_index': max_w_i,
+            'max_y_index': max_h_i,
+            'max_z_index': max_d_i,
+            'lod_min': lod_min,
+            'lod_max': lod_max,
+        })
+        return cursor.fetchall()
+
+    def get_cached_cells(self, local_cache, cursor, grid_id, min_w_i, min_h_i,
+            min_d_i, max_w_i, max_h_i, max_d_i, lod_min, lod_max) -> List:
+        """Like get_cells(), but answer the query from the process local cell
+        cache, if possible. If any cell of the queried range is unknown, the
+        range is read from the database and all cells of it are stored in the
+        cache, including the ones that don't exist in the database.
+        """
+        cell_indices = [(w_i, h_i, d_i)
+                for d_i in range(min_d_i, max_d_i)
+                for h_i in range(min_h_i, max_h_i + 1)
+                for w_i in range(min_w_i, max_w_i + 1)]
+
+        cached_rows = []
+        for w_i, h_i, d_i in cell_indices:
+            value = local_cache.get((grid_id, w_i, h_i, d_i, lod_min, lod_max,
+                    self.data_type))
+            if value is None:
+                break
+            if value is not MISSING_CELL:
+                cached_rows.append((value,))
+        else:
+            return cached_rows
+
+        generation = local_cache.generation
+        rows = self.get_cells(cursor, grid_id, min_w_i, min_h_i, min_d_i,
+                max_w_i, max_h_i, max_d_i, lod_min, lod_max, with_index=True)
+        found = dict(((r[1], r[2], r[3]), r[0]) for r in rows)
+
+        result = []
+        for cell_index in cell_indices:
+            value = found.get(cell_index, MISSING_CELL)
+            local_cache.set((grid_id, cell_index[0], cell_index[1],
+                    cell_index[2], lod_min, lod_max, self.data_type), value,
+                    generation=generation)
+            if value is not MISSING_CELL:
+                result.append((value,))
+
+        return result
+
     def get_tuples(self, params, project_id, explicit_treenode_ids,
             explicit_connector_ids, include_labels, with_relation_map,
             with_origin) -> Tuple[Any, Optional[str]]:
@@ -323,16 +589,24 @@ class GridCachedNodeProvider(CachedNodeProvider):
 
         # For JSONB type cache, use ujson to decode, this is roughly 2x faster
         psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+
+        # If enabled, use the process local grid cell cache.
+        local_cache = get_grid_cell_cache()
+
         # Find grid that has a cell configuration closest to what we are looking for.
-        cursor.execute("""
-            SELECT id, cell_width, cell_height, cell_depth, n_lod_levels
-            FROM node_grid_cache g
-            WHERE project_id = %(project_id)s
-            ORDER BY @((g.cell_width::double precision * g.cell_height::double precision * g.cell_depth::double precision) - %(volume)s::double precision) ASC
-            LIMIT 1;
-        """, params)
+        if local_cache is not None:
+            grid_data = self.get_closest_grid(local_cache, cursor, project_id,
+                    params['volume'])
+        else:
+            cursor.execute("""
+                SELECT id, cell_width, cell_height, cell_depth, n_lod_levels
+                FROM node_grid_cache g
+                WHERE project_id = %(project_id)s
+                ORDER BY @((g.cell_width::double precision * g.cell_height::double precision * g.cell_depth::double precision) - %(volume)s::double precision) ASC
+                LIMIT 1;
+            """, params)
+            grid_data = cursor.fetchone()
 
-        grid_data = cursor.fetchone()
         if not grid_data:
             return None, None
 
@@ -374,42 +648,27 @@ class GridCachedNodeProvider(CachedNodeProvider):
         # Do the actual grid cell lookup in a separate query, to only use
         # constant values in the index checks. The Z index condition is slightly
         # special, because the parameter is exclusive
-        cursor.execute("""
-            SELECT {data_type_column}[%(lod_min)s:%(lod_max)s]
-            FROM node_grid_cache_cell c
-            LEFT JOIN dirty_node_grid_cache_cell dc
-                -- Alternative: use ON dc.id = c.id and have update function
-                -- create ID entries in the dirty table.
-                ON dc.grid_id = c.grid_id
-                AND dc.x_index = c.x_index
-                AND dc.y_index = c.y_index
-                AND dc.z_index = c.z_index
-            WHERE c.grid_id = %(grid_id)s
-                AND c.x_index >= %(min_x_index)s AND c.x_index <= %(max_x_index)s
-                AND c.y_index >= %(min_y_index)s AND c.y_index <= %(max_y_index)s
-                AND c.z_index >= %(min_z_index)s AND c.z_index < %(max_z_index)s
-                AND {data_type_column} IS NOT NULL
-        """.format(**{
-            'data_type_column': self.data_type + '_data',
-        }), {
-            'grid_id': grid_id,
-            'min_x_index': min_w_i,
-            'min_y_index': min_h_i,
-            'min_z_index': min_d_i,
-            'max_x_index': max_w_i,
-            'max_y_index': max_h_i,
-            'max_z_index': max_d_i,
-            'lod_min': lod_min,
-            'lod_max': lod_max,
-        })
-        rows = cursor.fetchall()
-
+        n_cells = (max_w_i - min_w_i + 1) * (max_h_i - min_h_i + 1) * \
+                max(0, max_d_i - min_d_i)
+        if local_cache is not None and n_cells <= self.max_local_cache_cells:
+            rows = self.get_cached_cells(local_cache, cursor, grid_id, min_w_i,
+                    min_h_i, min_d_i, max_w_i, max_h_i, max_d_i, lod_min, lod_max)
+        else:
+            rows = self.get_cells(cursor, grid_id, min_w_i, min_h_i, min_d_i,
+                    max_w_i, max_h_i, max_d_i, lod_min, lod_max)
 
         if rows and rows[0]:
             # It is the first LOD of the LOD set of the first result cell.
             first_cell_lods = rows[0][0]
             tuples = first_cell_lods[0]
 
+            # Cached JSON data is shared between requests and must therefore
+            # not be modified when extra tuples are added.
+            if local_cache is not None and self.data_type == 'json':
+                tuples = list(tuples)
+                if len(tuples) > 5:
+                    tuples[5] = list(tuples[5])
+
             # All extra LODs that are included are transmitted as extra tuples.
             extra_lod_cells = first_cell_lods[1:]
             encoded_extra_tuples = [r for r in extra_lod_cells if r]
@@ -455,6 +714,17 @@ class GridCachedMsgpackNodeProvider(GridCachedNodeProvider):
         else:
             return tuples, dt
 
+
+class GridCachedColumnarNodeProvider(GridCachedNodeProvider):
+    data_type = 'columnar'
+
+    def get_tuples(self, *args, **kwargs) -> Tuple[Any, Optional[str]]:
+        tuples, dt = super().get_tuples(*args, **kwargs)
+        if tuples:
+            return bytes(tuples), dt
+        else:
+            return tuples, dt
+
 class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
 
     CONNECTOR_STATEMENT_NAME = 'get_connectors_postgis'
@@ -1392,6 +1662,7 @@ AVAILABLE_NODE_PROVIDERS = {
     'cached_json_grid': GridCachedJsonNodeProvider,
     'cached_json_text_grid': GridCachedJsonTextNodeProvider,
     'cached_msgpack_grid': GridCachedMsgpackNodeProvider,
+    'cached_columnar_grid': GridCachedColumnarNodeProvider,
 }
 
 
@@ -1442,13 +1713,13 @@ def update_node_query_cache(node_providers=None, log=print, force=False) -> None
     if not node_providers:
         node_providers = get_node_provider_configs()
 
-    for np in node_providers:
-        log(f"Checking node provider {np}")
-        if type(np) in (list, tuple):
-            key = np[0]
-            options = np[1]
+    for provider_config in node_providers:
+        log(f"Checking node provider {provider_config}")
+        if type(provider_config) in (list, tuple):
+            key = provider_config[0]
+            options = provider_config[1]
         else:
-            key = np
+            key = provider_config
             options = {}
 
         project_id = options.get('project_id')
@@ -1760,22 +2031,403 @@ def update_cache(project_id, data_type, orientations, steps, node_limit=None,
             z += step
 
 
-def process_batch(cell_defs, project_id, grid_id, cell_width, cell_height,
-        cell_depth, params, allow_empty, lod_levels,
-        lod_bucket_size, lod_strategy, update_json_cache,
-        update_json_text_cache, update_msgpack_cache):
-    created_in_process = 0
-    processed = 0
-    for w_i, h_i, d_i in cell_defs:
-        added = update_grid_cell(project_id, grid_id, w_i,
-            h_i, d_i, cell_width, cell_height, cell_depth, params,
-            allow_empty, lod_levels, lod_bucket_size, lod_strategy,
-            update_json_cache, update_json_text_cache,
-            update_msgpack_cache)
+def _grid_box_filter(geom, left, right) -> str:
+    """Return the SQL condition used by Postgis3dNodeProvider to test whether a
+    geometry column intersects a box. The X range is given by the passed in
+    SQL expressions, all other bounds are expected as query parameters.
+    """
+    return f'''
+        {geom} &&& ST_MakeLine(ARRAY[
+            ST_MakePoint({left}, %(bottom)s, %(z2)s),
+            ST_MakePoint({right}, %(top)s, %(z1)s)] ::geometry[])
+        AND ST_3DDWithin({geom}, ST_MakePolygon(ST_MakeLine(ARRAY[
+            ST_MakePoint({left},  %(top)s,    %(halfz)s),
+            ST_MakePoint({right}, %(top)s,    %(halfz)s),
+            ST_MakePoint({right}, %(bottom)s, %(halfz)s),
+            ST_MakePoint({left},  %(bottom)s, %(halfz)s),
+            ST_MakePoint({left},  %(top)s,    %(halfz)s)]::geometry[])),
+            %(halfzdiff)s)
+    '''
+
+
+def can_query_grid_slabs(params) -> bool:
+    """Whether the node data of grid cells with the passed in query parameters
+    can be computed in bulk for whole slabs of cells. This isn't possible if
+    node limits, skeleton filters or orderings are used, because they are
+    applied to each cell individually.
+    """
+    return not any(params.get(p) for p in ('limit', 'n_largest_skeletons_limit',
+            'n_last_edited_skeletons_limit', 'hidden_last_editor_id',
+            'min_skeleton_length', 'min_skeleton_nodes', 'ordering'))
+
+
+def get_grid_slab_tuples(cursor, project_id, min_w_i, max_w_i, h_i, d_i,
+        cell_width, cell_height, cell_depth, id_to_relation) -> Dict[int, List]:
+    """Get the node list result tuples for a slab of grid cells, i.e. all cells
+    from <min_w_i> to <max_w_i> (inclusive) in row <h_i> and layer <d_i>. The
+    returned dictionary maps the X index of each cell to a result of the same
+    form and content as _node_list_tuples_query() returns for this cell with a
+    Postgis3dNodeProvider, labels and the used relation map. Nodes for all
+    cells are retrieved with a fixed number of queries. Which nodes belong to
+    which cell is decided with the same spatial tests as the per-cell query
+    uses and results are split into cells afterwards. Node limits and skeleton
+    filters aren't supported.
+    """
+    params = {
+        'project_id': project_id,
+        'min_w_i': min_w_i,
+        'max_w_i': max_w_i,
+        'cell_width': cell_width,
+        'left': min_w_i * cell_width,
+        'right': (max_w_i + 1) * cell_width,
+        'top': h_i * cell_height,
+        'bottom': (h_i + 1) * cell_height,
+        'z1': d_i * cell_depth,
+        'z2': (d_i + 1) * cell_depth,
+    }
+    params['halfz'] = params['z1'] + (params['z2'] - params['z1']) * 0.5
+    params['halfzdiff'] = abs(params['z2'] - params['z1']) * 0.5
+
+    cell_cte = '''
+        cell AS (
+            SELECT w_i, w_i * %(cell_width)s AS left_x,
+                (w_i + 1) * %(cell_width)s AS right_x
+            FROM generate_series(%(min_w_i)s, %(max_w_i)s) w_i
+        )
+    '''
+    slab_filter = partial(_grid_box_filter, left='%(left)s', right='%(right)s')
+    cell_filter = partial(_grid_box_filter, left='cell.left_x', right='cell.right_x')
+
+    # Find the cells of all treenodes of intersecting edges.
+    cursor.execute(f'''
+        WITH {cell_cte}, bb_edge AS (
+            SELECT te.id, te.parent_id, te.edge
+            FROM treenode_edge te
+            WHERE {slab_filter('te.edge')}
+            AND te.project_id = %(project_id)s
+        )
+        SELECT DISTINCT cell.w_i, node.id
+        FROM bb_edge
+        JOIN cell
+            ON {cell_filter('bb_edge.edge')}
+        CROSS JOIN LATERAL (VALUES (bb_edge.id), (bb_edge.parent_id)) node(id)
+        WHERE node.id IS NOT NULL
+    ''', params)
+    cell_treenodes:DefaultDict[int, List] = defaultdict(list)
+    for w_i, node_id in cursor.fetchall():
+        cell_treenodes[w_i].append(node_id)
+
+    # Find the cells of all intersecting connector links and connectors.
+    cursor.execute(f'''
+        WITH {cell_cte}, bb_tce AS (
+            SELECT tce.id, tce.edge
+            FROM treenode_connector_edge tce
+            WHERE {slab_filter('tce.edge')}
+            AND tce.project_id = %(project_id)s
+        ), bb_cg AS (
+            SELECT cg.id, cg.geom
+            FROM connector_geom cg
+            WHERE {slab_filter('cg.geom')}
+            AND cg.project_id = %(project_id)s
+        )
+        SELECT cell.w_i, bb_tce.id, TRUE
+        FROM bb_tce
+        JOIN cell
+            ON {cell_filter('bb_tce.edge')}
+        UNION ALL
+        SELECT cell.w_i, bb_cg.id, FALSE
+        FROM bb_cg
+        JOIN cell
+            ON {cell_filter('bb_cg.geom')}
+    ''', params)
+    cell_links:DefaultDict[int, List] = defaultdict(list)
+    cell_connectors:DefaultDict[int, List] = defaultdict(list)
+    for w_i, element_id, is_link in cursor.fetchall():
+        if is_link:
+            cell_links[w_i].append(element_id)
+        else:
+            cell_connectors[w_i].append(element_id)
+
+    # Get connector data for all links and connectors of the slab.
+    link_ids = list(set(l for links in cell_links.values() for l in links))
+    connector_ids = list(set(c for cs in cell_connectors.values() for c in cs))
+    link_rows:Dict[Any, Tuple] = {}
+    connector_rows:Dict[Any, Tuple] = {}
+    if link_ids or connector_ids:
+        cursor.execute('''
+            SELECT
+                c.id,
+                c.location_x,
+                c.location_y,
+                c.location_z,
+                c.confidence,
+                EXTRACT(EPOCH FROM c.edition_time),
+                c.user_id,
+                tc.treenode_id,
+                tc.relation_id,
+                tc.confidence,
+                EXTRACT(EPOCH FROM tc.edition_time),
+                tc.id
+            FROM UNNEST(%(link_ids)s::bigint[]) query_link(id)
+            JOIN treenode_connector tc
+                ON tc.id = query_link.id
+            JOIN connector c
+                ON c.id = tc.connector_id
+
+            UNION ALL
+
+            SELECT
+                c.id,
+                c.location_x,
+                c.location_y,
+                c.location_z,
+                c.confidence,
+                EXTRACT(EPOCH FROM c.edition_time),
+                c.user_id,
+                NULL,
+                NULL,
+                NULL,
+                NULL,
+                NULL
+            FROM UNNEST(%(connector_ids)s::bigint[]) query_connector(id)
+            JOIN connector c
+                ON c.id = query_connector.id
+        ''', {
+            'link_ids': link_ids,
+            'connector_ids': connector_ids,
+        })
+        for row in cursor.fetchall():
+            if row[11] is None:
+                connector_rows[row[0]] = row
+            else:
+                link_rows[row[11]] = row
+
+    # Get treenode data for all treenodes of the slab, including the ones
+    # linked to connectors.
+    treenode_ids = set(n for nodes in cell_treenodes.values() for n in nodes)
+    treenode_ids.update(row[7] for row in link_rows.values())
+    treenode_rows:Dict[Any, Tuple] = {}
+    if treenode_ids:
+        cursor.execute('''
+            SELECT
+                t1.id,
+                t1.parent_id,
+                t1.location_x,
+                t1.location_y,
+                t1.location_z,
+                t1.confidence,
+                t1.radius,
+                t1.skeleton_id,
+                EXTRACT(EPOCH FROM t1.edition_time),
+                t1.user_id
+            FROM UNNEST(%(treenode_ids)s::bigint[]) query_treenode(id)
+            JOIN treenode t1
+                ON t1.id = query_treenode.id
+        ''', {
+            'treenode_ids': list(treenode_ids),
+        })
+        treenode_rows = {row[0]: row for row in cursor.fetchall()}
+
+    top, bottom = params['top'], params['bottom']
+    z1, z2 = params['z1'], params['z2']
+
+    # Get labels of all treenodes and connectors that are visible in any cell
+    # of the slab.
+    visible_treenode_ids = [row[0] for row in treenode_rows.values()
+            if params['left'] <= row[2] < params['right'] and
+               top <= row[3] < bottom and z1 <= row[4] < z2]
+    visible_connector_ids = list(set(row[0] for row in
+            chain(link_rows.values(), connector_rows.values())
+            if z1 <= row[3] < z2))
+    slab_labels:DefaultDict[Any, List] = defaultdict(list)
+    if visible_treenode_ids or visible_connector_ids:
+        cursor.execute('''
+            SELECT tci.treenode_id, ci.name
+            FROM UNNEST(%(treenode_ids)s::bigint[]) query_treenode(id)
+            JOIN treenode_class_instance tci
+                ON tci.treenode_id = query_treenode.id
+            JOIN class_instance ci
+                ON ci.id = tci.class_instance_id
+            WHERE tci.relation_id = %(labeled_as)s
+
+            UNION ALL
+
+            SELECT cci.connector_id, ci.name
+            FROM UNNEST(%(connector_ids)s::bigint[]) query_connector(id)
+            JOIN connector_class_instance cci
+                ON cci.connector_id = query_connector.id
+            JOIN class_instance ci
+                ON ci.id = cci.class_instance_id
+            WHERE cci.relation_id = %(labeled_as)s
+        ''', {
+            'treenode_ids': visible_treenode_ids,
+            'connector_ids': visible_connector_ids,
+            'labeled_as': {v: k for k, v in id_to_relation.items()}['labeled_as'],
+        })
+        for node_id, name in cursor.fetchall():
+            slab_labels[node_id].append(name)
+
+    results:Dict[int, List] = {}
+    for w_i in range(min_w_i, max_w_i + 1):
+        left = w_i * cell_width
+        right = (w_i + 1) * cell_width
+
+        # Collect connectors and their links like _node_list_tuples_query().
+        connectors = []
+        seen_connector_ids:Set = set()
+        links:DefaultDict[Any, List] = defaultdict(list)
+        used_relations = set()
+        missing_treenode_ids = set()
+        crows = chain((link_rows[l] for l in cell_links.get(w_i, [])),
+                (connector_rows[c] for c in cell_connectors.get(w_i, [])))
+        for row in crows:
+            cid = row[0]
+            if row[7] is not None:
+                missing_treenode_ids.add(row[7])
+                links[cid].append(row[7:12])
+                used_relations.add(row[8])
+            if cid not in seen_connector_ids:
+                connectors.append(row[0:7] + (links[cid],))
+                seen_connector_ids.add(cid)
+
+        cell_treenode_ids = set(cell_treenodes.get(w_i, []))
+        cell_treenode_ids.update(missing_treenode_ids)
+        treenodes = [treenode_rows[n] for n in cell_treenode_ids
+                if n in treenode_rows]
+
+        labels:DefaultDict[Any, List] = defaultdict(list)
+        for row in treenodes:
+            if left <= row[2] < right and top <= row[3] < bottom and \
+                    z1 <= row[4] < z2 and row[0] in slab_labels:
+                labels[row[0]].extend(slab_labels[row[0]])
+        for row in connectors:
+            if z1 <= row[3] < z2 and row[0] in slab_labels:
+                labels[row[0]].extend(slab_labels[row[0]])
+
+        results[w_i] = [treenodes, connectors, labels, False,
+                {r: id_to_relation[r] for r in used_relations}]
+
+    return results
+
+
+def process_slab(slab, project_id, grid_id, cell_width, cell_height,
+        cell_depth, params, allow_empty, lod_levels, lod_bucket_size,
+        lod_strategy, update_json_cache, update_json_text_cache,
+        update_msgpack_cache, update_columnar_cache=False, bulk=True,
+        provider=None) -> Tuple[int, int, int]:
+    """Compute and store all cells of a slab, a tuple of the form (min_w_i,
+    max_w_i, h_i, d_i). If <bulk> is true, the data of all cells is queried at
+    once, otherwise each cell is queried individually. Returns a tuple with the
+    number of processed cells, created cells and stored nodes.
+    """
+    min_w_i, max_w_i, h_i, d_i = slab
+    cursor = connection.cursor()
+    processed, created, n_nodes = 0, 0, 0
+
+    if bulk:
+        cursor.execute('''
+            SELECT id, relation_name FROM relation WHERE project_id = %(project_id)s
+        ''', {
+            'project_id': project_id,
+        })
+        id_to_relation = dict(cursor.fetchall())
+        cell_tuples = get_grid_slab_tuples(cursor, project_id, min_w_i,
+                max_w_i, h_i, d_i, cell_width, cell_height, cell_depth,
+                id_to_relation)
+    else:
+        provider = provider or Postgis3dNodeProvider()
+
+    for w_i in range(min_w_i, max_w_i + 1):
+        if bulk:
+            result_tuple = cell_tuples[w_i]
+        else:
+            set_grid_cell_bounds(params, w_i, h_i, d_i, cell_width,
+                    cell_height, cell_depth)
+            result_tuple = _node_list_tuples_query(params, project_id, provider,
+                    include_labels=True)
+        added = store_grid_cell(cursor, grid_id, w_i, h_i, d_i, result_tuple,
+                allow_empty, lod_levels, lod_bucket_size, lod_strategy,
+                update_json_cache, update_json_text_cache, update_msgpack_cache,
+                update_columnar_cache, notify=False)
         processed += 1
         if added:
-            created_in_process += 1
-    return processed, created_in_process
+            created += 1
+            n_nodes += len(result_tuple[0]) + len(result_tuple[1])
+
+    return processed, created, n_nodes
+
+
+class GridCacheCheckpoint(object):
+    """A persistent record of grid cache slabs that have been computed. Each
+    completed slab is appended as a line "<grid_id> <min_w_i> <max_w_i> <h_i>
+    <d_i>" to a plain text file, which allows an interrupted grid cache update
+    to skip slabs that are already done when it is started again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Map (grid_id, h_i, d_i) to a list of completed (min_w_i, max_w_i)
+        # ranges.
+        self.completed:DefaultDict[Tuple, List[Tuple[int, int]]] = defaultdict(list)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 5:
+                        # Ignore incomplete lines from interrupted writes
+                        continue
+                    grid_id, min_w_i, max_w_i, h_i, d_i = map(int, fields)
+                    self.completed[(grid_id, h_i, d_i)].append((min_w_i, max_w_i))
+        self._file = open(path, 'a')
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self.completed.values())
+
+    def is_done(self, grid_id, slab) -> bool:
+        min_w_i, max_w_i, h_i, d_i = slab
+        ranges = self.completed.get((grid_id, h_i, d_i))
+        if not ranges:
+            return False
+        return all(any(r[0] <= w_i <= r[1] for r in ranges)
+                for w_i in range(min_w_i, max_w_i + 1))
+
+    def mark_done(self, grid_id, slab) -> None:
+        min_w_i, max_w_i, h_i, d_i = slab
+        self.completed[(grid_id, h_i, d_i)].append((min_w_i, max_w_i))
+        self._file.write(f'{grid_id} {min_w_i} {max_w_i} {h_i} {d_i}\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class GridCacheThroughput(object):
+    """Keep track of the number of processed cells and nodes of a grid cache
+    update and report the throughput in regular intervals.
+    """
+
+    def __init__(self, log, interval=60):
+        self.log = log
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.n_cells = 0
+        self.n_nodes = 0
+
+    def add(self, n_cells, n_nodes) -> None:
+        self.n_cells += n_cells
+        self.n_nodes += n_nodes
+        now = time.time()
+        if self.interval and now - self.last_report >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        now = time.time()
+        self.last_report = now
+        elapsed = max(now - self.start, 1e-6)
+        self.log(f' -> Processed {self.n_cells} cells ({self.n_cells / elapsed:.1f} cells/s) '
+                f'and {self.n_nodes} nodes ({self.n_nodes / elapsed:.1f} nodes/s) '
+                f'in {elapsed:.1f}s')
 
 
 def update_grid_cache(project_id, data_type, orientations,
@@ -1787,9 +2439,18 @@ def update_grid_cache(project_id, data_type, orientations,
         delete=False, bb_limits=None, log=print, progress=True,
         allow_empty=False, lod_levels=1, lod_bucket_size=500,
         lod_strategy='quadratic', jobs=1, depth_steps=1, chunksize=10,
-        ordering=None) -> None:
-    if data_type not in ('json', 'json_text', 'msgpack'):
-        raise ValueError('Type must be one of: json, json_text, msgpack')
+        ordering=None, checkpoint=None, bulk=True,
+        throughput_interval=60) -> None:
+    """Compute the grid cache cells of a project. Cells are processed in
+    slabs of up to <chunksize> consecutive cells along the X axis. Unless
+    <bulk> is false or node limits, skeleton filters or an ordering are used,
+    all cells of a slab are queried at once. If a <checkpoint> file path is
+    provided, completed slabs are recorded in it and skipped when the same
+    update is run again. Throughput is logged every <throughput_interval>
+    seconds.
+    """
+    if data_type not in ('json', 'json_text', 'msgpack', 'columnar'):
+        raise ValueError('Type must be one of: json, json_text, msgpack, columnar')
     if project_id is None:
         raise ValueError('Need project ID')
     if not cell_width:
@@ -1867,10 +2528,23 @@ def update_grid_cache(project_id, data_type, orientations,
     update_json_cache = 'json' in data_types
     update_json_text_cache = 'json_text' in data_types
     update_msgpack_cache = 'msgpack' in data_types
+    update_columnar_cache = 'columnar' in data_types
 
     provider = Postgis3dNodeProvider()
     types = ', '.join(data_types)
 
+    bulk = bulk and can_query_grid_slabs(params)
+    if bulk:
+        log(f' -> Querying up to {chunksize} cells at once')
+    else:
+        log(' -> Querying cells individually')
+
+    if checkpoint:
+        checkpoint = GridCacheCheckpoint(checkpoint)
+        log(f' -> Resuming from checkpoint with {len(checkpoint)} completed slabs')
+
+    throughput = GridCacheThroughput(log, throughput_interval)
+
     executor = futures.ProcessPoolExecutor(jobs)
 
     for o in orientations:
@@ -1898,7 +2572,7 @@ def update_grid_cache(project_id, data_type, orientations,
         })
         grid_ids = cursor.fetchall()
         if grid_ids:
-            grid_id = grid_ids[0]
+            grid_id = grid_ids[0][0]
         else:
             cursor.execute("""
                 INSERT INTO node_grid_cache (project_id, orientation,
@@ -1906,13 +2580,13 @@ def update_grid_cache(project_id, data_type, orientations,
                     n_last_edited_skeletons_limit, hidden_last_editor_id,
                     n_lod_levels, lod_min_bucket_size, lod_strategy, allow_empty,
                     has_json_data, has_json_text_data, has_msgpack_data,
-                    ordering)
+                    has_columnar_data, ordering)
                 VALUES (%(project_id)s, %(orientation)s, %(cell_width)s,
                     %(cell_height)s, %(cell_depth)s, %(n_largest_sk_limit)s,
                     %(n_last_edit_limit)s, %(hidden_last_editor_id)s,
                     %(n_lod_levels)s, %(lod_min_bucket_size)s, %(lod_strategy)s,
                     %(allow_empty)s, %(has_json_data)s, %(has_json_text_data)s,
-                    %(has_msgpack_data)s, %(ordering)s)
+                    %(has_msgpack_data)s, %(has_columnar_data)s, %(ordering)s)
                 RETURNING id;
             """, {
                 'project_id': project_id,
@@ -1930,6 +2604,7 @@ def update_grid_cache(project_id, data_type, orientations,
                 'has_json_data': update_json_cache,
                 'has_json_text_data': update_json_text_cache,
                 'has_msgpack_data': update_msgpack_cache,
+                'has_columnar_data': update_columnar_cache,
                 'ordering': ordering,
             })
             grid_id = cursor.fetchone()[0]
@@ -2021,60 +2696,81 @@ def update_grid_cache(project_id, data_type, orientations,
                     counter += n_ignored_global_cells
                     bar.update(counter)
 
-            def iterate_space():
-                """A generator to iterate the local cell space."""
+            def iterate_slabs():
+                """A generator to iterate the local cell space in slabs of up
+                to <chunksize> cells along the X axis."""
                 for d_i in range(local_min_d_i, local_max_d_i + 1):
                     for h_i in range(local_min_h_i, local_max_h_i + 1):
-                        for w_i in range(local_min_w_i, local_max_w_i + 1):
-                            yield w_i, h_i, d_i
+                        for w_i in range(local_min_w_i, local_max_w_i + 1, chunksize):
+                            yield (w_i, min(w_i + chunksize - 1, local_max_w_i),
+                                    h_i, d_i)
+
+            def slab_done(slab, result):
+                nonlocal counter, created
+                if checkpoint:
+                    checkpoint.mark_done(grid_id, slab)
+                if progress:
+                    counter += result[0]
+                    bar.update(counter)
+                created += result[1]
+                throughput.add(result[0], result[2])
+
+            slabs = []
+            for slab in iterate_slabs():
+                if checkpoint and checkpoint.is_done(grid_id, slab):
+                    if progress:
+                        counter += slab[1] - slab[0] + 1
+                        bar.update(counter)
+                    continue
+                slabs.append(slab)
 
             if jobs > 1:
                 # We need to close all database connections to not accidentally
                 # share the file descriptors of current connections with forks.
                 connections.close_all()
 
-                tasks = [executor.submit(process_batch, cell_defs, project_id,
+                tasks = {executor.submit(process_slab, slab, project_id,
                         grid_id, cell_width, cell_height, cell_depth, params,
                         allow_empty, lod_levels, lod_bucket_size, lod_strategy,
                         update_json_cache, update_json_text_cache,
-                        update_msgpack_cache)
-                    for cell_defs in batches(iterate_space(), chunksize)]
+                        update_msgpack_cache, update_columnar_cache, bulk): slab
+                    for slab in slabs}
 
                 for future in futures.as_completed(tasks):
-                    result = future.result()
-                    if progress:
-                        counter += result[0]
-                        bar.update(counter)
-                    created += result[1]
+                    slab_done(tasks[future], future.result())
             else:
-                for w_i, h_i, d_i in iterate_space():
-                    if progress:
-                        counter += 1
-                        bar.update(counter)
-
-                    added = update_grid_cell(project_id, grid_id, w_i, h_i, d_i,
-                            cell_width, cell_height, cell_depth, provider,
-                            params, allow_empty, lod_levels, lod_bucket_size,
+                for slab in slabs:
+                    slab_done(slab, process_slab(slab, project_id, grid_id,
+                            cell_width, cell_height, cell_depth, params,
+                            allow_empty, lod_levels, lod_bucket_size,
                             lod_strategy, update_json_cache,
-                            update_json_text_cache, update_msgpack_cache, cursor)
-                    if added:
-                        created += 1
+                            update_json_text_cache, update_msgpack_cache,
+                            update_columnar_cache, bulk, provider))
+
+        # Let process local caches know about the changed grid as a whole,
+        # rather than emitting an event for every single cell.
+        notify_grid_cache_update(connection.cursor(), grid_id)
 
         log(f' -> Materialized {created} grid cells')
+        throughput.report()
         if progress:
             bar.finish()
 
+    if checkpoint:
+        checkpoint.close()
+
 
 def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
         cell_height, cell_depth, params, allow_empty, lod_levels,
         lod_bucket_size, lod_strategy, update_json_cache,
-        update_json_text_cache, update_msgpack_cache, provider=None, cursor=None) -> bool:
-    params['left'] = w_i * cell_width
-    params['right'] = (w_i + 1) * cell_width
-    params['top'] = h_i * cell_height
-    params['bottom'] = (h_i + 1) * cell_width
-    params['z1'] = d_i * cell_depth
-    params['z2'] = (d_i + 1) * cell_depth
+        update_json_text_cache, update_msgpack_cache, provider=None,
+        cursor=None, notify=True, update_columnar_cache=False) -> bool:
+    """Recompute a single grid cell and store it in the enabled data types.
+    Unless <notify> is false, a "catmaid.grid-cache-update" event is emitted
+    for the cell, which allows process local caches to evict their copy.
+    """
+    set_grid_cell_bounds(params, w_i, h_i, d_i, cell_width, cell_height,
+            cell_depth)
 
     if not provider:
         provider = Postgis3dNodeProvider()
@@ -2085,6 +2781,31 @@ def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
     result_tuple = _node_list_tuples_query(params, project_id, provider,
             include_labels=True)
 
+    return store_grid_cell(cursor, grid_id, w_i, h_i, d_i, result_tuple,
+            allow_empty, lod_levels, lod_bucket_size, lod_strategy,
+            update_json_cache, update_json_text_cache, update_msgpack_cache,
+            update_columnar_cache, notify)
+
+
+def set_grid_cell_bounds(params, w_i, h_i, d_i, cell_width, cell_height,
+        cell_depth) -> None:
+    """Set the bounding box of the passed in grid cell in <params>."""
+    params['left'] = w_i * cell_width
+    params['right'] = (w_i + 1) * cell_width
+    params['top'] = h_i * cell_height
+    params['bottom'] = (h_i + 1) * cell_height
+    params['z1'] = d_i * cell_depth
+    params['z2'] = (d_i + 1) * cell_depth
+
+
+def store_grid_cell(cursor, grid_id, w_i, h_i, d_i, result_tuple, allow_empty,
+        lod_levels, lod_bucket_size, lod_strategy, update_json_cache,
+        update_json_text_cache, update_msgpack_cache,
+        update_columnar_cache=False, notify=True) -> bool:
+    """Store the passed in node query result for a single grid cell in the
+    enabled data types. Returns whether the cell was stored, which isn't the
+    case for empty cells, unless <allow_empty> is true.
+    """
     if not (allow_empty or result_tuple[0] or result_tuple[1]):
         return False
 
@@ -2139,9 +2860,48 @@ def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
             'data':  [None if not v else psycopg2.Binary(msgpack.packb(v)) for v in result_buckets],
         })
 
+    if update_columnar_cache:
+        cursor.execute("""
+            INSERT INTO node_grid_cache_cell (grid_id,
+                x_index, y_index, z_index, update_time, columnar_data)
+            VALUES (%(grid_id)s, %(x_index)s, %(y_index)s, %(z_index)s,
+                now(), %(data)s)
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET columnar_data = EXCLUDED.columnar_data, update_time = EXCLUDED.update_time;
+        """, {
+            'grid_id': grid_id,
+            'x_index': w_i,
+            'y_index': h_i,
+            'z_index': d_i,
+            'data':  [None if not v else psycopg2.Binary(encode_columnar_block(v)) for v in result_buckets],
+        })
+
+    if notify:
+        notify_grid_cache_update(cursor, grid_id, w_i, h_i, d_i)
+
     return True
 
 
+def notify_grid_cache_update(cursor, grid_id=None, w_i=None, h_i=None, d_i=None) -> None:
+    """Emit a "catmaid.grid-cache-update" event for a single cell, a whole grid
+    (if no cell index is provided) or all grids (if no grid ID is provided).
+    Postgres delivers the event only once the current transaction commits.
+    """
+    payload:Dict[str, Any] = {}
+    if grid_id is not None:
+        payload['grid_id'] = grid_id
+        if w_i is not None and h_i is not None and d_i is not None:
+            payload['x'] = w_i
+            payload['y'] = h_i
+            payload['z'] = d_i
+    cursor.execute("""
+        SELECT pg_notify(%(channel)s, %(payload)s)
+    """, {
+        'channel': GRID_CACHE_UPDATE_CHANNEL,
+        'payload': json.dumps(payload),
+    })
+
+
 def prepare_db_statements(connection) -> None:
     node_providers = get_configured_node_providers(get_node_provider_configs(), connection)
     for node_provider in node_providers:
@@ -2249,9 +3009,30 @@ def node_list_tuples(request:HttpRequest, project_id=None, provider=None) -> Htt
       paramType: form
     - name: format
       description: |
-        Either "json" (default) or "msgpack", optional.
+        Either "json" (default), "msgpack", "columnar", "png" or "gif",
+        optional. The "columnar" format is a binary format that stores
+        treenodes as typed little-endian arrays, see
+        catmaid.control.node.encode_columnar_block for details.
+      required: false
+      type: string
+      paramType: form
+    - name: render_mode
+      description: |
+        Only used with the "png" and "gif" formats. Either "nodes", which draws
+        nodes and edges, "heatmap", which draws a node density map, or "auto"
+        (default), which draws a heatmap if the view contains more nodes than
+        can be drawn meaningfully.
       required: false
       type: string
+      defaultValue: auto
+      paramType: form
+    - name: render_edges
+      description: |
+        Only used with the "png" and "gif" formats. Whether edges should be
+        drawn in "nodes" render mode.
+      required: false
+      type: boolean
+      defaultValue: true
       paramType: form
     - name: with_relation_map
       description: |
@@ -2336,6 +3117,8 @@ def node_list_tuples(request:HttpRequest, project_id=None, provider=None) -> Htt
     target_options = {
         'view_width': int(data.get('view_width', 1000)),
         'view_height': int(data.get('view_height', 1000)),
+        'render_mode': data.get('render_mode', 'auto'),
+        'render_edges': get_request_bool(data, 'render_edges', True),
     }
     override_provider = data.get('src')
     with_relation_map = data.get('with_relation_map', 'used')
@@ -2580,6 +3363,8 @@ def create_node_response(result, params, target_format, target_options, data_typ
             data = result
         elif data_type == 'msgpack':
             data = ujson.dumps(msgpack.unpackb(result, use_list=False))
+        elif data_type == 'columnar':
+            data = ujson.dumps(decode_columnar_node_data(result))
         else:
             raise ValueError(f"Unknown data type: {data_type}")
         return HttpResponse(data, content_type='application/json')
@@ -2590,6 +3375,21 @@ def create_node_response(result, params, target_format, target_options, data_typ
             data = msgpack.packb(ujson.loads(result))
         elif data_type == 'msgpack':
             data = result
+        elif data_type == 'columnar':
+            data = msgpack.packb(decode_columnar_node_data(result))
+        else:
+            raise ValueError(f"Unknown data type: {data_type}")
+        return HttpResponse(data, content_type='application/octet-stream')
+    elif target_format == 'columnar':
+        if data_type == 'json':
+            data = encode_columnar_node_data(result)
+        elif data_type == 'json_text':
+            data = encode_columnar_node_data(ujson.loads(result))
+        elif data_type == 'msgpack':
+            data = encode_columnar_node_data(msgpack.unpackb(result,
+                    raw=False, strict_map_key=False))
+        elif data_type == 'columnar':
+            data = result
         else:
             raise ValueError(f"Unknown data type: {data_type}")
         return HttpResponse(data, content_type='application/octet-stream')
@@ -2600,6 +3400,8 @@ def create_node_response(result, params, target_format, target_options, data_typ
             data = ujson.loads(result)
         elif data_type == 'msgpack':
             data = msgpack.unpackb(result, use_list=False)
+        elif data_type == 'columnar':
+            data = decode_columnar_node_data(result)
         else:
             raise ValueError(f"Unknown data type: {data_type}")
         width = target_options['view_width']
@@ -2609,7 +3411,8 @@ def create_node_response(result, params, target_format, target_options, data_typ
         xscale = width / (params['right'] - params['left'])
         yscale = height / (params['bottom'] - params['top'])
         image = render_nodes_xy(data, params, width, height, view_min_x,
-                view_min_y, xscale, yscale)
+                view_min_y, xscale, yscale, target_options.get('render_mode', 'auto'),
+                target_options.get('render_edges', True))
         # serialize to HTTP response
         if target_format == 'png':
             response = HttpResponse(content_type="image/png")
@@ -2621,89 +3424,154 @@ def create_node_response(result, params, target_format, target_options, data_typ
     else:
         raise ValueError(f"Unknown target format: {target_format}")
 
+def project_nodes_xy(node_data, params, view_min_x=0, view_min_y=0,
+        xscale=1.0, yscale=1.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute the screen coordinates of all treenodes in <node_data> that
+    intersect the view defined by <params> in bulk. Besides nodes in the view,
+    virtual nodes are created where an edge crosses the Z plane z1 without
+    either of its nodes being in the [z1, z2) section. Edges are clipped to the
+    section. Returned is a tuple of an Nx2 array of node screen coordinates, a
+    boolean array of length N that marks root nodes and an Mx4 array of edges
+    (x1, y1, x2, y2) in screen coordinates.
+    """
+    left, right = params['left'], params['right']
+    top, bottom = params['top'], params['bottom']
+    z1, z2 = params['z1'], params['z2']
+
+    treenodes = node_data[0]
+    n = len(treenodes)
+    parent_ids = np.fromiter((-1 if tn[1] is None else tn[1] for tn in treenodes),
+            dtype=np.int64, count=n)
+    tree = ArrayTree(np.fromiter((tn[0] for tn in treenodes), dtype=np.int64,
+            count=n), parent_ids, np.array([tn[2:5] for tn in treenodes],
+            dtype=np.float64).reshape(-1, 3))
+    loc = tree.locations
+
+    def in_view(x, y):
+        return (x >= left) & (x < right) & (y >= top) & (y < bottom)
+
+    in_section = (loc[:, 2] >= z1) & (loc[:, 2] < z2)
+    visible = in_section & in_view(loc[:, 0], loc[:, 1])
+
+    # Edges between nodes and their parents, if the parent is part of the data.
+    child_idx = np.flatnonzero(tree.parents != -1)
+    parent_idx = tree.parents[child_idx]
+    a, b = loc[child_idx], loc[parent_idx]
+    d = b - a
+
+    # Virtual nodes for edges crossing z1 without a node in the section.
+    crossing = ~in_section[child_idx] & ~in_section[parent_idx] & \
+            ((a[:, 2] - z1) * (b[:, 2] - z1) < 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (z1 - a[crossing, 2]) / d[crossing, 2]
+    virtual = a[crossing, :2] + t[:, np.newaxis] * d[crossing, :2]
+    virtual = virtual[in_view(virtual[:, 0], virtual[:, 1])]
+
+    points = np.concatenate((loc[visible, :2], virtual))
+    is_root = np.concatenate((parent_ids[visible] == -1,
+            np.zeros(len(virtual), dtype=bool)))
+
+    # Clip edges to the section by intersecting their parameter ranges with the
+    # range in which they are between z1 and z2.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (z1 - a[:, 2]) / d[:, 2]
+        t2 = (z2 - a[:, 2]) / d[:, 2]
+    flat = d[:, 2] == 0
+    t_min = np.where(flat, 0.0, np.maximum(0.0, np.minimum(t1, t2)))
+    t_max = np.where(flat, np.where(in_section[child_idx], 1.0, -1.0),
+            np.minimum(1.0, np.maximum(t1, t2)))
+    keep = t_min <= t_max
+    start = a[keep, :2] + t_min[keep, np.newaxis] * d[keep, :2]
+    end = a[keep, :2] + t_max[keep, np.newaxis] * d[keep, :2]
+    edges = np.hstack((start, end))
+
+    # Remove edges that are entirely outside of the view.
+    edges = edges[(np.maximum(edges[:, 0], edges[:, 2]) >= left) &
+            (np.minimum(edges[:, 0], edges[:, 2]) < right) &
+            (np.maximum(edges[:, 1], edges[:, 3]) >= top) &
+            (np.minimum(edges[:, 1], edges[:, 3]) < bottom)]
+
+    offset = np.array([view_min_x, view_min_y])
+    scale = np.array([xscale, yscale])
+    points = (points - offset) * scale
+    edges = (edges - np.tile(offset, 2)) * np.tile(scale, 2)
+
+    return points, is_root, edges
+
 def render_nodes_xy(node_data, params, width, height, view_min_x=0, view_min_y=0,
-        xscale=1.0, yscale=1.0) -> Image:
-    """Render the passed in node data to an image.
+        xscale=1.0, yscale=1.0, mode='auto', with_edges=True) -> Image:
+    """Render the passed in node data to an image. In "nodes" mode, nodes and
+    optionally edges are drawn. In "heatmap" mode, a density map of the nodes
+    in view is rendered. In "auto" mode, a heatmap is rendered if there are
+    more than NODE_IMAGE_HEATMAP_DENSITY nodes per pixel, which is typically
+    the case for zoomed out views.
     """
-    import random
+    if mode not in ('auto', 'nodes', 'heatmap'):
+        raise ValueError(f"Unknown render mode: {mode}")
+
+    points, is_root, edges = project_nodes_xy(node_data, params, view_min_x,
+            view_min_y, xscale, yscale)
+
+    if mode == 'heatmap' or (mode == 'auto' and
+            len(points) > NODE_IMAGE_HEATMAP_DENSITY * width * height):
+        return render_node_heatmap(points, width, height)
+
     background = (255, 0, 0, 0)
     image = Image.new('RGBA', (width, height), background)
 
     radius = 4
     hr = radius / 2.0
+    edge_pen = Pen((255, 0, 255), 1)
     node_pen = Pen((255, 0, 255), 1)
     root_pen = Pen('red', 1)
-    # leaf_pen = Pen('red', 1)
     node_brush = Brush((255, 0, 255))
     root_brush = Brush('red')
-    # leaf_brush = Brush('red')
-
-    virtual_nodes = True
-
-    left, right = params['left'], params['right']
-    top, bottom = params['top'], params['bottom']
-    z1, z2 = params['z1'], params['z2']
-
-    # Map parents to children
-    nodes = dict()
-    treenodes = node_data[0]
-    for tn in treenodes:
-        nodes[tn[0]] = tn
 
     draw = Draw(image)
-    # Add treenodes:
-    for tn in treenodes:
-        parent_id = tn[1]
-        x, y, z = tn[2], tn[3], tn[4]
-        xs, ys = None, None
-        virtual_node_created = False
-
-        is_outside = x < left or x >= right or y < top \
-                or y >= bottom or z < z1 or z >= z2
-
-        # If this node and its parent are outside, create a virtual node
-        # location and replace current coordinates.
-        if is_outside:
-            if virtual_nodes and parent_id:
-                parent_node = nodes.get(parent_id)
-                if parent_node:
-                    px, py, pz = parent_node[2], parent_node[3], parent_node[4]
-                    p_is_outside = px < left or px >= right or py < top \
-                            or py >= bottom or pz < z1 or pz >= z2
-
-                    # If the parent ist outside, too, find virtual node
-                    # location.
-                    if p_is_outside:
-                        dx, dy, dz = px - x, py - y, pz - z
-                        if dz > -0.0001 and dz < 0.0001:
-                            continue
-                        t = (z1 - z) / dz
-
-                        x = x + t * dx
-                        y = y + t * dy
-                        z = z1
-                        virtual_node_created = True
-
-            if not virtual_node_created:
-                continue
-
-        xs = xscale * (x - view_min_x)
-        ys = yscale * (y - view_min_y)
-
-        if parent_id:
-            pen = node_pen
-            brush = node_brush
-        else:
-            pen = root_pen
-            brush = root_brush
+    if with_edges:
+        for edge in edges.tolist():
+            draw.line(edge, edge_pen)
 
-        # Render node or virtual node
-        draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), pen, brush)
+    for (xs, ys), root in zip(points.tolist(), is_root.tolist()):
+        if root:
+            draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), root_pen, root_brush)
+        else:
+            draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), node_pen, node_brush)
 
     draw.flush()
 
     return image
 
+def render_node_heatmap(points, width, height, bin_size=4) -> Image:
+    """Render a density map of the passed in Nx2 screen coordinates. Nodes are
+    counted in square bins of <bin_size> pixels. The logarithm of the counts
+    is mapped to a color ramp from transparent magenta to opaque yellow.
+    """
+    n_cols = -(-width // bin_size)
+    n_rows = -(-height // bin_size)
+    bins = np.floor(points / bin_size).astype(np.int64)
+    bins = bins[(bins[:, 0] >= 0) & (bins[:, 0] < n_cols) &
+            (bins[:, 1] >= 0) & (bins[:, 1] < n_rows)]
+    counts = np.bincount(bins[:, 1] * n_cols + bins[:, 0],
+            minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+    max_count = counts.max() if counts.size else 0
+    intensity = np.log1p(counts) / np.log1p(max_count) if max_count else \
+            np.zeros(counts.shape)
+
+    rgba = np.zeros((n_rows, n_cols, 4), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = 255 * intensity
+    rgba[..., 2] = 255 * (1 - intensity)
+    rgba[..., 3] = np.where(counts > 0, 64 + 191 * intensity, 0)
+
+    image = Image.fromarray(rgba, 'RGBA')
+    if bin_size > 1:
+        image = image.resize((n_cols * bin_size, n_rows * bin_size),
+                Image.NEAREST).crop((0, 0, width, height))
+
+    return image
+
 
 @requires_user_role(UserRole.Annotate)
 def update_location_reviewer(request:HttpRequest, project_id=None, node_id=None) -> JsonResponse:
@@ -1,3 +1,5 @@
+from typing import Any, Dict, List, Optional
+
 from django.db import connection
 from django.http import HttpRequest, JsonResponse
 
@@ -7,37 +9,192 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 
 
+# Search modes supported by search_class_instances()
+SEARCH_MODES = ('regex', 'prefix', 'trigram')
+
+# Search terms shorter than this can't be matched using the trigram index and
+# are matched as prefix instead.
+MIN_TRIGRAM_SEARCH_LENGTH = 3
+
+
+def search_class_instances(project_id, term, mode='regex', limit=None,
+        offset=0, cursor=None) -> List[Dict[str, Any]]:
+    """Find class instances (e.g. neurons, skeletons, groups and labels) with
+    a name matching <term>. Labels additionally get a "nodes" and a
+    "connectors" field with the treenodes and connectors they are linked to,
+    if any. The mode defines how names are matched:
+
+    regex: <term> is a case insensitive regular expression. Results are
+    ordered by class name and name.
+
+    prefix: Names start with <term>, regardless of case. This uses the
+    class_instance_project_id_upper_name_pattern_idx index.
+
+    trigram: Names contain a word similar to <term>. This uses the trigram
+    index on class instance names. Terms shorter than three characters are
+    matched as prefix.
+
+    Prefix and trigram results are ranked by their similarity to <term>, best
+    matches first. Results can be paginated using <limit> and <offset>.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+
+    if not cursor:
+        cursor = connection.cursor()
+
+    if mode == 'regex':
+        condition = 'ci.name ~* %(term)s'
+        rank = '0'
+        ordering = 'class_name, name, id'
+    else:
+        if mode == 'prefix' or len(term) < MIN_TRIGRAM_SEARCH_LENGTH:
+            condition = 'UPPER(ci.name) LIKE UPPER(%(pattern)s)'
+            rank = 'similarity(ci.name, %(term)s)'
+        else:
+            condition = '%(term)s <%% ci.name'
+            rank = 'word_similarity(%(term)s, ci.name)'
+        ordering = 'rank DESC, class_name, name, id'
+
+    # Escape LIKE wildcards in the search term for prefix matching.
+    pattern = term.replace('\\', '\\\\').replace('_', '\\_') \
+            .replace('%', '\\%') + '%'
+
+    relation_map = get_relation_to_id_map(project_id, ('labeled_as',), cursor)
+
+    # Find matching class instances and, for labels, the treenodes and
+    # connectors they are linked to, in a single query.
+    cursor.execute(f"""
+        WITH matched AS (
+            SELECT ci.id, ci.name, c.class_name, {rank} AS rank
+            FROM class_instance ci
+            JOIN class c
+                ON c.id = ci.class_id
+            WHERE ci.project_id = %(project_id)s
+                AND {condition}
+            ORDER BY {ordering}
+            {'LIMIT %(limit)s' if limit else ''}
+            OFFSET %(offset)s
+        )
+        SELECT m.id, m.name, m.class_name, nodes.data, connectors.data
+        FROM matched m
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object('id', t.id, 'x', t.location_x,
+                    'y', t.location_y, 'z', t.location_z,
+                    'skid', t.skeleton_id) ORDER BY t.id DESC) AS data
+            FROM treenode_class_instance tci
+            JOIN treenode t
+                ON t.id = tci.treenode_id
+            WHERE m.class_name = 'label'
+                AND tci.class_instance_id = m.id
+                AND tci.project_id = %(project_id)s
+                AND tci.relation_id = %(labeled_as_id)s
+        ) nodes
+            ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object('id', c.id, 'x', c.location_x,
+                    'y', c.location_y, 'z', c.location_z)) AS data
+            FROM connector_class_instance cci
+            JOIN connector c
+                ON c.id = cci.connector_id
+            WHERE m.class_name = 'label'
+                AND cci.class_instance_id = m.id
+                AND cci.project_id = %(project_id)s
+                AND cci.relation_id = %(labeled_as_id)s
+        ) connectors
+            ON TRUE
+        ORDER BY {ordering}
+    """, {
+        'project_id': project_id,
+        'term': term,
+        'pattern': pattern,
+        'limit': limit,
+        'offset': offset,
+        'labeled_as_id': relation_map['labeled_as'],
+    })
+
+    rows = []
+    for ci_id, name, class_name, nodes, connectors in cursor.fetchall():
+        row:Dict[str, Any] = {
+            'id': ci_id,
+            'name': name,
+            'class_name': class_name,
+        }
+        if nodes:
+            row['nodes'] = nodes
+        if connectors:
+            row['connectors'] = connectors
+        rows.append(row)
+
+    return rows
+
+
 @requires_user_role(UserRole.Browse)
 def search(request:HttpRequest, project_id=None) -> JsonResponse:
+    """Search for class instances, treenodes and connectors.
+
+    Class instances (e.g. neurons, skeletons, groups and labels) are matched by
+    name. Labels are returned along with the treenodes and connectors they are
+    linked to. If the search term is a number, neurons, skeletons, treenodes and
+    connectors with this ID are returned in addition on the first page.
+    ---
+    parameters:
+      - name: project_id
+        description: Project to search in
+        type: integer
+        paramType: path
+        required: true
+      - name: substring
+        description: The search term
+        type: string
+        paramType: query
+        required: true
+      - name: mode
+        description: |
+            How names are matched: "regex" treats the search term as case
+            insensitive regular expression, "prefix" finds names starting with
+            the search term and "trigram" finds names containing words similar
+            to the search term. Prefix and trigram results are ranked by
+            similarity to the search term and use database indices, which makes
+            them much faster on large projects.
+        type: string
+        enum: [regex, prefix, trigram]
+        paramType: query
+        required: false
+        defaultValue: regex
+      - name: limit
+        description: The maximum number of matched class instances to return.
+        type: integer
+        paramType: query
+        required: false
+      - name: offset
+        description: The number of matched class instances to skip.
+        type: integer
+        paramType: query
+        required: false
+        defaultValue: 0
+    """
     search_string = request.GET.get('substring', "")
     if not search_string:
         raise ValueError("Need search term")
 
-    ids = set()
+    mode = request.GET.get('mode', 'regex')
+    limit = request.GET.get('limit')
+    limit = int(limit) if limit else None
+    offset = int(request.GET.get('offset', 0))
+    if (limit is not None and limit < 0) or offset < 0:
+        raise ValueError("Limit and offset must not be negative")
 
-    cursor = connection.cursor()
+    # 1. Query ClassInstance objects, where the name matches the search string.
+    # This retrieves neurons, skeletons, groups and labels by name. Labels come
+    # with the treenodes and connectors they are linked to.
+    rows = search_class_instances(project_id, search_string, mode, limit,
+            offset)
+    ids = set(row['id'] for row in rows)
 
-    # 1. Query ClassInstance objects, where the name contains the search string.
-    # This retrieves neurons, skeletons and groups by name.
-    cursor.execute("""
-        SELECT ci.id, ci.name, c.class_name
-        FROM class_instance ci
-        JOIN class c
-            ON c.id = ci.class_id
-        WHERE ci.project_id = %(project_id)s
-            AND ci.name ~* %(term)s
-        ORDER BY c.class_name, ci.name
-    """, {
-        'project_id': project_id,
-        'term': search_string,
-    })
-    rows = [{
-        'id': row[0],
-        'name': row[1],
-        'class_name': row[2]
-    } for row in cursor.fetchall()]
-    for row in rows:
-        ids.add(row['id'])
+    # Add results for IDs only to the first page
+    if offset > 0:
+        return JsonResponse(rows, safe=False)
 
     # 2. Query skeletons and neurons by ID, if the search string is a number
     try:
@@ -75,89 +232,4 @@ def search(request:HttpRequest, project_id=None) -> JsonResponse:
         except ValueError:
             pass
 
-    # 3. Query labels in treenodes. First get a list of matching labels,
-    # and then find a list of treenodes for each label.
-    relation_map = get_relation_to_id_map(project_id)
-    matching_labels_set = set()
-    label_rows = {}
-    for row in rows:
-        # Prepare for retrieving nodes holding text labels
-        if row['class_name'] == 'label':
-            matching_labels_set.add(row['name'])
-            label_rows[row['id']] = row
-
-    # We need a list to pass it to psycopg2.
-    matching_labels = list(matching_labels_set)
-
-    # Find treenodes with label. Use the UPPER() function to be able to use the
-    # respective expression index, cutting down query times by a lot.
-    cursor.execute("""
-        SELECT tci.treenode_id, t.location_x, t.location_y, t.location_z,
-            t.skeleton_id, tci.class_instance_id
-        FROM treenode_class_instance tci
-        JOIN class_instance ci
-            ON tci.class_instance_id = ci.id
-        JOIN treenode t
-            ON tci.treenode_id = t.id
-        JOIN UNNEST(%(matching_labels)s::text[]) query(name)
-            ON query.name = ci.name AND UPPER(ci.name) = UPPER(query.name)
-        WHERE tci.project_id = %(project_id)s
-            AND tci.relation_id = %(labeled_as_id)s
-            AND t.project_id = %(project_id)s
-        ORDER BY tci.treenode_id DESC;
-    """, {
-        'project_id': project_id,
-        'labeled_as_id': relation_map['labeled_as'],
-        'matching_labels': matching_labels,
-    })
-
-    for node in cursor.fetchall():
-        row_with_node = label_rows[node[5]]
-        nodes = row_with_node.get('nodes', None)
-        if not nodes:
-            nodes = []
-            row_with_node['nodes'] = nodes
-        nodes.append({
-            'id': node[0],
-            'x': node[1],
-            'y': node[2],
-            'z': node[3],
-            'skid': node[4]
-        })
-
-
-    # Find connectors with label. Use the UPPER() function to be able to use the
-    # respective expression index, cutting down query times by a lot.
-    cursor.execute("""
-        SELECT c.id, c.location_x, c.location_y, c.location_z, ci.id
-        FROM connector_class_instance cci
-        JOIN class_instance ci
-            ON ci.id = cci.class_instance_id
-        JOIN connector c
-            ON c.id = cci.connector_id
-        JOIN UNNEST(%(matching_labels)s::text[]) query(name)
-            ON query.name = ci.name AND UPPER(ci.name) = UPPER(query.name)
-        WHERE cci.project_id = %(project_id)s
-            AND cci.relation_id = %(labeled_as_id)s
-            AND c.project_id = %(project_id)s
-    """, {
-        'project_id': project_id,
-        'labeled_as_id': relation_map['labeled_as'],
-        'matching_labels': matching_labels,
-    })
-
-    for connector in cursor.fetchall():
-        row_with_node = label_rows[connector[4]]
-        connectors = row_with_node.get('connectors', None)
-        if not connectors:
-            connectors = []
-            row_with_node['connectors'] = connectors
-        connectors.append({
-            'id': connector[0],
-            'x': connector[1],
-            'y': connector[2],
-            'z': connector[3]
-        })
-
-
     return JsonResponse(rows, safe=False)
@@ -27,6 +27,7 @@ from catmaid.control.common import (insert_into_log, get_class_to_id_map,
 from catmaid.models import (NblastConfig, NblastSample, Project, PointSet,
         NblastConfigDefaultDistanceBreaks, NblastConfigDefaultDotBreaks,
         NblastSimilarity, PointCloud, UserRole)
+from catmaid.control.nat import native
 from catmaid.control.nat.r import (compute_scoring_matrix, nblast,
         test_environment, setup_environment)
 from catmaid.control.pointcloud import list_pointclouds
@@ -34,6 +35,9 @@ from catmaid.control.pointcloud import list_pointclouds
 
 logger = get_task_logger(__name__)
 
+# Back-ends that can compute NBLAST scoring matrices and similarities
+NblastBackends = ('r', 'native')
+
 
 def serialize_sample(sample) -> Dict[str, Any]:
     return {
@@ -74,6 +78,7 @@ def serialize_config(config, simple=False) -> Dict[str, Any]:
             'scoring': config.scoring,
             'resample_step': config.resample_step,
             'tangent_neighbors': config.tangent_neighbors,
+            'backend': config.backend,
         }
 
 
@@ -257,6 +262,13 @@ class ConfigurationList(APIView):
             required: false
             defaultValue: 20
             paramType: form
+          - name: backend
+            description: |
+                The back-end to compute the scoring matrix and similarities
+                with. Either "r" (nat.nblast) or "native" (NumPy/SciPy).
+            required: false
+            defaultValue: "r"
+            paramType: form
           - name: matching_skeleton_ids
             description: A list of matching skeleton IDs if <source> is not "data".
             required: false
@@ -314,6 +326,9 @@ class ConfigurationList(APIView):
 
         source = request.data.get('source', 'backend-random')
         tangent_neighbors = int(request.data.get('tangent_neighbors', '20'))
+        backend = request.data.get('backend', 'r')
+        if backend not in NblastBackends:
+            raise ValueError(f"Unknown backend: {backend}")
         matching_sample_id = int(request.data.get('matching_sample_id')) \
                 if 'matching_sample_id' in request.data else None
         random_sample_id = int(request.data.get('random_sample_id')) \
@@ -388,7 +403,8 @@ class ConfigurationList(APIView):
 
         if scoring:
             config = self.add_from_raw_data(project_id, request.user.id, name,
-                    scoring, distance_breaks, dot_breaks, tangent_neighbors)
+                    scoring, distance_breaks, dot_breaks, tangent_neighbors,
+                    backend)
             return Response(serialize_config(config))
         elif source == 'request':
             if not matching_skeleton_ids and not matching_pointset_ids:
@@ -398,7 +414,7 @@ class ConfigurationList(APIView):
             config = self.add_delayed(project_id, user_id, name, matching_skeleton_ids,
                     matching_pointset_ids, random_skeleton_ids, distance_breaks,
                     dot_breaks, tangent_neighbors=tangent_neighbors,
-                    matching_subset=matching_subset)
+                    matching_subset=matching_subset, backend=backend)
             return Response(serialize_config(config))
         elif source == 'backend-random':
             if not matching_skeleton_ids and not matching_pointset_ids:
@@ -416,7 +432,7 @@ class ConfigurationList(APIView):
                     matching_skeleton_ids, matching_pointset_ids,
                     matching_pointcloud_ids, distance_breaks, dot_breaks, None,
                     None, n_random_skeletons, min_length, min_nodes,
-                    tangent_neighbors, matching_subset)
+                    tangent_neighbors, matching_subset, backend)
             return Response(serialize_config(config))
         else:
             raise ValueError("Unknown source: " + source)
@@ -425,21 +441,23 @@ class ConfigurationList(APIView):
     def add_from_raw_data(self, project_id, user_id, name, scoring,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks,
-            tangent_neighbors=20):
+            tangent_neighbors=20, backend='r'):
         """Add a scoring matrix based on the passed in array of arrays and
         dimensions.
         """
         return NblastConfig.objects.create(project_id=project_id,
             user_id=user_id, name=name, status='complete',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
-            match_sample=None, random_sample=None, scoring=scoring)
+            match_sample=None, random_sample=None, scoring=scoring,
+            tangent_neighbors=tangent_neighbors, backend=backend)
 
 
     def add_delayed(self, project_id, user_id, name, matching_skeleton_ids,
             matching_pointset_ids, random_skeleton_ids,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
-            random_sample_id=None, tangent_neighbors=20, matching_subset=None):
+            random_sample_id=None, tangent_neighbors=20, matching_subset=None,
+            backend='r'):
         """Create and queue a new Celery task to create the scoring matrix.
         """
         histogram:List = []
@@ -466,7 +484,7 @@ class ConfigurationList(APIView):
             user=user_id, name=name, status='queued',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
             match_sample=match_sample, random_sample=random_sample,
-            scoring=None, tangent_neighbors=tangent_neighbors)
+            scoring=None, tangent_neighbors=tangent_neighbors, backend=backend)
 
         # Queue recomputation task
         task = recompute_config.delay(config.id)
@@ -478,7 +496,8 @@ class ConfigurationList(APIView):
             matching_pointcloud_ids, distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
             random_sample_id=None, n_random_skeletons=5000, min_length=0,
-            min_nodes=100, tangent_neighbors=20, matching_subset=None):
+            min_nodes=100, tangent_neighbors=20, matching_subset=None,
+            backend='r'):
         """Select a random set of neurons, optionally of a minimum length and
         queue a job to compute the scoring matrix.
         """
@@ -547,7 +566,8 @@ class ConfigurationList(APIView):
                 user_id=user_id, name=name, status='queued',
                 distance_breaks=distance_breaks, dot_breaks=dot_breaks,
                 match_sample=match_sample, random_sample=random_sample,
-                scoring=None, tangent_neighbors=tangent_neighbors)
+                scoring=None, tangent_neighbors=tangent_neighbors,
+                backend=backend)
 
             transaction.on_commit(lambda: compute_nblast_config.delay(config.id,
                     user_id))
@@ -581,7 +601,12 @@ def compute_nblast_config(config_id, user_id, use_cache=True) -> str:
             config.status = 'computing'
             config.save()
 
-        scoring_info = compute_scoring_matrix(config.project_id, user_id,
+        if config.backend == 'native':
+            compute_fn = native.compute_scoring_matrix
+        else:
+            compute_fn = compute_scoring_matrix
+
+        scoring_info = compute_fn(config.project_id, user_id,
                 config.match_sample, config.random_sample,
                 config.distance_breaks, config.dot_breaks,
                 config.resample_step, config.tangent_neighbors)
@@ -707,7 +732,8 @@ def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
             raise ValueError(f"NBLAST config #{config.id}" +
                 " does not have a computed scoring.")
 
-        scoring_info = nblast(project_id, user_id, config.id,
+        nblast_fn = native.nblast if config.backend == 'native' else nblast
+        scoring_info = nblast_fn(project_id, user_id, config.id,
                 query_object_ids, target_object_ids,
                 similarity.query_type_id, similarity.target_type_id,
                 normalized=similarity.normalized,
@@ -3,19 +3,23 @@
 from collections import defaultdict
 import csv
 from datetime import datetime, timedelta
-from itertools import chain
+from io import StringIO
+from itertools import chain, repeat
 import dateutil.parser
+import hashlib
 import json
 import networkx as nx
+import numpy as np
 import pytz
 import re
 from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, Http404, \
         JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.views.decorators.cache import never_cache
 
@@ -40,7 +44,8 @@ from catmaid.control.annotation import (annotations_for_skeleton,
         create_annotation_query, _annotate_entities, _update_neuron_annotations)
 from catmaid.control.provenance import get_data_source, normalize_source_url
 from catmaid.control.review import get_review_status
-from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.tree_util import (ArrayTree, find_root, reroot,
+        edge_count_to_root)
 from catmaid.control.volume import get_volume_details
 
 
@@ -127,34 +132,29 @@ def _open_leaves(project_id, skeleton_id, tnid=None):
         WHERE t.skeleton_id = %s
         ''', (int(skeleton_id),))
 
-    # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents.
-    tree = nx.DiGraph()
-    n_nodes = 0
-    for row in cursor.fetchall():
-        n_nodes += 1
-        node_id = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], node_id)
-        else:
-            tree.add_node(node_id)
+    rows = cursor.fetchall()
+    n_nodes = len(rows)
+    tree = ArrayTree.from_rows(rows)
 
-            # Default to root node
-            if not tnid:
-                tnid = node_id
+    # Default to root node
+    if not tnid:
+        tnid = tree.root
 
     if tnid not in tree:
         raise ValueError("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
-    leaves = set()
+    tree.reroot(tnid)
+    # The query node has a distance of one to itself.
+    edge_counts = tree.edge_count_to_root() + 1
+    distances = dict(zip(tree.node_ids.tolist(), edge_counts.tolist()))
 
-    for node_id, out_degree in tree.out_degree_iter():
-        if 0 == out_degree or node_id == tnid and 1 == out_degree:
-            # Found an end node
-            leaves.add(node_id)
+    # End nodes are nodes without children and the query node if it has only
+    # one child.
+    n_children = tree.n_children
+    is_leaf = n_children == 0
+    tnid_index = tree.index(tnid)
+    is_leaf[tnid_index] |= n_children[tnid_index] == 1
+    leaves = tree.node_ids[is_leaf].tolist()
 
     # Select all nodes and their tags
     cursor.execute('''
@@ -169,7 +169,7 @@ def _open_leaves(project_id, skeleton_id, tnid=None):
                 AND tci.relation_id = %s)
           ON t.id = tci.treenode_id
         GROUP BY t.id
-        ''', (list(leaves), labeled_as))
+        ''', (leaves, labeled_as))
 
     # Iterate end nodes to find which are open.
     nearest = []
@@ -332,33 +332,71 @@ def _find_labels(project_id, skeleton_id, label_regex, tnid=None,
 @api_view(['POST'])
 @requires_user_role(UserRole.Browse)
 def within_spatial_distance(request:HttpRequest, project_id=None) -> JsonResponse:
-    """Find skeletons within a given L-infinity distance of a treenode.
-
-    Returns at most 100 results.
+    """Find skeletons with nodes within a given Euclidean distance of one or
+    more treenodes.
+
+    Skeletons are ordered by the distance of their closest node to any of the
+    query treenodes. Results can be paged using the limit and offset
+    parameters. Alternatively, the nearest N skeletons can be requested,
+    starting with the passed in distance as search radius, which is doubled
+    until enough skeletons are found or max_distance is reached.
     ---
     parameters:
         - name: treenode_id
           description: ID of the origin treenode to search around
-          required: true
+          required: false
           type: integer
           paramType: form
+        - name: treenode_ids
+          description: IDs of origin treenodes to search around
+          required: false
+          type: array
+          items:
+            type: integer
+          paramType: form
         - name: distance
-          description: L-infinity distance in nanometers within which to search
+          description: Euclidean distance in nanometers within which to search
           required: false
           default: 0
-          type: integer
+          type: number
           paramType: form
         - name: size_mode
           description: |
             Whether to return skeletons with only one node in the search area
-            (1) or more than one node in the search area (0).
+            (1), more than one node in the search area (0) or any skeleton with
+            nodes in the search area (2).
           required: false
           default: 0
           type: integer
           paramType: form
+        - name: limit
+          description: Maximum number of returned skeletons
+          required: false
+          default: 100
+          type: integer
+          paramType: form
+        - name: offset
+          description: Number of skeletons to skip, for paging
+          required: false
+          default: 0
+          type: integer
+          paramType: form
+        - name: nearest
+          description: |
+            If set, return this many skeletons closest to the query treenodes.
+            Limit and offset are ignored in this case.
+          required: false
+          type: integer
+          paramType: form
+        - name: max_distance
+          description: The maximum search radius when nearest skeletons are requested.
+          required: false
+          default: 100000
+          type: number
+          paramType: form
     type:
       reached_limit:
-        description: Whether the limit of at most 100 skeletons was reached
+        description: Whether more skeletons than the ones returned are available
         type: boolean
         required: true
       skeletons:
@@ -367,57 +405,115 @@ def within_spatial_distance(request:HttpRequest, project_id=None) -> JsonRespons
         required: true
         items:
           type: integer
+      distances:
+        description: Distance of each returned skeleton to the closest query treenode
+        type: array
+        required: true
+        items:
+          type: number
+      distance:
+        description: The search radius that was used
+        type: number
+        required: true
     """
     project_id = int(project_id)
-    tnid = request.POST.get('treenode_id', None)
-    if not tnid:
+    treenode_ids = get_request_list(request.POST, 'treenode_ids', [], map_fn=int)
+    if 'treenode_id' in request.POST:
+        treenode_ids.append(int(request.POST['treenode_id']))
+    if not treenode_ids:
         raise ValueError("Need a treenode!")
-    tnid = int(tnid)
-    distance = int(request.POST.get('distance', 0))
-    if 0 == distance:
-        return JsonResponse({"skeletons": []})
+    distance = float(request.POST.get('distance', 0))
     size_mode = int(request.POST.get("size_mode", 0))
-    having = ""
+    limit = int(request.POST.get('limit', 100))
+    offset = int(request.POST.get('offset', 0))
+    nearest = request.POST.get('nearest')
+
+    if nearest is not None:
+        max_distance = float(request.POST.get('max_distance', 100000))
+        limit = int(nearest)
+        offset = 0
+        distance = distance or min(1000.0, max_distance)
+        if distance <= 0:
+            raise ValueError("Need a positive distance")
+        while True:
+            skeletons = get_skeletons_within_distance(project_id, treenode_ids,
+                    distance, size_mode, limit + 1)
+            if len(skeletons) > limit or distance >= max_distance:
+                break
+            distance = min(2 * distance, max_distance)
+    else:
+        if 0 >= distance:
+            return JsonResponse({"skeletons": [], "distances": [],
+                    "reached_limit": False, "distance": distance})
+        skeletons = get_skeletons_within_distance(project_id, treenode_ids,
+                distance, size_mode, limit + 1, offset)
+
+    reached_limit = len(skeletons) > limit
+    skeletons = skeletons[:limit]
+
+    return JsonResponse({
+        "skeletons": [s[0] for s in skeletons],
+        "distances": [s[2] for s in skeletons],
+        "reached_limit": reached_limit,
+        "distance": distance,
+    })
 
+
+def get_skeletons_within_distance(project_id, treenode_ids, distance,
+        size_mode=0, limit=None, offset=0) -> List[Tuple[int, int, float]]:
+    """Find skeletons with nodes within Euclidean <distance> of any of the
+    passed in treenodes. Candidate nodes are looked up using the GiST index of
+    treenode_edge. With a <size_mode> of 0, only skeletons with more than one
+    node in range are returned, with 1 only skeletons with exactly one node in
+    range and with any other value all skeletons. Returns a list of
+    (skeleton_id, number of nodes in range, distance) tuples ordered by the
+    distance of the closest node.
+    """
     if 0 == size_mode:
-        having = "HAVING count(*) > 1"
+        having = "HAVING COUNT(*) > 1"
     elif 1 == size_mode:
-        having = "HAVING count(*) = 1"
-    # else, no constraint
+        having = "HAVING COUNT(*) = 1"
+    else:
+        having = ""
 
     cursor = connection.cursor()
-    cursor.execute('SELECT location_x, location_y, location_z FROM treenode WHERE id=%s' % tnid)
-    pos = cursor.fetchone()
-
-    limit = 100
-    x0 = pos[0] - distance
-    x1 = pos[0] + distance
-    y0 = pos[1] - distance
-    y1 = pos[1] + distance
-    z0 = pos[2] - distance
-    z1 = pos[2] + distance
-
-    # Cheap emulation of the distance
-    cursor.execute('''
-SELECT skeleton_id, count(*)
-FROM treenode
-WHERE project_id = %s
-  AND location_x > %s
-  AND location_x < %s
-  AND location_y > %s
-  AND location_y < %s
-  AND location_z > %s
-  AND location_z < %s
-GROUP BY skeleton_id
-%s
-LIMIT %s
-''' % (project_id, x0, x1, y0, y1, z0, z1, having, limit))
-
-
-    skeletons = tuple(row[0] for row in cursor.fetchall())
+    cursor.execute(f'''
+        WITH query_node AS (
+            SELECT t.location_x AS x, t.location_y AS y, t.location_z AS z,
+                ST_MakePoint(t.location_x, t.location_y, t.location_z) AS pos
+            FROM treenode t
+            JOIN UNNEST(%(treenode_ids)s::bigint[]) query(id)
+                ON query.id = t.id
+            WHERE t.project_id = %(project_id)s
+        ), near_node AS (
+            SELECT te.id, MIN(ST_3DDistance(ST_StartPoint(te.edge), qn.pos)) AS distance
+            FROM query_node qn
+            JOIN treenode_edge te
+                ON te.edge &&& ST_MakeLine(
+                    ST_MakePoint(qn.x - %(distance)s, qn.y - %(distance)s, qn.z - %(distance)s),
+                    ST_MakePoint(qn.x + %(distance)s, qn.y + %(distance)s, qn.z + %(distance)s))
+                AND ST_3DDWithin(ST_StartPoint(te.edge), qn.pos, %(distance)s)
+            WHERE te.project_id = %(project_id)s
+            GROUP BY te.id
+        )
+        SELECT t.skeleton_id, COUNT(*), MIN(nn.distance)
+        FROM near_node nn
+        JOIN treenode t
+            ON t.id = nn.id
+        GROUP BY t.skeleton_id
+        {having}
+        ORDER BY MIN(nn.distance), t.skeleton_id
+        LIMIT %(limit)s
+        OFFSET %(offset)s
+    ''', {
+        'project_id': int(project_id),
+        'treenode_ids': list(treenode_ids),
+        'distance': float(distance),
+        'limit': limit,
+        'offset': offset,
+    })
 
-    return JsonResponse({"skeletons": skeletons,
-                         "reached_limit": limit == len(skeletons)})
+    return cursor.fetchall()
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -1888,26 +1984,20 @@ def connectivity_matrix_csv(request:HttpRequest, project_id) -> StreamingHttpRes
     cols = tuple(get_request_list(request.POST, 'columns', [], map_fn=int))
     names:Dict = dict(map(lambda x: (int(x[0]), x[1]), get_request_list(request.POST, 'names', [])))
 
-    matrix = get_connectivity_matrix(project_id, rows, cols)
+    row_idx, col_idx, counts = get_connectivity_matrix_arrays(project_id,
+            rows, cols)
+    dense = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    dense[row_idx, col_idx] = counts
 
-    csv_data = []
-    header = [''] + list(map(lambda x: names.get(x, x), cols))
-    csv_data.append(header)
-
-    for n, skid_a in enumerate(rows):
-        # Add row header skeleton ID
-        row = [names.get(skid_a, skid_a)]
-        csv_data.append(row)
-        # Add connectivity information
-        for m, skid_b in enumerate(cols):
-            p = matrix.get(skid_a, {})
-            c = p.get(skid_b, 0)
-            row.append(c)
+    def csv_data():
+        yield [''] + [names.get(skid, skid) for skid in cols]
+        for skid_a, row in zip(rows, dense.tolist()):
+            yield [names.get(skid_a, skid_a)] + row
 
     pseudo_buffer = Echo()
     writer = csv.writer(pseudo_buffer, quoting=csv.QUOTE_NONNUMERIC)
 
-    response = StreamingHttpResponse((writer.writerow(row) for row in csv_data), # type: ignore
+    response = StreamingHttpResponse((writer.writerow(row) for row in csv_data()), # type: ignore
             content_type='text/csv')
 
     filename = 'catmaid-connectivity-matrix.csv'
@@ -1917,41 +2007,65 @@ def connectivity_matrix_csv(request:HttpRequest, project_id) -> StreamingHttpRes
 
 
 def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
-        with_locations=False) -> DefaultDict[Any, Dict]:
+        with_locations=False) -> Dict[Any, Dict]:
     """
     Return a sparse connectivity matrix representation for the given skeleton
     IDS. The returned dictionary has a key for each row skeleton having
     outgoing connections to one or more column skeletons. Each entry stores a
     dictionary that maps the connection partners to the individual outgoing
     synapse counts.
+
+    Results are cached for CONNECTIVITY_MATRIX_CACHE_TIMEOUT seconds. A cached
+    matrix is only used if the fingerprint of the involved connector links
+    (see get_connectivity_fingerprint()) didn't change.
     """
     cursor = connection.cursor()
-    relation_map = get_relation_to_id_map(project_id)
-    post_rel_id = relation_map['postsynaptic_to']
+    relation_map = get_relation_to_id_map(project_id, ('presynaptic_to',
+            'postsynaptic_to'), cursor)
     pre_rel_id = relation_map['presynaptic_to']
+    post_rel_id = relation_map['postsynaptic_to']
 
+    timeout = settings.CONNECTIVITY_MATRIX_CACHE_TIMEOUT
+    if timeout:
+        fingerprint = get_connectivity_fingerprint(row_skeleton_ids,
+                col_skeleton_ids, (pre_rel_id, post_rel_id), with_locations,
+                cursor)
+        key_data = json.dumps([project_id, sorted(set(row_skeleton_ids)),
+                sorted(set(col_skeleton_ids)), with_locations])
+        cache_key = 'connectivity-matrix-' + \
+                hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+        cached = cache.get(cache_key)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+    # Count all synapses made between row skeletons and column skeletons. If
+    # locations are requested, count per connector.
     if with_locations:
         extra_select = ', c.id, c.location_x, c.location_y, c.location_z'
         extra_join = 'JOIN connector c ON c.id = t2.connector_id'
+        extra_group = ', c.id'
     else:
         extra_select = ''
         extra_join = ''
+        extra_group = ''
 
-    # Obtain all synapses made between row skeletons and column skeletons.
-    cursor.execute('''
-        SELECT t1.skeleton_id, t2.skeleton_id
+    cursor.execute(f'''
+        SELECT t1.skeleton_id, t2.skeleton_id, COUNT(*)
             {extra_select}
-        FROM treenode_connector t1,
-             treenode_connector t2
-            {extra_join}
-        WHERE t1.skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
-          AND t2.skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
-          AND t1.connector_id = t2.connector_id
-          AND t1.relation_id = %(pre_rel_id)s
+        FROM treenode_connector t1
+        JOIN UNNEST(%(row_skeleton_ids)s::bigint[]) row_skeleton(id)
+            ON row_skeleton.id = t1.skeleton_id
+        JOIN treenode_connector t2
+            ON t2.connector_id = t1.connector_id
+        JOIN UNNEST(%(col_skeleton_ids)s::bigint[]) col_skeleton(id)
+            ON col_skeleton.id = t2.skeleton_id
+        {extra_join}
+        WHERE t1.relation_id = %(pre_rel_id)s
           AND t2.relation_id = %(post_rel_id)s
-    '''.format(extra_select=extra_select, extra_join=extra_join), {
-        'row_skeleton_ids': list(row_skeleton_ids),
-        'col_skeleton_ids': list(col_skeleton_ids),
+        GROUP BY t1.skeleton_id, t2.skeleton_id {extra_group}
+    ''', {
+        'row_skeleton_ids': list(set(row_skeleton_ids)),
+        'col_skeleton_ids': list(set(col_skeleton_ids)),
         'pre_rel_id': pre_rel_id,
         'post_rel_id': post_rel_id
     })
@@ -1961,36 +2075,101 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
     # connecting to each partner. If locations should be returned as well, an
     # object with the fields 'count' and 'locations' is returned instead of a
     # single count.
+    outgoing:DefaultDict[Any, Dict] = defaultdict(dict)
     if with_locations:
-        outgoing:DefaultDict[Any, Dict] = defaultdict(dict)
-        for r in cursor.fetchall():
-            source, target = r[0], r[1]
+        for source, target, count, connector_id, x, y, z in cursor.fetchall():
             mapping = outgoing[source]
-            connector_id = r[2]
             info = mapping.get(target)
             if not info:
                 info = { 'count': 0, 'locations': {} }
                 mapping[target] = info
-            count = info['count']
-            info['count'] = count + 1
-
-            if connector_id not in info['locations']:
-                location = [r[3], r[4], r[5]]
-                info['locations'][connector_id] = {
-                    'pos': location,
-                    'count': 1,
-                }
-            else:
-                info['locations'][connector_id]['count'] += 1
+            info['count'] += count
+            info['locations'][connector_id] = {
+                'pos': [x, y, z],
+                'count': count,
+            }
     else:
-        outgoing = defaultdict(dict)
-        for r in cursor.fetchall():
-            source, target = r[0], r[1]
-            mapping = outgoing[source]
-            count = mapping.get(target, 0)
-            mapping[target] = count + 1
+        for source, target, count in cursor.fetchall():
+            outgoing[source][target] = count
+
+    matrix = dict(outgoing)
+
+    if timeout:
+        cache.set(cache_key, (fingerprint, matrix), timeout)
+
+    return matrix
+
+
+def get_connectivity_fingerprint(row_skeleton_ids, col_skeleton_ids,
+        relation_ids, with_locations=False, cursor=None) -> Tuple:
+    """Return a value that changes whenever a synaptic connector link of the
+    passed in skeletons is added, changed or removed. It consists of the
+    number of these links and their most recent edition time. If locations are
+    included, the most recent edition time of the linked connectors is added.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if with_locations:
+        extra_select = ', MAX(c.edition_time)'
+        extra_join = 'JOIN connector c ON c.id = tc.connector_id'
+    else:
+        extra_select = ''
+        extra_join = ''
+
+    cursor.execute(f'''
+        SELECT COUNT(*), MAX(tc.edition_time) {extra_select}
+        FROM treenode_connector tc
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+            ON skeleton.id = tc.skeleton_id
+        {extra_join}
+        WHERE tc.relation_id = ANY(%(relation_ids)s::bigint[])
+    ''', {
+        'skeleton_ids': list(set(row_skeleton_ids) | set(col_skeleton_ids)),
+        'relation_ids': list(relation_ids),
+    })
 
-    return outgoing
+    return tuple(cursor.fetchone())
+
+
+def get_connectivity_matrix_arrays(project_id, row_skeleton_ids,
+        col_skeleton_ids, as_scipy=False) -> Union[Tuple[np.ndarray, np.ndarray, np.ndarray], Any]:
+    """Return the connectivity matrix of the passed in skeletons in coordinate
+    (COO) form: arrays of row indices, column indices and synapse counts. The
+    indices refer to positions in <row_skeleton_ids> and <col_skeleton_ids>.
+    If <as_scipy> is true, a scipy.sparse.coo_matrix is returned instead.
+    """
+    matrix = get_connectivity_matrix(project_id, row_skeleton_ids,
+            col_skeleton_ids)
+
+    row_index:DefaultDict[Any, List[int]] = defaultdict(list)
+    for n, skid in enumerate(row_skeleton_ids):
+        row_index[skid].append(n)
+    col_index:DefaultDict[Any, List[int]] = defaultdict(list)
+    for n, skid in enumerate(col_skeleton_ids):
+        col_index[skid].append(n)
+
+    rows:List[int] = []
+    cols:List[int] = []
+    counts:List[int] = []
+    for source, partners in matrix.items():
+        for target, count in partners.items():
+            for r in row_index[source]:
+                for c in col_index[target]:
+                    rows.append(r)
+                    cols.append(c)
+                    counts.append(count)
+
+    row_idx = np.array(rows, dtype=np.int64)
+    col_idx = np.array(cols, dtype=np.int64)
+    data = np.array(counts, dtype=np.int64)
+
+    if as_scipy:
+        from scipy.sparse import coo_matrix
+        return coo_matrix((data, (row_idx, col_idx)),
+                shape=(len(row_skeleton_ids), len(col_skeleton_ids)))
+
+    return row_idx, col_idx, data
 
 
 @api_view(['POST'])
@@ -2914,6 +3093,79 @@ def import_skeleton(request:HttpRequest, project_id=None) -> Union[HttpResponse,
     return HttpResponseBadRequest('No file received.')
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Import)
+def bulk_import_skeletons(request:HttpRequest, project_id=None) -> JsonResponse:
+    """Import many neurons modeled by skeletons from uploaded SWC and eSWC
+    files.
+
+    For each file a new neuron and skeleton is created, named after the file
+    name without extension. Skeletons are imported in batches, each in its own
+    transaction. Unlike the regular import, no node ID map is returned.
+    ---
+    consumes: multipart/form-data
+    parameters:
+      - name: annotations
+        description: >
+            An optional list of annotation names that is added to all imported
+            neurons.
+        paramType: form
+        type: array
+        items:
+          type: string
+      - name: batch_size
+        description: >
+            The number of skeletons imported in a single transaction.
+        type: integer
+        required: false
+        defaultValue: 100
+        paramType: form
+      - name: file
+        required: true
+        description: One or more skeleton files to import.
+        paramType: body
+        dataType: File
+    type:
+        skeletons:
+            type: array
+            required: true
+            description: >
+                For each imported file, an object with the fields file_name,
+                neuron_id, skeleton_id and n_nodes, in the order of the files.
+    """
+    project_id = int(project_id)
+    annotations = get_request_list(request.POST, 'annotations', ['Import'])
+    batch_size = int(request.POST.get('batch_size', 100))
+
+    if not request.FILES:
+        return HttpResponseBadRequest('No file received.')
+
+    # Several files can be uploaded with the same field name, values() would
+    # only return the last one of each.
+    files = list(chain.from_iterable(field_files for _, field_files in request.FILES.lists()))
+    for uploadedfile in files:
+        if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
+            return HttpResponse(f'File {uploadedfile.name} too large. Maximum file size is {settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE} bytes.', status=413)
+        extension = uploadedfile.name.split('.')[-1].strip().lower()
+        if extension not in ('swc', 'eswc'):
+            return HttpResponse(f'File type "{extension}" not understood. Known file types: swc, eswc', status=415)
+
+    def skeletons():
+        for uploadedfile in files:
+            name, extension = uploadedfile.name.rsplit('.', 1)
+            swc_string = '\n'.join([line.decode('utf-8') for line in uploadedfile])
+            yield name, swc_string, extension.strip().lower() == 'eswc'
+
+    imported = import_skeletons_swc(request.user, project_id, skeletons(),
+            annotations, batch_size)
+    for uploadedfile, info in zip(files, imported):
+        info['file_name'] = uploadedfile.name
+
+    return JsonResponse({
+        'skeletons': imported,
+    })
+
+
 def import_skeleton_swc(user, project_id, swc_string, neuron_id=None,
         skeleton_id=None, name=None, annotations=['Import'], force=False,
         auto_id=True, source_id=None, source_url=None, source_project_id=None,
@@ -3300,6 +3552,239 @@ def _import_skeleton(user, project_id, arborescence, neuron_id=None,
     }
 
 
+def parse_swc(swc_string, extended=False, user_map=None) -> Dict[str, Any]:
+    """Parse a SWC or, if <extended> is true, an eSWC file into NumPy arrays:
+    node IDs, parent IDs (-1 for the root), an Nx3 location array and radii.
+    For eSWC, user IDs, editor IDs and confidences are added and the creation
+    and edition time strings are kept as they are. Unknown eSWC user names are
+    created as deactivated users and added to <user_map>. The nodes have to
+    form a single tree, otherwise a ValueError is raised.
+    """
+    n_columns = 12 if extended else 7
+    rows = [line.split() for line in swc_string.splitlines()
+            if line.strip() and not line.startswith('#')]
+    for row in rows:
+        if len(row) != n_columns:
+            raise ValueError(f'SWC has a malformed line ({len(row)} instead of '
+                    f'{n_columns} columns): {" ".join(row)}')
+    if not rows:
+        raise ValueError('SWC contains no nodes')
+
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    parent_ids = np.array([r[6] for r in rows], dtype=np.int64)
+    values = np.array([r[2:6] for r in rows], dtype=np.float64)
+
+    data = {
+        'ids': ids,
+        'parent_ids': parent_ids,
+        'locations': values[:, :3],
+        'radii': values[:, 3],
+    }
+
+    if extended:
+        if user_map is None:
+            user_map = dict(User.objects.all().values_list('username', 'id'))
+        for username in set(chain.from_iterable((r[7], r[9]) for r in rows)):
+            if username not in user_map:
+                # Create deactivated user with this username
+                user_map[username] = User.objects.create(username=username,
+                        is_active=False).id
+        data['user_ids'] = np.array([user_map[r[7]] for r in rows], dtype=np.int64)
+        data['editor_ids'] = np.array([user_map[r[9]] for r in rows], dtype=np.int64)
+        data['confidences'] = np.array([r[11] for r in rows], dtype=np.int64)
+        data['creation_times'] = [r[8] for r in rows]
+        data['edition_times'] = [r[10] for r in rows]
+
+    # Make sure the nodes form a single tree.
+    if len(np.unique(ids)) != len(ids):
+        raise ValueError('SWC skeleton is malformed: it contains duplicate node IDs.')
+    tree = ArrayTree(ids, parent_ids)
+    if np.any((tree.parents == -1) & (parent_ids != -1)):
+        raise ValueError('SWC skeleton is malformed: it references unknown parent nodes.')
+    if np.count_nonzero(parent_ids == -1) != 1:
+        raise ValueError('SWC skeleton is malformed: it needs exactly one root node.')
+    # Let every node point to its ancestor 2^i steps up, with the root pointing
+    # to itself. After log2(n) steps, all nodes of a tree point to the root.
+    index = np.arange(len(ids))
+    ancestors = np.where(tree.parents == -1, index, tree.parents)
+    for _ in range(int(np.ceil(np.log2(max(len(ids), 2))))):
+        ancestors = ancestors[ancestors]
+    if np.any(tree.parents[ancestors] != -1):
+        raise ValueError('SWC skeleton is malformed: it contains a cycle.')
+
+    return data
+
+
+def import_skeletons_swc(user, project_id, skeletons, annotations=['Import'],
+        batch_size=100) -> List[Dict[str, Any]]:
+    """Import many skeletons from SWC or eSWC files. <skeletons> is an iterable
+    of (name, swc_string, extended) tuples, which is consumed lazily. A new
+    neuron and skeleton is created for each, named <name> or
+    "neuron <neuron_id>" if <name> is None. Skeletons are imported in batches
+    of <batch_size>, each in its own transaction, and their nodes are loaded
+    using COPY. Returns a list with the neuron ID, skeleton ID and number of
+    nodes for each imported skeleton.
+    """
+    if batch_size < 1:
+        raise ValueError("The batch size needs to be at least 1")
+
+    project_id = int(project_id)
+    relation_map = get_relation_to_id_map(project_id, ('model_of',))
+    class_map = get_class_to_id_map(project_id, ('neuron', 'skeleton'))
+    user_map = dict(User.objects.all().values_list('username', 'id'))
+
+    imported:List[Dict[str, Any]] = []
+    batch:List = []
+    for name, swc_string, extended in skeletons:
+        batch.append((name, parse_swc(swc_string, extended, user_map)))
+        if len(batch) == batch_size:
+            with transaction.atomic():
+                imported.extend(_import_swc_batch(user, project_id, batch,
+                        relation_map, class_map, annotations))
+            batch = []
+    if batch:
+        with transaction.atomic():
+            imported.extend(_import_swc_batch(user, project_id, batch,
+                    relation_map, class_map, annotations))
+
+    return imported
+
+
+def _import_swc_batch(user, project_id, batch, relation_map, class_map,
+        annotations) -> List[Dict[str, Any]]:
+    """Create neurons and skeletons for a list of (name, parsed SWC) tuples and
+    insert all their nodes. Needs to be called in a transaction.
+    """
+    cursor = connection.cursor()
+    n_skeletons = len(batch)
+
+    # Reserve IDs for all skeletons and neurons, so that default names can be
+    # set right away.
+    cursor.execute("""
+        SELECT nextval('concept_id_seq') FROM generate_series(1, %(n)s)
+    """, {
+        'n': 2 * n_skeletons,
+    })
+    concept_ids = [r[0] for r in cursor.fetchall()]
+    skeleton_ids, neuron_ids = concept_ids[:n_skeletons], concept_ids[n_skeletons:]
+    skeleton_names = [f'skeleton {skid}' if name is None else name
+            for (name, _), skid in zip(batch, skeleton_ids)]
+    neuron_names = [f'neuron {nid}' if name is None else name
+            for (name, _), nid in zip(batch, neuron_ids)]
+
+    cursor.execute("""
+        INSERT INTO class_instance (id, user_id, project_id, class_id, name)
+        SELECT ci.id, %(user_id)s, %(project_id)s, ci.class_id, ci.name
+        FROM UNNEST(%(ids)s::bigint[], %(class_ids)s::bigint[], %(names)s::text[])
+            AS ci(id, class_id, name)
+    """, {
+        'user_id': user.id,
+        'project_id': project_id,
+        'ids': concept_ids,
+        'class_ids': [class_map['skeleton']] * n_skeletons + \
+                [class_map['neuron']] * n_skeletons,
+        'names': skeleton_names + neuron_names,
+    })
+    cursor.execute("""
+        INSERT INTO class_instance_class_instance (user_id, project_id,
+            relation_id, class_instance_a, class_instance_b)
+        SELECT %(user_id)s, %(project_id)s, %(model_of)s, cici.skeleton_id,
+            cici.neuron_id
+        FROM UNNEST(%(skeleton_ids)s::bigint[], %(neuron_ids)s::bigint[])
+            AS cici(skeleton_id, neuron_id)
+    """, {
+        'user_id': user.id,
+        'project_id': project_id,
+        'model_of': relation_map['model_of'],
+        'skeleton_ids': skeleton_ids,
+        'neuron_ids': neuron_ids,
+    })
+
+    # Load all nodes into a staging table, where treenode IDs are assigned.
+    # Parent IDs are resolved in the database afterwards.
+    cursor.execute("""
+        DROP TABLE IF EXISTS swc_import_node;
+        CREATE TEMPORARY TABLE swc_import_node (
+            skeleton_id bigint NOT NULL,
+            swc_id bigint NOT NULL,
+            swc_parent_id bigint NOT NULL,
+            location_x real NOT NULL,
+            location_y real NOT NULL,
+            location_z real NOT NULL,
+            radius real NOT NULL,
+            user_id integer,
+            editor_id integer,
+            confidence smallint,
+            creation_time timestamptz,
+            edition_time timestamptz,
+            id bigint NOT NULL DEFAULT nextval('location_id_seq')
+        ) ON COMMIT DROP;
+    """)
+
+    def rows():
+        for (_, data), skeleton_id in zip(batch, skeleton_ids):
+            columns = [repeat(skeleton_id), data['ids'].tolist(),
+                    data['parent_ids'].tolist(), *data['locations'].T.tolist(),
+                    data['radii'].tolist()]
+            if 'user_ids' in data:
+                columns.extend((data['user_ids'].tolist(),
+                        data['editor_ids'].tolist(),
+                        data['confidences'].tolist(),
+                        data['creation_times'], data['edition_times']))
+            else:
+                columns.extend(repeat(repeat('\\N'), 5))
+            for row in zip(*columns):
+                yield '\t'.join(map(str, row)) + '\n'
+
+    cursor.copy_expert("""
+        COPY swc_import_node (skeleton_id, swc_id, swc_parent_id, location_x,
+            location_y, location_z, radius, user_id, editor_id, confidence,
+            creation_time, edition_time)
+        FROM STDIN
+    """, StringIO(''.join(rows())))
+
+    cursor.execute("""
+        CREATE INDEX ON swc_import_node (skeleton_id, swc_id);
+        ANALYZE swc_import_node;
+
+        INSERT INTO treenode (id, project_id, location_x, location_y,
+            location_z, parent_id, radius, skeleton_id, user_id, editor_id,
+            confidence, creation_time, edition_time)
+        SELECT n.id, %(project_id)s, n.location_x, n.location_y, n.location_z,
+            p.id, n.radius, n.skeleton_id, COALESCE(n.user_id, %(user_id)s),
+            COALESCE(n.editor_id, %(user_id)s), COALESCE(n.confidence, 5),
+            COALESCE(n.creation_time, now()), COALESCE(n.edition_time, now())
+        FROM swc_import_node n
+        LEFT JOIN swc_import_node p
+            ON p.skeleton_id = n.skeleton_id
+            AND p.swc_id = n.swc_parent_id;
+    """, {
+        'project_id': project_id,
+        'user_id': user.id,
+    })
+
+    # Add annotations, if that is requested
+    if annotations:
+        annotation_map = {a:{'user_id': user.id} for a in annotations}
+        _annotate_entities(project_id, neuron_ids, annotation_map)
+
+    # Log import.
+    annotation_info = f' {", ".join(annotations)}' if annotations else ''
+    imported = []
+    for (_, data), skeleton_id, neuron_id in zip(batch, skeleton_ids, neuron_ids):
+        root_location = data['locations'][data['parent_ids'] == -1][0].tolist()
+        insert_into_log(project_id, user.id, 'create_neuron', root_location,
+                f'Create neuron {neuron_id} and skeleton {skeleton_id} via '
+                f'import.{annotation_info}')
+        imported.append({
+            'neuron_id': neuron_id,
+            'skeleton_id': skeleton_id,
+            'n_nodes': len(data['ids']),
+        })
+
+    return imported
+
+
 @requires_user_role(UserRole.Annotate)
 def reset_own_reviewer_ids(request:HttpRequest, project_id=None, skeleton_id=None) -> JsonResponse:
     """ Remove all reviews done by the requsting user in the skeleten with ID
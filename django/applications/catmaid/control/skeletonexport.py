@@ -6,9 +6,9 @@ from datetime import datetime
 from functools import partial
 import json
 import logging
-from math import sqrt
 import msgpack
 import networkx as nx
+import numpy as np
 from psycopg2.extras import DateTimeTZRange
 import pytz
 import struct
@@ -16,7 +16,8 @@ from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.http import HttpRequest, HttpResponse, JsonResponse, Http404
+from django.http import (HttpRequest, HttpResponse, JsonResponse, Http404,
+        StreamingHttpResponse)
 from django.db.models.query import QuerySet
 
 from rest_framework.decorators import api_view
@@ -29,7 +30,7 @@ from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import accumulate_to_root, edge_count_to_root
 
 
 try:
@@ -392,7 +393,7 @@ def compact_skeleton(request:HttpRequest, project_id=None, skeleton_id=None,
 
 @api_view(['POST'])
 @requires_user_role(UserRole.Browse)
-def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[HttpResponse, JsonResponse]:
+def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> StreamingHttpResponse:
     """Get a compact treenode representation of a list of skeletons, optionally
     with the history of individual nodes and connectors.
 
@@ -419,6 +420,10 @@ def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[
     data. This requires the client to do slightly more work, but unfortunately
     the original creation time is needed for data that was created without
     history tables enabled.
+
+    The result is streamed skeleton by skeleton. Without history, skeletons are
+    loaded in batches with one query per data type for all skeletons in a
+    batch.
     ---
     parameters:
     - skeleton_ids:
@@ -478,6 +483,13 @@ def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[
       type: boolean
       defaultValue: "false"
       paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "msgpack".
+      required: false
+      type: string
+      defaultValue: json
+      paramType: form
     type:
     - type: array
       items:
@@ -499,24 +511,66 @@ def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    skeletons = {}
-    for skeleton_id in skeleton_ids:
-        skeletons[skeleton_id] = _compact_skeleton(project_id, skeleton_id,
-                with_connectors, with_tags, with_history, with_merge_history,
-                with_reviews, with_annotations, with_user_info, ordered)
+    # Remove duplicates, but keep the order.
+    skeleton_ids = list(dict.fromkeys(skeleton_ids))
 
-    result = {
-        "skeletons": skeletons
-    }
+    # Make sure all skeletons exist before the response is streamed.
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT query.id
+        FROM UNNEST(%(skeleton_ids)s::bigint[]) query(id)
+        LEFT JOIN class_instance ci
+            ON ci.id = query.id
+        WHERE ci.id IS NULL
+        LIMIT 1
+    """, {
+        'skeleton_ids': skeleton_ids,
+    })
+    missing = cursor.fetchone()
+    if missing:
+        raise Http404(f"Skeleton #{missing[0]} doesn't exist")
+
+    if with_history:
+        # History queries are done per skeleton.
+        skeletons:Any = ((skeleton_id, _compact_skeleton(project_id,
+                skeleton_id, with_connectors, with_tags, with_history,
+                with_merge_history, with_reviews, with_annotations,
+                with_user_info, ordered)) for skeleton_id in skeleton_ids)
+    else:
+        skeletons = _compact_skeletons(project_id, skeleton_ids,
+                with_connectors, with_tags, with_reviews, with_annotations,
+                with_user_info, ordered)
 
     if return_format == 'msgpack':
-        data = msgpack.packb(result)
-        return HttpResponse(data, content_type='application/octet-stream')
+        def msgpack_stream():
+            yield b'\x81' + msgpack.packb('skeletons') + \
+                    get_pack_map_header(len(skeleton_ids))
+            for skeleton_id, skeleton in skeletons:
+                yield msgpack.packb(skeleton_id) + msgpack.packb(skeleton)
+        return StreamingHttpResponse(msgpack_stream(),
+                content_type='application/octet-stream')
     else:
-        return JsonResponse(result, safe=False, json_dumps_params={
-            'separators': (',', ':'),
-            'default': default
-        })
+        def json_stream():
+            yield '{"skeletons":{'
+            for n, (skeleton_id, skeleton) in enumerate(skeletons):
+                yield '{}"{}":{}'.format(',' if n else '', skeleton_id,
+                        json.dumps(skeleton, separators=(',', ':'),
+                            default=default, cls=DjangoJSONEncoder))
+            yield '}}'
+        return StreamingHttpResponse(json_stream(),
+                content_type='application/json')
+
+
+def get_pack_map_header(n) -> bytes:
+    """Return the binary header of a msgpack map with <n> entries.
+    """
+    if n <= 0x0f:
+        return struct.pack('B', 0x80 + n)
+    if n <= 0xffff:
+        return struct.pack(">BH", 0xde, n)
+    if n <= 0xffffffff:
+        return struct.pack(">BI", 0xdf, n)
+    raise ValueError("Map is too large")
 
 
 def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
@@ -843,6 +897,146 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
     return nodes, connectors, tags, reviews, annotations
 
 
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_reviews=False, with_annotations=False,
+        with_user_info=False, ordered=False, batch_size=100):
+    """A generator for the current version of multiple compact skeletons. It
+    yields (skeleton_id, compact_skeleton) tuples in the order of the passed in
+    skeleton IDs. Each compact skeleton has the same format as the result of
+    _compact_skeleton() without history. Skeletons are loaded in batches of
+    <batch_size> skeletons, each using one query per data type, to only keep
+    the data of one batch in memory.
+    """
+    cursor = connection.cursor()
+
+    if with_connectors or with_tags or with_annotations:
+        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
+        relations = dict(cursor.fetchall())
+
+    if with_connectors:
+        pre = relations['presynaptic_to']
+        post = relations['postsynaptic_to']
+        gj = relations.get('gapjunction_with', -1)
+        dm = relations.get('desmosome_with', -3)
+        relation_index = {pre: 0, post: 1, gj: 2, dm: 3}
+
+    for batch_start in range(0, len(skeleton_ids), batch_size):
+        batch = skeleton_ids[batch_start:batch_start + batch_size]
+
+        nodes:DefaultDict[Any, List] = defaultdict(list)
+        cursor.execute('''
+            SELECT t.skeleton_id, t.id, t.parent_id, t.user_id,
+                t.location_x, t.location_y, t.location_z, t.radius,
+                t.confidence
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON skeleton.id = t.skeleton_id
+            {order}
+        '''.format(**{
+            'order': 'ORDER BY t.id' if ordered else '',
+        }), {
+            'skeleton_ids': batch,
+        })
+        for row in cursor.fetchall():
+            nodes[row[0]].append(row[1:])
+
+        connectors:DefaultDict[Any, List] = defaultdict(list)
+        if with_connectors:
+            user_select = ', tc.user_id' if with_user_info else ''
+            cursor.execute('''
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                    tc.relation_id, c.location_x, c.location_y, c.location_z
+                    {user_select}
+                FROM treenode_connector tc
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                    ON skeleton.id = tc.skeleton_id
+                JOIN connector c
+                    ON c.id = tc.connector_id
+                WHERE tc.relation_id IN (%(pre_id)s, %(post_id)s, %(gj_id)s, %(dm_id)s)
+            '''.format(**{
+                'user_select': user_select,
+            }), {
+                'skeleton_ids': batch,
+                'pre_id': pre,
+                'post_id': post,
+                'gj_id': gj,
+                'dm_id': dm,
+            })
+            for row in cursor.fetchall():
+                connectors[row[0]].append((row[1], row[2],
+                        relation_index.get(row[3], -1)) + row[4:])
+
+        tags:DefaultDict[Any, DefaultDict[Any, List]] = defaultdict(lambda: defaultdict(list))
+        if with_tags:
+            user_select = ', tci.user_id' if with_user_info else ''
+            cursor.execute('''
+                SELECT t.skeleton_id, c.name, tci.treenode_id
+                       {user_select}
+                FROM treenode t
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                    ON skeleton.id = t.skeleton_id
+                JOIN treenode_class_instance tci
+                    ON tci.treenode_id = t.id
+                JOIN class_instance c
+                    ON c.id = tci.class_instance_id
+                WHERE tci.relation_id = %(relation_id)s
+                {order}
+            '''.format(**{
+                'user_select': user_select,
+                'order': 'ORDER BY tci.treenode_id ASC' if ordered else '',
+            }), {
+                'skeleton_ids': batch,
+                'relation_id': relations['labeled_as'],
+            })
+            if with_user_info:
+                for row in cursor.fetchall():
+                    tags[row[0]][row[1]].append([row[2], row[3]])
+            else:
+                for row in cursor.fetchall():
+                    tags[row[0]][row[1]].append(row[2])
+
+        reviews:DefaultDict[Any, List] = defaultdict(list)
+        if with_reviews:
+            cursor.execute("""
+                SELECT r.skeleton_id, r.treenode_id, r.id, r.reviewer_id
+                FROM review r
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                    ON skeleton.id = r.skeleton_id
+            """, {
+                'skeleton_ids': batch,
+            })
+            for row in cursor.fetchall():
+                reviews[row[0]].append(row[1:])
+
+        annotations:DefaultDict[Any, List] = defaultdict(list)
+        if with_annotations:
+            user_select = ', neuron_link.user_id' if with_user_info else ''
+            cursor.execute(f'''
+                SELECT neuron_link.class_instance_a,
+                       annotation_link.class_instance_b
+                       {user_select}
+                FROM class_instance_class_instance neuron_link
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                    ON skeleton.id = neuron_link.class_instance_a
+                JOIN class_instance_class_instance annotation_link
+                    ON annotation_link.class_instance_a = neuron_link.class_instance_b
+                WHERE neuron_link.relation_id = %(model_of)s
+                  AND annotation_link.relation_id = %(annotated_with)s
+            ''', {
+                'skeleton_ids': batch,
+                'model_of': relations['model_of'],
+                'annotated_with': relations['annotated_with']
+            })
+            for row in cursor.fetchall():
+                annotations[row[0]].append(row[1:])
+
+        for skeleton_id in batch:
+            yield skeleton_id, (tuple(nodes.get(skeleton_id, ())),
+                    tuple(connectors.get(skeleton_id, ())),
+                    tags.get(skeleton_id, {}), reviews.get(skeleton_id, []),
+                    annotations.get(skeleton_id, []))
+
+
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
         with_connectors=None, with_tags=None, with_time=None, ordered=False,
         with_halflinks=False) -> Tuple[Tuple, List, DefaultDict[Any, List]]:
@@ -1186,152 +1380,167 @@ def skeleton_with_metadata(request:HttpRequest, project_id=None, skeleton_id=Non
         },
     )
 
-def _measure_skeletons(skeleton_ids) -> Dict[Any, Any]:
+class SkeletonMeasurements():
+    """Cable and topology measurements of a single skeleton."""
+    def __init__(self, n_nodes=0, raw_cable=0.0, smooth_cable=0.0,
+            principal_branch_cable=0.0, n_ends=0, n_branch=0):
+        self.n_nodes = n_nodes
+        self.raw_cable = raw_cable
+        self.smooth_cable = smooth_cable
+        self.principal_branch_cable = principal_branch_cable
+        self.n_ends = n_ends
+        self.n_branch = n_branch
+        self.n_pre = 0
+        self.n_post = 0
+
+
+def _measure_skeleton_nodes(node_ids, parent_ids, skeleton_ids, locations) -> Dict[int, SkeletonMeasurements]:
+    """Measure all skeletons represented by the passed in node arrays. Parent
+    IDs of root nodes are expected to be -1. Locations are expected as an Nx3
+    array.
+
+    Raw cable is the sum of all edge lengths. For the smooth cable, every slab
+    node is moved to 40% of its own location and 60% of the distance-weighted
+    average of its neighbors' locations (root, branch and end nodes stay in
+    place). The principal branch is the path from the node with the most edges
+    to the root to the root node, measured on the smoothed skeleton.
+    """
+    n_nodes = len(node_ids)
+    if not n_nodes:
+        return {}
+
+    unique_skeleton_ids, skeleton_idx, nodes_per_skeleton = np.unique(
+            skeleton_ids, return_inverse=True, return_counts=True)
+    n_skeletons = len(unique_skeleton_ids)
+
+    # Map parent IDs to node indices, parents that aren't part of the passed in
+    # nodes are treated as roots.
+    order = np.argsort(node_ids)
+    sorted_ids = node_ids[order]
+    parent_pos = np.minimum(np.searchsorted(sorted_ids, parent_ids), n_nodes - 1)
+    found = (parent_ids != -1) & (sorted_ids[parent_pos] == parent_ids)
+    parent_idx = np.where(found, order[parent_pos], -1)
+
+    child = np.flatnonzero(parent_idx != -1)
+    parent = parent_idx[child]
+    edge_skeleton = skeleton_idx[child]
+
+    n_children = np.bincount(parent, minlength=n_nodes)
+    is_root = parent_idx == -1
+    is_end = np.where(is_root, n_children == 1, n_children == 0)
+    is_branch = np.where(is_root, n_children > 2, n_children > 1)
+    # Root nodes with two children are in the middle of the skeleton and are
+    # treated like slab nodes.
+    is_slab = np.where(is_root, n_children == 2, n_children == 1)
+
+    raw_lengths = np.linalg.norm(locations[child] - locations[parent], axis=1)
+
+    # Weighted average of the neighbors of each node, the weight of each
+    # neighbor is its distance to the node.
+    weight_sums = np.bincount(child, weights=raw_lengths, minlength=n_nodes) + \
+            np.bincount(parent, weights=raw_lengths, minlength=n_nodes)
+    weighted = np.empty_like(locations)
+    for dim in range(3):
+        weighted[:, dim] = \
+                np.bincount(child, weights=raw_lengths * locations[parent, dim], minlength=n_nodes) + \
+                np.bincount(parent, weights=raw_lengths * locations[child, dim], minlength=n_nodes)
+    smooth = is_slab & (weight_sums > 0)
+    smoothed = locations.copy()
+    smoothed[smooth] = locations[smooth] * 0.4 + \
+            (weighted[smooth] / weight_sums[smooth, np.newaxis]) * 0.6
+
+    smooth_lengths = np.linalg.norm(smoothed[child] - smoothed[parent], axis=1)
+    node_smooth_lengths = np.zeros(n_nodes)
+    node_smooth_lengths[child] = smooth_lengths
+
+    # The principal branch is the path from the node with the largest number
+    # of edges to the root. Its smoothed cable is the accumulated smoothed edge
+    # length of this node.
+    depth, root_distance = accumulate_to_root(parent_idx, node_smooth_lengths)
+    by_depth = np.lexsort((-depth, skeleton_idx))
+    first_of_skeleton = np.concatenate(([0], np.cumsum(nodes_per_skeleton)[:-1]))
+    principal_branch_cable = root_distance[by_depth[first_of_skeleton]]
+
+    raw_cable = np.bincount(edge_skeleton, weights=raw_lengths, minlength=n_skeletons)
+    smooth_cable = np.bincount(edge_skeleton, weights=smooth_lengths, minlength=n_skeletons)
+    n_ends = np.bincount(skeleton_idx, weights=is_end, minlength=n_skeletons)
+    n_branch = np.bincount(skeleton_idx, weights=is_branch, minlength=n_skeletons)
+
+    return {int(skid): SkeletonMeasurements(int(nodes_per_skeleton[i]),
+                float(raw_cable[i]), float(smooth_cable[i]),
+                float(principal_branch_cable[i]), int(n_ends[i]),
+                int(n_branch[i]))
+            for i, skid in enumerate(unique_skeleton_ids)}
+
+
+def _measure_skeletons(skeleton_ids, batch_size=1000) -> Dict[int, SkeletonMeasurements]:
+    """Measure cable length and topology of the passed in skeletons along with
+    their number of inputs and outputs. Skeletons are queried and measured in
+    batches of <batch_size> skeletons to limit memory use.
+    """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
-    skids_string = ",".join(map(str, skeleton_ids))
-
+    skeleton_ids = list(skeleton_ids)
+    skeletons:Dict[int, SkeletonMeasurements] = {}
     cursor = connection.cursor()
-    cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x  # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children:Dict[Any, float] = {}  # node ID vs distance - is first type an int or an str?
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes:Dict[Any, Node] = {}
-            self.raw_cable = 0.0
-            self.smooth_cable = 0.0
-            self.principal_branch_cable = 0.0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    skeletons:Dict[Any, Skeleton] = {}  # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        if row[2] not in skeletons:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        else:
-            skeleton = skeletons[row[2]]
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
+    node_dtype = [('id', np.int64), ('parent_id', np.int64),
+            ('skeleton_id', np.int64), ('location', np.float64, 3)]
 
-    for skeleton in skeletons.values():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.items():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.values())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.items():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
-
-    # Count inputs
-    cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
-    ''' % skids_string)
-
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+    for i in range(0, len(skeleton_ids), batch_size):
+        batch = skeleton_ids[i:i + batch_size]
+        cursor.execute('''
+            SELECT t.id, COALESCE(t.parent_id, -1), t.skeleton_id,
+                t.location_x, t.location_y, t.location_z
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON query.skeleton_id = t.skeleton_id
+        ''', {
+            'skeleton_ids': batch,
+        })
+        nodes = np.array([(r[0], r[1], r[2], r[3:]) for r in cursor.fetchall()],
+                dtype=node_dtype)
+        skeletons.update(_measure_skeleton_nodes(nodes['id'],
+                nodes['parent_id'], nodes['skeleton_id'], nodes['location']))
 
-    # Count outputs
-    cursor.execute('''
-    SELECT tc1.skeleton_id, count(tc1.skeleton_id)
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         relation r1,
-         relation r2
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = 'presynaptic_to'
-      AND tc2.relation_id = r2.id
-      AND r2.relation_name = 'postsynaptic_to'
-      GROUP BY tc1.skeleton_id
-    ''' % skids_string)
+        # Count inputs
+        cursor.execute('''
+            SELECT tc.skeleton_id, count(tc.skeleton_id)
+            FROM treenode_connector tc
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON query.skeleton_id = tc.skeleton_id
+            JOIN relation r
+                ON r.id = tc.relation_id
+            WHERE r.relation_name = 'postsynaptic_to'
+            GROUP BY tc.skeleton_id
+        ''', {
+            'skeleton_ids': batch,
+        })
+        for skid, n_pre in cursor.fetchall():
+            if skid in skeletons:
+                skeletons[skid].n_pre = n_pre
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
+        # Count outputs
+        cursor.execute('''
+            SELECT tc1.skeleton_id, count(tc1.skeleton_id)
+            FROM treenode_connector tc1
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+                ON query.skeleton_id = tc1.skeleton_id
+            JOIN relation r1
+                ON r1.id = tc1.relation_id
+            JOIN treenode_connector tc2
+                ON tc2.connector_id = tc1.connector_id
+            JOIN relation r2
+                ON r2.id = tc2.relation_id
+            WHERE r1.relation_name = 'presynaptic_to'
+              AND r2.relation_name = 'postsynaptic_to'
+            GROUP BY tc1.skeleton_id
+        ''', {
+            'skeleton_ids': batch,
+        })
+        for skid, n_post in cursor.fetchall():
+            if skid in skeletons:
+                skeletons[skid].n_post = n_post
 
     return skeletons
 
@@ -1341,7 +1550,7 @@ def measure_skeletons(request:HttpRequest, project_id=None) -> JsonResponse:
     skeleton_ids = tuple(int(v) for k,v in request.POST.items() if k.startswith('skeleton_ids['))
 
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
     return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).items()], safe=False)
 
 
@@ -20,10 +20,12 @@ from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from catmaid import locks
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_request_bool
-from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
-        Review, Relation, TreenodeConnector
+from catmaid.middleware import request_instrumentation
+from catmaid.models import ClassInstance, Connector, Project, Treenode, User, \
+        UserRole, Review, Relation, TreenodeConnector
 
 
 @api_view(['GET'])
@@ -963,8 +965,11 @@ def select_review_stats(cursor, project_id, start_date_utc, end_date_utc,
     return cursor.fetchall()
 
 @transaction.atomic
-def populate_stats_summary(project_id, delete:bool=False, incremental:bool=True) -> None:
-    """Create statistics summary tables from scratch until yesterday.
+def populate_stats_summary(project_id, delete:bool=False, incremental:bool=True,
+        include_current_hour:bool=False) -> None:
+    """Create statistics summary tables from scratch until yesterday. Unless
+    <include_current_hour> is true, data of the current hour is skipped for
+    most statistics.
     """
     cursor = connection.cursor()
     if delete:
@@ -972,14 +977,19 @@ def populate_stats_summary(project_id, delete:bool=False, incremental:bool=True)
             DELETE FROM catmaid_stats_summary WHERE project_id = %(project_id)s
         """, dict(project_id=project_id))
 
-    populate_review_stats_summary(project_id, incremental, cursor)
-    populate_connector_stats_summary(project_id, incremental, cursor)
-    populate_cable_stats_summary(project_id, incremental, cursor)
+    populate_review_stats_summary(project_id, incremental, cursor,
+            include_current_hour)
+    populate_connector_stats_summary(project_id, incremental, cursor,
+            include_current_hour)
+    populate_cable_stats_summary(project_id, incremental, cursor,
+            include_current_hour)
     populate_nodecount_stats_summary(project_id, incremental, cursor)
     populate_import_nodecount_stats_summary(project_id, incremental, cursor)
-    populate_import_cable_stats_summary(project_id, incremental, cursor)
+    populate_import_cable_stats_summary(project_id, incremental, cursor,
+            include_current_hour)
 
-def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None,
+        include_current_hour:bool=False) -> None:
     """Add review summary information to the summary table. Create hourly
     aggregates in UTC time. These aggregates can still be moved in other
     timezones with good enough precision for our purpose. By default, this
@@ -1006,7 +1016,7 @@ def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None
             FROM review r, last_precomputation
             WHERE r.project_id = %(project_id)s
             AND r.review_time > last_precomputation.max_date
-            AND r.review_time < date_trunc('hour', CURRENT_TIMESTAMP)
+            AND (%(include_current_hour)s OR r.review_time < date_trunc('hour', CURRENT_TIMESTAMP))
             GROUP BY r.reviewer_id, date
         )
         INSERT INTO catmaid_stats_summary (project_id, user_id, date,
@@ -1015,9 +1025,11 @@ def populate_review_stats_summary(project_id, incremental:bool=True, cursor=None
         FROM review_info ri
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_reviewed_nodes = EXCLUDED.n_reviewed_nodes;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental,
+              include_current_hour=include_current_hour))
 
-def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=None,
+        include_current_hour:bool=False) -> None:
     """Add connector summary information to the summary table. Create hourly
     aggregates in UTC time. These aggregates can still be moved in other
     timezones with good enough precision for our purpose. By default, this
@@ -1047,7 +1059,7 @@ def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=N
                 JOIN treenode_connector t2 ON t1.connector_id = t2.connector_id
                 WHERE t1.project_id=%(project_id)s
                 AND t1.creation_time >= last_precomputation.max_date
-                AND t1.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
+                AND (%(include_current_hour)s OR t1.creation_time < date_trunc('hour', CURRENT_TIMESTAMP))
                 AND t1.relation_id <> t2.relation_id
                 AND (t1.relation_id = %(pre_id)s OR t1.relation_id = %(post_id)s)
                 AND (t2.relation_id = %(pre_id)s OR t2.relation_id = %(post_id)s)
@@ -1061,9 +1073,11 @@ def populate_connector_stats_summary(project_id, incremental:bool=True, cursor=N
             ON CONFLICT (project_id, user_id, date) DO UPDATE
             SET n_connector_links = EXCLUDED.n_connector_links;
         """, dict(project_id=project_id, pre_id=pre_id, post_id=post_id,
-                  incremental=incremental))
+                  incremental=incremental,
+                  include_current_hour=include_current_hour))
 
-def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None,
+        include_current_hour:bool=False) -> None:
     """Add cable length summary data to the statistics summary table. By
     default, this happens in an incremental manner, but can optionally be fone
     for all data from scratch (overriding existing statistics).
@@ -1095,7 +1109,7 @@ def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None)
                 FROM treenode child, last_precomputation
                 WHERE child.project_id = %(project_id)s
                   AND child.creation_time >= last_precomputation.max_date
-                  AND child.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
+                  AND (%(include_current_hour)s OR child.creation_time < date_trunc('hour', CURRENT_TIMESTAMP))
             ) AS child
             INNER JOIN LATERAL (
                 SELECT sqrt(pow(child.location_x - parent.location_x, 2)
@@ -1114,7 +1128,8 @@ def populate_cable_stats_summary(project_id, incremental:bool=True, cursor=None)
         FROM cable_info ci
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET cable_length = EXCLUDED.cable_length;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental,
+              include_current_hour=include_current_hour))
 
 def populate_nodecount_stats_summary(project_id, incremental:bool=True,
                                      cursor=None) -> None:
@@ -1209,7 +1224,8 @@ def populate_import_nodecount_stats_summary(project_id, incremental:bool=True,
         SET n_imported_treenodes = EXCLUDED.n_imported_treenodes;
     """, dict(project_id=project_id, incremental=incremental))
 
-def populate_import_cable_stats_summary(project_id, incremental:bool=True, cursor=None) -> None:
+def populate_import_cable_stats_summary(project_id, incremental:bool=True, cursor=None,
+        include_current_hour:bool=False) -> None:
     """Add imported cable length summary data to the statistics summary table.
     By default, this happens in an incremental manner, but can optionally be
     fone for all data from scratch (overriding existing statistics).
@@ -1236,7 +1252,7 @@ def populate_import_cable_stats_summary(project_id, incremental:bool=True, curso
             WHERE cti.project_id = %(project_id)s
               AND ABS(EXTRACT(EPOCH FROM t.creation_time) - EXTRACT(EPOCH FROM cti.execution_time)) < 3600
               AND t.creation_time >= last_precomputation.max_date
-              AND t.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
+              AND (%(include_current_hour)s OR t.creation_time < date_trunc('hour', CURRENT_TIMESTAMP))
               AND label = 'skeletons.import'
         ),
         cable_info AS (
@@ -1273,7 +1289,95 @@ def populate_import_cable_stats_summary(project_id, incremental:bool=True, curso
         FROM cable_info ci
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET import_cable_length = EXCLUDED.cable_length;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, incremental=incremental,
+              include_current_hour=include_current_hour))
+
+
+def is_stats_summary_delta_log_enabled(cursor=None) -> bool:
+    """Whether the triggers writing to the statistics summary delta log are
+    installed.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        SELECT EXISTS(SELECT * FROM pg_trigger
+        WHERE tgname = 'on_insert_treenode_update_stats_summary_delta')
+    """)
+    return cursor.fetchone()[0]
+
+@transaction.atomic
+def enable_stats_summary_delta_log(project_ids=None) -> None:
+    """Install the triggers that log changes of node counts, cable length,
+    reviews and synaptic links in the table catmaid_stats_summary_delta and
+    rebuild the statistics summary of the passed in projects (all by default)
+    from scratch, including the current hour. The triggers are (re)created
+    first, which locks the involved tables until the rebuild is done. This way
+    no change is missed or counted twice. The triggers log changes of all
+    projects, which is why all projects are rebuilt if the log wasn't enabled
+    before, regardless of the passed in project IDs.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        -- Obtain an advisory lock so that this function works also in a parallel
+        -- context.
+        SELECT pg_advisory_xact_lock(%(lock_id)s::bigint);
+    """, {
+        'lock_id': locks.stats_summary_delta_log_lock,
+    })
+    was_enabled = is_stats_summary_delta_log_enabled(cursor)
+    cursor.execute("SELECT enable_stats_summary_delta_log()")
+
+    # Changes logged before the triggers were recreated belong to the existing
+    # summary.
+    fold_stats_summary_delta_log(cursor)
+
+    projects = Project.objects.all()
+    if project_ids and was_enabled:
+        projects = projects.filter(id__in=project_ids)
+    for project_id in projects.values_list('id', flat=True):
+        populate_stats_summary(project_id, delete=True, incremental=False,
+                include_current_hour=True)
+
+def disable_stats_summary_delta_log() -> None:
+    """Remove the triggers writing to the statistics summary delta log and fold
+    remaining changes into the statistics summary.
+    """
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT pg_advisory_xact_lock(%(lock_id)s::bigint);
+            SELECT disable_stats_summary_delta_log();
+        """, {
+            'lock_id': locks.stats_summary_delta_log_lock,
+        })
+        fold_stats_summary_delta_log(cursor)
+
+def fold_stats_summary_delta_log(cursor=None) -> int:
+    """Add all changes in the statistics summary delta log to the statistics
+    summary and remove them from the log, in a single statement. Returns the
+    number of updated summary rows.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        WITH delta AS (
+            DELETE FROM catmaid_stats_summary_delta
+            RETURNING project_id, user_id, date, n_treenodes,
+                n_reviewed_nodes, n_connector_links, cable_length
+        )
+        INSERT INTO catmaid_stats_summary (project_id, user_id, date,
+                n_treenodes, n_reviewed_nodes, n_connector_links, cable_length)
+        SELECT project_id, user_id, date, SUM(n_treenodes),
+            SUM(n_reviewed_nodes), SUM(n_connector_links), SUM(cable_length)
+        FROM delta
+        GROUP BY project_id, user_id, date
+        ON CONFLICT (project_id, user_id, date) DO UPDATE
+        SET n_treenodes = catmaid_stats_summary.n_treenodes + EXCLUDED.n_treenodes,
+            n_reviewed_nodes = catmaid_stats_summary.n_reviewed_nodes + EXCLUDED.n_reviewed_nodes,
+            n_connector_links = catmaid_stats_summary.n_connector_links + EXCLUDED.n_connector_links,
+            cable_length = catmaid_stats_summary.cable_length + EXCLUDED.cable_length
+    """)
+    return cursor.rowcount
 
 
 class ServerStats(APIView):
@@ -1378,3 +1482,49 @@ class ServerStats(APIView):
             # Should be close to 0 or 0
             'replication_lag': bgwriter_stats[5],
         }
+
+
+class RequestStats(APIView):
+
+    @method_decorator(requires_user_role(UserRole.Admin))
+    def get(self, request:Request, project_id) -> Response:
+        """Return timing information of all requests handled by the server
+        process answering this request.
+
+        For each endpoint (HTTP method and URL pattern), the number of
+        requests, latency percentiles estimated from a histogram, the number of
+        SQL queries, the SQL time and the response size are returned, sorted by
+        the total time spent in an endpoint. The SQL queries of the most recent
+        slow requests are returned as well. Requests are only recorded if the
+        RequestInstrumentationMiddleware is enabled. With multiple server
+        processes, each process keeps its own statistics.
+        ---
+        parameters:
+        - name: endpoint
+          description: Only return endpoints that contain this string.
+          type: string
+          paramType: form
+          required: false
+        """
+        stats = request_instrumentation.get_stats()
+        endpoint_filter = request.query_params.get('endpoint')
+        if endpoint_filter:
+            stats['endpoints'] = [e for e in stats['endpoints']
+                    if endpoint_filter in e['endpoint']]
+            stats['slow_requests'] = [r for r in stats['slow_requests']
+                    if endpoint_filter in r['endpoint']]
+        stats['enabled'] = 'catmaid.middleware.RequestInstrumentationMiddleware' \
+                in settings.MIDDLEWARE
+        stats['slow_threshold'] = getattr(settings,
+                'REQUEST_INSTRUMENTATION_SLOW_THRESHOLD', 1.0)
+        return Response(stats)
+
+    @method_decorator(requires_user_role(UserRole.Admin))
+    def delete(self, request:Request, project_id) -> Response:
+        """Reset the request statistics of the server process answering this
+        request.
+        """
+        request_instrumentation.reset()
+        return Response({
+            'reset': True,
+        })
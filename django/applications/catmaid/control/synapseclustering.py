@@ -14,18 +14,34 @@ try:
     from scipy.sparse.csgraph import dijkstra
 except ImportError:
     logger.warning("CATMAID was unable to load the scipy module. "
-        "Synapse clustering won't be available")
+        "distanceMatrix() won't be available")
 
 from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import ArrayTree
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
 
 
+# Kernel densities are only evaluated for synapses within this many
+# bandwidths of a node. Contributions of synapses further away are below
+# exp(-37), i.e. below double precision relative to the density of one synapse,
+# and are ignored. Smaller values would change the order of nearly equal
+# densities on symmetric arbors.
+DENSITY_CUTOFF = 6.1
+
+SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
+
+
 def synapse_clustering(skeleton_id, h_list) -> Dict:
 
-    Gwud = createSpatialGraphFromSkeletonID( skeleton_id )
+    tree = ArrayTree.from_rows(Treenode.objects.filter(skeleton_id=skeleton_id)
+            .values_list('id', 'parent_id', 'location_x', 'location_y',
+            'location_z'), with_locations=True)
     synNodes, connector_ids, relations = synapseNodesFromSkeletonID( skeleton_id )
 
-    return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
+    child = np.flatnonzero(tree.parents != -1)
+    return arbor_max_density(tree.node_ids, child, tree.parents[child],
+            tree.edge_lengths()[child], synNodes, connector_ids, relations,
+            h_list)
 
 
 def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list) -> Dict:
@@ -35,67 +51,124 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list) -> Dict:
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
     """
+    node_ids = list(Gwud.nodes())
+    id2index = {node: i for i, node in enumerate(node_ids)}
+    edges = list(Gwud.edges(data=True))
+    a = np.fromiter((id2index[e[0]] for e in edges), dtype=np.int64, count=len(edges))
+    b = np.fromiter((id2index[e[1]] for e in edges), dtype=np.int64, count=len(edges))
+    w = np.fromiter((e[2].get('weight', 1.0) for e in edges), dtype=np.float64,
+            count=len(edges))
+
+    return arbor_max_density(node_ids, a, b, w, synNodes, connector_ids,
+            relations, h_list)
+
+
+def arbor_max_density(node_ids, a, b, w, synNodes, connector_ids, relations,
+        h_list) -> Dict:
+    """ Find synapse groups by climbing the synapse density field of a tree or
+    forest from each synapse node to a local maximum. The density at a node is
+    the sum of exp(-d^2 / h^2) over all synapse nodes, d being the path length
+    between them. The arbor is given as edges between the node indices <a> and
+    <b> with lengths <w>. <node_ids> maps indices to node IDs. Path lengths are
+    computed once for all synapse/node pairs within DENSITY_CUTOFF times the
+    largest bandwidth and shared by all bandwidths in <h_list>, which avoids
+    an all-to-all distance matrix. Returns a dictionary that maps each
+    bandwidth to a dictionary of group index vs SynapseGroup.
+    """
+    if not h_list:
+        return {}
+
+    node_ids = node_ids.tolist() if isinstance(node_ids, np.ndarray) else list(node_ids)
+    n = len(node_ids)
+    id2index = {node: i for i, node in enumerate(node_ids)}
+    syn_index = np.fromiter((id2index[node] for node in synNodes), dtype=np.int64,
+            count=len(synNodes))
+
+    # Adjacency in compressed sparse row form, edges are stored in both
+    # directions.
+    src = np.concatenate((a, b))
+    dst = np.concatenate((b, a))
+    lengths = np.concatenate((w, w))
+    order = np.argsort(src, kind='stable')
+    src, dst, lengths = src[order], dst[order], lengths[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n))))
+
+    # Multiple synapses on the same node contribute only once.
+    pair_nodes, pair_dist = _nodes_within(offsets, dst, lengths,
+            np.unique(syn_index), DENSITY_CUTOFF * max(h_list))
+    pair_dist_sq = pair_dist * pair_dist
 
-    D, id2index = distanceMatrix(Gwud, synNodes)
-
-    SynapseGroup:NamedTuple = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups:Dict = {}
 
     for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
-        targLoc:Dict = {}           # targLocs hosts the final destination nodes of the hill climbing
-        densityField:Dict = {}      # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    # Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
-
-        loc2group = {}
+        in_range = pair_dist <= DENSITY_CUTOFF * h
+        density = np.bincount(pair_nodes[in_range],
+                weights=np.exp(-pair_dist_sq[in_range] / (h * h)), minlength=n)
+
+        # Each node points to its densest neighbor, if that is denser than the
+        # node itself. The first neighbor wins ties.
+        best = np.full(n, -np.inf)
+        np.maximum.at(best, src, density[dst])
+        first_best = np.flatnonzero(density[dst] == best[src])
+        nodes_with_best, first = np.unique(src[first_best], return_index=True)
+        climb = np.arange(n)
+        uphill = best[nodes_with_best] > density[nodes_with_best]
+        climb[nodes_with_best[uphill]] = dst[first_best[first[uphill]]]
+
+        # Follow the pointers to the local maxima.
+        while True:
+            next_climb = climb[climb]
+            if np.array_equal(next_climb, climb):
+                break
+            climb = next_climb
+
+        targets = climb[syn_index]
+        unique_targets, first_seen = np.unique(targets, return_index=True)
+        unique_targets = unique_targets[np.argsort(first_seen)]
 
         synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
-            loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
+        loc2group = {}
+        for ind, target in enumerate(unique_targets.tolist()):
+            loc2group[target] = ind
+            synapseGroups[h][ind] = SynapseGroup([], [], [], node_ids[target])
 
-        for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
-            synapseGroups[h][ gi ].node_ids.append( node )
-            synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
-            synapseGroups[h][ gi ].relations.append( relations[ind] )
+        for ind, (node, target) in enumerate(zip(synNodes, targets.tolist())):
+            group = synapseGroups[h][loc2group[target]]
+            group.node_ids.append( node )
+            group.connector_ids.append( connector_ids[ind] )
+            group.relations.append( relations[ind] )
 
     return synapseGroups
 
+
+def _nodes_within(offsets, neighbors, lengths, sources, cutoff) -> Tuple[np.ndarray, np.ndarray]:
+    """ Find all nodes within path length <cutoff> of each source node by
+    expanding all sources at once, one edge per step, never walking back the
+    edge a node was reached through. This expects a tree or forest. Returns
+    the reached node index and the path length for each (source, node) pair.
+    """
+    node = np.asarray(sources, dtype=np.int64)
+    came_from = np.full(len(node), -1, dtype=np.int64)
+    dist = np.zeros(len(node))
+    reached_nodes = [node]
+    reached_dist = [dist]
+
+    while len(node):
+        degree = offsets[node + 1] - offsets[node]
+        step = np.repeat(np.arange(len(node)), degree)
+        edge = np.repeat(offsets[node], degree) + \
+                np.arange(len(step)) - np.repeat(np.cumsum(degree) - degree, degree)
+        next_node = neighbors[edge]
+        next_dist = dist[step] + lengths[edge]
+        keep = (next_node != came_from[step]) & (next_dist <= cutoff)
+        came_from = node[step][keep]
+        node = next_node[keep]
+        dist = next_dist[keep]
+        reached_nodes.append(node)
+        reached_dist.append(dist)
+
+    return np.concatenate(reached_nodes), np.concatenate(reached_dist)
+
 def distanceMatrix(G, synNodes) -> Tuple[Any, Dict]:
     """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
      Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
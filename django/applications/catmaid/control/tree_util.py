@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 
-# A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# A 'tree' is a networkx.DiGraph with a single root node (a node without parents).
+# ArrayTree provides the same operations on a compact NumPy representation.
 
 from collections import defaultdict
 from itertools import islice
 from math import sqrt
 from networkx import Graph, DiGraph
+import numpy as np
 from operator import itemgetter
 from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
 
+from django.db import connection
+
 from catmaid.models import Treenode
 
 
@@ -227,3 +231,262 @@ def lazy_load_trees(skeleton_ids, node_properties):
 
     if tree:
         yield (skid, tree)
+
+
+def accumulate_to_root(parent_idx, weights=None) -> Tuple[np.ndarray, np.ndarray]:
+    """ Compute for each node of a forest the number of edges to its root and
+    the sum of <weights> along this path, where the weight of a node is the
+    weight of the edge to its parent. The parent index of root nodes is
+    expected to be -1. Sums are accumulated by pointer jumping, which needs only
+    a logarithmic number of vectorized passes over all nodes in the depth of
+    the forest. """
+    ancestor = np.array(parent_idx, dtype=np.int64)
+    has_parent = ancestor != -1
+    depth = has_parent.astype(np.int64)
+    if weights is None:
+        distance = depth.astype(np.float64)
+    else:
+        distance = np.where(has_parent, weights, 0.0)
+    max_iterations = max(1, int(np.ceil(np.log2(max(len(ancestor), 2)))) + 1)
+    for _ in range(max_iterations):
+        active = np.flatnonzero(ancestor != -1)
+        if not len(active):
+            break
+        next_ancestor = ancestor[active]
+        depth[active] += depth[next_ancestor]
+        distance[active] += distance[next_ancestor]
+        ancestor[active] = ancestor[next_ancestor]
+    else:
+        if (ancestor != -1).any():
+            raise ValueError("Tree contains a cycle")
+    return depth, distance
+
+
+class ArrayTree():
+    """ A compact tree of node IDs, backed by NumPy arrays rather than a
+    networkx graph. Nodes are addressed by their index in <node_ids>, <parents>
+    stores the index of each node's parent or -1 for the root. Children are
+    kept in compressed sparse row form and are computed when first needed.
+    Optionally, an Nx3 array of node locations can be attached. """
+
+    __slots__ = ('node_ids', 'parents', 'locations', '_sorted', '_order',
+            '_child_offsets', '_children')
+
+    def __init__(self, node_ids, parent_ids, locations=None):
+        """ Parent IDs of root nodes are expected to be None or -1. """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        parent_ids = np.array([-1 if p is None else p for p in parent_ids],
+                dtype=np.int64) if not isinstance(parent_ids, np.ndarray) \
+                else parent_ids.astype(np.int64)
+        self._order = np.argsort(self.node_ids, kind='stable')
+        self._sorted = self.node_ids[self._order]
+        self.parents = self._lookup(parent_ids)
+        self.locations = None if locations is None else \
+                np.asarray(locations, dtype=np.float64)
+        self._child_offsets:Optional[np.ndarray] = None
+        self._children:Optional[np.ndarray] = None
+
+    @classmethod
+    def from_rows(cls, rows, with_locations=False) -> "ArrayTree":
+        """ Create a tree from (id, parent_id) or, if <with_locations> is
+        True, (id, parent_id, x, y, z) rows. """
+        rows = list(rows)
+        node_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        parent_ids = np.fromiter((-1 if r[1] is None else r[1] for r in rows),
+                dtype=np.int64, count=len(rows))
+        locations = np.array([r[2:5] for r in rows], dtype=np.float64).reshape(-1, 3) \
+                if with_locations else None
+        return cls(node_ids, parent_ids, locations)
+
+    def _lookup(self, ids) -> np.ndarray:
+        """ Map node IDs to indices, unknown IDs are mapped to -1. """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self._sorted):
+            return np.full(ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self._sorted, ids), len(self._sorted) - 1)
+        return np.where(self._sorted[pos] == ids, self._order[pos], -1)
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __contains__(self, node_id) -> bool:
+        return self._lookup([node_id])[0] != -1
+
+    def index(self, node_id) -> int:
+        """ Return the index of the passed in node ID or raise a KeyError. """
+        idx = self._lookup([node_id])[0]
+        if idx == -1:
+            raise KeyError(node_id)
+        return int(idx)
+
+    def _ensure_children(self) -> None:
+        if self._children is None:
+            child = np.flatnonzero(self.parents != -1)
+            by_parent = np.argsort(self.parents[child], kind='stable')
+            self._children = child[by_parent]
+            counts = np.bincount(self.parents[child], minlength=len(self))
+            self._child_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    @property
+    def root(self):
+        """ The ID of the first node without parent or None if the tree is
+        empty. """
+        roots = np.flatnonzero(self.parents == -1)
+        return int(self.node_ids[roots[0]]) if len(roots) else None
+
+    @property
+    def n_children(self) -> np.ndarray:
+        self._ensure_children()
+        return np.diff(self._child_offsets)
+
+    def children(self, node_id) -> np.ndarray:
+        """ Return the IDs of the child nodes of the passed in node. """
+        self._ensure_children()
+        idx = self.index(node_id)
+        return self.node_ids[self._children[
+                self._child_offsets[idx]:self._child_offsets[idx + 1]]]
+
+    def parent(self, node_id):
+        """ Return the ID of the parent of the passed in node or None for the
+        root. """
+        parent = self.parents[self.index(node_id)]
+        return None if parent == -1 else int(self.node_ids[parent])
+
+    def leaves(self) -> np.ndarray:
+        """ Return the IDs of all nodes without children. """
+        return self.node_ids[self.n_children == 0]
+
+    def edge_count_to_root(self) -> np.ndarray:
+        """ Return the number of edges between each node and the root, in node
+        index order. Unlike the edge_count_to_root() function, the root has a
+        count of zero. """
+        return accumulate_to_root(self.parents)[0]
+
+    def edge_lengths(self) -> np.ndarray:
+        """ Return the Euclidean length of the edge to the parent of each node
+        in node index order, zero for the root. Requires locations. """
+        if self.locations is None:
+            raise ValueError("Tree has no locations")
+        has_parent = self.parents != -1
+        lengths = np.zeros(len(self))
+        lengths[has_parent] = np.linalg.norm(self.locations[has_parent] -
+                self.locations[self.parents[has_parent]], axis=1)
+        return lengths
+
+    def distance_to_root(self) -> np.ndarray:
+        """ Return the path length of each node to the root in node index
+        order. Requires locations. """
+        return accumulate_to_root(self.parents, self.edge_lengths())[1]
+
+    def cable_length(self) -> float:
+        """ Return the total cable length. Requires locations. """
+        return float(self.edge_lengths().sum())
+
+    def topological_order(self) -> np.ndarray:
+        """ Return the node indices ordered such that every parent comes
+        before its children. """
+        return np.argsort(self.edge_count_to_root(), kind='stable')
+
+    def _path_to_root(self, idx) -> List[int]:
+        path = [idx]
+        parent = self.parents[idx]
+        while parent != -1:
+            path.append(parent)
+            parent = self.parents[parent]
+            if len(path) > len(self):
+                raise ValueError("Tree contains a cycle")
+        return path
+
+    def reroot(self, new_root) -> None:
+        """ Reverse in place the direction of the edges from <new_root> to
+        the root. """
+        path = self._path_to_root(self.index(new_root))
+        if len(path) == 1:
+            # new_root is already the root
+            return
+        path_array = np.array(path, dtype=np.int64)
+        self.parents[path_array[1:]] = path_array[:-1]
+        self.parents[path_array[0]] = -1
+        self._children = None
+        self._child_offsets = None
+
+    def find_common_ancestor(self, node_ids) -> Tuple[Any, Any]:
+        """ Return the node ID that is the nearest common ancestor to all
+        passed in nodes along with its number of edges to the root. All nodes
+        are expected to be part of this tree. """
+        indices = [self.index(n) for n in node_ids]
+        if not indices:
+            raise ValueError("Need at least one node")
+        ancestors = self._path_to_root(indices[0])
+        on_path = np.zeros(len(self), dtype=bool)
+        on_path[ancestors] = True
+        lca_pos = 0
+        for idx in indices[1:]:
+            while not on_path[idx]:
+                idx = self.parents[idx]
+            # Nodes below the new common ancestor can't be part of the
+            # result anymore.
+            pos = ancestors.index(idx)
+            if pos > lca_pos:
+                on_path[ancestors[lca_pos:pos]] = False
+                lca_pos = pos
+        lca = ancestors[lca_pos]
+        return int(self.node_ids[lca]), len(ancestors) - lca_pos - 1
+
+    def partition(self):
+        """ Partition the tree as a list of sequences of node IDs, with
+        branch nodes repeated as ends of all sequences except the longest one
+        that finishes at the root. Each sequence runs from an end node to
+        either the root or a branch node. """
+        depths = self.edge_count_to_root()
+        leaves = np.flatnonzero(self.n_children == 0)
+        leaves = leaves[np.argsort(-depths[leaves], kind='stable')]
+        seen = np.zeros(len(self), dtype=bool)
+        parents = self.parents
+        node_ids = self.node_ids
+        for leaf in leaves:
+            sequence = [leaf]
+            parent = parents[leaf]
+            while parent != -1:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parents[parent]
+
+            if len(sequence) > 1:
+                yield node_ids[sequence].tolist()
+
+    def to_digraph(self) -> DiGraph:
+        """ Return a networkx DiGraph with edges from parents to children. """
+        tree = DiGraph()
+        tree.add_nodes_from(self.node_ids.tolist())
+        child = np.flatnonzero(self.parents != -1)
+        tree.add_edges_from(zip(self.node_ids[self.parents[child]].tolist(),
+                self.node_ids[child].tolist()))
+        return tree
+
+
+def lazy_load_array_trees(skeleton_ids, with_locations=False):
+    """ Return a lazy collection of pairs of (skeleton_id, ArrayTree). Unlike
+    lazy_load_trees(), all nodes of a skeleton are loaded in one go and no
+    per-node Python objects are kept. """
+    cursor = connection.cursor()
+    location_columns = ', t.location_x, t.location_y, t.location_z' \
+            if with_locations else ''
+    cursor.execute(f'''
+        SELECT t.skeleton_id, t.id, t.parent_id {location_columns}
+        FROM treenode t
+        JOIN UNNEST(%(skeleton_ids)s::bigint[]) query(skeleton_id)
+            ON query.skeleton_id = t.skeleton_id
+        ORDER BY t.skeleton_id
+    ''', {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    rows = cursor.fetchall()
+    start = 0
+    for i in range(1, len(rows) + 1):
+        if i == len(rows) or rows[i][0] != rows[start][0]:
+            yield (rows[start][0], ArrayTree.from_rows(
+                    (r[1:] for r in rows[start:i]), with_locations))
+            start = i
@@ -3,86 +3,88 @@
 import json
 import networkx as nx
 from networkx.readwrite import json_graph
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
-from django.http import HttpRequest, JsonResponse
-from django.db.models import Count
+from django.db import connection
+from django.http import HttpRequest, JsonResponse, StreamingHttpResponse
 
-from catmaid.models import Treenode, TreenodeConnector, UserRole
+from rest_framework.decorators import api_view
+
+from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map
+
+
+def get_wiring_diagram_edges(project_id, lower_treenode_number_limit=0,
+        relations=None) -> Iterator[Tuple[int, int, int, int, int]]:
+    """Yield the weighted edges of the skeleton wiring diagram of a project as
+    tuples of the form (source skeleton ID, target skeleton ID, number of
+    connectors, source node count, target node count). Edges are aggregated in
+    a single query and read through a server-side cursor. Each connector is
+    counted for its first presynaptic skeleton and all postsynaptic
+    skeletons. Only skeletons with at least <lower_treenode_number_limit> nodes
+    are included.
+    """
+    if not relations:
+        relations = get_relation_to_id_map(project_id,
+                ('presynaptic_to', 'postsynaptic_to'))
+
+    cursor = connection.chunked_cursor()
+    try:
+        cursor.execute("""
+            WITH pre AS (
+                SELECT DISTINCT ON (tc.connector_id) tc.connector_id,
+                    tc.skeleton_id
+                FROM treenode_connector tc
+                WHERE tc.project_id = %(project_id)s
+                    AND tc.relation_id = %(pre_id)s
+                ORDER BY tc.connector_id, tc.id
+            )
+            SELECT pre.skeleton_id, post.skeleton_id, COUNT(*),
+                pre_css.num_nodes, post_css.num_nodes
+            FROM pre
+            JOIN treenode_connector post
+                ON post.connector_id = pre.connector_id
+            JOIN catmaid_skeleton_summary pre_css
+                ON pre_css.skeleton_id = pre.skeleton_id
+            JOIN catmaid_skeleton_summary post_css
+                ON post_css.skeleton_id = post.skeleton_id
+            WHERE post.project_id = %(project_id)s
+                AND post.relation_id = %(post_id)s
+                AND pre_css.num_nodes >= %(min_nodes)s
+                AND post_css.num_nodes >= %(min_nodes)s
+            GROUP BY pre.skeleton_id, post.skeleton_id, pre_css.num_nodes,
+                post_css.num_nodes
+        """, {
+            'project_id': project_id,
+            'pre_id': relations['presynaptic_to'],
+            'post_id': relations['postsynaptic_to'],
+            'min_nodes': lower_treenode_number_limit,
+        })
+        yield from cursor
+    finally:
+        cursor.close()
 
 
 def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0) -> Dict[str, List]:
-
-    # result dictionary: {connectorid: presyn_skeletonid}
-    tmp:Dict = {}
-    result:Dict = {}
-    # get the presynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'presynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id not in tmp:
-            tmp[e.connector_id]=e.skeleton_id
-            result[e.skeleton_id]={}
-        else:
-            # connector with multiple presynaptic connections
-            pass
-
-    skeletons={}
-    qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
-    for e in qs:
-        skeletons[ e['skeleton'] ]=e['skeleton__count']
-
-    # get the postsynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'postsynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id in tmp:
-
-            # limit the skeletons to include
-            if skeletons[ tmp[e.connector_id] ] < lower_treenode_number_limit or\
-               skeletons[ e.skeleton_id ] < lower_treenode_number_limit:
-                continue
-
-            # an existing connector, so we add a connection
-            if e.skeleton_id in result[tmp[e.connector_id]]:
-                result[tmp[e.connector_id]][e.skeleton_id] += 1
-            else:
-                result[tmp[e.connector_id]][e.skeleton_id] = 1
-        else:
-            # connector with only postsynaptic connections
-            pass
-
     nodes_tmp:Dict = {}
-    edges=[]
-
-    for k,v in result.items():
-
-        for kk,vv in v.items():
-
-            edges.append(
-                    {"id": str(k)+"_"+str(kk),
-                     "source": str(k),
-                     "target": str(kk),
-                     "number_of_connector": vv}
-            )
-
-            nodes_tmp[k]=None
-            nodes_tmp[kk]=None
-
-    nodes=[]
-    for k,v in nodes_tmp.items():
-        nodes.append(
-            {
-                "id": str(k),
-                "label": "Skeleton "+str(k),
-                'node_count': skeletons[k],
-            }
-        )
+    edges = []
+    for source, target, n_connectors, source_nodes, target_nodes in \
+            get_wiring_diagram_edges(project_id, lower_treenode_number_limit):
+        edges.append({
+            "id": f"{source}_{target}",
+            "source": str(source),
+            "target": str(target),
+            "number_of_connector": n_connectors,
+        })
+        nodes_tmp[source] = source_nodes
+        nodes_tmp[target] = target_nodes
+
+    nodes = [{
+        "id": str(skeleton_id),
+        "label": f"Skeleton {skeleton_id}",
+        'node_count': node_count,
+    } for skeleton_id, node_count in nodes_tmp.items()]
 
     return { 'nodes': nodes, 'edges': edges }
 
@@ -135,3 +137,101 @@ def export_wiring_diagram(request:HttpRequest, project_id=None) -> JsonResponse:
         'sort_keys': True,
         'indent': 4
     })
+
+
+@api_view(['GET'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def stream_wiring_diagram(request:HttpRequest, project_id=None) -> StreamingHttpResponse:
+    """Export the skeleton wiring diagram of a project as JSON or GraphML. Edges
+    are computed by the database and streamed as they are read, followed by
+    all skeletons that are part of an edge.
+    ---
+    parameters:
+      - name: project_id
+        description: Project to export the wiring diagram of
+        type: integer
+        paramType: path
+        required: true
+      - name: format
+        description: Either "json" or "graphml".
+        type: string
+        paramType: form
+        required: false
+        defaultValue: json
+      - name: lower_skeleton_count
+        description: Only include skeletons with at least this many nodes.
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 0
+    """
+    export_format = request.query_params.get('format', 'json')
+    if export_format not in ('json', 'graphml'):
+        raise ValueError(f"Unknown format: {export_format}")
+    lower_treenode_number_limit = int(request.query_params.get(
+            'lower_skeleton_count', 0))
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'))
+
+    # Edges are read when the response is streamed, node counts are
+    # collected on the way.
+    nodes:Dict[int, int] = {}
+    def edges():
+        for source, target, n_connectors, source_nodes, target_nodes in \
+                get_wiring_diagram_edges(project_id,
+                        lower_treenode_number_limit, relations):
+            nodes[source] = source_nodes
+            nodes[target] = target_nodes
+            yield source, target, n_connectors
+
+    if export_format == 'graphml':
+        def graphml_stream():
+            yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                    '<key id="label" for="node" attr.name="label" attr.type="string"/>\n'
+                    '<key id="node_count" for="node" attr.name="node_count" attr.type="int"/>\n'
+                    '<key id="number_of_connector" for="edge" attr.name="number_of_connector" attr.type="int"/>\n'
+                    '<graph id="wiringdiagram" edgedefault="directed">\n')
+            for source, target, n_connectors in edges():
+                yield (f'<edge id="{source}_{target}" source="{source}" target="{target}">'
+                        f'<data key="number_of_connector">{n_connectors}</data></edge>\n')
+            for skeleton_id, node_count in nodes.items():
+                yield (f'<node id="{skeleton_id}"><data key="label">Skeleton {skeleton_id}</data>'
+                        f'<data key="node_count">{node_count}</data></node>\n')
+            yield '</graph>\n</graphml>\n'
+        response = StreamingHttpResponse(graphml_stream(),
+                content_type='application/graphml+xml')
+        extension = 'graphml'
+    else:
+        data_schema = {
+            'nodes': [
+                {'name':'id','type':'string'},
+                {'name':'label','type':'string'},
+                {'name':'node_count','type':'number'},
+            ],
+            'edges': [
+                {'name': 'id','type':'string'},
+                {'name': 'number_of_connector','type':'number'},
+                {'name': "directed", "type": "boolean", "defValue": True},
+            ],
+        }
+        def json_stream():
+            yield '{{"dataSchema":{},"data":{{"edges":['.format(
+                    json.dumps(data_schema, separators=(',', ':')))
+            for n, (source, target, n_connectors) in enumerate(edges()):
+                yield '{}{{"id":"{}_{}","source":"{}","target":"{}","number_of_connector":{}}}'.format(
+                        ',' if n else '', source, target, source, target,
+                        n_connectors)
+            yield '],"nodes":['
+            for n, (skeleton_id, node_count) in enumerate(nodes.items()):
+                yield '{}{{"id":"{}","label":"Skeleton {}","node_count":{}}}'.format(
+                        ',' if n else '', skeleton_id, skeleton_id, node_count)
+            yield ']}}'
+        response = StreamingHttpResponse(json_stream(),
+                content_type='application/json')
+        extension = 'json'
+
+    filename = f'catmaid-wiring-diagram-{project_id}.{extension}'
+    response['Content-Disposition'] = f'attachment; filename={filename}'
+
+    return response
@@ -6,3 +6,9 @@ base_lock_id = 123666608142000
 spatial_update_event_lock = base_lock_id + 1
 # Postgres advisory lock ID to update history update even handling
 history_update_event_lock = base_lock_id + 2
+# Postgres advisory lock ID to enable or disable the statistics summary delta log
+stats_summary_delta_log_lock = base_lock_id + 3
+# Postgres advisory lock key to serialize annotation closure table updates. It
+# is used together with a project ID as second key and has therefore to fit
+# into a 32 bit integer.
+annotation_closure_lock = (base_lock_id + 4) % 2**31
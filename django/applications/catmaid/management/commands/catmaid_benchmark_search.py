@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from catmaid.control.search import SEARCH_MODES, search_class_instances
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = '''Compare the query times of the search modes of the search
+        endpoint for a set of search terms. Each search is repeated a few times
+        and the minimum and median time are reported.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='+', help='The search terms to test')
+        parser.add_argument('--project_id', dest='project_id', required=True,
+                type=int, help='The ID of the project to search in')
+        parser.add_argument('--mode', dest='modes', action='append',
+                choices=SEARCH_MODES, default=None, help='A search mode to '
+                'test, can be used multiple times. All modes are tested by '
+                'default.')
+        parser.add_argument('--limit', dest='limit', type=int, default=None,
+                help='The maximum number of results per search')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                help='How often each search is run')
+
+    def handle(self, *args, **options):
+        project_id = options['project_id']
+        if not Project.objects.filter(pk=project_id).exists():
+            raise CommandError(f'Could not find project {project_id}')
+        if options['repeat'] < 1:
+            raise CommandError('Need at least one repetition')
+
+        modes = options['modes'] or SEARCH_MODES
+        cursor = connection.cursor()
+
+        self.stdout.write('term\tmode\tresults\tmin (ms)\tmedian (ms)')
+        for term in options['terms']:
+            for mode in modes:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    rows = search_class_instances(project_id, term, mode,
+                            options['limit'], cursor=cursor)
+                    timings.append((time.perf_counter() - start) * 1000)
+                self.stdout.write(f'{term}\t{mode}\t{len(rows)}\t'
+                        f'{min(timings):.1f}\t{statistics.median(timings):.1f}')
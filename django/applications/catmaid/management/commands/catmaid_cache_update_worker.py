@@ -1,20 +1,19 @@
-from collections import defaultdict
 import json
 import logging
+import multiprocessing
 import select
 import signal
 import time
-from typing import Dict, List, Set
+from typing import Dict, List
 
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, connections, transaction
 
-from catmaid.control.edge import get_intersected_grid_cells
-from catmaid.control.node import (get_configured_node_providers,
-        GridCachedNodeProvider, Postgis3dNodeProvider, update_grid_cell)
-from catmaid.models import NodeGridCache, DirtyNodeGridCacheCell
+from catmaid.control.node import (Postgis3dNodeProvider, update_grid_cell,
+        notify_grid_cache_update)
+from catmaid.models import NodeGridCache
 from catmaid.util import str2bool
 from .common import set_log_level
 
@@ -23,56 +22,141 @@ logger = logging.getLogger(__name__)
 
 
 class GridWorker():
-
-    def __init__(self):
-        pass
+    """Recompute dirty grid cache cells. Dirty cells are claimed in batches
+    from the dirty cell table using FOR UPDATE SKIP LOCKED, which allows
+    multiple worker processes (also on different hosts) to work on the same
+    table without processing a cell twice. If <n_shards> is larger than one,
+    only cells for which a hash of (grid_id, x, y, z) modulo <n_shards> equals
+    <shard> are claimed.
+    """
+
+    def __init__(self, shard=0, n_shards=1, batch_size=10):
+        self.shard = shard
+        self.n_shards = n_shards
+        self.batch_size = batch_size
+        self.provider = Postgis3dNodeProvider()
+        self.updated_cells = 0
+        # If set, no new batch of dirty cells is claimed.
+        self.stopped = False
 
     def update(self, updates, cursor):
-        """Pop the oldest item from the diry cell table, compute the respective
-        FOV and update the cache cell.
+        """Notifications only signal that there are dirty cells. Process all
+        dirty cells of this worker's shard.
+        """
+        self.process_dirty_cells()
+
+    def claim_dirty_cells(self, cursor) -> List:
+        """Lock and return up to <batch_size> of the oldest dirty cells of this
+        worker's shard that aren't locked by another worker. Needs to be called
+        in a transaction.
+        """
+        if self.n_shards > 1:
+            shard_filter = '''
+                AND mod(abs(hashtext(concat_ws(',', grid_id, x_index,
+                    y_index, z_index))), %(n_shards)s) = %(shard)s
+            '''
+        else:
+            shard_filter = ''
+        cursor.execute(f'''
+            SELECT id, grid_id, x_index, y_index, z_index
+            FROM dirty_node_grid_cache_cell
+            WHERE TRUE
+            {shard_filter}
+            ORDER BY invalidation_time
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        ''', {
+            'n_shards': self.n_shards,
+            'shard': self.shard,
+            'batch_size': self.batch_size,
+        })
+        return cursor.fetchall()
+
+    def process_dirty_cells(self) -> int:
+        """Claim, recompute and remove dirty cells until there are no more
+        unclaimed dirty cells in this worker's shard. Each batch is processed in
+        its own transaction, so that cells of a failed batch stay dirty.
+        Returns the number of recomputed cells.
+        """
+        n_processed = 0
+        grid_map:Dict = {}
+        while not self.stopped:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                dirty_cells = self.claim_dirty_cells(cursor)
+                if not dirty_cells:
+                    break
+
+                missing_grid_ids = set(c[1] for c in dirty_cells) - set(grid_map.keys())
+                if missing_grid_ids:
+                    grid_map.update((g.id, g) for g in
+                            NodeGridCache.objects.filter(pk__in=missing_grid_ids))
+
+                for _, grid_id, w_i, h_i, d_i in dirty_cells:
+                    g = grid_map.get(grid_id)
+                    if g:
+                        self.update_cell(g, w_i, h_i, d_i, cursor)
+
+                cursor.execute('''
+                    DELETE FROM dirty_node_grid_cache_cell
+                    WHERE id = ANY(%(ids)s::bigint[])
+                ''', {
+                    'ids': [c[0] for c in dirty_cells],
+                })
+                n_processed += len(dirty_cells)
+
+        if n_processed:
+            self.updated_cells += n_processed
+            logger.debug(f'Updated {n_processed} grid cell(s) in shard {self.shard + 1}/{self.n_shards}')
+
+        return n_processed
+
+    def update_cell(self, g, w_i, h_i, d_i, cursor) -> None:
+        """Recompute a single cell of grid <g>. Cells that are empty now are
+        removed, unless the grid allows empty cells.
         """
-        # Get all referenced grids along with their project IDs and node
-        # constraints: n_last_edited_skeletons_limit,
-        # n_last_edited_skeletons_limit, hidden_last_editor_id
-        referenced_grid_ids = set(u['grid_id'] for u in updates)
-        grids = NodeGridCache.objects.filter(pk__in=referenced_grid_ids)
-        grid_map = dict((g.id, g) for g in grids)
-
-        provider = Postgis3dNodeProvider()
-        cursor = connection.cursor()
-
-        # Batch of grids to update during one run
-        updated_cells = 0
-        for update in updates:
-            g = grid_map[update['grid_id']]
-            w_i, h_i, d_i = update['x'], update['y'], update['z']
-
-            params = {
-                'project_id': g.project_id,
-                'limit': settings.NODE_LIST_MAXIMUM_COUNT,
-                'ordering': g.ordering,
-            }
-            if g.n_last_edited_skeletons_limit:
-                params['n_largest_skeletons_limit'] = int(g.n_largest_skeletons_limit)
-            if g.n_last_edited_skeletons_limit:
-                params['n_last_edited_skeletons_limit'] = int(g.n_last_edited_skeletons_limit)
-            if g.hidden_last_editor_id:
-                params['hidden_last_editor_id'] = int(g.hidden_last_editor_id)
-
-            added = update_grid_cell(g.project_id, g.id, w_i, h_i, d_i,
-                    g.cell_width, g.cell_height, g.cell_depth,
-                    params, g.allow_empty, g.n_lod_levels, g.lod_min_bucket_size,
-                    g.lod_strategy, g.has_json_data, g.has_json_text_data,
-                    g.has_msgpack_data, provider=provider, cursor=cursor)
-
-            if added:
-                updated_cells += 1
-
-                # TODO: delete in batches
-                DirtyNodeGridCacheCell.objects.filter(grid_id=g.id, x_index=w_i,
-                        y_index=h_i, z_index=d_i).delete()
-
-        logger.debug(f'Updated {updated_cells} grid cell(s) in {len(referenced_grid_ids)} grid cache(s)')
+        params = {
+            'project_id': g.project_id,
+            'limit': settings.NODE_LIST_MAXIMUM_COUNT,
+            'ordering': g.ordering,
+        }
+        if g.n_largest_skeletons_limit:
+            params['n_largest_skeletons_limit'] = int(g.n_largest_skeletons_limit)
+        if g.n_last_edited_skeletons_limit:
+            params['n_last_edited_skeletons_limit'] = int(g.n_last_edited_skeletons_limit)
+        if g.hidden_last_editor_id:
+            params['hidden_last_editor_id'] = int(g.hidden_last_editor_id)
+
+        added = update_grid_cell(g.project_id, g.id, w_i, h_i, d_i,
+                g.cell_width, g.cell_height, g.cell_depth,
+                params, g.allow_empty, g.n_lod_levels, g.lod_min_bucket_size,
+                g.lod_strategy, g.has_json_data, g.has_json_text_data,
+                g.has_msgpack_data, provider=self.provider, cursor=cursor,
+                update_columnar_cache=g.has_columnar_data)
+
+        if not added:
+            # Don't keep outdated data for cells that became empty.
+            cursor.execute('''
+                DELETE FROM node_grid_cache_cell
+                WHERE grid_id = %(grid_id)s
+                AND x_index = %(x)s
+                AND y_index = %(y)s
+                AND z_index = %(z)s
+            ''', {
+                'grid_id': g.id,
+                'x': w_i,
+                'y': h_i,
+                'z': d_i,
+            })
+            if cursor.rowcount:
+                notify_grid_cache_update(cursor, g.id, w_i, h_i, d_i)
+
+
+def run_shard(shard, n_shards, options):
+    """Entry point of a worker process in a multi-process run."""
+    command = Command()
+    command.init(options)
+    command.run(GridWorker(shard, n_shards, options['batch_size']))
 
 
 class Command(BaseCommand):
@@ -90,23 +174,44 @@ class Command(BaseCommand):
         )
         parser.add_argument("--grid-cache", type=str2bool, nargs='?',
                 const=True, default=True, help="Update spatial grid caches.")
-
-    def handle(self, **options):
+        parser.add_argument('--workers', type=int, default=1,
+                help="The number of worker processes. Dirty cells are "
+                "partitioned by a hash of their grid ID and cell index across "
+                "processes.")
+        parser.add_argument('--batch-size', type=int, default=10,
+                help="The number of dirty cells claimed and updated in one "
+                "transaction.")
+
+    def init(self, options):
         set_log_level(logger, options.get('verbosity', 1))
+        self.workers:List = []
         self._shutdown = False
         self._in_task = False
         self.delay = options['delay']
         self.grid_cache_update = options['grid_cache']
 
-        self.workers:List = []
-
-        if options['grid_cache']:
-            self.workers.append(GridWorker())
+    def handle(self, **options):
+        self.init(options)
 
-        if not self.workers:
+        if not options['grid_cache']:
             logger.warn("No grids provided")
             return
 
+        n_workers = options['workers']
+        if n_workers < 1:
+            raise ValueError("Need at least one worker")
+        if options['batch_size'] < 1:
+            raise ValueError("The batch size needs to be at least 1")
+
+        if n_workers == 1:
+            self.run(GridWorker(batch_size=options['batch_size']))
+        else:
+            self.supervise(n_workers, options)
+
+    def run(self, worker):
+        """Process dirty cells whenever notified and in regular intervals."""
+        self.workers = [worker]
+
         self.listen()
 
         try:
@@ -114,18 +219,60 @@ class Command(BaseCommand):
             signal.signal(signal.SIGINT, self.handle_shutdown)
             signal.signal(signal.SIGTERM, self.handle_shutdown)
 
-            while True:
+            # Process cells that were marked dirty while no worker was running.
+            self.process([])
+
+            while not self._shutdown:
                 self.wait_and_queue()
-                # Wait for 0.01s to not have the busy waiting cause 100% CPU.
-                time.sleep(0.01)
         except InterruptedError:
             # got shutdown signal
             pass
 
+    def supervise(self, n_workers, options):
+        """Start one process per shard and restart processes that exit
+        unexpectedly.
+        """
+        # Forked processes must not share the file descriptors of existing
+        # database connections.
+        connections.close_all()
+
+        def start(shard):
+            process = multiprocessing.Process(target=run_shard,
+                    args=(shard, n_workers, options), daemon=True,
+                    name=f'catmaid-cache-update-worker-{shard}')
+            process.start()
+            return process
+
+        processes = [start(shard) for shard in range(n_workers)]
+        logger.info(f'Started {n_workers} cache update worker processes')
+
+        def stop(sig, frame):
+            self._shutdown = True
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        while not self._shutdown:
+            for shard, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.warn(f'Worker process {shard + 1}/{n_workers} '
+                            f'exited with code {process.exitcode}, restarting')
+                    processes[shard] = start(shard)
+            time.sleep(self.delay)
+
+        logger.info('Waiting for worker processes to finish...')
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
     def handle_shutdown(self, sig, frame):
         if self._in_task:
             logger.info('Waiting for active tasks to finish...')
             self._shutdown = True
+            for worker in self.workers:
+                worker.stopped = True
         else:
             raise InterruptedError
 
@@ -155,23 +302,29 @@ class Command(BaseCommand):
         select.select([connection.connection], [], [], self.delay)
         connection.connection.poll()
         notifies = self.filter_notifies()
-        count = len(self.filter_notifies())
-        logger.debug('Woke up with %s NOTIFYs.', count)
+        logger.debug('Woke up with %s NOTIFYs.', len(notifies))
         return notifies
 
     def wait_and_queue(self):
         notifications = self.wait()
-        if notifications:
+        updates = []
+        for n in notifications:
+            try:
+                data = json.loads(n.payload)
+                updates.append(data)
+            except json.decoder.JSONDecodeError:
+                logger.warn(f'Could not parse Postgres NOTIFY message: {n.payload}')
+                continue
+
+        # Also without notifications, look for dirty cells regularly, in case
+        # cells were claimed and released by another worker.
+        self.process(updates)
+
+    def process(self, updates):
+        self._in_task = True
+        try:
             cursor = connection.cursor()
-
-            updates = []
-            for n in notifications:
-                try:
-                    data = json.loads(n.payload)
-                    updates.append(data)
-                except json.decoder.JSONDecodeError:
-                    logger.warn(f'Could not parse Postgres NOTIFY message: {n.payload}')
-                    continue
-
             for worker in self.workers:
                 worker.update(updates, cursor)
+        finally:
+            self._in_task = False
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+import gzip
 from itertools import chain
-from typing import Dict, List, Optional, Set
+import multiprocessing
+import os
+import shutil
+import tempfile
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 from catmaid.control.annotation import (get_annotated_entities,
         get_annotation_to_id_map, get_sub_annotation_ids)
@@ -12,8 +17,11 @@ from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
         Relation, Connector, Project, Treenode, TreenodeClassInstance,
         TreenodeConnector, User, ReducedInfoUser, ExportUser, Volume)
 from catmaid.util import str2bool
-from django.db import connection
+from django.db import connection, connections
+from django.db.models import QuerySet
+from django.db.models.sql import Query
 from django.core import serializers
+from django.core.serializers.json import Serializer as JSONSerializer
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.hashers import make_password
 from .common import set_log_level
@@ -41,6 +49,46 @@ def ask_to_continue():
         if c is not None:
             return c
 
+class JSONFragmentSerializer(JSONSerializer):
+    """A JSON serializer that writes objects without the enclosing brackets
+    of a JSON array. This allows to write the objects of multiple groups
+    independently and join them later.
+    """
+
+    def start_serialization(self):
+        self._init_options()
+
+    def end_serialization(self):
+        pass
+
+
+def iterate_group(group, chunk_size) -> Iterator:
+    """Iterate over all objects of an export group. Querysets are read in
+    chunks of <chunk_size> objects using a server-side cursor, without
+    loading all objects into memory.
+    """
+    if isinstance(group, QuerySet):
+        return group.iterator(chunk_size=chunk_size)
+    return iter(group)
+
+
+def serialize_group(task:Tuple) -> str:
+    """Entry point of a worker process in a parallel export. Writes all
+    objects of an export group as JSON fragment to the passed in path and
+    returns this path.
+    """
+    group, path, indent, chunk_size = task
+    if isinstance(group, Query):
+        queryset = group.model._default_manager.all()
+        queryset.query = group
+        group = queryset
+    serializer = JSONFragmentSerializer()
+    with open(path, 'w') as out:
+        serializer.serialize(iterate_group(group, chunk_size), indent=indent,
+                stream=out)
+    return path
+
+
 class Exporter():
 
     def __init__(self, project, options):
@@ -62,12 +110,20 @@ class Exporter():
             self.run_noninteractive = options['run_noninteractive']
         else:
             self.run_noninteractive = False
+        self.n_workers = options.get('workers', 1)
+        self.stream = options.get('stream', False) or self.n_workers > 1
+        self.chunk_size = options.get('chunk_size', 2000)
+        self.compress = options.get('gzip', False)
         self.target_file = options.get('file', None)
         if self.target_file:
             self.target_file = self.target_file.format(project.id)
+            if self.target_file.endswith('.gz'):
+                self.compress = True
         else:
             now = datetime.now().strftime('%Y-%m-%d-%H-%M')
             self.target_file = f'catmaid-export-pid-{project.id}-{now}.json'
+            if self.compress:
+                self.target_file += '.gz'
 
         self.show_traceback = True
         self.format = 'json'
@@ -363,9 +419,12 @@ class Exporter():
 
 
         # Export referenced neurons and skeletons
-        exported_tids:Set = set()
-        if treenodes:
-            treenode_skeleton_ids = set(t.skeleton_id for t in treenodes)
+        # The treenode QuerySet is part of the serialized data and is only
+        # queried here, without being evaluated. Otherwise all treenodes would
+        # stay in memory for the whole export.
+        if treenodes is not None and treenodes.exists():
+            treenode_skeleton_ids = set(treenodes.order_by().values_list(
+                    'skeleton_id', flat=True).distinct())
             n_skeletons = ClassInstance.objects.filter(
                     project=self.project,
                     id__in=treenode_skeleton_ids).count()
@@ -375,8 +434,7 @@ class Exporter():
             n_neuron_links = len(neuron_links)
             neurons = set([link.class_instance_b_id for link in neuron_links])
 
-            exported_tids = set(treenodes.values_list('id', flat=True))
-            logger.info(f"Exporting {len(exported_tids)} treenodes in {n_skeletons} skeletons and {len(neurons)} neurons")
+            logger.info(f"Exporting {treenodes.count()} treenodes in {n_skeletons} skeletons and {len(neurons)} neurons")
 
         # Get current maximum concept ID
         cursor = connection.cursor()
@@ -395,7 +453,10 @@ class Exporter():
                     .filter(project=self.project, connector__in=connector_ids) \
                     .exclude(skeleton_id__in=skeleton_id_constraints))
                 connector_tids = set(c.treenode_id for c in connector_links)
-                extra_tids = connector_tids - exported_tids
+                extra_tids = connector_tids
+                if treenodes is not None:
+                    extra_tids = connector_tids - set(treenodes.filter(
+                            id__in=connector_tids).values_list('id', flat=True))
                 if self.original_placeholder_context:
                     logger.info("Exporting %s placeholder nodes" % len(extra_tids))
                 else:
@@ -523,16 +584,7 @@ class Exporter():
                 logger.info("No volumes found to export")
 
         # Export users, either completely or in a reduced form
-        seen_user_ids = set()
-        # Find users involved in exported data
-        for group in self.to_serialize:
-            for o in group:
-                if hasattr(o, 'user_id'):
-                    seen_user_ids.add(o.user_id)
-                if hasattr(o, 'reviewer_id'):
-                    seen_user_ids.add(o.reviewer_id)
-                if hasattr(o, 'editor_id'):
-                    seen_user_ids.add(o.editor_id)
+        seen_user_ids = self.collect_user_ids()
         users = [ExportUser(id=u.id, username=u.username, password=u.password,
                 first_name=u.first_name, last_name=u.last_name, email=u.email,
                 date_joined=u.date_joined) \
@@ -552,24 +604,110 @@ class Exporter():
                     ", ".join([u.username for u in reduced_users])))
             self.to_serialize.append(reduced_users)
 
+    def collect_user_ids(self) -> Set:
+        """Find users involved in exported data.
+        """
+        seen_user_ids = set()
+        user_fields = ('user_id', 'reviewer_id', 'editor_id')
+        for group in self.to_serialize:
+            if self.stream and isinstance(group, QuerySet):
+                # Let the database find the users rather than loading all
+                # objects into memory.
+                for field in group.model._meta.concrete_fields:
+                    if field.attname in user_fields:
+                        seen_user_ids.update(group.order_by().values_list(
+                                field.attname, flat=True).distinct())
+                continue
+            for o in group:
+                if hasattr(o, 'user_id'):
+                    seen_user_ids.add(o.user_id)
+                if hasattr(o, 'reviewer_id'):
+                    seen_user_ids.add(o.reviewer_id)
+                if hasattr(o, 'editor_id'):
+                    seen_user_ids.add(o.editor_id)
+        return seen_user_ids
+
+    def open_target(self):
+        if self.compress:
+            return gzip.open(self.target_file, 'wt', encoding='utf-8')
+        return open(self.target_file, 'w')
+
     def export(self):
         """ Writes all objects matching
         """
         try:
             self.collect_data()
 
+            if self.stream:
+                if self.n_workers > 1:
+                    self.write_parallel()
+                else:
+                    self.write_stream()
+                return
+
             data = list(chain(*self.to_serialize))
 
             CurrentSerializer = serializers.get_serializer(self.format)
             serializer = CurrentSerializer()
 
-            with open(self.target_file, "w") as out:
+            with self.open_target() as out:
                 serializer.serialize(data, indent=self.indent, stream=out)
         except Exception as e:
             if self.show_traceback:
                 raise
             raise CommandError("Unable to serialize database: %s" % e)
 
+    def write_stream(self):
+        """Serialize all export groups one object at a time. Only
+        <chunk_size> objects are kept in memory at any time.
+        """
+        data = chain.from_iterable(iterate_group(group, self.chunk_size)
+                for group in self.to_serialize)
+
+        CurrentSerializer = serializers.get_serializer(self.format)
+        serializer = CurrentSerializer()
+
+        with self.open_target() as out:
+            serializer.serialize(data, indent=self.indent, stream=out)
+
+    def write_parallel(self):
+        """Serialize each export group in a separate worker process into a
+        temporary file and join these files in order of the groups.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='catmaid-export-')
+        # Pickling a QuerySet evaluates it, only its query is passed to the
+        # workers.
+        tasks = [(group.query if isinstance(group, QuerySet) else group,
+                os.path.join(tmp_dir, f'group-{i}.json'), self.indent,
+                self.chunk_size) for i, group in enumerate(self.to_serialize)]
+
+        # Forked processes must not share the file descriptors of existing
+        # database connections.
+        connections.close_all()
+        pool = multiprocessing.Pool(self.n_workers)
+        try:
+            with self.open_target() as out:
+                out.write('[')
+                first = True
+                for n, path in enumerate(pool.imap(serialize_group, tasks), 1):
+                    if os.path.getsize(path):
+                        if not first:
+                            out.write(',')
+                        with open(path, 'r') as fragment:
+                            shutil.copyfileobj(fragment, out)
+                        first = False
+                    os.remove(path)
+                    logger.info(f'Wrote export group {n}/{len(tasks)}')
+                if self.indent:
+                    out.write('\n')
+                out.write(']')
+                if self.indent:
+                    out.write('\n')
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
 
 class Command(BaseCommand):
     """ Call e.g. like
@@ -622,6 +760,19 @@ class Command(BaseCommand):
             action='store_true', default=False, help='Whether or not neurons ' +
             'should be excluded if in addition to an exclusion annotation ' +
             'they are also annotated with a required (inclusion) annotation.')
+        parser.add_argument('--stream', dest='stream', action='store_true',
+            default=False, help='Write objects incrementally while reading ' +
+            'them in chunks from the database, rather than loading all ' +
+            'exported data into memory first.')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+            default=2000, help='The number of objects read from the database ' +
+            'at a time when streaming.')
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+            help='Serialize each type of exported objects in one of this ' +
+            'many parallel worker processes. Implies --stream.')
+        parser.add_argument('--gzip', dest='gzip', action='store_true',
+            default=False, help='Compress the written file using gzip. This ' +
+            'is also done if the file name ends with ".gz".')
 
     def ask_for_project(self, title):
         """ Return a valid project object.
@@ -676,6 +827,11 @@ class Command(BaseCommand):
             logger.info("Excluding skeletons with the following annotation: " +
                   ", ".join(options['excluded_annotations']))
 
+        if options['workers'] < 1:
+            raise CommandError("Need at least one worker")
+        if options['chunk_size'] < 1:
+            raise CommandError("The chunk size needs to be at least 1")
+
         exporter = Exporter(source, options)
         exporter.export()
 
@@ -3,10 +3,13 @@
 from abc import ABC, abstractmethod
 import argparse
 from collections import defaultdict
+import gzip
 import inspect
+from io import StringIO
+import json
 import logging
 import progressbar
-from typing import Any, DefaultDict, Dict, List, Set, Type
+from typing import Any, DefaultDict, Dict, Iterator, List, Set, Tuple, Type
 
 from catmaid.apps import get_system_user
 from catmaid.control.annotationadmin import copy_annotations
@@ -31,6 +34,62 @@ ordered_save_tasks = [Project, User, Class, Relation, ClassClass,
         ClassInstance, ClassInstanceClassInstance, Treenode, Connector]
 
 
+def iterate_json_array(stream, buffer_size=2**20) -> Iterator:
+    """Parse the elements of a JSON array from a file-like object one at a
+    time. Only <buffer_size> characters plus the size of the largest element
+    are kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = False
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON data")
+            chunk = stream.read(buffer_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            eof = not chunk
+            continue
+
+        c = buf[pos]
+        if not in_array:
+            if c != '[':
+                raise ValueError("Expected a JSON array")
+            in_array = True
+            pos += 1
+        elif c == ']':
+            return
+        elif c == ',':
+            pos += 1
+        else:
+            try:
+                element, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # The element is likely incomplete, read more data
+                if eof:
+                    raise
+                chunk = stream.read(buffer_size)
+                buf = buf[pos:] + chunk
+                pos = 0
+                eof = not chunk
+                continue
+            yield element
+
+
+def copy_value(value) -> str:
+    """Format a value for the text format of COPY.
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+
 def ask_a_b(a, b, title):
     """Return true if a, False if b.
     """
@@ -367,11 +426,7 @@ class FileImporter(AbstractImporter):
         cursor.execute('SET CONSTRAINTS ALL DEFERRED')
 
         # Drop summary table trigger to make insertion faster
-        cursor.execute("""
-            DROP TRIGGER on_edit_treenode_update_summary_and_edges ON treenode;
-            DROP TRIGGER on_insert_treenode_update_summary_and_edges ON treenode;
-            DROP TRIGGER on_delete_treenode_update_summary_and_edges ON treenode;
-        """)
+        self.drop_summary_triggers(cursor)
 
         # Get all existing users so that we can map them based on their username.
         mapped_user_ids:Set = set()
@@ -383,7 +438,7 @@ class FileImporter(AbstractImporter):
 
         # Read the file and sort by type
         logger.info(f"Loading data from {self.source}")
-        with open(self.source, "r") as data:
+        with self.open_source() as data:
             loaded_data = serializers.deserialize(self.format, data)
             for deserialized_object in progressbar.progressbar(loaded_data,
                     max_value=progressbar.UnknownLength, redirect_stdout=True):
@@ -578,57 +633,15 @@ class FileImporter(AbstractImporter):
                 if deserialized_object.object.username in created_users.keys():
                     deserialized_object.save()
 
-        # Reset counters to current maximum IDs
-        cursor.execute('''
-            SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
-            FROM concept;
-            SELECT setval('location_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
-            FROM location;
-            SELECT setval('auth_user_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
-            FROM auth_user;
-        ''')
-
-        cursor.execute("""
-            CREATE TRIGGER on_insert_treenode_update_summary_and_edges
-            AFTER INSERT ON treenode
-            REFERENCING NEW TABLE as inserted_treenode
-            FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_update_summary_and_edges();
-
-            CREATE TRIGGER on_edit_treenode_update_summary_and_edges
-            AFTER UPDATE ON treenode
-            REFERENCING NEW TABLE as new_treenode OLD TABLE as old_treenode
-            FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_update_summary_and_edges();
-
-            CREATE TRIGGER on_delete_treenode_update_summary_and_edges
-            AFTER DELETE ON treenode
-            REFERENCING OLD TABLE as deleted_treenode
-            FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_update_summary_and_edges();
-        """)
+        self.reset_sequences(cursor)
+        self.create_summary_triggers(cursor)
 
         n_imported_treenodes = len(import_objects_by_type_and_id.get(Treenode, []))
         n_imported_connectors = len(import_objects_by_type_and_id.get(Connector, []))
 
         if self.options.get('update_project_materializations'):
-            if n_imported_connectors or n_imported_connectors:
-                logger.info(f"Updating edge tables for project {self.target.id}")
-                rebuild_edge_tables(project_ids=[self.target.id], log=lambda msg: logger.info(msg))
-            else:
-                logger.info("No edge table update needed")
-
-            if n_imported_treenodes:
-                logger.info("Updated skeleton summary tables")
-                cursor.execute("""
-                    DELETE FROM catmaid_skeleton_summary;
-                    SELECT refresh_skeleton_summary_table();
-                """)
-
-                logger.info('Recreating skeleton summary table')
-                cursor.execute("""
-                    TRUNCATE catmaid_skeleton_summary;
-                    SELECT refresh_skeleton_summary_table();
-                """)
-            else:
-                logger.info("No skeleton summary update needed")
+            self.update_materializations(cursor, n_imported_treenodes,
+                    n_imported_connectors)
         else:
             logger.info("Finding imported skeleton IDs and connector IDs")
 
@@ -660,6 +673,76 @@ class FileImporter(AbstractImporter):
                     if ci.class_column_id in skeleton_classes:
                         skeleton_ids.append(ci.id)
 
+            self.update_materializations(cursor, n_imported_treenodes,
+                    n_imported_connectors, skeleton_ids, connector_ids)
+
+    def open_source(self):
+        """Open the import file, which is expected to be gzip-compressed if its
+        name ends with ".gz".
+        """
+        if self.source.endswith('.gz'):
+            return gzip.open(self.source, 'rt', encoding='utf-8')
+        return open(self.source, 'r')
+
+    def drop_summary_triggers(self, cursor):
+        cursor.execute("""
+            DROP TRIGGER on_edit_treenode_update_summary_and_edges ON treenode;
+            DROP TRIGGER on_insert_treenode_update_summary_and_edges ON treenode;
+            DROP TRIGGER on_delete_treenode_update_summary_and_edges ON treenode;
+        """)
+
+    def create_summary_triggers(self, cursor):
+        cursor.execute("""
+            CREATE TRIGGER on_insert_treenode_update_summary_and_edges
+            AFTER INSERT ON treenode
+            REFERENCING NEW TABLE as inserted_treenode
+            FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_update_summary_and_edges();
+
+            CREATE TRIGGER on_edit_treenode_update_summary_and_edges
+            AFTER UPDATE ON treenode
+            REFERENCING NEW TABLE as new_treenode OLD TABLE as old_treenode
+            FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_update_summary_and_edges();
+
+            CREATE TRIGGER on_delete_treenode_update_summary_and_edges
+            AFTER DELETE ON treenode
+            REFERENCING OLD TABLE as deleted_treenode
+            FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_update_summary_and_edges();
+        """)
+
+    def reset_sequences(self, cursor):
+        """Reset counters to current maximum IDs.
+        """
+        cursor.execute('''
+            SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+            FROM concept;
+            SELECT setval('location_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+            FROM location;
+            SELECT setval('auth_user_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+            FROM auth_user;
+        ''')
+
+    def update_materializations(self, cursor, n_imported_treenodes,
+            n_imported_connectors, skeleton_ids=None, connector_ids=None):
+        """Update edge tables and skeleton summaries once after all data has
+        been imported, either for the whole target project or only for the
+        passed in skeletons and connectors.
+        """
+        if self.options.get('update_project_materializations'):
+            if n_imported_treenodes or n_imported_connectors:
+                logger.info(f"Updating edge tables for project {self.target.id}")
+                rebuild_edge_tables(project_ids=[self.target.id], log=lambda msg: logger.info(msg))
+            else:
+                logger.info("No edge table update needed")
+
+            if n_imported_treenodes:
+                logger.info('Recreating skeleton summary table')
+                cursor.execute("""
+                    TRUNCATE catmaid_skeleton_summary;
+                    SELECT refresh_skeleton_summary_table();
+                """)
+            else:
+                logger.info("No skeleton summary update needed")
+        else:
             if skeleton_ids or connector_ids:
                 logger.info(f"Updating edge tables for {len(skeleton_ids)} skeleton(s) " + \
                             f"and {len(connector_ids)} connector(s)")
@@ -680,6 +763,354 @@ class FileImporter(AbstractImporter):
                 logger.info('No skeleton summary table updated needed')
 
 
+class UserReference():
+    """A stand-in for an imported object that references a single user. It
+    is used to map or create each imported user only once, regardless of the
+    number of objects referencing it.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.user = None
+
+
+class StreamingFileImporter(FileImporter):
+    """Import a file in two passes over the data, without loading it into
+    memory. The first pass records the ID of every imported object in a
+    temporary lookup table, in which new IDs are allocated and classes,
+    relations and class instances are matched to existing ones. The second pass
+    remaps IDs and foreign keys of batches of objects using this table and
+    inserts each batch using bulk_create(). Users are mapped or created once per
+    referenced user. Edge tables and skeleton summaries are updated once at the
+    end.
+    """
+
+    def __init__(self, source, target, user, options):
+        super().__init__(source, target, user, options)
+        self.batch_size = options.get('batch_size', 10000)
+        self.user_lookup:Dict[int, int] = {}
+
+    def iterate_source(self) -> Iterator:
+        with self.open_source() as data:
+            yield from progressbar.progressbar(iterate_json_array(data),
+                    max_value=progressbar.UnknownLength, redirect_stdout=True)
+
+    def collect_ids(self, cursor) -> Tuple[int, Dict]:
+        """Read all object IDs, names and class references into the temporary
+        lookup table and return the total number of objects as well as all
+        imported users.
+        """
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_id_map_raw (
+                model text NOT NULL,
+                old_id bigint NOT NULL,
+                name text,
+                class_id bigint
+            ) ON COMMIT DROP;
+        """)
+
+        import_users = dict()
+        n_objects = 0
+        rows:List = []
+
+        def flush():
+            cursor.copy_expert("""
+                COPY import_id_map_raw (model, old_id, name, class_id)
+                FROM STDIN
+            """, StringIO(''.join(rows)))
+            rows.clear()
+
+        logger.info(f"Collecting object IDs from {self.source}")
+        for element in self.iterate_source():
+            n_objects += 1
+            model, fields = element['model'], element['fields']
+            if model == 'auth.user':
+                for deserialized_object in serializers.deserialize('python', [element]):
+                    import_users[deserialized_object.object.id] = deserialized_object
+                continue
+            name = fields.get('class_name', fields.get('relation_name',
+                    fields.get('name'))) if model in ('catmaid.class',
+                    'catmaid.relation', 'catmaid.classinstance') else None
+            rows.append('\t'.join((copy_value(model), copy_value(element['pk']),
+                    copy_value(name), copy_value(fields.get('class_column')))) + '\n')
+            if len(rows) >= self.batch_size:
+                flush()
+        if rows:
+            flush()
+
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_id_map ON COMMIT DROP AS
+            SELECT DISTINCT ON (model, old_id) model, old_id, name, class_id,
+                NULL::bigint AS new_id, false AS reused
+            FROM import_id_map_raw;
+
+            ALTER TABLE import_id_map ADD PRIMARY KEY (model, old_id);
+            DROP TABLE import_id_map_raw;
+        """)
+
+        return n_objects, import_users
+
+    def allocate_ids(self, cursor) -> None:
+        """Match imported classes, relations and class instances to existing
+        ones by name and allocate new IDs for all other objects. With
+        --preserve-ids, imported IDs are kept unless they are in use already.
+        """
+        # Semantic data like classes and class instances are expected to be
+        # unique with respect to their names. Neurons and skeletons are a
+        # special case, because there can be multiple ones with the same name.
+        cursor.execute("""
+            UPDATE import_id_map m
+            SET new_id = c.id, reused = true
+            FROM class c
+            WHERE m.model = 'catmaid.class'
+                AND c.project_id = %(project_id)s
+                AND c.class_name = m.name;
+
+            UPDATE import_id_map m
+            SET new_id = r.id, reused = true
+            FROM relation r
+            WHERE m.model = 'catmaid.relation'
+                AND r.project_id = %(project_id)s
+                AND r.relation_name = m.name;
+
+            UPDATE import_id_map m
+            SET new_id = ci.id, reused = true
+            FROM (
+                SELECT DISTINCT ON (name) name, id
+                FROM class_instance
+                WHERE project_id = %(project_id)s
+                ORDER BY name, id
+            ) ci
+            WHERE m.model = 'catmaid.classinstance'
+                AND ci.name = m.name
+                AND m.class_id NOT IN (
+                    SELECT old_id
+                    FROM import_id_map
+                    WHERE model = 'catmaid.class'
+                        AND name IN ('neuron', 'skeleton'));
+        """, {
+            'project_id': self.target.id,
+        })
+        cursor.execute("SELECT count(*) FROM import_id_map WHERE reused")
+        logger.info(f"Reusing {cursor.fetchone()[0]} existing objects")
+
+        cursor.execute("SELECT DISTINCT model FROM import_id_map")
+        for (label,) in cursor.fetchall():
+            model = apps.get_model(label)
+            table = model._meta.db_table
+            # Tables that inherit from concept or location use the sequence of
+            # their parent table, which pg_get_serial_sequence() doesn't
+            # report. Their ID column default references it though.
+            cursor.execute(r"""
+                SELECT COALESCE(pg_get_serial_sequence(%(table)s, 'id'), (
+                    SELECT substring(pg_get_expr(d.adbin, d.adrelid)
+                        FROM 'nextval\(''([^'']+)''')
+                    FROM pg_attrdef d
+                    JOIN pg_attribute a
+                        ON a.attrelid = d.adrelid
+                        AND a.attnum = d.adnum
+                    WHERE d.adrelid = %(table)s::regclass
+                        AND a.attname = 'id'))
+            """, {
+                'table': table,
+            })
+            sequence = cursor.fetchone()[0]
+            if not sequence:
+                raise CommandError(f"Can't allocate IDs for model {label}")
+            if self.preserve_ids:
+                # Like the regular importer, existing concept IDs lead to new
+                # IDs.
+                cursor.execute("""
+                    UPDATE import_id_map m
+                    SET new_id = CASE WHEN EXISTS (
+                        SELECT 1 FROM concept c WHERE c.id = m.old_id)
+                        THEN nextval(%(sequence)s) ELSE m.old_id END
+                    WHERE m.model = %(model)s
+                        AND m.new_id IS NULL
+                """, {
+                    'model': label,
+                    'sequence': sequence,
+                })
+            else:
+                cursor.execute("""
+                    UPDATE import_id_map m
+                    SET new_id = nextval(%(sequence)s)
+                    WHERE m.model = %(model)s
+                        AND m.new_id IS NULL
+                """, {
+                    'model': label,
+                    'sequence': sequence,
+                })
+
+    def map_user(self, user_id, import_users, replacement_users,
+            mapped_user_ids, mapped_user_target_ids, created_users):
+        """Return the ID of the user an imported user ID is mapped to. Users are
+        mapped or created only once.
+        """
+        mapped_id = self.user_lookup.get(user_id)
+        if mapped_id is None:
+            ref = UserReference(user_id)
+            self.map_or_create_users(ref, import_users, replacement_users,
+                    mapped_user_ids, mapped_user_target_ids, created_users)
+            mapped_id = ref.user.id if ref.user else ref.user_id
+            self.user_lookup[user_id] = mapped_id
+        return mapped_id
+
+    def save_batch(self, model, objects, cursor, user_args) -> int:
+        """Remap IDs and foreign keys of the passed in objects and insert all
+        objects that don't reuse existing objects. Returns the number of
+        inserted objects.
+        """
+        label = model._meta.label_lower
+        fk_fields = [(f.attname, f.related_model._meta.label_lower)
+                for f in model._meta.concrete_fields
+                if f.many_to_one and f.related_model._meta.app_label == 'catmaid']
+        user_fields = [ref + '_id' for ref in ('user', 'reviewer', 'editor')
+                if hasattr(objects[0], ref + '_id')]
+
+        models, old_ids = [], []
+        for obj in objects:
+            models.append(label)
+            old_ids.append(obj.id)
+            for attname, related_label in fk_fields:
+                value = getattr(obj, attname)
+                if value is not None:
+                    models.append(related_label)
+                    old_ids.append(value)
+        cursor.execute("""
+            SELECT m.model, m.old_id, m.new_id, m.reused
+            FROM import_id_map m
+            JOIN UNNEST(%(models)s::text[], %(old_ids)s::bigint[]) q(model, old_id)
+                ON q.model = m.model AND q.old_id = m.old_id
+        """, {
+            'models': models,
+            'old_ids': old_ids,
+        })
+        id_map = dict(((row[0], row[1]), (row[2], row[3])) for row in cursor.fetchall())
+
+        to_save = []
+        for obj in objects:
+            new_id, reused = id_map.get((label, obj.id), (obj.id, False))
+            if reused:
+                continue
+            obj.id = new_id
+            # Foreign keys to objects that are not part of the import are kept.
+            for attname, related_label in fk_fields:
+                value = getattr(obj, attname)
+                if value is not None:
+                    mapped = id_map.get((related_label, value))
+                    if mapped:
+                        setattr(obj, attname, mapped[0])
+            if self.user:
+                self.override_fields(obj)
+            else:
+                if hasattr(obj, 'project_id'):
+                    obj.project = self.target
+                for attname in user_fields:
+                    user_id = getattr(obj, attname)
+                    if user_id is not None:
+                        setattr(obj, attname, self.map_user(user_id, *user_args))
+            to_save.append(obj)
+
+        if to_save:
+            model.objects.bulk_create(to_save, batch_size=self.batch_size)
+        return len(to_save)
+
+    @transaction.atomic
+    def import_data(self):
+        """ Imports data from a file in bounded memory.
+        """
+        cursor = connection.cursor()
+        # Defer all constraint checks, objects can reference objects that are
+        # inserted later.
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+        # Drop summary table trigger to make insertion faster
+        self.drop_summary_triggers(cursor)
+
+        n_objects, import_users = self.collect_ids(cursor)
+        if n_objects == 0:
+            raise CommandError("Nothing to import, no importable data found")
+        logger.info(f"Found {len(import_users)} referenceable users in import data")
+
+        username_mapping = {}
+        for m in self.options['username_mapping'] or []:
+            username_mapping[m[0]] = m[1]
+            logger.info(f'Mapping import user "{m[0]}" to target user "{m[1]}"')
+
+        self.allocate_ids(cursor)
+
+        created_users:Dict = dict()
+        user_args = (import_users, username_mapping, set(), set(), created_users)
+        app = apps.get_app_config('catmaid')
+        importable_models = set(app.get_models())
+
+        logger.info(f"Storing {n_objects} objects in batches of {self.batch_size}")
+        batches:DefaultDict[Any, List] = defaultdict(list)
+        n_saved = 0
+        for element in self.iterate_source():
+            if element['model'] == 'auth.user':
+                continue
+            for deserialized_object in serializers.deserialize('python', [element]):
+                obj = deserialized_object.object
+                model = type(obj)
+                if model not in importable_models:
+                    logger.warning(f"Skipping object of unsupported type {model.__name__}")
+                    continue
+                batch = batches[model]
+                batch.append(obj)
+                if len(batch) >= self.batch_size:
+                    n_saved += self.save_batch(model, batch, cursor, user_args)
+                    batch.clear()
+        for model, batch in batches.items():
+            if batch:
+                n_saved += self.save_batch(model, batch, cursor, user_args)
+        logger.info(f"Stored {n_saved} new objects")
+
+        if len(created_users) > 0:
+            logger.info("Created {} new users: {}".format(len(created_users),
+                    ", ".join(sorted([u.username for u in created_users.values()]))))
+            for deserialized_object in import_users.values():
+                if deserialized_object.object.username in created_users.keys():
+                    deserialized_object.save()
+        else:
+            logger.info("No unmapped users imported")
+
+        self.reset_sequences(cursor)
+        self.create_summary_triggers(cursor)
+
+        cursor.execute("""
+            SELECT m.new_id
+            FROM import_id_map m
+            WHERE m.model = 'catmaid.connector'
+                AND NOT m.reused
+        """)
+        connector_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT m.new_id
+            FROM import_id_map m
+            LEFT JOIN import_id_map c
+                ON c.model = 'catmaid.class'
+                AND c.old_id = m.class_id
+            JOIN class cl
+                ON cl.id = COALESCE(c.new_id, m.class_id)
+            WHERE m.model = 'catmaid.classinstance'
+                AND NOT m.reused
+                AND cl.class_name = 'skeleton'
+        """)
+        skeleton_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            SELECT count(*)
+            FROM import_id_map
+            WHERE model = 'catmaid.treenode'
+                AND NOT reused
+        """)
+        n_imported_treenodes = cursor.fetchone()[0]
+
+        self.update_materializations(cursor, n_imported_treenodes,
+                len(connector_ids), skeleton_ids, connector_ids)
+
+
 class InternalImporter(AbstractImporter):
     def import_data(self):
         # Process with import
@@ -740,6 +1171,13 @@ class Command(BaseCommand):
                 action='store_true', help='Use IDs provided in import data. Warning: this can cause changes in existing data.')
         parser.add_argument('--no-analyze', dest='analyze_db', default=True,
                 action='store_false', help='If ANALYZE to update database statistics should not be called after the import.')
+        parser.add_argument('--stream', dest='stream', default=False,
+                action='store_true', help='Read the import file incrementally '
+                'and insert objects in batches, rather than loading all data '
+                'into memory. Needed for large imports.')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=10000, help='The number of objects of a type that '
+                'are inserted at once when streaming.')
         parser.add_argument('--update-project-materializations', dest='update_project_materializations', default=False,
                 action='store_true', help='Whether all materializations (edges, summary) of the current project should be updated or only the ones of imported skeletons.')
 
@@ -798,8 +1236,14 @@ class Command(BaseCommand):
                 Importer: Type[AbstractImporter] = InternalImporter
             except ValueError:
                 source = options['source']
-                logger.info("Using file importer")
-                Importer = FileImporter
+                if options['stream']:
+                    if options['batch_size'] < 1:
+                        raise CommandError("The batch size needs to be at least 1")
+                    logger.info("Using streaming file importer")
+                    Importer = StreamingFileImporter
+                else:
+                    logger.info("Using file importer")
+                    Importer = FileImporter
         else:
             source = self.ask_for_project('source')
 
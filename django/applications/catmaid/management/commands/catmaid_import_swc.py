@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control.skeleton import import_skeletons_swc
+from .common import set_log_level
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '''Import many skeletons from SWC and eSWC files. Each file results
+        in a new neuron and skeleton, named after the file. Directories are
+        searched recursively for .swc and .eswc files.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+',
+                help='SWC/eSWC files or directories containing them')
+        parser.add_argument('--project_id', dest='project_id', required=True,
+                type=int, help='The ID of the project to import into')
+        parser.add_argument('--user', dest='user_id', required=False, default=None,
+                help='The ID of the user who will own the imported data')
+        parser.add_argument('--annotation', dest='annotations', action='append',
+                default=None, help='An annotation to add to all imported '
+                'neurons, can be used multiple times. Defaults to "Import".')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=100, help='The number of skeletons imported in one '
+                'transaction')
+
+    def handle(self, *args, **options):
+        set_log_level(logger, options.get('verbosity', 1))
+        user = None
+        user_id = options['user_id']
+        if user_id is not None:
+            user = User.objects.get(pk=user_id)
+
+        if not user:
+            from catmaid.apps import get_system_user
+            user = get_system_user()
+            logger.info(f"Using system user account {user} (ID: {user.id})")
+
+        file_paths = []
+        for path in options['paths']:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    file_paths.extend(os.path.join(root, f) for f in sorted(files)
+                            if f.lower().endswith(('.swc', '.eswc')))
+            elif os.path.isfile(path):
+                file_paths.append(path)
+            else:
+                raise CommandError(f'Could not find file or directory: {path}')
+
+        if not file_paths:
+            raise CommandError('No SWC or eSWC files found')
+
+        annotations = options['annotations'] or ['Import']
+        logger.info(f'Importing {len(file_paths)} skeletons')
+
+        def skeletons():
+            for n, file_path in enumerate(file_paths):
+                name, extension = os.path.splitext(os.path.basename(file_path))
+                with open(file_path, 'r') as f:
+                    swc_string = f.read()
+                if n > 0 and n % options['batch_size'] == 0:
+                    logger.info(f'Imported {n}/{len(file_paths)} skeletons')
+                yield name, swc_string, extension.lower() == '.eswc'
+
+        imported = import_skeletons_swc(user, options['project_id'],
+                skeletons(), annotations, options['batch_size'])
+        n_nodes = sum(i['n_nodes'] for i in imported)
+        logger.info(f'Imported {len(imported)} skeletons with {n_nodes} nodes')
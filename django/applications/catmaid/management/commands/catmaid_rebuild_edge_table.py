@@ -6,7 +6,7 @@ import catmaid
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.models import Project
-from catmaid.control.edge import rebuild_edge_tables
+from catmaid.control.edge import rebuild_edge_tables, rebuild_edge_tables_chunked
 
 
 class DryRunRollback(Exception):
@@ -21,8 +21,23 @@ class Command(BaseCommand):
             default=False, help='Don\'t actually apply changes')
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             help='Rebuild edge tables for these projects')
+        parser.add_argument('--chunked', action='store_true', default=False,
+            help='Rebuild edge tables in chunks of source rows, each in its '
+            'own transaction. Only changed rows are written and regular edits '
+            'can continue during the rebuild.')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+            default=100000, help='The average number of source rows processed '
+            'per chunk in a chunked rebuild.')
+        parser.add_argument('--workers', type=int, default=1,
+            help='The number of worker processes for a chunked rebuild.')
+        parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+            type=str, help='A file to record completed chunks of a chunked '
+            'rebuild in. Running the command again with the same file skips '
+            'these chunks.')
+        parser.add_argument('--no-verify', dest='verify', action='store_false',
+            default=True, help='Don\'t compare all chunks with their source '
+            'tables after a chunked rebuild.')
 
-    @transaction.atomic
     def handle(self, *args, **options):
         project_ids = options['project_id']
         if not project_ids:
@@ -41,6 +56,27 @@ class Command(BaseCommand):
             self.stdout.write('Canceled on user request')
             return
 
+        if options['chunked']:
+            # Every chunk is committed in its own transaction. In a dry run,
+            # differences are only counted.
+            stats = rebuild_edge_tables_chunked(project_ids,
+                    chunk_size=options['chunk_size'], n_jobs=options['workers'],
+                    checkpoint=options['checkpoint'], verify=options['verify'],
+                    dryrun=dryrun, log=lambda msg: self.stdout.write(msg))
+            for table, table_stats in stats.items():
+                self.stdout.write(f'{table}: {table_stats["removed"]} removed, '
+                        f'{table_stats["added"]} added, '
+                        f'{table_stats["mismatched"]} mismatched')
+            if dryrun:
+                self.stdout.write('Dry run completed')
+            else:
+                self.stdout.write('Successfully rebuilt edge tables')
+            return
+
+        self.rebuild(project_ids, dryrun)
+
+    @transaction.atomic
+    def rebuild(self, project_ids, dryrun):
         try:
 
             rebuild_edge_tables(project_ids, log=lambda msg: self.stdout.write(msg))
@@ -1,7 +1,11 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import connection
 
-from catmaid.control.stats import populate_stats_summary
+from catmaid.control.stats import (enable_stats_summary_delta_log,
+        fold_stats_summary_delta_log, is_stats_summary_delta_log_enabled,
+        populate_import_cable_stats_summary,
+        populate_import_nodecount_stats_summary, populate_stats_summary)
 from catmaid.models import Project
 
 
@@ -23,8 +27,13 @@ class Command(BaseCommand):
         else:
             projects = Project.objects.all()
 
-        delete = False
         clean = options['clean']
+
+        if getattr(settings, 'STATS_SUMMARY_DELTA_LOG', False):
+            self.refresh_with_delta_log(projects, project_ids, clean, cursor)
+            return
+
+        delete = False
         if clean:
             if project_ids:
                 delete = True
@@ -36,3 +45,30 @@ class Command(BaseCommand):
         for p in projects:
             populate_stats_summary(p.id, delete, incremental)
             self.stdout.write(f'Computed statistics for project {p.id}')
+
+    def refresh_with_delta_log(self, projects, project_ids, clean, cursor):
+        """With the delta log enabled, node counts, cable length, reviews and
+        connector links only need to be folded into the summary. Only import
+        statistics are computed the regular way.
+        """
+        if not is_stats_summary_delta_log_enabled(cursor):
+            # The delta log is kept for all projects, which therefore all have
+            # to be rebuilt when it is enabled.
+            enable_stats_summary_delta_log()
+            self.stdout.write('Enabled statistics summary delta log and '
+                    'computed statistics of all projects from scratch')
+            return
+
+        if clean:
+            enable_stats_summary_delta_log(project_ids)
+            self.stdout.write('Computed statistics from scratch')
+            return
+
+        n_updated = fold_stats_summary_delta_log(cursor)
+        self.stdout.write(f'Updated {n_updated} statistics summary entries '
+                'from delta log')
+
+        for p in projects:
+            populate_import_nodecount_stats_summary(p.id, cursor=cursor)
+            populate_import_cable_stats_summary(p.id, cursor=cursor)
+            self.stdout.write(f'Computed import statistics for project {p.id}')
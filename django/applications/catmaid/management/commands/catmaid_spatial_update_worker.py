@@ -1,11 +1,11 @@
-from collections import defaultdict
 import json
 import logging
 import select
 import signal
 import time
-from typing import Dict, List, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from psycopg2.extras import execute_values
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
@@ -23,8 +23,17 @@ logger = logging.getLogger(__name__)
 
 
 class GridWorker():
+    """Collect the grid cells intersected by spatial updates and mark them
+    dirty. Received updates are coalesced: affected cells are kept in a set
+    until either <batch_size> distinct cells are pending or the oldest pending
+    update is older than <max_latency> seconds. All pending cells are then
+    marked dirty with a single INSERT per batch.
+    """
+
+    def __init__(self, batch_size=10000, max_latency=1.0):
+        self.batch_size = batch_size
+        self.max_latency = max_latency
 
-    def __init__(self):
         # Keep a reference to all enabled grid caches
         enabled_node_providers = get_configured_node_providers(
                 settings.NODE_PROVIDERS, enabled_only=True)
@@ -35,6 +44,15 @@ class GridWorker():
         # Keep track of received events
         self.updatesReceived = 0
         self.cellsMarkedDirty = 0
+        self.cellsCoalesced = 0
+        self.flushes = 0
+        self.lastFlushLag = 0.0
+        self.maxFlushLag = 0.0
+
+        # Cells to be marked dirty, as (grid_id, x, y, z) tuples, and the time
+        # the oldest update was received that hasn't been flushed yet.
+        self.pending_cells:Set[Tuple[int, int, int, int]] = set()
+        self.oldest_pending:Optional[float] = None
 
         if enabled_grid_cache_providers:
             logger.info(f"Found {len(enabled_grid_cache_providers)} enabled grid cache provider(s)")
@@ -48,8 +66,8 @@ class GridWorker():
             # If a particular cache is referenced explicitly, use it if it is
             # enabled.
             if provider.cache_id is not None:
-                grid_cache = NodeGridCache.get(pk=provider.cache_id,
-                        enabled=True)
+                grid_cache = NodeGridCache.objects.filter(pk=provider.cache_id,
+                        enabled=True).first()
                 if grid_cache:
                     self.grid_caches.append(grid_cache)
             # Without an explicit ID, get all enabled grid caches
@@ -64,33 +82,85 @@ class GridWorker():
         send another notify(). Queue entries are then processed by a set of
         different workers. To do this, get all the enabled grid caches for each
         project and then, for each notification compute the intersected grid
-        indices with each grid, update existing grids and create missing ones.
+        indices with each grid. Cells are only marked dirty once a batch is
+        complete or the maximum latency is reached, see flush_if_needed().
         """
-        # Batch of grids to update during one run
-        grid_coords_to_update:Dict = {}
+        if updates and self.oldest_pending is None:
+            self.oldest_pending = time.time()
+
+        grid_coords_to_update:Dict[int, Set] = {}
         for update in updates:
             self.updatesReceived += 1
             self.get_intersected_grid_cell_ids(update,
                     cursor, create=True, grid_coords_to_update=grid_coords_to_update)
 
-        dirty_rows:Set = set()
+        n_pending = len(self.pending_cells)
+        n_cells = 0
         for grid_id, coords in grid_coords_to_update.items():
-            for c in coords:
-                self.cellsMarkedDirty += 1
-                key = f"({grid_id},{c[0]},{c[1]},{c[2]})"
-                if key not in dirty_rows:
-                    dirty_rows.add(key)
-
-        if dirty_rows:
-            # Mark cells as dirty
-            cursor.execute(f"""
+            n_cells += len(coords)
+            self.pending_cells.update((grid_id, c[0], c[1], c[2]) for c in coords)
+        self.cellsCoalesced += n_cells - (len(self.pending_cells) - n_pending)
+
+        self.flush_if_needed(cursor)
+
+    def lag(self, now=None) -> float:
+        """The time in seconds the oldest pending update is waiting."""
+        if self.oldest_pending is None:
+            return 0.0
+        return (now or time.time()) - self.oldest_pending
+
+    def needs_flush(self, now=None) -> bool:
+        if not self.pending_cells:
+            return False
+        return len(self.pending_cells) >= self.batch_size or \
+                self.lag(now) >= self.max_latency
+
+    def time_to_flush(self, now=None) -> Optional[float]:
+        """The number of seconds until the pending cells have to be flushed or
+        None if there are no pending cells."""
+        if not self.pending_cells:
+            return None
+        return max(0.0, self.max_latency - self.lag(now))
+
+    def flush_if_needed(self, cursor) -> None:
+        if self.needs_flush():
+            self.flush(cursor)
+
+    def flush(self, cursor) -> None:
+        """Mark all pending cells as dirty, using one INSERT per batch."""
+        if not self.pending_cells:
+            return
+
+        lag = self.lag()
+        dirty_rows = sorted(self.pending_cells)
+        for i in range(0, len(dirty_rows), self.batch_size):
+            execute_values(cursor, """
                 INSERT INTO dirty_node_grid_cache_cell (grid_id, x_index, y_index, z_index)
-                VALUES {','.join(dirty_rows)}
+                VALUES %s
                 ON CONFLICT (grid_id, x_index, y_index, z_index)
                 DO UPDATE SET invalidation_time = EXCLUDED.invalidation_time
-            """)
-
-            logger.debug(f'Marked {len(dirty_rows)} grid cells as dirty and queued update')
+            """, dirty_rows[i:i + self.batch_size], page_size=self.batch_size)
+
+        self.cellsMarkedDirty += len(dirty_rows)
+        self.flushes += 1
+        self.lastFlushLag = lag
+        self.maxFlushLag = max(self.maxFlushLag, lag)
+        self.pending_cells.clear()
+        self.oldest_pending = None
+
+        logger.debug(f'Marked {len(dirty_rows)} grid cells as dirty and queued update (lag: {lag:.3f}s)')
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'updates_received': self.updatesReceived,
+            'cells_marked_dirty': self.cellsMarkedDirty,
+            'cells_coalesced': self.cellsCoalesced,
+            'flushes': self.flushes,
+            'queue_depth': len(self.pending_cells),
+            'lag': self.lag(),
+            'last_flush_lag': self.lastFlushLag,
+            'max_flush_lag': self.maxFlushLag,
+        }
 
     def append_cells_to_update(self, coords_to_update, p1, p2, cell_width,
             cell_height, cell_depth):
@@ -118,17 +188,19 @@ class GridWorker():
         n_cells_total = n_cells[0] * n_cells[1] * n_cells[2]
         if n_cells_total == 1:
             # Common case, only one cell is changed.
-            coords_to_update.append(p1_cell)
+            coords_to_update.add(tuple(p1_cell))
         else:
             # Find all intersecting cells in this grid.
-            coords_to_update.extend(get_intersected_grid_cells(p1,
+            coords_to_update.update(tuple(c) for c in get_intersected_grid_cells(p1,
                 p2, cell_width, cell_height, cell_depth, p1_cell, p2_cell))
 
     def get_intersected_grid_cell_ids(self, data, cursor, create=True,
-            grid_coords_to_update=dict()):
+            grid_coords_to_update=None):
         """Iterate over all known enabled grid caches and find all intersected
-        cells.
+        cells. Cells are collected as sets of (x, y, z) tuples per grid.
         """
+        if grid_coords_to_update is None:
+            grid_coords_to_update = {}
         project_id = data.get('project_id')
         if project_id is None:
             logger.warn('Could not parse project ID of message: ' + str(data))
@@ -143,8 +215,8 @@ class GridWorker():
         for grid_cache in self.grid_caches:
             grid_id = grid_cache.id
             coords_to_update = grid_coords_to_update.get(grid_id)
-            if not coords_to_update:
-                coords_to_update = []
+            if coords_to_update is None:
+                coords_to_update = set()
                 grid_coords_to_update[grid_id] = coords_to_update
             cell_width = grid_cache.cell_width
             cell_height = grid_cache.cell_height
@@ -166,11 +238,11 @@ class GridWorker():
                         cell_width, cell_height, cell_depth)
             elif data_type == 'point':
                 p = data['p']
-                coords_to_update.append([
+                coords_to_update.add((
                     int(p[0] // cell_width),
                     int(p[1] // cell_height),
                     int(p[2] // cell_depth),
-                ])
+                ))
             else:
                 logger.error(f"Unknown data type: {data_type}")
 
@@ -192,6 +264,15 @@ class Command(BaseCommand):
         )
         parser.add_argument("--grid-cache", type=str2bool, nargs='?',
                 const=True, default=True, help="Update spatial grid caches.")
+        parser.add_argument('--batch-size', type=int, default=10000,
+                help="The number of distinct dirty cells after which they are "
+                "marked dirty in the database, regardless of the latency.")
+        parser.add_argument('--max-latency', type=float, default=1.0,
+                help="The maximum number of seconds a received update is held "
+                "back to be coalesced with other updates.")
+        parser.add_argument('--stats-interval', type=float, default=60,
+                help="The number of seconds between log messages with queue "
+                "depth and lag metrics, 0 disables them.")
 
     def handle(self, **options):
         set_log_level(logger, options.get('verbosity', 1))
@@ -199,11 +280,17 @@ class Command(BaseCommand):
         self._in_task = False
         self.delay = options['delay']
         self.grid_cache_update = options['grid_cache']
+        self.stats_interval = options['stats_interval']
+        self.last_stats = time.time()
+
+        if options['batch_size'] < 1:
+            raise ValueError("The batch size needs to be at least 1")
 
         self.workers:List = []
 
         if options['grid_cache']:
-            self.workers.append(GridWorker())
+            self.workers.append(GridWorker(options['batch_size'],
+                    options['max_latency']))
 
         if not self.workers:
             logger.warn("No grids provided")
@@ -216,13 +303,17 @@ class Command(BaseCommand):
             signal.signal(signal.SIGINT, self.handle_shutdown)
             signal.signal(signal.SIGTERM, self.handle_shutdown)
 
-            while True:
+            while not self._shutdown:
                 self.wait_and_queue()
-                # Wait for 0.01s to not have the busy waiting cause 100% CPU.
-                time.sleep(0.01)
+                self.log_metrics()
         except InterruptedError:
             # got shutdown signal
             pass
+        finally:
+            # Don't lose updates that are still held back
+            cursor = connection.cursor()
+            for worker in self.workers:
+                worker.flush(cursor)
 
     def handle_shutdown(self, sig, frame):
         if self._in_task:
@@ -247,33 +338,66 @@ class Command(BaseCommand):
         ]
         return notifies
 
+    def drain(self):
+        """Read all notifications that are available without waiting."""
+        notifies = []
+        while True:
+            connection.connection.poll()
+            new_notifies = self.filter_notifies()
+            if not new_notifies:
+                return notifies
+            notifies.extend(new_notifies)
 
     def wait(self):
-        connection.connection.poll()
-        notifies = self.filter_notifies()
+        notifies = self.drain()
         if notifies:
             return notifies
 
-        select.select([connection.connection], [], [], self.delay)
-        connection.connection.poll()
-        notifies = self.filter_notifies()
-        count = len(self.filter_notifies())
-        logger.debug('Woke up with %s NOTIFYs.', count)
+        # Don't wait longer than pending updates are allowed to be held back.
+        timeout = self.delay
+        for worker in self.workers:
+            time_to_flush = worker.time_to_flush()
+            if time_to_flush is not None:
+                timeout = min(timeout, time_to_flush)
+
+        select.select([connection.connection], [], [], timeout)
+        notifies = self.drain()
+        logger.debug('Woke up with %s NOTIFYs.', len(notifies))
         return notifies
 
     def wait_and_queue(self):
         notifications = self.wait()
-        if notifications:
-            cursor = connection.cursor()
-
-            updates = []
-            for n in notifications:
-                try:
-                    data = json.loads(n.payload)
-                    updates.append(data)
-                except json.decoder.JSONDecodeError:
-                    logger.warn(f'Could not parse Postgres NOTIFY message: {n.payload}')
-                    continue
-
+        cursor = connection.cursor()
+
+        updates = []
+        for n in notifications:
+            try:
+                data = json.loads(n.payload)
+                updates.append(data)
+            except json.decoder.JSONDecodeError:
+                logger.warn(f'Could not parse Postgres NOTIFY message: {n.payload}')
+                continue
+
+        self._in_task = True
+        try:
             for worker in self.workers:
+                # Flushes pending cells if the batch is full or the maximum
+                # latency is reached, also without new updates.
                 worker.update(updates, cursor)
+        finally:
+            self._in_task = False
+
+    def log_metrics(self):
+        if not self.stats_interval:
+            return
+        now = time.time()
+        if now - self.last_stats < self.stats_interval:
+            return
+        self.last_stats = now
+        for worker in self.workers:
+            metrics = worker.metrics()
+            logger.info('Queue depth: {queue_depth} cells, lag: {lag:.3f}s, '
+                    'last flush lag: {last_flush_lag:.3f}s, max flush lag: '
+                    '{max_flush_lag:.3f}s, updates: {updates_received}, '
+                    'dirty cells: {cells_marked_dirty}, coalesced cells: '
+                    '{cells_coalesced}, flushes: {flushes}'.format(**metrics))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from catmaid.control.stats import (enable_stats_summary_delta_log,
+        fold_stats_summary_delta_log, is_stats_summary_delta_log_enabled)
+from .common import set_log_level
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '''Keep the statistics summary up to date by regularly folding the
+        statistics summary delta log into it. If the delta log isn't enabled
+        yet, it is enabled and the statistics summary is rebuilt first.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delay', type=float, default=10,
+                help="The number of seconds to wait between folding the log.")
+        parser.add_argument('--once', action='store_true', default=False,
+                help="Fold the log only once and exit.")
+
+    def handle(self, *args, **options):
+        set_log_level(logger, options.get('verbosity', 1))
+
+        # Without this setting, the log would be removed again by the start-up
+        # checks of CATMAID and stop filling without notice.
+        if not getattr(settings, 'STATS_SUMMARY_DELTA_LOG', False):
+            raise CommandError('The statistics summary delta log is disabled, '
+                    'set STATS_SUMMARY_DELTA_LOG = True in settings.py to use it')
+
+        if not is_stats_summary_delta_log_enabled():
+            logger.info('Enabling statistics summary delta log and rebuilding '
+                    'statistics summary')
+            enable_stats_summary_delta_log()
+
+        try:
+            while True:
+                n_updated = fold_stats_summary_delta_log(connection.cursor())
+                if n_updated:
+                    logger.debug(f'Updated {n_updated} statistics summary entries')
+                if options['once']:
+                    break
+                time.sleep(options['delay'])
+        except KeyboardInterrupt:
+            pass
@@ -22,7 +22,8 @@ class Command(BaseCommand):
         parser.add_argument('--cache', dest='cache_type', default="section",
             help='Which type of cache should be used: grid or section'),
         parser.add_argument('--type', dest='data_type', default="msgpack",
-            help='Which type of cache to populate: json, json_text, msgpack'),
+            help='Which type of cache to populate: json, json_text, msgpack, ' +
+            'columnar (grid caches only)'),
         parser.add_argument('--orientation', dest='orientations', nargs='+',
             default='xy', help='Which orientations should be generated: xy, ' +
             'xz, zy. Only used if a section cache type is used.'),
@@ -74,7 +75,11 @@ class Command(BaseCommand):
         parser.add_argument('--depth-steps', dest='depth_steps', default=1, type=int,
                 help='The number of steps in which the source bounding box is re-evaluated')
         parser.add_argument('--chunk-size', dest='chunk_size', default=10, type=int,
-                help='The number of cache cells evaluated per process')
+                help='The number of grid cache cells along the X axis that are queried and evaluated together')
+        parser.add_argument('--checkpoint', dest='checkpoint', default=None, type=str,
+                help='A file in which completed grid cache cells are recorded. If the file exists, recorded cells are skipped.')
+        parser.add_argument('--per-cell-queries', dest='bulk', action='store_false', default=True,
+                help='Query the data of each grid cache cell individually rather than for multiple cells at once')
         parser.add_argument('--order', dest='order', default=None, type=str,
                 help='The order of data in the cache, can be either "cable-asc" or "cable-desc". By default no ordering is applied.')
 
@@ -151,8 +156,10 @@ class Command(BaseCommand):
 
         data_type = options['data_type']
 
-        if data_type not in ('json', 'json_text', 'msgpack'):
-            raise CommandError('Type must be one of: json, json_text, msgpack')
+        if data_type not in ('json', 'json_text', 'msgpack', 'columnar'):
+            raise CommandError('Type must be one of: json, json_text, msgpack, columnar')
+        if data_type == 'columnar' and cache_type != 'grid':
+            raise CommandError('The columnar type is only supported by grid caches')
 
         cell_width = options['cell_width']
         if cell_width:
@@ -189,6 +196,10 @@ class Command(BaseCommand):
             raise ValueError("Depth steps work currently only with grid caches")
 
         chunksize = options['chunk_size']
+        checkpoint = options['checkpoint']
+        if checkpoint and cache_type != 'grid':
+            raise ValueError("Checkpoints work currently only with grid caches")
+        bulk = options['bulk']
         ordering = options['order']
         progress = options['progress']
 
@@ -209,5 +220,5 @@ class Command(BaseCommand):
                         lod_bucket_size=lod_bucket_size,
                         lod_strategy=lod_strategy, jobs=jobs,
                         depth_steps=depth_steps, chunksize=chunksize,
-                        ordering=ordering)
+                        ordering=ordering, checkpoint=checkpoint, bulk=bulk)
             self.stdout.write(f'Updated {cache_type} cache for project {p.id}')
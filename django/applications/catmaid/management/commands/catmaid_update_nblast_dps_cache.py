@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from catmaid.control.nat.native import update_dps_cache
+from catmaid.models import Project
+
+from .common import set_log_level
+
+
+logger = logging.getLogger('catmaid.control.nat.native')
+
+
+class Command(BaseCommand):
+    help = 'Create or update the memory-mapped dotprops cache that is used ' \
+           'by the native NBLAST back-end. By default, only skeletons that ' \
+           'changed since the last update are recomputed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Update caches of these projects (otherwise all)')
+        parser.add_argument('--type', dest='object_type', default='skeleton',
+            choices=('skeleton', 'pointcloud'),
+            help='The type of objects to cache')
+        parser.add_argument('--tangent-neighbors', dest='tangent_neighbors',
+            type=int, default=20, help='The number of neighbors used to '
+            'compute tangent vectors')
+        parser.add_argument('--detail', dest='detail', type=int, default=10,
+            help='The number of branches simplified skeletons keep, 0 disables '
+            'simplification')
+        parser.add_argument('--min-nodes', dest='min_nodes', type=int,
+            default=500, help='Only cache skeletons with at least this many '
+            'nodes')
+        parser.add_argument('--full', action='store_true', default=False,
+            help='Recompute all objects instead of only changed ones')
+        parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+            help='The number of processes to use')
+
+    def handle(self, *args, **options):
+        set_log_level(logger, options.get('verbosity', 1))
+
+        project_ids = options['project_id']
+        if not project_ids:
+            project_ids = list(Project.objects.all().values_list('id', flat=True))
+
+        for project_id in project_ids:
+            try:
+                result = update_dps_cache(project_id, options['object_type'],
+                        tangent_neighbors=options['tangent_neighbors'],
+                        detail=options['detail'],
+                        min_nodes=options['min_nodes'], full=options['full'],
+                        n_jobs=options['jobs'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            logger.info(f'Project {project_id}: updated {result["updated"]} '
+                    f'and removed {result["removed"]} cached objects')
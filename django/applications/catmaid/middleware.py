@@ -2,14 +2,21 @@
 
 import re
 import cProfile
+import os
 import pstats
 import logging
+import threading
+import time
 
+from bisect import bisect_left
+from collections import deque
 from traceback import format_exc
 from datetime import datetime
+from typing import Any, Deque, Dict, List
 
 from django.http import JsonResponse, Http404
 from django.conf import settings
+from django.db import connection
 
 from guardian.utils import get_anonymous_user
 
@@ -241,3 +248,229 @@ class NewRelicMiddleware(object):
         self.newrelic.agent.add_custom_parameter('execution_context', exec_ctx)
 
         return self.get_response(request)
+
+
+class RequestInstrumentation(object):
+    """Aggregate timing information of all requests handled by the current
+    process. For every endpoint (HTTP method and URL pattern), a latency
+    histogram, the number of SQL queries, the total SQL time and the response
+    size are kept. For requests that take longer than
+    REQUEST_INSTRUMENTATION_SLOW_THRESHOLD seconds, the executed SQL queries
+    are kept as a sample, of which the last
+    REQUEST_INSTRUMENTATION_SLOW_SAMPLES are available.
+    """
+
+    # Upper bounds of latency histogram buckets in milliseconds. The last
+    # bucket collects all slower requests.
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+            float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.since = datetime.now()
+            self.endpoints:Dict[str, Dict[str, Any]] = {}
+            self.slow_requests:Deque = deque(maxlen=getattr(settings,
+                    'REQUEST_INSTRUMENTATION_SLOW_SAMPLES', 50))
+
+    def add(self, endpoint, duration, n_queries, sql_time, size, status,
+            queries=None, path=None) -> None:
+        """Record a single request. Durations are expected in seconds.
+        """
+        bucket = bisect_left(self.buckets, duration * 1000)
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if not stats:
+                stats = self.endpoints[endpoint] = {
+                    'count': 0,
+                    'errors': 0,
+                    'time': 0.0,
+                    'max_time': 0.0,
+                    'histogram': [0] * len(self.buckets),
+                    'queries': 0,
+                    'max_queries': 0,
+                    'sql_time': 0.0,
+                    'size': 0,
+                    'max_size': 0,
+                }
+            stats['count'] += 1
+            if status >= 500:
+                stats['errors'] += 1
+            stats['time'] += duration
+            stats['max_time'] = max(stats['max_time'], duration)
+            stats['histogram'][bucket] += 1
+            stats['queries'] += n_queries
+            stats['max_queries'] = max(stats['max_queries'], n_queries)
+            stats['sql_time'] += sql_time
+            stats['size'] += size
+            stats['max_size'] = max(stats['max_size'], size)
+
+            if queries is not None:
+                self.slow_requests.append({
+                    'time': datetime.now().isoformat(),
+                    'endpoint': endpoint,
+                    'path': path,
+                    'duration': duration,
+                    'n_queries': n_queries,
+                    'sql_time': sql_time,
+                    'queries': queries,
+                })
+
+    def percentile(self, histogram, count, p) -> float:
+        """Estimate the <p>th percentile of the latency in milliseconds by the
+        upper bound of the histogram bucket it falls into.
+        """
+        target = count * p / 100.0
+        seen = 0
+        for upper_bound, n in zip(self.buckets, histogram):
+            seen += n
+            if seen >= target:
+                return upper_bound
+        return self.buckets[-1]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            endpoints = []
+            for endpoint, stats in self.endpoints.items():
+                count = stats['count']
+                endpoints.append({
+                    'endpoint': endpoint,
+                    'count': count,
+                    'errors': stats['errors'],
+                    'total_time': stats['time'],
+                    'mean_time': stats['time'] / count,
+                    'max_time': stats['max_time'],
+                    'p50': self.percentile(stats['histogram'], count, 50),
+                    'p95': self.percentile(stats['histogram'], count, 95),
+                    'p99': self.percentile(stats['histogram'], count, 99),
+                    'histogram': list(stats['histogram']),
+                    'mean_queries': stats['queries'] / count,
+                    'max_queries': stats['max_queries'],
+                    'total_sql_time': stats['sql_time'],
+                    'mean_sql_time': stats['sql_time'] / count,
+                    'mean_size': stats['size'] / count,
+                    'max_size': stats['max_size'],
+                })
+            slow_requests = list(self.slow_requests)
+
+        # Endpoints with the largest total time first
+        endpoints.sort(key=lambda e: e['total_time'], reverse=True)
+
+        return {
+            'pid': os.getpid(),
+            'since': self.since.isoformat(),
+            'histogram_buckets': [None if b == float('inf') else b
+                    for b in self.buckets],
+            'endpoints': endpoints,
+            'slow_requests': slow_requests,
+        }
+
+
+request_instrumentation = RequestInstrumentation()
+
+
+class InstrumentedStreamingContent(object):
+    """Wrap the content of a streaming response to count its bytes and the SQL
+    queries executed while it is produced. Once the content is exhausted or
+    closed, <on_done> is called with the number of bytes.
+    """
+
+    def __init__(self, content, record_query, on_done):
+        self.content = iter(content)
+        self.record_query = record_query
+        self.on_done = on_done
+        self.size = 0
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            with connection.execute_wrapper(self.record_query):
+                chunk = next(self.content)
+        except StopIteration:
+            self.close()
+            raise
+        self.size += len(chunk)
+        return chunk
+
+    def close(self) -> None:
+        if self.done:
+            return
+        self.done = True
+        close = getattr(self.content, 'close', None)
+        if close:
+            close()
+        self.on_done(self.size)
+
+
+class RequestInstrumentationMiddleware(object):
+    """Record latency, the number of SQL queries, the SQL time and response
+    size for every request in the process-wide RequestInstrumentation
+    instance. SQL statements are only kept in memory for the duration of a
+    request and are recorded only if the request was slower than
+    REQUEST_INSTRUMENTATION_SLOW_THRESHOLD seconds. This middleware should be
+    listed first, so that the time spent in other middlewares is included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = getattr(settings,
+                'REQUEST_INSTRUMENTATION_SLOW_THRESHOLD', 1.0)
+        self.max_queries = getattr(settings,
+                'REQUEST_INSTRUMENTATION_MAX_QUERIES', 100)
+
+    def __call__(self, request):
+        queries:List = []
+        sql_time = [0.0]
+        n_queries = [0]
+
+        def record_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                duration = time.perf_counter() - start
+                sql_time[0] += duration
+                n_queries[0] += 1
+                if len(queries) < self.max_queries:
+                    queries.append((sql, duration))
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(record_query):
+            response = self.get_response(request)
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match:
+            route = getattr(resolver_match, 'route', None) or resolver_match.view_name
+        else:
+            route = 'unresolved'
+        endpoint = f'{request.method} {route}'
+
+        def record(size):
+            duration = time.perf_counter() - start
+            slow_queries = None
+            if duration >= self.slow_threshold:
+                slow_queries = [{
+                    'sql': sql,
+                    'time': query_duration,
+                } for sql, query_duration in queries]
+
+            request_instrumentation.add(endpoint, duration, n_queries[0],
+                    sql_time[0], size, response.status_code, slow_queries,
+                    request.path)
+
+        # The content of streaming responses is produced after this middleware
+        # returns, which is why they are recorded once their content is
+        # consumed or closed.
+        if getattr(response, 'streaming', False):
+            response.streaming_content = InstrumentedStreamingContent(
+                    response.streaming_content, record_query, record)
+        else:
+            record(len(response.content))
+
+        return response
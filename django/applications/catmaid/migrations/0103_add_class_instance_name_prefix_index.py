@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+forward = """
+    -- The text_pattern_ops operator class allows prefix LIKE queries to use
+    -- this index, regardless of the database locale.
+    CREATE INDEX class_instance_project_id_upper_name_pattern_idx
+        ON class_instance (project_id, UPPER(name) text_pattern_ops);
+"""
+
+backward = """
+    DROP INDEX class_instance_project_id_upper_name_pattern_idx;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add an index for case insensitive prefix searches of class instance
+    names within a project. Short search terms can't make use of the existing
+    trigram index, which is why the prefix search mode of the search endpoint
+    uses this index.
+    """
+
+    dependencies = [
+        ('catmaid', '0102_add_columnar_node_grid_cache_data'),
+    ]
+
+    operations = [
+            migrations.RunSQL(forward, backward),
+    ]
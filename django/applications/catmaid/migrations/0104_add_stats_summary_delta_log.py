@@ -0,0 +1,457 @@
+from django.db import migrations
+
+
+def length(a, b):
+    """Return SQL for the Euclidean distance between the locations of the
+    table aliases <a> and <b>.
+    """
+    return f"""sqrt(pow({a}.location_x - {b}.location_x, 2)
+                      + pow({a}.location_y - {b}.location_y, 2)
+                      + pow({a}.location_z - {b}.location_z, 2))"""
+
+
+def hour(col):
+    """Return SQL for the UTC hour bucket of timestamp <col>, independent of the
+    time zone of the session that changes data.
+    """
+    return f"date_trunc('hour', {col} AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+
+
+forward = f"""
+    -- Changes of statistics summary values, written by triggers on treenode,
+    -- review and treenode_connector and folded regularly into the table
+    -- catmaid_stats_summary. There are no foreign keys to keep writes cheap.
+    CREATE TABLE catmaid_stats_summary_delta (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL,
+        user_id integer NOT NULL,
+        date timestamptz NOT NULL,
+        n_treenodes integer NOT NULL DEFAULT 0,
+        n_reviewed_nodes integer NOT NULL DEFAULT 0,
+        n_connector_links integer NOT NULL DEFAULT 0,
+        cable_length double precision NOT NULL DEFAULT 0
+    );
+
+
+    -- Count new nodes and the cable length to their parents per creator and
+    -- hour of creation.
+    CREATE OR REPLACE FUNCTION on_insert_treenode_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_treenodes, cable_length)
+        SELECT t.project_id, t.user_id, {hour('t.creation_time')},
+            count(*), COALESCE(SUM({length('t', 'p')}), 0)
+        FROM new_treenode t
+        LEFT JOIN treenode p
+            ON p.id = t.parent_id
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Treenode updates only affect the cable length of changed nodes and
+    -- their children. The edge of each affected node is subtracted in its old
+    -- state and added in its new state. Nodes with a changed creator, project
+    -- or hour of creation are also moved to their new node count bucket.
+    CREATE OR REPLACE FUNCTION on_edit_treenode_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH changed AS (
+            SELECT n.id
+            FROM new_treenode n
+            JOIN old_treenode o
+                ON o.id = n.id
+            WHERE n.parent_id IS DISTINCT FROM o.parent_id
+                OR n.location_x <> o.location_x
+                OR n.location_y <> o.location_y
+                OR n.location_z <> o.location_z
+                OR n.user_id <> o.user_id
+                OR n.creation_time <> o.creation_time
+                OR n.project_id <> o.project_id
+        ), edge_delta AS (
+            -- New edges of changed nodes
+            SELECT n.project_id, n.user_id, n.creation_time, 0 AS n,
+                {length('n', 'p')} AS length
+            FROM changed c
+            JOIN new_treenode n
+                ON n.id = c.id
+            JOIN treenode p
+                ON p.id = n.parent_id
+
+            UNION ALL
+
+            -- Old edges of changed nodes, the parent might have been changed
+            -- by the same statement.
+            SELECT o.project_id, o.user_id, o.creation_time, 0,
+                -1 * {length('o', 'p')}
+            FROM changed c
+            JOIN old_treenode o
+                ON o.id = c.id
+            JOIN LATERAL (
+                SELECT COALESCE(op.location_x, tp.location_x) AS location_x,
+                    COALESCE(op.location_y, tp.location_y) AS location_y,
+                    COALESCE(op.location_z, tp.location_z) AS location_z
+                FROM (SELECT o.parent_id AS id) parent
+                LEFT JOIN old_treenode op
+                    ON op.id = parent.id
+                LEFT JOIN treenode tp
+                    ON tp.id = parent.id
+            ) p
+                ON o.parent_id IS NOT NULL
+
+            UNION ALL
+
+            -- Edges of unchanged children of changed nodes
+            SELECT k.project_id, k.user_id, k.creation_time, 0,
+                {length('k', 'n')} - {length('k', 'o')}
+            FROM changed c
+            JOIN new_treenode n
+                ON n.id = c.id
+            JOIN old_treenode o
+                ON o.id = c.id
+            JOIN treenode k
+                ON k.parent_id = c.id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM changed c2 WHERE c2.id = k.id
+            )
+        ), moved AS (
+            -- Changed nodes that belong to another node count bucket
+            SELECT n.project_id, n.user_id, n.creation_time,
+                o.project_id AS old_project_id,
+                o.user_id AS old_user_id,
+                o.creation_time AS old_creation_time
+            FROM changed c
+            JOIN new_treenode n
+                ON n.id = c.id
+            JOIN old_treenode o
+                ON o.id = c.id
+            WHERE n.project_id <> o.project_id
+                OR n.user_id <> o.user_id
+                OR {hour('n.creation_time')} <> {hour('o.creation_time')}
+        ), node_delta AS (
+            SELECT project_id, user_id, creation_time, 1 AS n,
+                0::double precision AS length
+            FROM moved
+            UNION ALL
+            SELECT old_project_id, old_user_id, old_creation_time, -1, 0
+            FROM moved
+        ), delta AS (
+            SELECT * FROM edge_delta
+            UNION ALL
+            SELECT * FROM node_delta
+        )
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_treenodes, cable_length)
+        SELECT d.project_id, d.user_id, {hour('d.creation_time')},
+            SUM(d.n), SUM(d.length)
+        FROM delta d
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Subtract deleted nodes and the cable length to their parents, which
+    -- might have been deleted by the same statement.
+    CREATE OR REPLACE FUNCTION on_delete_treenode_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_treenodes, cable_length)
+        SELECT t.project_id, t.user_id, {hour('t.creation_time')},
+            -1 * count(*), -1 * COALESCE(SUM({length('t', 'p')}), 0)
+        FROM old_treenode t
+        LEFT JOIN LATERAL (
+            SELECT COALESCE(op.location_x, tp.location_x) AS location_x,
+                COALESCE(op.location_y, tp.location_y) AS location_y,
+                COALESCE(op.location_z, tp.location_z) AS location_z
+            FROM (SELECT t.parent_id AS id) parent
+            LEFT JOIN old_treenode op
+                ON op.id = parent.id
+            LEFT JOIN treenode tp
+                ON tp.id = parent.id
+        ) p
+            ON t.parent_id IS NOT NULL
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Count reviews per reviewer and hour of review.
+    CREATE OR REPLACE FUNCTION on_insert_review_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_reviewed_nodes)
+        SELECT r.project_id, r.reviewer_id, {hour('r.review_time')}, count(*)
+        FROM new_review r
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Repeated reviews of a node update the review time of the existing
+    -- review, which moves it to another hour.
+    CREATE OR REPLACE FUNCTION on_edit_review_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH changed AS (
+            SELECT n.project_id, n.reviewer_id, n.review_time,
+                o.project_id AS old_project_id,
+                o.reviewer_id AS old_reviewer_id,
+                o.review_time AS old_review_time
+            FROM new_review n
+            JOIN old_review o
+                ON o.id = n.id
+            WHERE n.reviewer_id <> o.reviewer_id
+                OR n.review_time <> o.review_time
+                OR n.project_id <> o.project_id
+        ), review_delta AS (
+            SELECT project_id, reviewer_id, review_time, 1 AS n
+            FROM changed
+            UNION ALL
+            SELECT old_project_id, old_reviewer_id, old_review_time, -1
+            FROM changed
+        )
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_reviewed_nodes)
+        SELECT rd.project_id, rd.reviewer_id, {hour('rd.review_time')},
+            SUM(rd.n)
+        FROM review_delta rd
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_delete_review_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_reviewed_nodes)
+        SELECT r.project_id, r.reviewer_id, {hour('r.review_time')},
+            -1 * count(*)
+        FROM old_review r
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- A synaptic connection (a pre- and a postsynaptic link of the same
+    -- connector) is counted for the user and hour of creation of the link
+    -- that was created last. Pairs of two new links are only counted once.
+    CREATE OR REPLACE FUNCTION on_insert_treenode_connector_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH synaptic_relation AS (
+            SELECT id
+            FROM relation
+            WHERE relation_name IN ('presynaptic_to', 'postsynaptic_to')
+        ), new_link AS (
+            SELECT tc.*
+            FROM new_treenode_connector tc
+            JOIN synaptic_relation sr
+                ON sr.id = tc.relation_id
+        ), connection AS (
+            SELECT n.project_id,
+                CASE WHEN n.creation_time > o.creation_time
+                    THEN n.user_id ELSE o.user_id END AS user_id,
+                GREATEST(n.creation_time, o.creation_time) AS creation_time
+            FROM new_link n
+            JOIN treenode_connector o
+                ON o.connector_id = n.connector_id
+            JOIN synaptic_relation sr
+                ON sr.id = o.relation_id
+            WHERE o.relation_id <> n.relation_id
+                AND o.creation_time <> n.creation_time
+                AND (n.id < o.id OR NOT EXISTS (
+                    SELECT 1 FROM new_link n2 WHERE n2.id = o.id))
+        )
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_connector_links)
+        SELECT c.project_id, c.user_id, {hour('c.creation_time')}, count(*)
+        FROM connection c
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Subtract synaptic connections of deleted links. The partner link might
+    -- have been deleted by the same statement.
+    CREATE OR REPLACE FUNCTION on_delete_treenode_connector_update_stats_summary_delta()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        WITH synaptic_relation AS (
+            SELECT id
+            FROM relation
+            WHERE relation_name IN ('presynaptic_to', 'postsynaptic_to')
+        ), deleted_link AS (
+            SELECT tc.*
+            FROM old_treenode_connector tc
+            JOIN synaptic_relation sr
+                ON sr.id = tc.relation_id
+        ), partner_link AS (
+            SELECT tc.id, tc.connector_id, tc.relation_id, tc.user_id,
+                tc.creation_time
+            FROM treenode_connector tc
+            JOIN (
+                SELECT DISTINCT connector_id FROM deleted_link
+            ) c
+                ON c.connector_id = tc.connector_id
+            UNION ALL
+            SELECT id, connector_id, relation_id, user_id, creation_time
+            FROM deleted_link
+        ), connection AS (
+            SELECT d.project_id,
+                CASE WHEN d.creation_time > o.creation_time
+                    THEN d.user_id ELSE o.user_id END AS user_id,
+                GREATEST(d.creation_time, o.creation_time) AS creation_time
+            FROM deleted_link d
+            JOIN partner_link o
+                ON o.connector_id = d.connector_id
+            JOIN synaptic_relation sr
+                ON sr.id = o.relation_id
+            WHERE o.relation_id <> d.relation_id
+                AND o.creation_time <> d.creation_time
+                AND (d.id < o.id OR NOT EXISTS (
+                    SELECT 1 FROM deleted_link d2 WHERE d2.id = o.id))
+        )
+        INSERT INTO catmaid_stats_summary_delta (project_id, user_id, date,
+            n_connector_links)
+        SELECT c.project_id, c.user_id, {hour('c.creation_time')},
+            -1 * count(*)
+        FROM connection c
+        GROUP BY 1, 2, 3;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- (Re)create all triggers writing to the delta log.
+    CREATE OR REPLACE FUNCTION enable_stats_summary_delta_log() RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        PERFORM disable_stats_summary_delta_log();
+
+        CREATE TRIGGER on_insert_treenode_update_stats_summary_delta
+        AFTER INSERT ON treenode
+        REFERENCING NEW TABLE AS new_treenode
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_update_stats_summary_delta();
+
+        CREATE TRIGGER on_edit_treenode_update_stats_summary_delta
+        AFTER UPDATE ON treenode
+        REFERENCING NEW TABLE AS new_treenode OLD TABLE AS old_treenode
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_update_stats_summary_delta();
+
+        CREATE TRIGGER on_delete_treenode_update_stats_summary_delta
+        AFTER DELETE ON treenode
+        REFERENCING OLD TABLE AS old_treenode
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_update_stats_summary_delta();
+
+        CREATE TRIGGER on_insert_review_update_stats_summary_delta
+        AFTER INSERT ON review
+        REFERENCING NEW TABLE AS new_review
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_review_update_stats_summary_delta();
+
+        CREATE TRIGGER on_edit_review_update_stats_summary_delta
+        AFTER UPDATE ON review
+        REFERENCING NEW TABLE AS new_review OLD TABLE AS old_review
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_review_update_stats_summary_delta();
+
+        CREATE TRIGGER on_delete_review_update_stats_summary_delta
+        AFTER DELETE ON review
+        REFERENCING OLD TABLE AS old_review
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_review_update_stats_summary_delta();
+
+        CREATE TRIGGER on_insert_treenode_connector_update_stats_summary_delta
+        AFTER INSERT ON treenode_connector
+        REFERENCING NEW TABLE AS new_treenode_connector
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_connector_update_stats_summary_delta();
+
+        CREATE TRIGGER on_delete_treenode_connector_update_stats_summary_delta
+        AFTER DELETE ON treenode_connector
+        REFERENCING OLD TABLE AS old_treenode_connector
+        FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_connector_update_stats_summary_delta();
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION disable_stats_summary_delta_log() RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        DROP TRIGGER IF EXISTS on_insert_treenode_update_stats_summary_delta ON treenode;
+        DROP TRIGGER IF EXISTS on_edit_treenode_update_stats_summary_delta ON treenode;
+        DROP TRIGGER IF EXISTS on_delete_treenode_update_stats_summary_delta ON treenode;
+        DROP TRIGGER IF EXISTS on_insert_review_update_stats_summary_delta ON review;
+        DROP TRIGGER IF EXISTS on_edit_review_update_stats_summary_delta ON review;
+        DROP TRIGGER IF EXISTS on_delete_review_update_stats_summary_delta ON review;
+        DROP TRIGGER IF EXISTS on_insert_treenode_connector_update_stats_summary_delta ON treenode_connector;
+        DROP TRIGGER IF EXISTS on_delete_treenode_connector_update_stats_summary_delta ON treenode_connector;
+    END;
+    $$;
+"""
+
+backward = """
+    SELECT disable_stats_summary_delta_log();
+
+    DROP FUNCTION enable_stats_summary_delta_log();
+    DROP FUNCTION disable_stats_summary_delta_log();
+    DROP FUNCTION on_insert_treenode_update_stats_summary_delta();
+    DROP FUNCTION on_edit_treenode_update_stats_summary_delta();
+    DROP FUNCTION on_delete_treenode_update_stats_summary_delta();
+    DROP FUNCTION on_insert_review_update_stats_summary_delta();
+    DROP FUNCTION on_edit_review_update_stats_summary_delta();
+    DROP FUNCTION on_delete_review_update_stats_summary_delta();
+    DROP FUNCTION on_insert_treenode_connector_update_stats_summary_delta();
+    DROP FUNCTION on_delete_treenode_connector_update_stats_summary_delta();
+
+    DROP TABLE catmaid_stats_summary_delta;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a log of statistics summary changes along with trigger functions
+    that write to it. The triggers are only created if the log is enabled
+    through enable_stats_summary_delta_log(), which allows to keep the
+    statistics summary up to date without periodic recomputation.
+    """
+
+    dependencies = [
+        ('catmaid', '0103_add_class_instance_name_prefix_index'),
+    ]
+
+    operations = [
+            migrations.RunSQL(forward, backward),
+    ]
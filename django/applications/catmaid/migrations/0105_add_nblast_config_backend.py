@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+forward = """
+    ALTER TABLE nblast_config
+    ADD COLUMN backend text NOT NULL DEFAULT 'r'
+    CHECK (backend IN ('r', 'native'));
+"""
+
+backward = """
+    ALTER TABLE nblast_config
+    DROP COLUMN backend;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow NBLAST configurations to select the back-end that computes
+    scoring matrices and similarities: the R based nat.nblast implementation
+    or the native NumPy/SciPy implementation.
+    """
+
+    dependencies = [
+        ('catmaid', '0104_add_stats_summary_delta_log'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastconfig',
+                name='backend',
+                field=models.TextField(default='r'),
+            ),
+        ]),
+    ]
@@ -0,0 +1,319 @@
+from django.db import migrations
+
+from catmaid.locks import annotation_closure_lock
+
+
+def annotation_link(cici):
+    """Return SQL joins that limit the class_instance_class_instance rows of
+    alias <cici> to annotations that are annotated with other annotations.
+    """
+    return f"""
+        JOIN relation {cici}_r
+            ON {cici}_r.id = {cici}.relation_id
+        JOIN class_instance {cici}_ci
+            ON {cici}_ci.id = {cici}.class_instance_a
+        JOIN class {cici}_c
+            ON {cici}_c.id = {cici}_ci.class_id
+    """
+
+
+def is_annotation_link(cici):
+    return f"""{cici}_r.relation_name = 'annotated_with'
+        AND {cici}_c.class_name = 'annotation'"""
+
+
+# Each trigger reads the closure before writing it. Two concurrent
+# transactions would otherwise both miss each other's changes, e.g. linking B
+# to C in one and A to B in the other leaves C without the sub-annotation A.
+# An advisory lock per project serializes closure updates for the rest of the
+# transaction. Only statements that change links between annotations take it,
+# other class_instance_class_instance changes don't wait for each other. The
+# projects are locked in order to avoid deadlocks.
+def lock_closure(project_ids):
+    return f"""
+        PERFORM pg_advisory_xact_lock({annotation_closure_lock}, p.id)
+        FROM UNNEST({project_ids}) p(id);
+    """
+
+
+forward = f"""
+    -- The transitive closure of annotations annotated with other annotations.
+    -- Each row links an annotation to one of the annotations that are directly
+    -- or indirectly annotated with it (its sub-annotations). There are no
+    -- foreign keys to keep writes cheap.
+    CREATE TABLE catmaid_annotation_closure (
+        project_id integer NOT NULL,
+        annotation_id bigint NOT NULL,
+        sub_annotation_id bigint NOT NULL,
+        PRIMARY KEY (annotation_id, sub_annotation_id)
+    );
+
+    CREATE INDEX catmaid_annotation_closure_sub_annotation_id_idx
+        ON catmaid_annotation_closure (sub_annotation_id);
+
+
+    -- Recompute all sub-annotations of the passed in annotations.
+    CREATE OR REPLACE FUNCTION update_annotation_closure(annotation_ids bigint[])
+        RETURNS void
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        DELETE FROM catmaid_annotation_closure
+        WHERE annotation_id = ANY(annotation_ids);
+
+        -- UNION instead of UNION ALL ends the recursion in cycles.
+        WITH RECURSIVE sub_annotation(project_id, annotation_id, sub_annotation_id) AS (
+            SELECT cici.project_id, cici.class_instance_b, cici.class_instance_a
+            FROM class_instance_class_instance cici
+            {annotation_link('cici')}
+            WHERE cici.class_instance_b = ANY(annotation_ids)
+                AND {is_annotation_link('cici')}
+            UNION
+            SELECT sa.project_id, sa.annotation_id, cici.class_instance_a
+            FROM sub_annotation sa
+            JOIN class_instance_class_instance cici
+                ON cici.class_instance_b = sa.sub_annotation_id
+            {annotation_link('cici')}
+            WHERE {is_annotation_link('cici')}
+        )
+        INSERT INTO catmaid_annotation_closure (project_id, annotation_id,
+            sub_annotation_id)
+        SELECT project_id, annotation_id, sub_annotation_id
+        FROM sub_annotation;
+    END;
+    $$;
+
+
+    -- Every new link between two annotations adds all sub-annotations of the
+    -- annotated annotation (and itself) to all annotations it is a
+    -- sub-annotation of (and its new meta-annotation). New links can extend
+    -- each other, which is why this is repeated until nothing is added.
+    CREATE OR REPLACE FUNCTION on_insert_cici_update_annotation_closure()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        project_ids integer[];
+        n_added bigint;
+    BEGIN
+        SELECT array_agg(DISTINCT cici.project_id ORDER BY cici.project_id)
+        INTO project_ids
+        FROM new_cici cici
+        {annotation_link('cici')}
+        WHERE {is_annotation_link('cici')};
+
+        IF project_ids IS NULL THEN
+            RETURN NULL;
+        END IF;
+
+        {lock_closure('project_ids')}
+
+        LOOP
+            INSERT INTO catmaid_annotation_closure (project_id, annotation_id,
+                sub_annotation_id)
+            SELECT DISTINCT cici.project_id, meta.id, sub.id
+            FROM new_cici cici
+            {annotation_link('cici')}
+            CROSS JOIN LATERAL (
+                SELECT cici.class_instance_b
+                UNION
+                SELECT ac.annotation_id
+                FROM catmaid_annotation_closure ac
+                WHERE ac.sub_annotation_id = cici.class_instance_b
+            ) meta(id)
+            CROSS JOIN LATERAL (
+                SELECT cici.class_instance_a
+                UNION
+                SELECT ac.sub_annotation_id
+                FROM catmaid_annotation_closure ac
+                WHERE ac.annotation_id = cici.class_instance_a
+            ) sub(id)
+            WHERE {is_annotation_link('cici')}
+            ON CONFLICT DO NOTHING;
+
+            GET DIAGNOSTICS n_added = ROW_COUNT;
+            EXIT WHEN n_added = 0;
+        END LOOP;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Removed links can only change the sub-annotations of the annotations
+    -- they linked to and their meta-annotations, which are recomputed. Links
+    -- that are no part of the closure, like those of neurons, are ignored.
+    CREATE OR REPLACE FUNCTION on_delete_cici_update_annotation_closure()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        project_ids integer[];
+        annotation_ids bigint[];
+    BEGIN
+        SELECT array_agg(DISTINCT cici.project_id ORDER BY cici.project_id)
+        INTO project_ids
+        FROM old_cici cici
+        JOIN catmaid_annotation_closure link
+            ON link.annotation_id = cici.class_instance_b
+            AND link.sub_annotation_id = cici.class_instance_a;
+
+        IF project_ids IS NULL THEN
+            RETURN NULL;
+        END IF;
+
+        {lock_closure('project_ids')}
+
+        SELECT array_agg(DISTINCT meta.id)
+        INTO annotation_ids
+        FROM old_cici cici
+        JOIN catmaid_annotation_closure link
+            ON link.annotation_id = cici.class_instance_b
+            AND link.sub_annotation_id = cici.class_instance_a
+        CROSS JOIN LATERAL (
+            SELECT cici.class_instance_b
+            UNION
+            SELECT ac.annotation_id
+            FROM catmaid_annotation_closure ac
+            WHERE ac.sub_annotation_id = cici.class_instance_b
+        ) meta(id);
+
+        IF annotation_ids IS NOT NULL THEN
+            PERFORM update_annotation_closure(annotation_ids);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    -- Changed links are treated like removed links in their old state and new
+    -- links in their new state. Both is covered by recomputing the affected
+    -- annotations.
+    CREATE OR REPLACE FUNCTION on_edit_cici_update_annotation_closure()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        project_ids integer[];
+        annotation_ids bigint[];
+    BEGIN
+        SELECT array_agg(DISTINCT p.project_id ORDER BY p.project_id)
+        INTO project_ids
+        FROM (
+            SELECT cici.project_id
+            FROM old_cici cici
+            JOIN catmaid_annotation_closure link
+                ON link.annotation_id = cici.class_instance_b
+                AND link.sub_annotation_id = cici.class_instance_a
+            UNION ALL
+            SELECT cici.project_id
+            FROM new_cici cici
+            {annotation_link('cici')}
+            WHERE {is_annotation_link('cici')}
+        ) p;
+
+        IF project_ids IS NULL THEN
+            RETURN NULL;
+        END IF;
+
+        {lock_closure('project_ids')}
+
+        WITH meta_annotation AS (
+            SELECT cici.class_instance_b AS id
+            FROM old_cici cici
+            JOIN catmaid_annotation_closure link
+                ON link.annotation_id = cici.class_instance_b
+                AND link.sub_annotation_id = cici.class_instance_a
+            UNION
+            SELECT cici.class_instance_b
+            FROM new_cici cici
+            {annotation_link('cici')}
+            WHERE {is_annotation_link('cici')}
+        )
+        SELECT array_agg(DISTINCT meta.id)
+        INTO annotation_ids
+        FROM meta_annotation ma
+        CROSS JOIN LATERAL (
+            SELECT ma.id
+            UNION
+            SELECT ac.annotation_id
+            FROM catmaid_annotation_closure ac
+            WHERE ac.sub_annotation_id = ma.id
+        ) meta(id);
+
+        IF annotation_ids IS NOT NULL THEN
+            PERFORM update_annotation_closure(annotation_ids);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_cici_update_annotation_closure
+    AFTER INSERT ON class_instance_class_instance
+    REFERENCING NEW TABLE AS new_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_cici_update_annotation_closure();
+
+    CREATE TRIGGER on_edit_cici_update_annotation_closure
+    AFTER UPDATE ON class_instance_class_instance
+    REFERENCING NEW TABLE AS new_cici OLD TABLE AS old_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_cici_update_annotation_closure();
+
+    CREATE TRIGGER on_delete_cici_update_annotation_closure
+    AFTER DELETE ON class_instance_class_instance
+    REFERENCING OLD TABLE AS old_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_cici_update_annotation_closure();
+
+
+    -- Initialize the closure of all existing annotation hierarchies.
+    WITH RECURSIVE sub_annotation(project_id, annotation_id, sub_annotation_id) AS (
+        SELECT cici.project_id, cici.class_instance_b, cici.class_instance_a
+        FROM class_instance_class_instance cici
+        {annotation_link('cici')}
+        WHERE {is_annotation_link('cici')}
+        UNION
+        SELECT sa.project_id, sa.annotation_id, cici.class_instance_a
+        FROM sub_annotation sa
+        JOIN class_instance_class_instance cici
+            ON cici.class_instance_b = sa.sub_annotation_id
+        {annotation_link('cici')}
+        WHERE {is_annotation_link('cici')}
+    )
+    INSERT INTO catmaid_annotation_closure (project_id, annotation_id,
+        sub_annotation_id)
+    SELECT project_id, annotation_id, sub_annotation_id
+    FROM sub_annotation;
+
+    ANALYZE catmaid_annotation_closure;
+"""
+
+backward = """
+    DROP TRIGGER on_insert_cici_update_annotation_closure ON class_instance_class_instance;
+    DROP TRIGGER on_edit_cici_update_annotation_closure ON class_instance_class_instance;
+    DROP TRIGGER on_delete_cici_update_annotation_closure ON class_instance_class_instance;
+
+    DROP FUNCTION on_insert_cici_update_annotation_closure();
+    DROP FUNCTION on_edit_cici_update_annotation_closure();
+    DROP FUNCTION on_delete_cici_update_annotation_closure();
+    DROP FUNCTION update_annotation_closure(bigint[]);
+
+    DROP TABLE catmaid_annotation_closure;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table with the transitive closure of annotation hierarchies, i.e.
+    all sub-annotations of each meta-annotation. It is kept up to date by
+    triggers on class_instance_class_instance, so that sub-annotations can be
+    looked up with a single query.
+    """
+
+    dependencies = [
+        ('catmaid', '0105_add_nblast_config_backend'),
+    ]
+
+    operations = [
+            migrations.RunSQL(forward, backward),
+    ]
@@ -999,6 +999,8 @@ class NblastConfig(NonCascadingUserFocusedModel):
     scoring = ArrayField(ArrayField(models.FloatField()))
     resample_step = models.FloatField(default=1000)
     tangent_neighbors = models.IntegerField(default=5)
+    # Either 'r' (nat.nblast through Rpy2) or 'native' (NumPy/SciPy)
+    backend = models.TextField(default='r')
 
 
     class Meta:
@@ -1434,6 +1436,7 @@ class NodeGridCache(models.Model):
     has_json_data = models.BooleanField(default=False, null=False)
     has_json_text_data = models.BooleanField(default=False, null=False)
     has_msgpack_data = models.BooleanField(default=False, null=False)
+    has_columnar_data = models.BooleanField(default=False, null=False)
     enabled = models.BooleanField(default=True, null=False)
     ordering = models.TextField(null=True, default=None)
 
@@ -1451,6 +1454,7 @@ class NodeGridCacheCell(models.Model):
     json_data = JSONField(blank=True, null=True)
     json_text_data = models.TextField(blank=True, null=True)
     msgpack_data = models.BinaryField(null=True)
+    columnar_data = models.BinaryField(null=True)
 
     class Meta:
         db_table = "node_grid_cache_cell"
@@ -6,6 +6,8 @@ from datetime import datetime
 
 from catmaid.control.annotation import _annotate_entities
 from catmaid.control.annotation import create_annotation_query
+from catmaid.control.annotation import (get_annotation_to_id_map,
+        get_sub_annotation_ids)
 
 from .common import CatmaidApiTestCase
 
@@ -268,3 +270,43 @@ class AnnotationsApiTests(CatmaidApiTestCase):
         ]
         self.assertEqual(parsed_response['totalRecords'], 1)
         self.assertCountEqual(parsed_response['entities'], expected_entities)
+
+    def test_sub_annotation_hierarchy(self):
+        self.fake_authentication()
+
+        # C and F are annotated with D, which is annotated with E.
+        for annotation, meta_annotation in (('C', 'D'), ('F', 'D'), ('D', 'E')):
+            response = self.client.post(
+                '/%d/annotations/add' % (self.test_project_id,),
+                {'meta_annotations[0]': meta_annotation,
+                 'annotations[0]': annotation})
+            self.assertStatus(response)
+        ids = get_annotation_to_id_map(self.test_project_id, ['C', 'D', 'E', 'F'])
+
+        def sub_annotations(name):
+            annotation_set = frozenset([ids[name]])
+            sub_annotation_ids = get_sub_annotation_ids(self.test_project_id,
+                    [annotation_set], None, None)
+            return set(sub_annotation_ids[annotation_set])
+
+        self.assertEqual({ids['C'], ids['D'], ids['F']}, sub_annotations('E'))
+        self.assertEqual({ids['C'], ids['F']}, sub_annotations('D'))
+        self.assertEqual(set(), sub_annotations('C'))
+
+        # Removing D from C removes C from the hierarchy of D and E.
+        response = self.client.post(
+            '/%d/annotations/remove' % (self.test_project_id,),
+            {'entity_ids[0]': ids['C'],
+             'annotation_ids[0]': ids['D']})
+        self.assertStatus(response)
+        self.assertEqual({ids['D'], ids['F']}, sub_annotations('E'))
+        self.assertEqual({ids['F']}, sub_annotations('D'))
+
+        # Annotating E with F creates a cycle, which includes E itself.
+        response = self.client.post(
+            '/%d/annotations/add' % (self.test_project_id,),
+            {'meta_annotations[0]': 'F',
+             'annotations[0]': 'E'})
+        self.assertStatus(response)
+        self.assertEqual({ids['D'], ids['E'], ids['F']}, sub_annotations('F'))
+        self.assertEqual({ids['D'], ids['E'], ids['F']}, sub_annotations('E'))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from catmaid.control import circles
+from catmaid.state import make_nocheck_state
+
+from .common import CatmaidApiTestCase
+
+
+class CirclesApiTests(CatmaidApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Connectivity indices are kept across requests and would otherwise
+        # include changes of other tests.
+        circles._connectivity_indices.clear()
+
+    def circles_of_hell(self, skeleton_ids, n_circles=1):
+        data = {'n_circles': n_circles, 'min_pre': 1, 'min_post': 1}
+        for i, skeleton_id in enumerate(skeleton_ids):
+            data[f'skeleton_ids[{i}]'] = skeleton_id
+        response = self.client.post(
+                '/%d/graph/circlesofhell' % self.test_project_id, data)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        return set(parsed_response[0])
+
+    def test_connectivity_index(self):
+        index = circles.SkeletonConnectivityIndex.build(self.test_project_id)
+        sources, targets, weights = index.edges()
+        self.assertEqual({
+            (235, 361): 1,
+            (235, 373): 2,
+            (2388, 2364): 1,
+            (2411, 2364): 1,
+            (2462, 2468): 1,
+        }, dict(zip(zip(sources.tolist(), targets.tolist()), weights.tolist())))
+
+        self.assertEqual({373}, index.adjacent([235], 'out', 2))
+        self.assertEqual({2388, 2411}, index.adjacent([2364, 2468], 'in'))
+        self.assertEqual(set(), index.adjacent([12345], 'in'))
+
+    def test_circles_of_hell(self):
+        self.fake_authentication()
+
+        self.assertEqual({361, 373}, self.circles_of_hell([235]))
+        self.assertEqual({361, 373}, self.circles_of_hell([235], 2))
+
+        # A new postsynaptic link of skeleton 2364 is picked up by the warm
+        # connectivity index.
+        response = self.client.post(
+                '/%d/link/create' % self.test_project_id, {
+                    'from_id': 2374,
+                    'to_id': 421,
+                    'link_type': 'postsynaptic_to',
+                    'state': make_nocheck_state(),
+                })
+        self.assertStatus(response)
+
+        self.assertEqual({361, 373, 2364}, self.circles_of_hell([235]))
+        self.assertEqual({361, 373, 2364, 2388, 2411},
+                self.circles_of_hell([235], 2))
+
+    def test_find_directed_paths(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/graph/directedpaths' % self.test_project_id, {
+                    'sources[0]': 235,
+                    'targets[0]': 373,
+                    'targets[1]': 361,
+                    'min_synapses': 2,
+                })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([[235, 373]], parsed_response)
+
+        response = self.client.post(
+                '/%d/graph/dps' % self.test_project_id, {
+                    'sources[0]': 2388,
+                    'targets[0]': 2364,
+                    'min_synapses': 1,
+                })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual({2388, 2364}, set(parsed_response))
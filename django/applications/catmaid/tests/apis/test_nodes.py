@@ -442,6 +442,56 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_rel_response, parsed_response[4])
 
 
+    def test_node_list_columnar_format(self):
+        from catmaid.control.node import decode_columnar_node_data
+
+        self.fake_authentication()
+        params = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+        self.assertStatus(response)
+        json_response = json.loads(response.content.decode('utf-8'))
+
+        params['format'] = 'columnar'
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        columnar_response = decode_columnar_node_data(response.content)
+
+        self.assertCountEqual(json_response[0], columnar_response[0])
+        self.assertEqual(len(json_response[1]), len(columnar_response[1]))
+        self.assertEqual(json_response[3], columnar_response[3])
+        self.assertEqual(json_response[4],
+                dict((str(k), v) for k, v in columnar_response[4].items()))
+
+    def test_node_list_image_format(self):
+        self.fake_authentication()
+        params = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+            'format': 'png',
+            'view_width': 200,
+            'view_height': 100,
+        }
+
+        for render_mode in ('nodes', 'heatmap', 'auto'):
+            params['render_mode'] = render_mode
+            response = self.client.post('/%d/node/list' % (self.test_project_id,), params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertTrue(response.content.startswith(b'\x89PNG'))
+
     def test_node_list_with_active_node(self):
         self.fake_authentication()
         expected_t_result = [
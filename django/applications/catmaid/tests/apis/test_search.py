@@ -149,3 +149,50 @@ class SearchApiTests(CatmaidApiTestCase):
                     "nodes":[{"id":403, "x":7840, "y":2380, "z":0, "skid":373}]},
                 {"id":233, "name":"branched neuron", "class_name":"neuron"}]
         self.assertEqual(expected_result, parsed_response)
+
+
+    def test_search_prefix_mode(self):
+        self.fake_authentication()
+
+        response = self.client.get(
+                '/%d/search' % self.test_project_id,
+                {'substring': 'UNCERT', 'mode': 'prefix'})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = [
+                {"id":2342, "name":"uncertain end", "class_name":"label",
+                    "nodes":[{"id":403, "x":7840, "y":2380, "z":0, "skid":373}]}]
+        self.assertEqual(expected_result, parsed_response)
+
+        # Wildcards are matched literally
+        response = self.client.get(
+                '/%d/search' % self.test_project_id,
+                {'substring': '%', 'mode': 'prefix'})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([], parsed_response)
+
+
+    def test_search_trigram_mode_with_pagination(self):
+        self.fake_authentication()
+
+        # Similar words are found as well
+        response = self.client.get(
+                '/%d/search' % self.test_project_id,
+                {'substring': 'downstrem', 'mode': 'trigram'})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = [
+                {"id":374, "name":"downstream-A", "class_name":"neuron"},
+                {"id":362, "name":"downstream-B", "class_name":"neuron"}]
+        self.assertEqual(expected_result, parsed_response)
+
+        response = self.client.get(
+                '/%d/search' % self.test_project_id,
+                {'substring': 'downstrem', 'mode': 'trigram', 'limit': 1,
+                'offset': 1})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = [
+                {"id":362, "name":"downstream-B", "class_name":"neuron"}]
+        self.assertEqual(expected_result, parsed_response)
@@ -415,9 +415,30 @@ class SkeletonsApiTests(CatmaidApiTestCase):
                 {'treenode_id': treenode_id, 'distance': 2000, 'size_mode': 1})
         self.assertStatus(response)
         parsed_response = json.loads(response.content.decode('utf-8'))
-        expected_result = [2462, 2433, 373]
+        expected_result = [2462, 2433]
         self.assertCountEqual(expected_result, parsed_response['skeletons'])
 
+        # Skeletons are ordered by distance and can be paged
+        response = self.client.post(
+                '/%d/skeletons/within-spatial-distance' % (self.test_project_id,),
+                {'treenode_id': treenode_id, 'distance': 2000, 'size_mode': 2,
+                 'limit': 3, 'offset': 1})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([2364, 235, 2468], parsed_response['skeletons'])
+        self.assertAlmostEqual(988.585, parsed_response['distances'][0], places=2)
+        self.assertTrue(parsed_response['reached_limit'])
+
+        # Multiple query nodes and nearest skeletons
+        response = self.client.post(
+                '/%d/skeletons/within-spatial-distance' % (self.test_project_id,),
+                {'treenode_ids': [treenode_id, 367], 'distance': 500,
+                 'size_mode': 2, 'nearest': 2})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([361, 2411], parsed_response['skeletons'])
+        self.assertEqual([0.0, 0.0], parsed_response['distances'])
+
 
     def test_skeleton_permissions(self):
         skeleton_id = 235
@@ -488,6 +509,28 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_skeleton_measure(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/skeletons/measure' % (self.test_project_id,), {
+                    'skeleton_ids[0]': 235,
+                    'skeleton_ids[1]': 373,
+                })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        # Skeleton ID, raw cable, smooth cable, inputs, outputs, nodes,
+        # branches, ends and principal branch cable.
+        expected_result = [
+            [235, 11243, 10640, 0, 3, 28, 2, 4, 7391.129118055569],
+            [373, 2345, 2324, 2, 0, 5, 0, 2, 1705.8585462212545],
+        ]
+        self.assertEqual(len(expected_result), len(parsed_response))
+        for expected, row in zip(expected_result, sorted(parsed_response)):
+            self.assertEqual(expected[:8], row[:8])
+            self.assertAlmostEqual(expected[8], row[8], places=3)
+
+
     def test_skeleton_ancestry(self):
         skeleton_id = 361
 
@@ -541,6 +584,30 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_skeleton_connectivity_matrix_cache(self):
+        from catmaid.control.skeleton import (get_connectivity_matrix,
+                get_connectivity_matrix_arrays)
+        self.fake_authentication()
+
+        skeleton_ids = [235, 361, 373, 2364, 2388, 2411]
+        matrix = get_connectivity_matrix(self.test_project_id, skeleton_ids,
+                skeleton_ids)
+        self.assertEqual({235: {361: 1, 373: 2}, 2388: {2364: 1},
+                2411: {2364: 1}}, matrix)
+
+        row_idx, col_idx, counts = get_connectivity_matrix_arrays(
+                self.test_project_id, skeleton_ids, skeleton_ids)
+        self.assertCountEqual([(0, 1, 1), (0, 2, 2), (4, 3, 1), (5, 3, 1)],
+                zip(row_idx.tolist(), col_idx.tolist(), counts.tolist()))
+
+        # Removing a link has to invalidate the cached matrix.
+        TreenodeConnector.objects.filter(pk=372).delete()
+        matrix = get_connectivity_matrix(self.test_project_id, skeleton_ids,
+                skeleton_ids)
+        self.assertEqual({235: {373: 2}, 2388: {2364: 1}, 2411: {2364: 1}},
+                matrix)
+
+
     def test_skeleton_connectivity_matrix_with_locations(self):
         self.fake_authentication()
 
@@ -762,6 +829,42 @@ class SkeletonsApiTests(CatmaidApiTestCase):
             self.assertTrue(row in parsed_response['edges'])
 
 
+    def test_skeleton_graph_split_cache(self):
+        self.fake_authentication()
+
+        params = {
+            'skeleton_ids[0]': 235,
+            'skeleton_ids[1]': 361,
+            'skeleton_ids[2]': 373,
+            'confidence_threshold': 4,
+        }
+        response = self.client.post(
+            '/%d/skeletons/confidence-compartment-subgraph' % self.test_project_id,
+            params)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(frozenset(['235', '361', '373']),
+                frozenset(parsed_response['nodes']))
+
+        # Lowering the confidence of a node has to invalidate the cached split
+        # of its skeleton.
+        response = self.client.post('/%d/treenodes/289/confidence' % self.test_project_id,
+                {'new_confidence': 3, 'state': '{"nocheck": true}'})
+        self.assertStatus(response)
+        response = self.client.post(
+            '/%d/skeletons/confidence-compartment-subgraph' % self.test_project_id,
+            params)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(frozenset(['235_1', '235_2', '361', '373']),
+                frozenset(parsed_response['nodes']))
+        expected_result_edges = [
+                ['235_1', '373', [0, 0, 0, 0, 1]],
+                ['235_2', '373', [0, 0, 0, 0, 1]],
+                ['235_2', '361', [0, 0, 0, 0, 1]]]
+        self.assertCountEqual(expected_result_edges, parsed_response['edges'])
+
+
     def test_reroot_and_join_skeletons(self):
         self.fake_authentication()
 
@@ -1544,6 +1647,51 @@ class SkeletonsApiTransactionTests(CatmaidApiTransactionTestCase):
         transaction.commit()
 
 
+    def test_bulk_import_skeletons(self):
+        self.fake_authentication()
+        assign_perm('can_import', self.test_user, self.test_project)
+
+        files = []
+        n_orig_nodes = {}
+        for skeleton_id in (235, 373):
+            response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, skeleton_id))
+            self.assertStatus(response)
+            swc_file = StringIO(response.content.decode('utf-8'))
+            swc_file.name = 'skeleton-%d.swc' % skeleton_id
+            files.append(swc_file)
+            n_orig_nodes[skeleton_id] = Treenode.objects.filter(skeleton_id=skeleton_id).count()
+
+        # All files are uploaded with the same field name.
+        response = self.client.post('/%d/skeletons/bulk-import' % (self.test_project_id,),
+                {'file': files, 'batch_size': 1, 'annotations': ['bulk']})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(parsed_response['skeletons']), 2)
+
+        for info in parsed_response['skeletons']:
+            orig_skeleton_id = int(info['file_name'][9:-4])
+            self.assertEqual(n_orig_nodes[orig_skeleton_id], info['n_nodes'])
+
+            neuron = ClassInstance.objects.get(id=info['neuron_id'])
+            self.assertEqual(info['file_name'][:-4], neuron.name)
+            ClassInstanceClassInstance.objects.get(class_instance_a=info['skeleton_id'],
+                    class_instance_b=neuron, relation__relation_name='model_of')
+            ClassInstanceClassInstance.objects.get(class_instance_a=neuron,
+                    relation__relation_name='annotated_with',
+                    class_instance_b__name='bulk')
+
+            orig_edges = set()
+            for tn in Treenode.objects.filter(skeleton_id=orig_skeleton_id):
+                parent = Treenode.objects.get(id=tn.parent_id) if tn.parent_id else None
+                orig_edges.add(((tn.location_x, tn.location_y, tn.location_z),
+                        (parent.location_x, parent.location_y, parent.location_z) if parent else None))
+            new_edges = set()
+            for tn in Treenode.objects.filter(skeleton_id=info['skeleton_id']):
+                parent = Treenode.objects.get(id=tn.parent_id) if tn.parent_id else None
+                new_edges.add(((tn.location_x, tn.location_y, tn.location_z),
+                        (parent.location_x, parent.location_y, parent.location_z) if parent else None))
+            self.assertEqual(orig_edges, new_edges)
+
     def test_import_skeleton_eswc(self):
         self.fake_authentication()
 
@@ -8,10 +8,11 @@ import pytz
 from itertools import chain
 
 from django.db import connection
-from catmaid.models import Connector
+from catmaid.models import Connector, StatsSummary
 from catmaid.tests.apis.common import CatmaidApiTestCase
 from catmaid.control import stats
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
+from catmaid.middleware import RequestInstrumentation
 from guardian.shortcuts import assign_perm
 from io import StringIO
 
@@ -1174,3 +1175,152 @@ class StatsApiTests(CatmaidApiTestCase):
         node_stats = stats.select_node_stats(cursor,
                 self.test_project_id, start_date_utc, end_date_utc, time_zone)
         self.assertEqual(node_stats, expected_stats)
+
+    def test_stats_summary_delta_log(self):
+        cursor = connection.cursor()
+
+        # The log is kept for all projects, so enabling it has to rebuild the
+        # summary of other projects too, which removes this bogus entry.
+        bogus_summary = StatsSummary.objects.create(project_id=1,
+                user_id=self.test_user_id, n_treenodes=12345)
+
+        stats.enable_stats_summary_delta_log([self.test_project_id])
+        self.assertTrue(stats.is_stats_summary_delta_log_enabled(cursor))
+
+        self.assertFalse(StatsSummary.objects.filter(id=bogus_summary.id).exists())
+
+        def get_summary():
+            cursor.execute("""
+                SELECT user_id, date, n_treenodes, n_reviewed_nodes,
+                    n_connector_links, cable_length
+                FROM catmaid_stats_summary
+                WHERE project_id = %(project_id)s
+                AND (n_treenodes <> 0 OR n_reviewed_nodes <> 0
+                    OR n_connector_links <> 0 OR cable_length <> 0)
+            """, {
+                'project_id': self.test_project_id,
+            })
+            return {(row[0], row[1]): (row[2], row[3], row[4],
+                    round(row[5], 3)) for row in cursor.fetchall()}
+
+        # Changes are only logged until the log is folded
+        summary_before = get_summary()
+        self.add_test_treenodes()
+        self.add_test_connector_links()
+        self.add_test_reviews()
+        self.assertEqual(summary_before, get_summary())
+
+        # Move a node with children, re-review a node and delete a leaf node
+        # along with its links.
+        cursor.execute("""
+            UPDATE treenode SET location_x = location_x + 100 WHERE id = 11;
+            UPDATE review SET review_time = '2017-07-03T10:00:00Z'
+            WHERE treenode_id = 13 AND reviewer_id = 1;
+            DELETE FROM treenode_connector WHERE treenode_id = 15;
+            DELETE FROM review WHERE treenode_id = 15;
+            DELETE FROM treenode_class_instance WHERE treenode_id = 15;
+            UPDATE treenode SET parent_id = NULL WHERE parent_id = 15;
+            DELETE FROM treenode WHERE id = 15;
+        """)
+
+        self.assertTrue(stats.fold_stats_summary_delta_log(cursor) > 0)
+        cursor.execute("SELECT COUNT(*) FROM catmaid_stats_summary_delta")
+        self.assertEqual(0, cursor.fetchone()[0])
+        incremental_summary = get_summary()
+
+        # The folded summary has to match a summary computed from scratch.
+        stats.populate_stats_summary(self.test_project_id, delete=True,
+                incremental=False, include_current_hour=True)
+        self.assertEqual(get_summary(), incremental_summary)
+
+        # Skeleton imports that replace a skeleton rewrite the creator and
+        # creation time of its nodes, including the root node, which has no
+        # edge.
+        cursor.execute("""
+            UPDATE treenode
+            SET user_id = %(user_id)s, creation_time = '2017-07-04T10:00:00Z'
+            WHERE skeleton_id = 235
+        """, {
+            'user_id': 1,
+        })
+        self.assertTrue(stats.fold_stats_summary_delta_log(cursor) > 0)
+        moved_summary = get_summary()
+        stats.populate_stats_summary(self.test_project_id, delete=True,
+                incremental=False, include_current_hour=True)
+        self.assertEqual(get_summary(), moved_summary)
+
+        stats.disable_stats_summary_delta_log()
+        self.assertFalse(stats.is_stats_summary_delta_log_enabled(cursor))
+
+    def test_request_instrumentation(self):
+        instrumentation = RequestInstrumentation()
+        instrumentation.add('GET a', 0.004, 3, 0.002, 100, 200)
+        instrumentation.add('GET a', 0.150, 5, 0.1, 300, 200,
+                [{'sql': 'SELECT 1', 'time': 0.1}], '/a')
+        instrumentation.add('GET b', 0.001, 1, 0.0005, 10, 500)
+
+        stats = instrumentation.get_stats()
+        self.assertEqual([e['endpoint'] for e in stats['endpoints']],
+                ['GET a', 'GET b'])
+        a = stats['endpoints'][0]
+        self.assertEqual(a['count'], 2)
+        self.assertEqual(a['errors'], 0)
+        self.assertEqual(a['mean_queries'], 4)
+        self.assertEqual(a['max_queries'], 5)
+        self.assertEqual(a['max_size'], 300)
+        self.assertEqual(a['p50'], 5)
+        self.assertEqual(a['p99'], 200)
+        self.assertEqual(sum(a['histogram']), 2)
+        self.assertEqual(stats['endpoints'][1]['errors'], 1)
+        self.assertEqual(len(stats['slow_requests']), 1)
+        self.assertEqual(stats['slow_requests'][0]['path'], '/a')
+
+        instrumentation.reset()
+        self.assertEqual(instrumentation.get_stats()['endpoints'], [])
+
+    def test_request_stats(self):
+        self.fake_authentication()
+        assign_perm('can_administer', self.test_user, self.test_project)
+
+        response = self.client.delete(f'/{self.test_project_id}/stats/requests')
+        self.assertStatus(response)
+
+        response = self.client.get(f'/{self.test_project_id}/stats/nodecount')
+        self.assertStatus(response)
+
+        response = self.client.get(f'/{self.test_project_id}/stats/requests',
+                {'endpoint': 'nodecount'})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(parsed_response['endpoints']), 1)
+        endpoint = parsed_response['endpoints'][0]
+        self.assertIn('stats/nodecount', endpoint['endpoint'])
+        self.assertEqual(endpoint['count'], 1)
+        self.assertTrue(endpoint['mean_queries'] > 0)
+        self.assertTrue(endpoint['mean_size'] > 0)
+
+    def test_streaming_request_stats(self):
+        self.fake_authentication()
+        assign_perm('can_administer', self.test_user, self.test_project)
+
+        response = self.client.delete(f'/{self.test_project_id}/stats/requests')
+        self.assertStatus(response)
+
+        response = self.client.post(
+                f'/{self.test_project_id}/skeletons/connectivity_matrix/csv', {
+                    'rows[0]': 235,
+                    'columns[0]': 373,
+                })
+        self.assertStatus(response)
+        # Streaming responses are only recorded once their content is consumed.
+        content = b''.join(response.streaming_content)
+
+        response = self.client.get(f'/{self.test_project_id}/stats/requests',
+                {'endpoint': 'connectivity_matrix/csv'})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(parsed_response['endpoints']), 1)
+        endpoint = parsed_response['endpoints'][0]
+        self.assertEqual(endpoint['count'], 1)
+        self.assertTrue(endpoint['mean_queries'] > 0)
+        self.assertEqual(endpoint['mean_size'], len(content))
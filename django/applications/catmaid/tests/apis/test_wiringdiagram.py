@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import json
+from xml.etree import ElementTree
+
+from .common import CatmaidApiTestCase
+
+
+class WiringDiagramApiTests(CatmaidApiTestCase):
+
+    expected_edges = {
+        ('235', '361'): 1,
+        ('235', '373'): 2,
+        ('2388', '2364'): 1,
+        ('2462', '2462'): 1,
+        ('2462', '2468'): 1,
+    }
+
+    expected_nodes = {
+        '235': 28,
+        '361': 9,
+        '373': 5,
+        '2364': 6,
+        '2388': 3,
+        '2462': 4,
+        '2468': 2,
+    }
+
+    def test_export_wiring_diagram(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/wiringdiagram/json' % self.test_project_id)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        edges = {(e['source'], e['target']): e['number_of_connector']
+                for e in parsed_response['data']['edges']}
+        self.assertEqual(self.expected_edges, edges)
+        nodes = {n['id']: n['node_count']
+                for n in parsed_response['data']['nodes']}
+        self.assertEqual(self.expected_nodes, nodes)
+
+    def test_stream_wiring_diagram(self):
+        self.fake_authentication()
+
+        response = self.client.get(
+                '/%d/wiringdiagram/export' % self.test_project_id,
+                {'lower_skeleton_count': 4})
+        self.assertStatus(response)
+        parsed_response = json.loads(b''.join(
+                response.streaming_content).decode('utf-8'))
+        edges = {(e['source'], e['target']): e['number_of_connector']
+                for e in parsed_response['data']['edges']}
+        self.assertEqual({
+            ('235', '361'): 1,
+            ('235', '373'): 2,
+            ('2462', '2462'): 1,
+        }, edges)
+        nodes = {n['id']: n['node_count']
+                for n in parsed_response['data']['nodes']}
+        self.assertEqual({'235': 28, '361': 9, '373': 5, '2462': 4}, nodes)
+
+        response = self.client.get(
+                '/%d/wiringdiagram/export' % self.test_project_id,
+                {'format': 'graphml'})
+        self.assertStatus(response)
+        ns = {'g': 'http://graphml.graphdrawing.org/xmlns'}
+        graph = ElementTree.fromstring(b''.join(response.streaming_content))
+        edges = {(e.get('source'), e.get('target')): int(e.find('g:data', ns).text)
+                for e in graph.iterfind('g:graph/g:edge', ns)}
+        self.assertEqual(self.expected_edges, edges)
+        nodes = {n.get('id'): int(n.find('g:data[@key="node_count"]', ns).text)
+                for n in graph.iterfind('g:graph/g:node', ns)}
+        self.assertEqual(self.expected_nodes, nodes)
@@ -7,7 +7,8 @@ import mock
 from rest_framework.authtoken.models import Token
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
 from django.test.client import Client
 from guardian.shortcuts import assign_perm
 from catmaid.models import Class, ClassInstance, Project, User, Treenode
@@ -143,3 +144,128 @@ class GetTokenTest(TestCase):
         self.user.save()
         with self.assertRaisesMessage(CommandError, 'account is disabled'):
             self.attempt_command(self.username, '--password', self.password)
+
+
+class SpatialUpdateWorkerTest(TestCase):
+    """
+    Test the coalescing of spatial updates in CATMAID's spatial update worker.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO node_grid_cache (project_id, orientation, cell_width,
+                cell_height, cell_depth)
+            VALUES (3, 0, 1000, 1000, 40)
+            RETURNING id
+        """)
+        self.grid_id = cursor.fetchone()[0]
+
+    @override_settings(NODE_PROVIDERS=['cached_msgpack_grid'])
+    def test_coalescing(self):
+        from catmaid.management.commands.catmaid_spatial_update_worker import GridWorker
+        worker = GridWorker(batch_size=100, max_latency=3600)
+        cursor = connection.cursor()
+
+        updates = [
+            {'project_id': 3, 'type': 'point', 'p': [100, 100, 0]},
+            {'project_id': 3, 'type': 'point', 'p': [200, 300, 10]},
+            {'project_id': 3, 'type': 'edge', 'p1': [500, 500, 0], 'p2': [2500, 500, 0]},
+        ]
+        worker.update(updates, cursor)
+
+        # Updates are held back until the maximum latency is reached.
+        metrics = worker.metrics()
+        self.assertEqual(metrics['queue_depth'], 3)
+        self.assertEqual(metrics['cells_coalesced'], 2)
+        self.assertEqual(metrics['cells_marked_dirty'], 0)
+        cursor.execute("SELECT COUNT(*) FROM dirty_node_grid_cache_cell")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+        worker.flush(cursor)
+        cursor.execute("""
+            SELECT grid_id, x_index, y_index, z_index
+            FROM dirty_node_grid_cache_cell
+        """)
+        self.assertCountEqual(cursor.fetchall(), [
+            (self.grid_id, 0, 0, 0),
+            (self.grid_id, 1, 0, 0),
+            (self.grid_id, 2, 0, 0),
+        ])
+        metrics = worker.metrics()
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['cells_marked_dirty'], 3)
+        self.assertEqual(metrics['flushes'], 1)
+
+    @override_settings(NODE_PROVIDERS=['cached_msgpack_grid'])
+    def test_batch_size(self):
+        from catmaid.management.commands.catmaid_spatial_update_worker import GridWorker
+        worker = GridWorker(batch_size=2, max_latency=3600)
+        cursor = connection.cursor()
+
+        worker.update([
+            {'project_id': 3, 'type': 'point', 'p': [100, 100, 0]},
+            {'project_id': 3, 'type': 'point', 'p': [1100, 100, 0]},
+            {'project_id': 3, 'type': 'point', 'p': [2100, 100, 0]},
+        ], cursor)
+
+        # A full batch is flushed right away.
+        self.assertEqual(worker.metrics()['queue_depth'], 0)
+        cursor.execute("SELECT COUNT(*) FROM dirty_node_grid_cache_cell")
+        self.assertEqual(cursor.fetchone()[0], 3)
+
+
+class CacheUpdateWorkerTest(TestCase):
+    """
+    Test the claiming and sharding of dirty cells in CATMAID's cache update
+    worker.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO node_grid_cache (project_id, orientation, cell_width,
+                cell_height, cell_depth, has_msgpack_data)
+            VALUES (3, 0, 2000, 2000, 40, TRUE)
+            RETURNING id
+        """)
+        self.grid_id = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO dirty_node_grid_cache_cell (grid_id, x_index, y_index, z_index)
+            SELECT %(grid_id)s, x, y, 0
+            FROM generate_series(0, 4) x, generate_series(0, 3) y
+        """, {
+            'grid_id': self.grid_id,
+        })
+
+    def test_sharding(self):
+        from catmaid.management.commands.catmaid_cache_update_worker import GridWorker
+        cursor = connection.cursor()
+        shards = []
+        for shard in range(3):
+            worker = GridWorker(shard, 3, batch_size=100)
+            shards.append(set(c[1:] for c in worker.claim_dirty_cells(cursor)))
+
+        all_cells = set((self.grid_id, x, y, 0) for x in range(5) for y in range(4))
+        self.assertEqual(shards[0] | shards[1] | shards[2], all_cells)
+        self.assertFalse(shards[0] & shards[1])
+        self.assertFalse(shards[0] & shards[2])
+        self.assertFalse(shards[1] & shards[2])
+
+    def test_process_dirty_cells(self):
+        from catmaid.management.commands.catmaid_cache_update_worker import GridWorker
+        worker = GridWorker(batch_size=3)
+        self.assertEqual(worker.process_dirty_cells(), 20)
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM dirty_node_grid_cache_cell")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute("""
+            SELECT COUNT(*) FROM node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s
+        """, {
+            'grid_id': self.grid_id,
+        })
+        self.assertTrue(cursor.fetchone()[0] > 0)
@@ -536,6 +536,44 @@ class ViewPageTests(TestCase, AssertStatusMixin):
         self.assertEqual(parsed_response[3], expected_response[3])
         self.assertEqual(parsed_response[4], expected_response[4])
 
+    def test_export_compact_skeleton_many(self):
+        self.fake_authentication()
+
+        skeleton_ids = [373, 235]
+        params = {
+            'skeleton_ids': skeleton_ids,
+            'with_connectors': True,
+            'with_tags': True,
+            'with_annotations': True,
+        }
+        response = self.client.post('/%d/skeletons/compact-detail' % (
+                self.test_project_id,), params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertCountEqual(['373', '235'], parsed_response['skeletons'].keys())
+
+        for skeleton_id in skeleton_ids:
+            response = self.client.get('/%d/skeletons/%d/compact-detail' % (
+                    self.test_project_id, skeleton_id), {
+                        'with_connectors': True,
+                        'with_tags': True,
+                        'with_annotations': True,
+                    })
+            self.assertStatus(response)
+            expected_response = json.loads(response.content.decode('utf-8'))
+            skeleton = parsed_response['skeletons'][str(skeleton_id)]
+            self.assertEqual(len(skeleton), len(expected_response))
+            self.assertCountEqual(skeleton[0], expected_response[0])
+            self.assertCountEqual(skeleton[1], expected_response[1])
+            self.assertEqual(skeleton[2], expected_response[2])
+            self.assertCountEqual(skeleton[3], expected_response[3])
+            self.assertCountEqual(skeleton[4], expected_response[4])
+
+        # Unknown skeletons are reported before any data is returned.
+        response = self.client.post('/%d/skeletons/compact-detail' % (
+                self.test_project_id,), {'skeleton_ids': [373, 99999999]})
+        self.assertEqual(response.status_code, 404)
+
     def test_export_compact_arbor(self):
         self.fake_authentication()
 
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+
+from catmaid.control.gridcache import GridCellCache, MISSING_CELL, ENTRY_OVERHEAD
+from catmaid.control.node import (GridCacheCheckpoint, GridCachedJsonNodeProvider,
+        Postgis3dNodeProvider,
+        _node_list_tuples_query, get_grid_slab_tuples, set_grid_cell_bounds)
+
+
+class GridCellCacheTests(TestCase):
+
+    def test_lru_eviction(self):
+        cache = GridCellCache(max_bytes=2 * (ENTRY_OVERHEAD + 10))
+        cache.set((1, 0, 0, 0, 1, 1, 'msgpack'), b'a' * 10)
+        cache.set((1, 1, 0, 0, 1, 1, 'msgpack'), b'b' * 10)
+        # Access first entry to make the second one the least recently used.
+        self.assertEqual(cache.get((1, 0, 0, 0, 1, 1, 'msgpack')), b'a' * 10)
+        cache.set((1, 2, 0, 0, 1, 1, 'msgpack'), b'c' * 10)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get((1, 1, 0, 0, 1, 1, 'msgpack')))
+        self.assertEqual(cache.get((1, 0, 0, 0, 1, 1, 'msgpack')), b'a' * 10)
+        self.assertEqual(cache.get((1, 2, 0, 0, 1, 1, 'msgpack')), b'c' * 10)
+
+    def test_oversized_entries_are_ignored(self):
+        cache = GridCellCache(max_bytes=ENTRY_OVERHEAD + 10)
+        cache.set((1, 0, 0, 0, 1, 1, 'json_text'), 'x' * 11)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.n_bytes, 0)
+
+    def test_cell_invalidation(self):
+        cache = GridCellCache(max_bytes=10000)
+        cache.set((1, 0, 0, 0, 1, 1, 'msgpack'), b'a')
+        cache.set((1, 0, 0, 0, 1, 2, 'msgpack'), b'b')
+        cache.set((1, 0, 0, 1, 1, 1, 'msgpack'), MISSING_CELL)
+        cache.set(('grids', 1), [(1, 100, 100, 40, 1)])
+
+        cache.invalidate_cell(1, 0, 0, 0)
+        self.assertIsNone(cache.get((1, 0, 0, 0, 1, 1, 'msgpack')))
+        self.assertIsNone(cache.get((1, 0, 0, 0, 1, 2, 'msgpack')))
+        self.assertIs(cache.get((1, 0, 0, 1, 1, 1, 'msgpack')), MISSING_CELL)
+        self.assertIsNotNone(cache.get(('grids', 1)))
+
+        cache.invalidate_grid(1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.n_bytes, 0)
+
+    def test_stale_generation_is_not_stored(self):
+        cache = GridCellCache(max_bytes=10000)
+        generation = cache.generation
+        cache.invalidate_cell(1, 0, 0, 0)
+        cache.set((1, 0, 0, 0, 1, 1, 'msgpack'), b'old', generation=generation)
+        self.assertIsNone(cache.get((1, 0, 0, 0, 1, 1, 'msgpack')))
+
+    def test_ttl(self):
+        cache = GridCellCache(max_bytes=10000, ttl=-1)
+        cache.set((1, 0, 0, 0, 1, 1, 'msgpack'), b'a')
+        self.assertIsNone(cache.get((1, 0, 0, 0, 1, 1, 'msgpack')))
+        self.assertEqual(len(cache), 0)
+
+
+class GridCachedNodeProviderTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    test_project_id = 3
+
+    def setUp(self):
+        from catmaid.management.commands.catmaid_cache_update_worker import GridWorker
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO node_grid_cache (project_id, orientation, cell_width,
+                cell_height, cell_depth, has_json_data)
+            VALUES (%(project_id)s, 0, 2000, 2000, 40, TRUE)
+            RETURNING id
+        """, {
+            'project_id': self.test_project_id,
+        })
+        grid_id = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO dirty_node_grid_cache_cell (grid_id, x_index, y_index, z_index)
+            SELECT %(grid_id)s, x, y, z
+            FROM generate_series(0, 4) x, generate_series(0, 3) y,
+                generate_series(0, 7) z
+        """, {
+            'grid_id': grid_id,
+        })
+        GridWorker(batch_size=200).process_dirty_cells()
+
+    def test_local_cache(self):
+        provider = GridCachedJsonNodeProvider()
+        params = {
+            'left': 0,
+            'top': 0,
+            'right': 9999,
+            'bottom': 7999,
+            'z1': 0,
+            'z2': 320,
+        }
+
+        def get_tuples():
+            return provider.get_tuples(dict(params), self.test_project_id, [],
+                    [], False, False, False)
+
+        # A new and empty cache is used like any other.
+        cache = GridCellCache(max_bytes=10000000)
+        with patch('catmaid.control.node.get_grid_cell_cache', return_value=cache):
+            tuples, data_type = get_tuples()
+            self.assertEqual(data_type, 'json')
+            self.assertIsNotNone(tuples)
+            self.assertTrue(len(cache) > 0)
+
+            # The same cells are read from the cache only.
+            with self.assertNumQueries(0):
+                cached_tuples, _ = get_tuples()
+            self.assertEqual(tuples, cached_tuples)
+            self.assertTrue(cache.hits > 0)
+
+
+class GridCacheBuilderTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    test_project_id = 3
+
+    def normalize(self, result):
+        treenodes, connectors, labels, _, relation_map = result[:5]
+        return (
+            sorted(treenodes),
+            sorted(c[:7] + (sorted(c[7]),) for c in connectors),
+            {k: sorted(v) for k, v in labels.items() if v},
+            relation_map,
+        )
+
+    def test_slab_tuples_match_cell_queries(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT id, relation_name FROM relation WHERE project_id = %s
+        """, (self.test_project_id,))
+        id_to_relation = dict(cursor.fetchall())
+
+        cell_width, cell_height, cell_depth = 2000, 2000, 40
+        provider = Postgis3dNodeProvider()
+        params = {
+            'project_id': self.test_project_id,
+            'limit': None,
+        }
+        n_non_empty = 0
+        for d_i in range(0, 8):
+            for h_i in range(0, 4):
+                slab = get_grid_slab_tuples(cursor, self.test_project_id, 0,
+                        4, h_i, d_i, cell_width, cell_height, cell_depth,
+                        id_to_relation)
+                self.assertCountEqual(slab.keys(), range(0, 5))
+                for w_i in range(0, 5):
+                    set_grid_cell_bounds(params, w_i, h_i, d_i, cell_width,
+                            cell_height, cell_depth)
+                    expected = _node_list_tuples_query(params,
+                            self.test_project_id, provider, include_labels=True)
+                    self.assertEqual(self.normalize(expected),
+                            self.normalize(slab[w_i]))
+                    if expected[0] or expected[1]:
+                        n_non_empty += 1
+        self.assertTrue(n_non_empty > 0)
+
+    def test_checkpoint(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            checkpoint = GridCacheCheckpoint(path)
+            self.assertFalse(checkpoint.is_done(1, (0, 9, 0, 0)))
+            checkpoint.mark_done(1, (0, 4, 0, 0))
+            checkpoint.mark_done(1, (5, 9, 0, 0))
+            checkpoint.close()
+
+            checkpoint = GridCacheCheckpoint(path)
+            self.assertEqual(len(checkpoint), 2)
+            self.assertTrue(checkpoint.is_done(1, (0, 9, 0, 0)))
+            self.assertTrue(checkpoint.is_done(1, (2, 3, 0, 0)))
+            self.assertFalse(checkpoint.is_done(1, (0, 10, 0, 0)))
+            self.assertFalse(checkpoint.is_done(1, (0, 4, 1, 0)))
+            self.assertFalse(checkpoint.is_done(2, (0, 4, 0, 0)))
+            checkpoint.close()
+        finally:
+            os.remove(path)
@@ -275,7 +275,9 @@ class HistoryTableTests(TransactionTestCase):
         'node_grid_cache',
         'catmaid_transaction_info',
         'catmaid_stats_summary',
+        'catmaid_stats_summary_delta',
         'catmaid_skeleton_summary',
+        'catmaid_annotation_closure',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 
 from ast import literal_eval
+import gzip
+from io import StringIO
 import json
+import os
+import tempfile
 from typing import List
 import yaml
 
 from guardian.shortcuts import assign_perm
 
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
 from django.http import HttpResponse
 from django.test.client import Client
 from django.test import TestCase
 
 from catmaid.control import importer
 from catmaid.control.common import urljoin
+from catmaid.management.commands.catmaid_export_data import (Command as
+        ExportCommand, Exporter)
+from catmaid.management.commands.catmaid_import_data import iterate_json_array
 from catmaid.models import (Class, ClassInstance, Project, ProjectStack,
-        Relation, Stack, StackClassInstance, StackGroup, StackStackGroup, User)
+        Relation, Stack, StackClassInstance, StackGroup, StackStackGroup,
+        Treenode, User)
+from catmaid.tests.apis.common import CatmaidApiTransactionTestCase
 from catmaid.tests.common import AssertStatusMixin
 
 
@@ -374,3 +386,155 @@ class ImportExportTests(TestCase, AssertStatusMixin):
         result_json = json.loads(response.content.decode('utf-8'),
                 object_hook=parse_list)
         test_result(result_json)
+
+
+class StreamingImportTests(TestCase):
+
+    def test_iterate_json_array(self):
+        data = [{
+            'model': 'catmaid.classinstance',
+            'pk': i,
+            'fields': {
+                'name': 'Neuron {}, "tab"\t[{}]'.format(i, i),
+            },
+        } for i in range(20)]
+
+        # Elements need to be found independent of how the data is split up
+        # into reads.
+        for indent in (None, 2):
+            serialized = json.dumps(data, indent=indent)
+            for buffer_size in (1, 7, 4096):
+                parsed = list(iterate_json_array(StringIO(serialized), buffer_size))
+                self.assertEqual(parsed, data)
+
+        self.assertEqual(list(iterate_json_array(StringIO(' [ ] '))), [])
+        with self.assertRaises(ValueError):
+            list(iterate_json_array(StringIO('{"pk": 1}')))
+        with self.assertRaises(ValueError):
+            list(iterate_json_array(StringIO('[{"pk": 1}, {"pk": ')))
+
+
+def export_options(**options):
+    """Return the default options of catmaid_export_data, updated with the
+    passed in options.
+    """
+    parser = ExportCommand().create_parser('manage.py', 'catmaid_export_data')
+    export_options = vars(parser.parse_args([]))
+    export_options['run_noninteractive'] = True
+    export_options.update(options)
+    return export_options
+
+
+class StreamingImportExportTests(CatmaidApiTransactionTestCase):
+    """Test exports and imports of the test project in bounded memory. Data is
+    committed, so that parallel export workers can read it.
+    """
+
+    def skeleton_structure(self, project_id):
+        """Return locations of all nodes and their parents as well as all
+        connector links of a project, independent of IDs.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT t.location_x, t.location_y, t.location_z,
+                p.location_x, p.location_y, p.location_z
+            FROM treenode t
+            LEFT JOIN treenode p
+                ON p.id = t.parent_id
+            WHERE t.project_id = %(project_id)s
+            ORDER BY 1, 2, 3, 4, 5, 6
+        """, {
+            'project_id': project_id,
+        })
+        nodes = cursor.fetchall()
+        cursor.execute("""
+            SELECT r.relation_name, c.location_x, c.location_y, c.location_z,
+                t.location_x, t.location_y, t.location_z
+            FROM treenode_connector tc
+            JOIN relation r
+                ON r.id = tc.relation_id
+            JOIN connector c
+                ON c.id = tc.connector_id
+            JOIN treenode t
+                ON t.id = tc.treenode_id
+            WHERE tc.project_id = %(project_id)s
+            ORDER BY 1, 2, 3, 4, 5, 6, 7
+        """, {
+            'project_id': project_id,
+        })
+        links = cursor.fetchall()
+        return nodes, links
+
+    def read_export(self, path, compressed=False):
+        """Return all exported objects, ordered by model and ID. Passwords
+        of exported users are random and are ignored.
+        """
+        opener = gzip.open if compressed else open
+        with opener(path, 'rt') as f:
+            data = json.load(f)
+        for element in data:
+            element['fields'].pop('password', None)
+        return sorted(data, key=lambda e: (e['model'], e['pk']))
+
+    def test_streaming_export(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'export.json')
+            Exporter(self.test_project, export_options(file=path)).export()
+            expected = self.read_export(path)
+            self.assertTrue(expected)
+
+            # Exported QuerySets are not evaluated before they are written.
+            exporter = Exporter(self.test_project, export_options(
+                    file=path, stream=True))
+            exporter.collect_data()
+            querysets = [g for g in exporter.to_serialize if isinstance(g, QuerySet)]
+            self.assertTrue(querysets)
+            for queryset in querysets:
+                self.assertIsNone(queryset._result_cache)
+
+            path = os.path.join(tmp_dir, 'export-stream.json')
+            Exporter(self.test_project, export_options(file=path,
+                    stream=True, chunk_size=3)).export()
+            self.assertEqual(expected, self.read_export(path))
+
+            # Compression is enabled either explicitly or by file name.
+            path = os.path.join(tmp_dir, 'export-stream-gzip.json')
+            Exporter(self.test_project, export_options(file=path,
+                    stream=True, gzip=True)).export()
+            self.assertEqual(expected, self.read_export(path, True))
+
+            path = os.path.join(tmp_dir, 'export-parallel.json.gz')
+            Exporter(self.test_project, export_options(file=path,
+                    workers=2, chunk_size=3)).export()
+            self.assertEqual(expected, self.read_export(path, True))
+
+    def test_streaming_import(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'export.json')
+            Exporter(self.test_project, export_options(file=path)).export()
+
+            target = Project.objects.create(title='Import target')
+            call_command('catmaid_import_data', source=path, target=target.id,
+                    stream=True, batch_size=7, analyze_db=False)
+
+        source_nodes, source_links = self.skeleton_structure(self.test_project_id)
+        target_nodes, target_links = self.skeleton_structure(target.id)
+        self.assertTrue(source_nodes)
+        self.assertEqual(source_nodes, target_nodes)
+        self.assertTrue(source_links)
+        self.assertEqual(source_links, target_links)
+
+        # All objects got new IDs and imported skeletons are summarized.
+        source_ids = Treenode.objects.filter(project_id=self.test_project_id) \
+                .values_list('id', flat=True)
+        self.assertFalse(Treenode.objects.filter(project=target,
+                id__in=source_ids).exists())
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT SUM(num_nodes)
+            FROM catmaid_skeleton_summary
+            WHERE project_id = %(project_id)s
+        """, {
+            'project_id': target.id,
+        })
+        self.assertEqual(len(target_nodes), cursor.fetchone()[0])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import os
+import tempfile
+
+from django.test import TestCase
+
+from catmaid.control.nat.native import (compute_histogram, make_dotprops,
+        resample_skeleton, score_all, simplify_skeleton, DotpropsCache)
+
+
+class NativeNblastTests(TestCase):
+
+    # Two distance bins below 1 µm and 2 µm, one bin above, two dot product
+    # bins.
+    smat = np.array([[3, 4], [0, 1], [-1, -2]], dtype=np.float64)
+    distance_breaks = np.array([0, 1, 2, 500], dtype=np.float64)
+    dot_breaks = np.array([0, 0.5, 1], dtype=np.float64)
+
+    def line(self, offset=(0, 0, 0)):
+        points = np.column_stack([np.arange(50.0), np.zeros(50), np.zeros(50)])
+        return points + offset
+
+    def test_make_dotprops(self):
+        dotprops = make_dotprops(self.line(), k=5)
+        self.assertEqual(dotprops.points.shape, (50, 3))
+        np.testing.assert_allclose(np.abs(dotprops.vect[:, 0]), 1)
+        np.testing.assert_allclose(dotprops.alpha, 1)
+
+        with self.assertRaises(ValueError):
+            make_dotprops([[0, 0, 0]])
+
+    def test_resample_skeleton(self):
+        # A chain of ten nodes along x with 0.3 µm spacing and a three node
+        # branch along y at the sixth node.
+        parent_idx = np.array([-1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 5, 10, 11])
+        locations = np.array([[i * 0.3, 0, 0] for i in range(10)] +
+                [[1.5, 0.3, 0], [1.5, 0.6, 0], [1.5, 0.9, 0]])
+
+        points = resample_skeleton(parent_idx, locations, 1.0)
+        expected = [[0, 0, 0], [1.5, 0, 0], [0.75, 0, 0], [2.7, 0, 0],
+                [2.1, 0, 0], [1.5, 0.9, 0]]
+        np.testing.assert_allclose(points, expected)
+
+        # Without branches only the longer chain remains.
+        keep = simplify_skeleton(parent_idx, locations, 0)
+        self.assertEqual(keep.tolist(), [True] * 10 + [False] * 3)
+        keep = simplify_skeleton(parent_idx, locations, 1)
+        self.assertTrue(keep.all())
+
+    def test_score_all(self):
+        a = make_dotprops(self.line(), k=5)
+        b = make_dotprops(self.line((0, 1.5, 0)), k=5)
+
+        scores = score_all([a, b], [a, b], self.smat, self.distance_breaks,
+                self.dot_breaks)
+        np.testing.assert_allclose(scores, [[200, 50], [50, 200]])
+
+        scores = score_all([a, b], [a, b], self.smat, self.distance_breaks,
+                self.dot_breaks, normalized=True)
+        np.testing.assert_allclose(scores, [[1, 0.25], [0.25, 1]])
+
+    def test_compute_histogram(self):
+        a = make_dotprops(self.line(), k=5)
+        b = make_dotprops(self.line((0, 1.5, 0)), k=5)
+
+        histogram = compute_histogram([a, b], [(0, 1), (1, 0)],
+                self.distance_breaks, self.dot_breaks)
+        self.assertEqual(histogram.tolist(), [[0, 0], [0, 100], [0, 0]])
+
+    def test_dotprops_cache(self):
+        a = make_dotprops(self.line(), k=5)
+        b = make_dotprops(self.line((0, 1.5, 0)), k=5)
+        meta = {'tangent_neighbors': 5, 'resample': 1.0, 'last_update': 0}
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path_prefix = os.path.join(cache_dir, 'cache')
+            cache = DotpropsCache(path_prefix)
+            self.assertFalse(cache.exists())
+            cache.update({1: a, 2: b}, meta=meta)
+
+            cache = DotpropsCache(path_prefix)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.meta['tangent_neighbors'], 5)
+            cached = cache.get(2)
+            self.assertEqual(cached.points.dtype, np.float32)
+            np.testing.assert_allclose(cached.points, b.points)
+            np.testing.assert_allclose(cached.vect, b.vect, atol=1e-6)
+
+            # Replacing and removing objects leaves more than half of all rows
+            # unused, which compacts the cache.
+            cache.update({1: b}, removed=[2])
+            cache = DotpropsCache(path_prefix)
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.n_rows, 50)
+            self.assertIsNone(cache.get(2))
+            np.testing.assert_allclose(cache.get(1).points, b.points)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
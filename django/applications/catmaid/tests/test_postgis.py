@@ -5,10 +5,12 @@ from django.test import TestCase
 from django.test.client import Client
 from guardian.shortcuts import assign_perm
 from catmaid.models import Project, User, TreenodeConnector
-from catmaid.control import node, skeleton, treenode
+from catmaid.control import edge, node, skeleton, treenode
 from catmaid.tests.common import CatmaidTestCase
 
 import json
+import os
+import tempfile
 
 class PostGISTests(CatmaidTestCase):
     """
@@ -220,3 +222,61 @@ class PostGISTests(CatmaidTestCase):
             'tce_id': treenode_connector_id,
         })
         self.assertTrue(cursor.fetchone()[0])
+
+    def test_chunked_edge_rebuild(self):
+        cursor = connection.cursor()
+        # Make the edge tables of the test project stale
+        cursor.execute("""
+            UPDATE treenode_edge
+            SET edge = ST_MakeLine(ST_MakePoint(0, 0, 0), ST_MakePoint(1, 1, 1))
+            WHERE id = 7
+        """)
+        cursor.execute("DELETE FROM treenode_edge WHERE id = 11")
+        cursor.execute("DELETE FROM connector_geom WHERE project_id = %s",
+                (self.test_project_id,))
+
+        stats = edge.rebuild_edge_tables_chunked([self.test_project_id],
+                chunk_size=3, dryrun=True)
+        self.assertEqual(stats['treenode_edge']['mismatched'], 3)
+        self.assertEqual(stats['treenode_connector_edge']['mismatched'], 0)
+        cursor.execute("SELECT count(*) FROM connector c WHERE project_id = %s",
+                (self.test_project_id,))
+        n_connectors = cursor.fetchone()[0]
+        self.assertEqual(stats['connector_geom']['mismatched'], n_connectors)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stats = edge.rebuild_edge_tables_chunked([self.test_project_id],
+                    chunk_size=3, checkpoint=path)
+            self.assertEqual(stats['treenode_edge']['removed'], 1)
+            self.assertEqual(stats['treenode_edge']['added'], 2)
+            self.assertEqual(stats['connector_geom']['added'], n_connectors)
+            self.assertEqual(stats['treenode_edge']['mismatched'], 0)
+
+            # Completed chunks are skipped when resuming
+            checkpoint = edge.EdgeRebuildCheckpoint(path)
+            self.assertTrue(len(checkpoint) > 0)
+            for table in edge.EDGE_TABLES:
+                step = checkpoint.get_step(table, self.test_project_id)
+                self.assertIsNotNone(step)
+                for chunk in edge.get_edge_table_chunks(table,
+                        self.test_project_id, step):
+                    self.assertTrue(checkpoint.is_done(table,
+                            self.test_project_id, *chunk))
+            checkpoint.close()
+
+            # A resumed rebuild uses the chunks of the checkpoint, even with a
+            # different chunk size.
+            messages = []
+            edge.rebuild_edge_tables_chunked([self.test_project_id],
+                    chunk_size=2, checkpoint=path, verify=False,
+                    log=messages.append)
+            self.assertIn('Rebuilding 0 chunks with 1 worker(s)', messages)
+        finally:
+            os.remove(path)
+
+        stats = edge.rebuild_edge_tables_chunked([self.test_project_id],
+                chunk_size=3, dryrun=True)
+        for table_stats in stats.values():
+            self.assertEqual(table_stats['mismatched'], 0)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from django.test import TestCase
+
+from catmaid.control.synapseclustering import arbor_max_density
+
+
+class SynapseClusteringTests(TestCase):
+
+    def test_arbor_max_density(self):
+        # A chain of nodes 10 - 11 - ... - 29 with 100 nm long edges and
+        # synapses close to both ends.
+        node_ids = np.arange(10, 30)
+        a = np.arange(1, 20)
+        b = np.arange(0, 19)
+        w = np.full(19, 100.0)
+        syn_nodes = [10, 11, 11, 12, 25, 27, 28, 29]
+        connector_ids = list(range(100, 108))
+        relations = [1, 1, 2, 1, 2, 2, 2, 2]
+
+        groups = arbor_max_density(node_ids, a, b, w, syn_nodes,
+                connector_ids, relations, [100, 10000])
+
+        small = groups[100]
+        self.assertEqual(len(small), 3)
+        self.assertEqual(small[0].node_ids, [10, 11, 11, 12])
+        self.assertEqual(small[0].connector_ids, [100, 101, 102, 103])
+        self.assertEqual(small[0].relations, [1, 1, 2, 1])
+        self.assertEqual(small[0].local_max, 11)
+        self.assertEqual(small[1].node_ids, [25])
+        self.assertEqual(small[1].local_max, 25)
+        self.assertEqual(small[2].node_ids, [27, 28, 29])
+        self.assertEqual(small[2].local_max, 28)
+
+        # With a large bandwidth, all synapses are in one group.
+        large = groups[10000]
+        self.assertEqual(len(large), 1)
+        self.assertEqual(large[0].node_ids, syn_nodes)
+        self.assertEqual(large[0].local_max, 20)
+
+        # Without bandwidths, there is nothing to group.
+        self.assertEqual(arbor_max_density(node_ids, a, b, w, syn_nodes,
+                connector_ids, relations, []), {})
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from django.test import TestCase
+
+from catmaid.control.tree_util import ArrayTree, accumulate_to_root
+
+
+class ArrayTreeTests(TestCase):
+
+    def make_tree(self):
+        # 1 - 2 - 3 - 4
+        #      \
+        #       5 - 6
+        rows = [
+            (1, None, 0, 0, 0),
+            (2, 1, 1, 0, 0),
+            (3, 2, 2, 0, 0),
+            (4, 3, 3, 0, 0),
+            (5, 2, 1, 1, 0),
+            (6, 5, 1, 3, 0),
+        ]
+        return ArrayTree.from_rows(reversed(rows), with_locations=True)
+
+    def test_structure(self):
+        tree = self.make_tree()
+        self.assertEqual(len(tree), 6)
+        self.assertEqual(tree.root, 1)
+        self.assertIn(5, tree)
+        self.assertNotIn(7, tree)
+        self.assertEqual(tree.parent(1), None)
+        self.assertEqual(tree.parent(5), 2)
+        self.assertCountEqual(tree.children(2).tolist(), [3, 5])
+        self.assertCountEqual(tree.leaves().tolist(), [4, 6])
+        with self.assertRaises(KeyError):
+            tree.index(7)
+
+    def test_edge_count_and_distance(self):
+        tree = self.make_tree()
+        edge_counts = dict(zip(tree.node_ids.tolist(),
+                tree.edge_count_to_root().tolist()))
+        self.assertEqual(edge_counts, {1: 0, 2: 1, 3: 2, 4: 3, 5: 2, 6: 3})
+        distances = dict(zip(tree.node_ids.tolist(),
+                tree.distance_to_root().tolist()))
+        self.assertAlmostEqual(distances[4], 3.0)
+        self.assertAlmostEqual(distances[6], 4.0)
+        self.assertAlmostEqual(tree.cable_length(), 6.0)
+
+        order = tree.node_ids[tree.topological_order()].tolist()
+        for node_id in tree.node_ids.tolist():
+            parent = tree.parent(node_id)
+            if parent is not None:
+                self.assertLess(order.index(parent), order.index(node_id))
+
+    def test_reroot(self):
+        tree = self.make_tree()
+        tree.reroot(4)
+        self.assertEqual(tree.root, 4)
+        self.assertEqual(tree.parent(3), 4)
+        self.assertEqual(tree.parent(2), 3)
+        self.assertEqual(tree.parent(1), 2)
+        self.assertEqual(tree.parent(5), 2)
+        self.assertCountEqual(tree.children(2).tolist(), [1, 5])
+        self.assertAlmostEqual(tree.cable_length(), 6.0)
+
+    def test_find_common_ancestor(self):
+        tree = self.make_tree()
+        self.assertEqual(tree.find_common_ancestor([4, 6]), (2, 1))
+        self.assertEqual(tree.find_common_ancestor([4, 3]), (3, 2))
+        self.assertEqual(tree.find_common_ancestor([6, 4, 1]), (1, 0))
+        self.assertEqual(tree.find_common_ancestor([6]), (6, 3))
+
+    def test_partition(self):
+        tree = self.make_tree()
+        sequences = list(tree.partition())
+        # Both leaves have the same distance to the root, either one can
+        # start the sequence that ends at the root.
+        self.assertEqual(len(sequences), 2)
+        self.assertEqual(sequences[0][-2:], [2, 1])
+        self.assertEqual(sequences[1][-1], 2)
+        self.assertCountEqual(sequences[0] + sequences[1][:-1], [1, 2, 3, 4, 5, 6])
+
+    def test_accumulate_cycle(self):
+        with self.assertRaises(ValueError):
+            accumulate_to_root(np.array([1, 0]))
@@ -163,6 +163,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/stats/user-history$', stats.stats_user_history),
     url(r'^(?P<project_id>\d+)/stats/user-activity$', stats.stats_user_activity),
     url(r'^(?P<project_id>\d+)/stats/server$', stats.ServerStats.as_view()),
+    url(r'^(?P<project_id>\d+)/stats/requests$', stats.RequestStats.as_view()),
 ]
 
 # Annotations
@@ -310,6 +311,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/sampler-count$', skeleton.list_sampler_count),
     url(r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/permissions$', skeleton.get_skeleton_permissions),
     url(r'^(?P<project_id>\d+)/skeletons/import$', record_view("skeletons.import")(skeleton.import_skeleton)),
+    url(r'^(?P<project_id>\d+)/skeletons/bulk-import$', record_view("skeletons.import")(skeleton.bulk_import_skeletons)),
     url(r'^(?P<project_id>\d+)/skeleton/annotationlist$', skeleton.annotation_list),
     url(r'^(?P<project_id>\d+)/skeletons/within-spatial-distance$', skeleton.within_spatial_distance),
     url(r'^(?P<project_id>\d+)/skeletons/node-labels$', skeleton.skeletons_by_node_labels),
@@ -574,6 +576,7 @@ urlpatterns += [
     # Wiring diagram export
     url(r'^(?P<project_id>\d+)/wiringdiagram/json$', wiringdiagram.export_wiring_diagram),
     url(r'^(?P<project_id>\d+)/wiringdiagram/nx_json$', wiringdiagram.export_wiring_diagram_nx),
+    url(r'^(?P<project_id>\d+)/wiringdiagram/export$', wiringdiagram.stream_wiring_diagram),
 
     # Annotation graph export
     url(r'^(?P<project_id>\d+)/annotationdiagram/nx_json$', object.convert_annotations_to_networkx),
@@ -51,6 +51,8 @@ MANAGERS = ADMINS
 USE_I18N = True
 
 MIDDLEWARE = [
+    # Record timing information of all requests, should be listed first.
+    'catmaid.middleware.RequestInstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -438,11 +440,48 @@ DEFAULT_CACHE_GRID_CELL_WIDTH = 25000
 DEFAULT_CACHE_GRID_CELL_HEIGHT = 25000
 DEFAULT_CACHE_GRID_CELL_DEPTH = 40
 
+# The maximum size in bytes of the process local cache for node grid cache
+# cells. Each web worker process keeps its own cache, which is kept up to date
+# using a separate database connection that listens for grid cache events. A
+# value of 0 disables this cache.
+NODE_GRID_CACHE_LOCAL_SIZE = 0
+
+# The maximum time in seconds an entry is kept in the process local node grid
+# cache cell cache. None means entries only expire on invalidation.
+NODE_GRID_CACHE_LOCAL_TTL = 300
+
+# The time in seconds connectivity matrices are kept in Django's cache. Cached
+# matrices are only used as long as the involved connector links didn't change.
+# A value of 0 disables caching.
+CONNECTIVITY_MATRIX_CACHE_TIMEOUT = 3600
+
+# The time in seconds the per-skeleton results of splitting skeletons by
+# confidence and synapse domain for the graph widget are kept in Django's cache.
+# Cached splits are only used as long as the skeleton and its synapses didn't
+# change. A value of 0 disables caching.
+GRAPH_SPLIT_CACHE_TIMEOUT = 3600
+
 # Whether Postgres should emit "catmaid.spatial-update" events on changes of
 # spatial data (e.g. inserts, updates and deletions of treenodes, connectors and
 # connector links).
 SPATIAL_UPDATE_NOTIFICATIONS = False
 
+# Whether changes of treenodes, reviews and connector links are logged by
+# database triggers, so that the statistics summary can be updated
+# incrementally by folding in the logged changes (e.g. using the
+# catmaid_stats_summary_worker management command), rather than by periodic
+# recomputation.
+STATS_SUMMARY_DELTA_LOG = False
+
+# Requests that take longer than this many seconds are sampled by the
+# RequestInstrumentationMiddleware along with their SQL queries, of which at
+# most REQUEST_INSTRUMENTATION_MAX_QUERIES are kept per request. The last
+# REQUEST_INSTRUMENTATION_SLOW_SAMPLES slow requests are available through the
+# request statistics API.
+REQUEST_INSTRUMENTATION_SLOW_THRESHOLD = 1.0
+REQUEST_INSTRUMENTATION_MAX_QUERIES = 100
+REQUEST_INSTRUMENTATION_SLOW_SAMPLES = 50
+
 # On statup, the default client instance settings can be populated based on a
 # JSON string, representing a list of objects with a "key" field and a "value"
 # field. These settings will only be applied if they exist already.